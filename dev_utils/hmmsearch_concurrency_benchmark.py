@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+import inspect
+import glob
+import time
+import logging
+
+cmd_folder = os.path.realpath(os.path.abspath(os.path.split(inspect.getfile(inspect.currentframe()))[0]))
+sys.path.insert(0, cmd_folder + os.sep + ".." + os.sep)
+from treesapp.classy import prep_logging
+from treesapp.file_parsers import parse_ref_build_params
+from treesapp.wrapper import hmmsearch_orfs
+from treesapp.utilities import which
+
+__author__ = 'Connor Morgan-Lang'
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description="Measures the wall-clock time of TreeSAPP's hmmsearch stage "
+                                                 "while varying the number of concurrent hmmsearch processes.")
+    parser.add_argument("-i", "--fasta_input", required=True, dest="input",
+                        help="A FASTA file of protein sequences to search, e.g. test_data/marker_test_suite.faa")
+    parser.add_argument("-o", "--output", required=False, default="./hmmsearch_benchmark/",
+                        help="Directory for writing the temporary domain tables. [DEFAULT = ./hmmsearch_benchmark/]")
+    parser.add_argument("-n", "--num_procs", dest="num_threads", required=False, default=4, type=int,
+                        help="The total number of threads available to hmmsearch. [DEFAULT = 4]")
+    parser.add_argument("-t", "--targets", required=False, default="",
+                        help="A comma-separated list of refpkg codes to search with. [DEFAULT = ALL]")
+    parser.add_argument("-r", "--replicates", required=False, default=1, type=int,
+                        help="The number of times to repeat each concurrency level. [DEFAULT = 1]")
+    args = parser.parse_args()
+    if args.output[-1] != os.sep:
+        args.output += os.sep
+    return args
+
+
+def concurrency_levels(num_threads: int):
+    levels = list()
+    n = 1
+    while n < num_threads:
+        levels.append(n)
+        n *= 2
+    levels.append(num_threads)
+    return levels
+
+
+def main():
+    args = get_options()
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    prep_logging(args.output + "hmmsearch_benchmark_log.txt", False)
+
+    treesapp_dir = cmd_folder + os.sep + ".." + os.sep + "treesapp" + os.sep
+    hmm_dir = treesapp_dir + "data" + os.sep + "hmm_data" + os.sep
+    hmmsearch_exe = which("hmmsearch")
+    if not hmmsearch_exe:
+        logging.error("Unable to find hmmsearch in your $PATH.\n")
+        sys.exit(3)
+    marker_build_dict = parse_ref_build_params(treesapp_dir, [t for t in args.targets.split(',') if t])
+
+    timings = "n_parallel\tthreads_per_job\treplicate\twall_seconds\n"
+    for n_parallel in concurrency_levels(args.num_threads):
+        for rep in range(args.replicates):
+            start_time = time.time()
+            hmmsearch_orfs(hmmsearch_exe, hmm_dir, marker_build_dict, args.input, args.output,
+                           args.num_threads, n_parallel)
+            wall_time = time.time() - start_time
+            timings += "\t".join([str(n_parallel), str(max(1, args.num_threads // n_parallel)),
+                                  str(rep), str(round(wall_time, 2))]) + "\n"
+
+            for domtbl in glob.glob(args.output + "*_domtbl.txt"):
+                os.remove(domtbl)
+
+    sys.stdout.write(timings)
+
+
+main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+import inspect
+import shutil
+import time
+import logging
+
+cmd_folder = os.path.realpath(os.path.abspath(os.path.split(inspect.getfile(inspect.currentframe()))[0]))
+sys.path.insert(0, cmd_folder + os.sep + ".." + os.sep)
+from treesapp.classy import prep_logging
+from treesapp.file_parsers import parse_ref_build_params, parse_domain_tables
+from treesapp.wrapper import hmmsearch_orfs
+from treesapp.utilities import which
+
+__author__ = 'Connor Morgan-Lang'
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description="Validates the input-sharded hmmsearch by comparing its merged domain "
+                                                 "tables and the homologs parsed from them to those of a single, "
+                                                 "unsharded hmmsearch of the same query sequences.")
+    parser.add_argument("-i", "--fasta_input", required=False, dest="input",
+                        default=cmd_folder + os.sep + ".." + os.sep + "test_data" + os.sep + "marker_test_suite.faa",
+                        help="A FASTA file of protein sequences to search. [DEFAULT = test_data/marker_test_suite.faa]")
+    parser.add_argument("-o", "--output", required=False, default="./hmmsearch_shard_concordance/",
+                        help="Directory for writing the domain tables. [DEFAULT = ./hmmsearch_shard_concordance/]")
+    parser.add_argument("-n", "--num_procs", dest="num_threads", required=False, default=4, type=int,
+                        help="The total number of threads available to hmmsearch. [DEFAULT = 4]")
+    parser.add_argument("-k", "--shards", required=False, default=4, type=int,
+                        help="The number of shards to split the query sequences into. [DEFAULT = 4]")
+    parser.add_argument("-t", "--targets", required=False, default="",
+                        help="A comma-separated list of refpkg codes to search with. [DEFAULT = ALL]")
+    args = parser.parse_args()
+    if args.output[-1] != os.sep:
+        args.output += os.sep
+    return args
+
+
+def read_domtbl_rows(domtbl_file):
+    """
+    Reads the rows of a domain table, separating the conditional E-value from the other fields. Conditional E-values
+    are rescaled from the 2-digit P-values printed by hmmsearch when merging shards so they may differ from those of
+    an unsharded search in the last digit, and domains with a conditional E-value within that rounding error of the
+    reporting threshold (--domE 10) may be reported by one search but not the other.
+    """
+    rows = dict()
+    c_evalues = dict()
+    with open(domtbl_file) as domtbl:
+        for line in domtbl:
+            if line[0] == '#':
+                continue
+            fields = line.rstrip("\n").split(None, 22)
+            key = (fields[0], fields[3], fields[9])
+            rows[key] = fields[:11] + fields[12:]
+            c_evalues[key] = float(fields[11])
+    return rows, c_evalues
+
+
+def summarize_matches(hmm_matches):
+    return set([(match.orf, match.target_hmm, match.start, match.end)
+                for marker in hmm_matches for match in hmm_matches[marker]])
+
+
+def main():
+    args = get_options()
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    prep_logging(args.output + "hmmsearch_shard_concordance_log.txt", False)
+
+    treesapp_dir = cmd_folder + os.sep + ".." + os.sep + "treesapp" + os.sep
+    hmm_dir = treesapp_dir + "data" + os.sep + "hmm_data" + os.sep
+    hmmsearch_exe = which("hmmsearch")
+    if not hmmsearch_exe:
+        logging.error("Unable to find hmmsearch in your $PATH.\n")
+        sys.exit(3)
+    marker_build_dict = parse_ref_build_params(treesapp_dir, [t for t in args.targets.split(',') if t])
+
+    domtbls = dict()
+    matches = dict()
+    for num_shards in [1, args.shards]:
+        search_dir = args.output + "shards_" + str(num_shards) + os.sep
+        if os.path.isdir(search_dir):
+            shutil.rmtree(search_dir)
+        os.makedirs(search_dir)
+        start_time = time.time()
+        domtbl_files = hmmsearch_orfs(hmmsearch_exe, hmm_dir, marker_build_dict, args.input, search_dir,
+                                      args.num_threads, num_shards=num_shards)
+        sys.stdout.write(str(num_shards) + " shard(s): " + str(round(time.time() - start_time, 2)) + " seconds\n")
+        domtbls[num_shards] = {os.path.basename(domtbl): read_domtbl_rows(domtbl) for domtbl in domtbl_files}
+        matches[num_shards] = summarize_matches(parse_domain_tables(args, domtbl_files, False))
+
+    discordant = 0
+    borderline = 0
+    for domtbl_name in sorted(domtbls[1]):
+        single_rows, single_c = domtbls[1][domtbl_name]
+        sharded_rows, sharded_c = domtbls[args.shards].get(domtbl_name, (dict(), dict()))
+        missing = [key for key in set(single_rows).difference(sharded_rows) if single_c[key] < 9.5]
+        extra = [key for key in set(sharded_rows).difference(single_rows) if sharded_c[key] < 9.5]
+        borderline += len(set(single_rows).symmetric_difference(sharded_rows)) - len(missing) - len(extra)
+        different = [key for key in set(single_rows).intersection(sharded_rows)
+                     if single_rows[key] != sharded_rows[key]]
+        if missing or extra or different:
+            discordant += 1
+            sys.stdout.write(domtbl_name + ": " + str(len(missing)) + " missing, " + str(len(extra)) + " extra and " +
+                             str(len(different)) + " different domain rows\n")
+    if borderline:
+        sys.stdout.write(str(borderline) + " domain rows at the reporting threshold differed " +
+                         "(expected from rounding)\n")
+
+    sys.stdout.write(str(len(domtbls[1]) - discordant) + '/' + str(len(domtbls[1])) + " domain tables concordant\n")
+    sys.stdout.write("Homologs identified: " + str(len(matches[1])) + " unsharded, " +
+                     str(len(matches[args.shards])) + " sharded, " +
+                     str(len(matches[1].symmetric_difference(matches[args.shards]))) + " differing\n")
+    if discordant or matches[1] != matches[args.shards]:
+        sys.exit(1)
+
+
+main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+import inspect
+import glob
+import time
+import logging
+from ete3 import Tree
+
+cmd_folder = os.path.realpath(os.path.abspath(os.path.split(inspect.getfile(inspect.currentframe()))[0]))
+sys.path.insert(0, cmd_folder + os.sep + ".." + os.sep)
+from treesapp.classy import prep_logging
+from treesapp.assign import read_the_raxml_out_tree, build_terminal_children_strings_of_assignments
+from treesapp.entish import TerminalChildrenIndex
+
+__author__ = 'Connor Morgan-Lang'
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description="Times the indexing of a RAxML labelled tree for finding the "
+                                                 "terminal children of every edge under all rootings of the tree.")
+    parser.add_argument("-t", "--tree", required=False, default="",
+                        help="A reference tree to label and index. [DEFAULT = the largest tree in data/tree_data/]")
+    parser.add_argument("-o", "--output", required=False, default="./labelled_tree_benchmark/",
+                        help="Directory for writing the labelled tree. [DEFAULT = ./labelled_tree_benchmark/]")
+    parser.add_argument("-r", "--replicates", required=False, default=3, type=int,
+                        help="The number of times the tree is read and indexed. [DEFAULT = 3]")
+    args = parser.parse_args()
+    if args.output[-1] != os.sep:
+        args.output += os.sep
+    return args
+
+
+def largest_reference_tree(tree_data_dir):
+    largest = ("", 0)
+    for tree_file in glob.glob(tree_data_dir + "*_tree.txt"):
+        num_leaves = len(Tree(tree_file))
+        if num_leaves > largest[1]:
+            largest = (tree_file, num_leaves)
+    return largest[0]
+
+
+def write_labelled_tree(tree_file: str, labelled_tree_file: str):
+    """
+    Writes a reference tree in the format of RAxML's originalLabelledTree: an unrooted tree with numerical leaf names,
+    branch lengths and every edge labelled with its number in square brackets, e.g. 12:0.1[I3]
+
+    :return: The number of labelled edges
+    """
+    tree = Tree(tree_file)
+    tree.unroot()
+    edge_num = 0
+    labelled_nodes = dict()
+    for node in tree.traverse("postorder"):
+        if node.is_leaf():
+            newick = node.name.split('_')[0]
+        else:
+            newick = '(' + ','.join([labelled_nodes.pop(child) for child in node.children]) + ')'
+        if node.is_root():
+            with open(labelled_tree_file, 'w') as labelled_tree:
+                labelled_tree.write(newick + ";\n")
+            break
+        labelled_nodes[node] = newick + ':' + str(round(node.dist, 6)) + "[I" + str(edge_num) + ']'
+        edge_num += 1
+    return edge_num
+
+
+def main():
+    args = get_options()
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    prep_logging(args.output + "labelled_tree_benchmark_log.txt", False)
+
+    tree_data_dir = cmd_folder + os.sep + ".." + os.sep + "treesapp" + os.sep + "data" + os.sep + "tree_data" + os.sep
+    tree_file = args.tree if args.tree else largest_reference_tree(tree_data_dir)
+    if not os.path.isfile(tree_file):
+        logging.error("Unable to find a reference tree to benchmark with.\n")
+        sys.exit(3)
+    labelled_tree_file = args.output + os.path.basename(tree_file).replace("_tree.txt", "_labelledTree.txt")
+    num_edges = write_labelled_tree(tree_file, labelled_tree_file)
+    logging.info("Labelled " + str(num_edges) + " edges of " + tree_file + "\n")
+
+    run_times = {"read": 0.0, "index": 0.0, "query": 0.0, "strings": 0.0}
+    for _ in range(args.replicates):
+        start_time = time.time()
+        labelled_tree_elements, insertion_point_node_hash = read_the_raxml_out_tree(labelled_tree_file)
+        run_times["read"] += time.time() - start_time
+
+        start_time = time.time()
+        labelled_tree_index = TerminalChildrenIndex(labelled_tree_elements)
+        run_times["index"] += time.time() - start_time
+        if labelled_tree_index.malformed:
+            logging.error("Unable to index the labelled tree " + labelled_tree_file + "\n")
+            sys.exit(5)
+
+        start_time = time.time()
+        for edge in insertion_point_node_hash:
+            labelled_tree_index.terminal_children(int(insertion_point_node_hash[edge]))
+        run_times["query"] += time.time() - start_time
+
+        start_time = time.time()
+        build_terminal_children_strings_of_assignments(labelled_tree_index, insertion_point_node_hash,
+                                                       {edge: 1 for edge in insertion_point_node_hash})
+        run_times["strings"] += time.time() - start_time
+
+    sys.stdout.write("Tree: " + tree_file + " (" + str(len(labelled_tree_index.leaves)) + " leaves, " +
+                     str(num_edges) + " edges)\n")
+    sys.stdout.write("Mean seconds to read the labelled tree = " +
+                     str(round(run_times["read"] / args.replicates, 4)) + "\n")
+    sys.stdout.write("Mean seconds to index the labelled tree = " +
+                     str(round(run_times["index"] / args.replicates, 4)) + "\n")
+    sys.stdout.write("Mean microseconds to find an edge's terminal children = " +
+                     str(round(1E6 * run_times["query"] / (args.replicates * len(insertion_point_node_hash)), 2)) +
+                     "\n")
+    sys.stdout.write("Mean seconds to write the terminal children strings of all edges = " +
+                     str(round(run_times["strings"] / args.replicates, 4)) + "\n")
+    return
+
+
+main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import re
+import shutil
+import argparse
+import inspect
+import logging
+
+cmd_folder = os.path.realpath(os.path.abspath(os.path.split(inspect.getfile(inspect.currentframe()))[0]))
+sys.path.insert(0, cmd_folder + os.sep + ".." + os.sep)
+from treesapp.classy import prep_logging
+from treesapp.file_parsers import parse_ref_build_params, read_species_translation_files
+from treesapp.assign import parse_raxml_output, filter_placements, write_tabular_output
+
+__author__ = 'Connor Morgan-Lang'
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description="Classifies the placements in a JPlace file written by pplacer, "
+                                                 "whose fields are in alphabetical order rather than RAxML's, "
+                                                 "and checks the placement edges and LWRs in the classification "
+                                                 "table against those expected.")
+    parser.add_argument("-j", "--jplace", required=False,
+                        default=os.sep.join([cmd_folder, "..", "test_data", "pplacer_test.jplace"]),
+                        help="A JPlace file written by pplacer for the McrA (M0701) reference package. "
+                             "[DEFAULT = test_data/pplacer_test.jplace]")
+    parser.add_argument("-e", "--expected", required=False, default="contig_1:3:0.55,contig_2:0:1.0",
+                        help="Comma-separated list of the expected query:edge:LWR of each classified query when "
+                             "placements are parsed with the 'best' method. [DEFAULT = contig_1:3:0.55,contig_2:0:1.0]")
+    parser.add_argument("-o", "--output", required=False, default="./pplacer_jplace_check/",
+                        help="Directory for writing the classification tables. [DEFAULT = ./pplacer_jplace_check/]")
+    args = parser.parse_args()
+    if args.output[-1] != os.sep:
+        args.output += os.sep
+    return args
+
+
+def read_classifications(classification_table: str):
+    """
+    :param classification_table: A classification table written by write_tabular_output
+    :return: Dictionary of the (iNode, LWR) tuple of each query, indexed by the query name
+    """
+    classifications = dict()
+    with open(classification_table) as table_handler:
+        header = table_handler.readline().strip().split("\t")
+        for line in table_handler:
+            fields = dict(zip(header, line.strip("\n").split("\t")))
+            classifications[fields["Query"]] = (fields["iNode"], float(fields["LWR"]))
+    return classifications
+
+
+def main():
+    args = get_options()
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    prep_logging(args.output + "pplacer_jplace_check_log.txt", False)
+
+    treesapp_dir = cmd_folder + os.sep + ".." + os.sep + "treesapp" + os.sep
+    tree_data_dir = treesapp_dir + "data" + os.sep + "tree_data" + os.sep
+    marker_build_dict = parse_ref_build_params(treesapp_dir, ["M0701"])
+    tree_numbers_translation = read_species_translation_files(treesapp_dir, marker_build_dict)
+
+    # The JPlace file is named as RAxML's would be so organize_jplace_files maps it to the McrA reference package
+    jplace_dir = args.output + "jplace" + os.sep
+    if not os.path.isdir(jplace_dir):
+        os.makedirs(jplace_dir)
+    shutil.copy(args.jplace, jplace_dir + "RAxML_portableTree.M0701_McrA_pplacer.jplace")
+
+    expected = dict()
+    for query_info in args.expected.split(','):
+        query, edge, lwr = query_info.split(':')
+        expected[query] = (edge, float(lwr))
+
+    failures = 0
+    for parsing_method in ["best", "lca"]:
+        tree_saps, _ = parse_raxml_output(jplace_dir, tree_data_dir, marker_build_dict, parsing_method)
+        tree_saps = filter_placements(tree_saps, marker_build_dict, tree_data_dir, 0.1)
+        classification_table = args.output + "marker_contig_map_" + parsing_method + ".tsv"
+        write_tabular_output(tree_saps, tree_numbers_translation, marker_build_dict, "pplacer",
+                             classification_table)
+        classifications = read_classifications(classification_table)
+        for query in sorted(expected):
+            if query not in classifications:
+                logging.error("'" + query + "' was not classified with the '" + parsing_method + "' method.\n")
+                failures += 1
+                continue
+            edge, lwr = classifications[query]
+            if parsing_method == "lca":
+                # The edges of ambiguous placements are harmonized to their LCA, so only the LWRs are compared
+                for tree_sap in tree_saps["M0701"]:
+                    if re.sub(r"\|.*", '', tree_sap.contig_name) == query and len(tree_sap.placements[0].loci) != 1:
+                        logging.error("The placements of '" + query + "' were not harmonized to a single edge.\n")
+                        failures += 1
+                if lwr < expected[query][1]:
+                    logging.error("The harmonized LWR of '" + query + "' (" + str(lwr) +
+                                  ") is less than that of its best placement.\n")
+                    failures += 1
+            elif (edge, lwr) != expected[query]:
+                logging.error("'" + query + "' was placed on edge " + edge + " with LWR " + str(lwr) +
+                              " but edge " + expected[query][0] + " with LWR " + str(expected[query][1]) +
+                              " was expected.\n")
+                failures += 1
+            logging.info(parsing_method + "\t" + query + "\t" + edge + "\t" + str(lwr) + "\n")
+
+    if failures:
+        logging.error(str(failures) + " classifications differed from those expected.\n")
+        sys.exit(1)
+    logging.info("All classifications of the pplacer JPlace file were as expected.\n")
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import argparse
+import inspect
+import time
+import logging
+
+cmd_folder = os.path.realpath(os.path.abspath(os.path.split(inspect.getfile(inspect.currentframe()))[0]))
+sys.path.insert(0, cmd_folder + os.sep + ".." + os.sep)
+from treesapp.classy import prep_logging
+from treesapp.file_parsers import parse_ref_build_params, read_multiple_alignment
+from treesapp.alignment_trimming import ENGINE_NAME, trim_alignment_file
+from treesapp.wrapper import bmge_command
+from treesapp.external_command_interface import launch_write_command
+from treesapp.utilities import which
+
+__author__ = 'Connor Morgan-Lang'
+
+
+def get_options():
+    parser = argparse.ArgumentParser(description="Benchmarks the in-process BMGE implementation (" + ENGINE_NAME +
+                                                 ") against BMGE.jar and checks that both select the same "
+                                                 "sequences and columns from each reference package's alignment.")
+    parser.add_argument("-o", "--output", required=False, default="./trim_engine_concordance/",
+                        help="Directory for writing the trimmed alignments. [DEFAULT = ./trim_engine_concordance/]")
+    parser.add_argument("-t", "--targets", required=False, default="",
+                        help="A comma-separated list of refpkg codes whose alignments are trimmed. [DEFAULT = ALL]")
+    parser.add_argument("-r", "--replicates", required=False, default=1, type=int,
+                        help="The number of times each alignment is trimmed by each engine. [DEFAULT = 1]")
+    args = parser.parse_args()
+    if args.output[-1] != os.sep:
+        args.output += os.sep
+    return args
+
+
+def main():
+    args = get_options()
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    prep_logging(args.output + "trim_engine_concordance_log.txt", False)
+
+    treesapp_dir = cmd_folder + os.sep + ".." + os.sep + "treesapp" + os.sep
+    aln_dir = treesapp_dir + "data" + os.sep + "alignment_data" + os.sep
+    bmge_jar = treesapp_dir + "sub_binaries" + os.sep + "BMGE.jar"
+    if not which("java"):
+        logging.error("Unable to find java in your $PATH.\n")
+        sys.exit(3)
+    marker_build_dict = parse_ref_build_params(treesapp_dir, [t for t in args.targets.split(',') if t])
+
+    run_times = {"BMGE": 0.0, ENGINE_NAME: 0.0}
+    discordant = 0
+    compared = 0
+    for denominator in sorted(marker_build_dict):
+        marker_build = marker_build_dict[denominator]
+        mfa_file = aln_dir + marker_build.cog + ".fa"
+        if not os.path.isfile(mfa_file):
+            continue
+        bmge_file = args.output + marker_build.cog + "-BMGE.fasta"
+        engine_file = args.output + marker_build.cog + '-' + ENGINE_NAME + ".fasta"
+
+        for _ in range(args.replicates):
+            start_time = time.time()
+            stdout, returncode = launch_write_command(bmge_command(bmge_jar, mfa_file, bmge_file,
+                                                                   marker_build.molecule))
+            run_times["BMGE"] += time.time() - start_time
+            if returncode != 0:
+                logging.error("BMGE did not complete successfully for " + mfa_file + ":\n" + stdout + "\n")
+                sys.exit(5)
+
+            start_time = time.time()
+            trim_alignment_file(mfa_file, engine_file, marker_build.molecule)
+            run_times[ENGINE_NAME] += time.time() - start_time
+
+        compared += 1
+        bmge_seqs = read_multiple_alignment(bmge_file).to_dict()
+        engine_seqs = read_multiple_alignment(engine_file).to_dict()
+        missing = set(bmge_seqs).difference(engine_seqs)
+        extra = set(engine_seqs).difference(bmge_seqs)
+        different = [name for name in set(bmge_seqs).intersection(engine_seqs)
+                     if bmge_seqs[name] != engine_seqs[name]]
+        if missing or extra or different:
+            discordant += 1
+            sys.stdout.write(marker_build.cog + ": " + str(len(missing)) + " missing, " + str(len(extra)) +
+                             " extra and " + str(len(different)) + " differently trimmed sequences\n")
+
+    for engine in run_times:
+        sys.stdout.write(engine + ": " + str(round(run_times[engine], 2)) + " seconds to trim " +
+                         str(compared * args.replicates) + " alignments\n")
+    sys.stdout.write(str(compared - discordant) + '/' + str(compared) + " trimmed alignments concordant\n")
+    if discordant:
+        sys.exit(1)
+
+
+main()
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from treesapp.fasta import FASTA
+from treesapp.classy import TreeProtein
+from treesapp.commands import collapse_duplicates
+from treesapp.assign import fan_out_duplicates
+
+__author__ = 'Connor Morgan-Lang'
+
+query_seqs = [("seq_1 McrA from a methanogen", "MADKLFINALKKKFEESPEEKKTTFYTLGGWKQS"),
+              ("seq_2", "MAKFEDKVDLYDDRGNLLEEGIELSEVPFS"),
+              ("seq_3 identical to seq_1", "MADKLFINALKKKFEESPEEKKTTFYTLGGWKQS"),
+              ("seq_4", "MPQYEDKLDLYDDRGNLVRE"),
+              ("seq_5 identical to seq_2", "MAKFEDKVDLYDDRGNLLEEGIELSEVPFS"),
+              ("seq_6 identical to seq_1", "MADKLFINALKKKFEESPEEKKTTFYTLGGWKQS")]
+
+
+def classify(seq_name: str, refpkg_name: str, lineage: str):
+    placed_seq = TreeProtein()
+    placed_seq.contig_name = seq_name + '|' + refpkg_name + "|1_30"
+    placed_seq.name = refpkg_name
+    placed_seq.lct = lineage
+    placed_seq.inode = "12"
+    placed_seq.lwr = 0.9
+    return placed_seq
+
+
+class DuplicateFanOutTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+        self.fasta_file = self.output_dir + "query.faa"
+        with open(self.fasta_file, 'w') as fasta_handler:
+            for header, seq in query_seqs:
+                fasta_handler.write('>' + header + "\n" + seq + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_collapse_duplicates(self):
+        fasta = FASTA(self.fasta_file)
+        fasta.load_fasta()
+        fasta.change_dict_keys("num")
+        duplicate_headers = collapse_duplicates(fasta)
+        # The first of each group of identical sequences represents the rest
+        self.assertEqual({"seq_1 McrA from a methanogen": ["seq_3 identical to seq_1", "seq_6 identical to seq_1"],
+                          "seq_2": ["seq_5 identical to seq_2"]},
+                         duplicate_headers)
+        self.assertEqual(["1", "2", "4"], sorted(fasta.fasta_dict, key=int))
+        self.assertEqual(len(query_seqs), len(fasta.header_registry))
+
+    def test_fan_out_matches_placing_every_sequence(self):
+        fasta = FASTA(self.fasta_file)
+        fasta.load_fasta()
+        fasta.change_dict_keys("num")
+        duplicate_headers = collapse_duplicates(fasta)
+
+        lineages = {"seq_1 McrA from a methanogen": "r__Root; d__Archaea; p__Euryarchaeota",
+                    "seq_2": "r__Root; d__Archaea",
+                    "seq_4": "r__Root; d__Archaea; p__Thaumarchaeota"}
+        tree_saps = {"M0701": [classify(header, "McrA", lineages[header]) for header in lineages]}
+        classified_seq_dict = {placed_seq.contig_name: dict(query_seqs)[placed_seq.contig_name.split('|')[0]]
+                               for placed_seq in tree_saps["M0701"]}
+        fan_out_duplicates(tree_saps, classified_seq_dict, duplicate_headers)
+
+        # Each duplicate is classified as its representative would be, had every sequence been placed
+        expected = dict()
+        for header, seq in query_seqs:
+            representative = [rep for rep in lineages if dict(query_seqs)[rep] == seq][0]
+            expected[header + "|McrA|1_30"] = (lineages[representative], "12", 0.9, seq)
+        observed = {placed_seq.contig_name: (placed_seq.lct, placed_seq.inode, placed_seq.lwr,
+                                             classified_seq_dict[placed_seq.contig_name])
+                    for placed_seq in tree_saps["M0701"]}
+        self.assertEqual(expected, observed)
+        self.assertEqual(len(query_seqs), len(tree_saps["M0701"]))
+
+        # The abundances of duplicates are measured independently of their representative's
+        tree_saps["M0701"][-1].abundance = 2.0
+        self.assertEqual(1, len([placed_seq for placed_seq in tree_saps["M0701"] if placed_seq.abundance]))
+
+    def test_no_duplicates(self):
+        tree_saps = {"M0701": [classify("seq_4", "McrA", "r__Root")]}
+        fan_out_duplicates(tree_saps, dict(), {})
+        self.assertEqual(["seq_4|McrA|1_30"], [placed_seq.contig_name for placed_seq in tree_saps["M0701"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from treesapp.HMMER_domainTblParser import merge_domain_tables
+from treesapp.file_parsers import parse_ref_build_params
+from treesapp.wrapper import hmmsearch_orfs
+from treesapp.utilities import which
+
+__author__ = 'Connor Morgan-Lang'
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + os.sep
+treesapp_dir = repo_dir + "treesapp" + os.sep
+
+domtbl_header = "#                                                                            --- full sequence --- " \
+                "-------------- this domain -------------   hmm coord   ali coord   env coord\n" \
+                "# target name        accession   tlen query name           accession   qlen   E-value  score  bias " \
+                "  #  of  c-Evalue  i-Evalue  score  bias  from    to  from    to  from    to  acc " \
+                "description of target\n" \
+                "#------------------- ---------- ----- -------------------- ---------- ----- --------- ------ ----- " \
+                "--- --- --------- --------- ------ ----- ----- ----- ----- ----- ----- ----- ---- " \
+                "---------------------\n"
+domtbl_footer = "#\n# Program:         hmmsearch\n# Version:         3.3 (Nov 2019)\n# [ok]\n"
+
+# The hits of two profiles: (target, query, full-sequence E-value, score, [(domain P-value, i-Evalue), ...])
+hits = [("seq_1", "McrA", 1.2E-150, 501.3, [(1.1E-155, 2.2E-150)]),
+        ("seq_2", "McrA", 3.4E-80, 270.1, [(2.5E-85, 5.0E-80), (0.47, 9.4E3)]),
+        ("seq_3", "McrA", 3.4E-80, 275.8, [(7.7E-86, 1.5E-80)]),
+        ("seq_4", "McrA", 0.0021, 14.2, [(1.3E-4, 0.26), (3.9, 7.8E3)]),
+        ("seq_5", "McrA", 4.6, 2.0, [(0.0092, 18.0)]),
+        ("seq_2", "McrB", 6.1E-12, 42.0, [(5.6E-17, 1.1E-11)]),
+        ("seq_6", "McrB", 1.0E-200, 670.9, [(4.4E-206, 8.8E-201)])]
+
+
+def format_domtbl_rows(query_hits, dom_z):
+    """
+    Formats the hits of a profile as hmmsearch does in its domain table, with conditional E-values for dom_z targets.
+    Domains with conditional E-values greater than the reporting threshold (--domE 10) are not reported.
+    """
+    rows = ""
+    for target, query, e_value, score, domains in sorted(query_hits, key=lambda h: (h[2], -h[3], h[0])):
+        for dom_num, (p_value, i_evalue) in enumerate(domains, 1):
+            c_evalue = p_value * dom_z
+            if c_evalue > 10:
+                continue
+            rows += "%-20s %-10s %5d %-20s %-10s %5d %9.2g %6.1f %5.1f %3d %3d %9.2g %9.2g %6.1f %5.1f " \
+                    "%5d %5d %5d %5d %5d %5d %4.2f %s\n" % (target, '-', 560, query, '-', 550, e_value, score, 0.1,
+                                                            dom_num, len(domains), c_evalue, i_evalue, score, 0.1,
+                                                            1, 550, 2, 555, 1, 558, 0.98, '-')
+    return rows
+
+
+def read_domtbl_rows(domtbl_file):
+    """
+    :return: List of the fields in each row of a domain table, with the conditional E-values as floats
+    """
+    rows = list()
+    with open(domtbl_file) as domtbl:
+        for line in domtbl:
+            if line[0] == '#':
+                continue
+            fields = line.rstrip("\n").split(None, 22)
+            fields[11] = float(fields[11])
+            rows.append(fields)
+    return rows
+
+
+class MergeDomainTablesTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def write_domtbl(self, file_name, hits_subset, dom_z=None):
+        rows = ""
+        for query in sorted(set([hit[1] for hit in hits_subset])):
+            query_hits = [hit for hit in hits_subset if hit[1] == query]
+            rows += format_domtbl_rows(query_hits, dom_z if dom_z else len(query_hits))
+        with open(self.output_dir + file_name, 'w') as domtbl:
+            domtbl.write(domtbl_header + rows + domtbl_footer)
+        return self.output_dir + file_name
+
+    def test_merged_shards_match_single_search(self):
+        single_domtbl = self.write_domtbl("single.domtbl", hits)
+        # Each shard is searched with '--domZ 1' so its conditional E-values are P-values
+        shard_domtbls = [self.write_domtbl("shard_" + str(i) + ".domtbl", hits[i::3], dom_z=1) for i in range(3)]
+        merged_domtbl = self.output_dir + "merged.domtbl"
+        merge_domain_tables(shard_domtbls, merged_domtbl)
+
+        single_rows = read_domtbl_rows(single_domtbl)
+        merged_rows = read_domtbl_rows(merged_domtbl)
+        self.assertEqual([fields[:11] + fields[12:] for fields in single_rows],
+                         [fields[:11] + fields[12:] for fields in merged_rows])
+        # The merged conditional E-values are scaled from P-values printed with two significant digits
+        for single_fields, merged_fields in zip(single_rows, merged_rows):
+            self.assertAlmostEqual(single_fields[11], merged_fields[11], delta=0.05 * single_fields[11])
+
+        with open(merged_domtbl) as merged:
+            merged_lines = merged.readlines()
+        self.assertEqual(domtbl_header, ''.join(merged_lines[:3]))
+        self.assertEqual(domtbl_footer, ''.join(merged_lines[-4:]))
+
+    def test_domains_beyond_threshold_removed(self):
+        shard_domtbls = [self.write_domtbl("shard_" + str(i) + ".domtbl", hits[i::3], dom_z=1) for i in range(3)]
+        merged_domtbl = self.output_dir + "merged.domtbl"
+        merge_domain_tables(shard_domtbls, merged_domtbl, dom_e=1.0)
+        for fields in read_domtbl_rows(merged_domtbl):
+            self.assertLessEqual(fields[11], 1.0)
+        self.assertNotIn(("seq_2", "McrA", "2"), [(f[0], f[3], f[9]) for f in read_domtbl_rows(merged_domtbl)])
+
+
+@unittest.skipUnless(which("hmmsearch"), "hmmsearch is not in the $PATH")
+class ShardedHmmsearchTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_sharded_search_matches_single_search(self):
+        hmm_dir = treesapp_dir + "data" + os.sep + "hmm_data" + os.sep
+        marker_build_dict = parse_ref_build_params(treesapp_dir, ["M0701", "M0702"])
+        query_fasta = repo_dir + "test_data" + os.sep + "marker_test_suite.faa"
+        domtbl_rows = dict()
+        for num_shards in [1, 3]:
+            search_dir = self.output_dir + "shards_" + str(num_shards) + os.sep
+            os.makedirs(search_dir)
+            domtbl_files = hmmsearch_orfs(which("hmmsearch"), hmm_dir, marker_build_dict, query_fasta, search_dir,
+                                          num_threads=2, num_shards=num_shards)
+            domtbl_rows[num_shards] = {os.path.basename(domtbl): read_domtbl_rows(domtbl) for domtbl in domtbl_files}
+
+        self.assertEqual(set(domtbl_rows[1]), set(domtbl_rows[3]))
+        for domtbl_name in domtbl_rows[1]:
+            # Domains within the rounding error of the reporting threshold may be reported by only one search
+            single_rows = [f[:11] + f[12:] for f in domtbl_rows[1][domtbl_name] if f[11] < 9.5]
+            sharded_rows = [f[:11] + f[12:] for f in domtbl_rows[3][domtbl_name] if f[11] < 9.5]
+            self.assertEqual(single_rows, sharded_rows)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from treesapp.fasta import generate_fasta_chunks, read_fasta_to_dict, split_fasta_by_length, merge_prodigal_orfs
+
+__author__ = 'Connor Morgan-Lang'
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + os.sep
+test_fasta = repo_dir + "test_data" + os.sep + "marker_test_suite.faa"
+
+
+def read_records(fasta_file):
+    records = list()
+    for chunk in generate_fasta_chunks(fasta_file):
+        records += chunk
+    return records
+
+
+class FastaChunksTest(unittest.TestCase):
+    def setUp(self):
+        self.records = read_records(test_fasta)
+
+    def test_whole_file(self):
+        self.assertEqual(1, len(list(generate_fasta_chunks(test_fasta))))
+        self.assertEqual(len(read_fasta_to_dict(test_fasta)), len(self.records))
+
+    def test_chunks_by_number_of_sequences(self):
+        chunks = list(generate_fasta_chunks(test_fasta, max_seqs=7))
+        self.assertEqual(self.records, [record for chunk in chunks for record in chunk])
+        for chunk in chunks[:-1]:
+            self.assertEqual(7, len(chunk))
+        self.assertLessEqual(len(chunks[-1]), 7)
+
+    def test_chunks_by_size(self):
+        max_bytes = 5000
+        chunks = list(generate_fasta_chunks(test_fasta, max_bytes=max_bytes))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(self.records, [record for chunk in chunks for record in chunk])
+        for chunk in chunks:
+            # A chunk is yielded as soon as it reaches max_bytes so only its last record may pass the limit
+            self.assertLess(sum([len(name) + len(seq) for name, seq in chunk[:-1]]), max_bytes)
+
+    def test_chunks_by_first_limit_reached(self):
+        chunks = list(generate_fasta_chunks(test_fasta, max_seqs=3, max_bytes=10 ** 9))
+        self.assertEqual([3] * (len(chunks) - 1), [len(chunk) for chunk in chunks[:-1]])
+        self.assertEqual(self.records, [record for chunk in chunks for record in chunk])
+
+
+def write_prodigal_orfs(orf_file, records, first_seq_num=1):
+    """
+    Writes an ORF file with headers in the format of Prodigal's, numbering the ID attribute of each ORF by the
+    position of its sequence in the input, starting from first_seq_num.
+    """
+    with open(orf_file, 'w') as orf_handler:
+        for seq_num, (name, sequence) in enumerate(records, first_seq_num):
+            orf_handler.write('>' + name.split()[0] + "_1 # 1 # " + str(3 * len(sequence)) + " # 1 # ID=" +
+                              str(seq_num) + "_1;partial=00;start_type=ATG\n" + sequence + "\n")
+
+
+class FastaShardsTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+        self.records = read_records(test_fasta)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_shards_are_contiguous(self):
+        shards = split_fasta_by_length(test_fasta, self.output_dir + "shard", 4)
+        self.assertEqual(4, len(shards))
+        shard_records = [read_records(shard_file) for shard_file, _ in shards]
+        self.assertEqual(self.records, [record for records in shard_records for record in records])
+        self.assertEqual(0, shards[0][1])
+        for i in range(1, len(shards)):
+            self.assertEqual(shards[i - 1][1] + len(shard_records[i - 1]), shards[i][1])
+
+    def test_shards_have_equal_residues(self):
+        shards = split_fasta_by_length(test_fasta, self.output_dir + "shard", 3)
+        total_length = sum([len(seq) for _, seq in self.records])
+        longest = max([len(seq) for _, seq in self.records])
+        for shard_file, _ in shards:
+            shard_length = sum([len(seq) for _, seq in read_records(shard_file)])
+            self.assertLess(abs(shard_length - total_length / 3), longest)
+
+    def test_more_shards_than_sequences(self):
+        fasta_file = self.output_dir + "two.faa"
+        with open(fasta_file, 'w') as fasta_handler:
+            fasta_handler.write(">a\nMKV\n>b\nMKVL\n>c\nMKVLA\n")
+        shards = split_fasta_by_length(fasta_file, self.output_dir + "shard", 8)
+        self.assertLessEqual(len(shards), 3)
+        self.assertEqual(read_records(fasta_file),
+                         [record for shard_file, _ in shards for record in read_records(shard_file)])
+
+    def test_merged_orfs_match_unsharded_run(self):
+        unsharded_orfs = self.output_dir + "unsharded_ORFs.faa"
+        write_prodigal_orfs(unsharded_orfs, self.records)
+
+        shards = split_fasta_by_length(test_fasta, self.output_dir + "shard", 4)
+        # Prodigal numbers the sequences of each shard from one
+        shard_orfs = list()
+        for shard_file, _ in shards:
+            shard_orfs.append(shard_file.replace(".fasta", "_ORFs.faa"))
+            write_prodigal_orfs(shard_orfs[-1], read_records(shard_file))
+        merged_orfs = self.output_dir + "merged_ORFs.faa"
+        merge_prodigal_orfs(shard_orfs, [offset for _, offset in shards], merged_orfs)
+
+        with open(unsharded_orfs) as unsharded, open(merged_orfs) as merged:
+            self.assertEqual(unsharded.read(), merged.read())
+
+        merge_prodigal_orfs(shard_orfs[:1], [0], merged_orfs, append=True)
+        self.assertEqual(len(self.records) + len(read_records(shard_orfs[0])), len(read_records(merged_orfs)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from treesapp.file_parsers import parse_ref_build_params
+from treesapp.wrapper import allocate_threads, hmmsearch_command, hmmsearch_orfs
+from treesapp.utilities import which
+
+__author__ = 'Connor Morgan-Lang'
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + os.sep
+treesapp_dir = repo_dir + "treesapp" + os.sep
+
+
+def read_domtbl_rows(domtbl_file):
+    """
+    :return: The rows of a domain table, without the comments that record the command and run time
+    """
+    with open(domtbl_file) as domtbl:
+        return [line for line in domtbl if line[0] != '#']
+
+
+class AllocateThreadsTest(unittest.TestCase):
+    def test_thread_budget_respected(self):
+        for num_jobs in range(0, 12):
+            for num_threads in range(1, 17):
+                n_parallel, threads_per_job = allocate_threads(num_jobs, num_threads)
+                self.assertGreaterEqual(n_parallel, 1)
+                self.assertGreaterEqual(threads_per_job, 1)
+                self.assertLessEqual(n_parallel * threads_per_job, num_threads)
+                self.assertLessEqual(n_parallel, max(1, num_jobs))
+
+    def test_minimum_threads_per_job(self):
+        self.assertEqual((4, 2), allocate_threads(10, 8))
+        self.assertEqual((2, 4), allocate_threads(2, 8))
+        self.assertEqual((1, 1), allocate_threads(5, 1))
+        self.assertEqual((8, 1), allocate_threads(10, 8, min_threads=1))
+
+
+class HmmsearchCommandTest(unittest.TestCase):
+    def test_command(self):
+        command, domtbl = hmmsearch_command("hmmsearch", "/hmms/McrA.hmm", "queries.faa", "/out/", 3)
+        self.assertEqual("/out/McrA_to_ORFs_domtbl.txt", domtbl)
+        self.assertEqual(["hmmsearch", "--cpu", "3", "--noali", "--domtblout", domtbl, "/hmms/McrA.hmm",
+                          "queries.faa"], command)
+
+    def test_shard_command(self):
+        command, _ = hmmsearch_command("hmmsearch", "/hmms/McrA.hmm", "shard_1.fasta", "/out/", 1, 500, 1)
+        self.assertEqual(["-Z", "500", "--domZ", "1"], command[4:8])
+
+
+@unittest.skipUnless(which("hmmsearch"), "hmmsearch is not in the $PATH")
+class ConcurrentHmmsearchTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_concurrent_search_matches_serial_search(self):
+        hmm_dir = treesapp_dir + "data" + os.sep + "hmm_data" + os.sep
+        marker_build_dict = parse_ref_build_params(treesapp_dir, ["M0701", "M0702", "M0705"])
+        query_fasta = repo_dir + "test_data" + os.sep + "marker_test_suite.faa"
+        domtbl_rows = dict()
+        for n_parallel in [1, 3]:
+            search_dir = self.output_dir + "parallel_" + str(n_parallel) + os.sep
+            os.makedirs(search_dir)
+            domtbl_files = hmmsearch_orfs(which("hmmsearch"), hmm_dir, marker_build_dict, query_fasta, search_dir,
+                                          num_threads=3, n_parallel=n_parallel)
+            domtbl_rows[n_parallel] = {os.path.basename(domtbl): read_domtbl_rows(domtbl) for domtbl in domtbl_files}
+        self.assertEqual(3, len(domtbl_rows[1]))
+        self.assertEqual(domtbl_rows[1], domtbl_rows[3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from treesapp.classy import JPlacePQuery
+from treesapp.jplace_utils import jplace_parser, write_jplace
+
+__author__ = 'Connor Morgan-Lang'
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + os.sep
+pplacer_jplace = repo_dir + "test_data" + os.sep + "pplacer_test.jplace"
+
+
+class JPlacePQueryTest(unittest.TestCase):
+    def test_from_json(self):
+        raxml_pquery = '{"p":[[12, -5012.1, 0.8, 0.01, 0.2], [13, -5013.5, 0.2, 0.02, 0.3]], "n":["seq_1|McrA|1_300"]}'
+        pquery = JPlacePQuery.from_json(raxml_pquery)
+        self.assertEqual(["seq_1|McrA|1_300"], pquery.names)
+        self.assertEqual([[12, -5012.1, 0.8, 0.01, 0.2], [13, -5013.5, 0.2, 0.02, 0.3]], pquery.loci)
+        self.assertEqual(json.loads(raxml_pquery), json.loads(pquery.to_json()))
+
+        # A single name may be a string and pplacer writes names with their multiplicities
+        self.assertEqual(["seq_1"], JPlacePQuery.from_json({"p": [], "n": "seq_1"}).names)
+        pplacer_pquery = {"p": [], "nm": [["seq_1", 1], ["seq_2", 2]]}
+        self.assertEqual(["seq_1", "seq_2"], JPlacePQuery.from_json(pplacer_pquery).names)
+
+
+class JPlaceParserTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+        with open(pplacer_jplace) as jplace_handler:
+            self.raw_jplace = json.load(jplace_handler)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_pplacer_fields_reordered(self):
+        jplace_data = jplace_parser(pplacer_jplace)
+        self.assertEqual(["edge_num", "likelihood", "like_weight_ratio", "distal_length", "pendant_length",
+                          "marginal_like"], jplace_data.fields)
+        self.assertEqual(len(self.raw_jplace["placements"]), len(jplace_data.placements))
+        for raw_pquery, pquery in zip(self.raw_jplace["placements"], jplace_data.placements):
+            self.assertEqual([name for name, _ in raw_pquery["nm"]], pquery.names)
+            for raw_locus, locus in zip(raw_pquery["p"], pquery.loci):
+                raw_fields = dict(zip(self.raw_jplace["fields"], raw_locus))
+                self.assertEqual([raw_fields[field] for field in jplace_data.fields], locus)
+
+    def test_write_and_parse(self):
+        jplace_file = self.output_dir + "rewritten.jplace"
+        # The fields are quoted for writing so the file is parsed again for comparison
+        write_jplace(jplace_parser(pplacer_jplace), jplace_file)
+        jplace_data = jplace_parser(pplacer_jplace)
+        rewritten_data = jplace_parser(jplace_file)
+        self.assertEqual(jplace_data.tree, rewritten_data.tree)
+        self.assertEqual(jplace_data.fields, rewritten_data.fields)
+        self.assertEqual([(pquery.names, pquery.loci) for pquery in jplace_data.placements],
+                         [(pquery.names, pquery.loci) for pquery in rewritten_data.placements])
+
+
+if __name__ == "__main__":
+    unittest.main()
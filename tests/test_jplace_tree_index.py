@@ -0,0 +1,137 @@
+import os
+import re
+import json
+import unittest
+from ete3 import Tree
+
+from treesapp.entish import get_node, index_jplace_tree
+
+__author__ = 'Connor Morgan-Lang'
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + os.sep
+tree_data_dir = repo_dir + "treesapp" + os.sep + "data" + os.sep + "tree_data" + os.sep
+
+
+def legacy_map_internal_nodes_leaves(tree):
+    """
+    The character-by-character parser that index_jplace_tree replaced, kept as a reference for its node-leaves map.
+    It does not support branch lengths in scientific notation and only maps two of a trifurcating root's children.
+    """
+    no_length_tree = re.sub(r":[0-9.]+(\[\d+\])?{", ":{", tree)
+    node_map = dict()
+    node_stack = list()
+    leaf_stack = list()
+    x = 0
+    num_buffer = ""
+    while x < len(no_length_tree):
+        c = no_length_tree[x]
+        if re.search(r"\d", c):
+            while re.search(r"\d", c):
+                num_buffer += c
+                x += 1
+                c = no_length_tree[x]
+            node_stack.append([str(num_buffer)])
+            num_buffer = ""
+            x -= 1
+        elif c == ':':
+            current_node, x = get_node(no_length_tree, x + 1)
+            node_map[current_node] = node_stack.pop()
+            leaf_stack.append(current_node)
+        elif c == ')':
+            while c == ')' and x < len(no_length_tree):
+                if no_length_tree[x + 1] == ';':
+                    break
+                while c != '{':
+                    x += 1
+                    c = no_length_tree[x]
+                current_node, x = get_node(no_length_tree, x)
+                node_map[current_node] = node_map[leaf_stack.pop()] + node_map[leaf_stack.pop()]
+                leaf_stack.append(current_node)
+                x += 1
+                c = no_length_tree[x]
+        x += 1
+    return node_map
+
+
+def legacy_index_tree_edges(tree):
+    """
+    The character-by-character parser of edge lengths that index_jplace_tree replaced.
+    """
+    edge_index = dict()
+    dist = ""
+    edge = ""
+    i = 0
+    while i < len(tree):
+        if tree[i] in [':', '{']:
+            i += 1
+            if dist:
+                while re.match(r"[0-9]", tree[i]):
+                    edge += tree[i]
+                    i += 1
+                edge_index[edge] = float(dist)
+                dist = ""
+                edge = ""
+            else:
+                while re.match(r"[0-9.]", tree[i]):
+                    dist += tree[i]
+                    i += 1
+        else:
+            i += 1
+    return edge_index
+
+
+def jplace_tree_string(tree_file):
+    """
+    Numbers the edges of a reference tree in post-order, as RAxML and pplacer do in JPlace files.
+    """
+    tree = Tree(tree_file)
+    edge_num = 0
+    newick_strings = dict()
+    for node in tree.traverse("postorder"):
+        if node.is_leaf():
+            newick = node.name
+        else:
+            newick = '(' + ','.join([newick_strings.pop(child) for child in node.children]) + ')'
+        if node.is_root():
+            return newick + '{' + str(edge_num) + "};"
+        newick_strings[node] = newick + ':' + "%f" % node.dist + '{' + str(edge_num) + '}'
+        edge_num += 1
+
+
+class IndexJPlaceTreeTest(unittest.TestCase):
+    def compare_to_legacy(self, jplace_tree):
+        node_map, edge_lengths, parent_map = index_jplace_tree(jplace_tree)
+        legacy_node_map = legacy_map_internal_nodes_leaves(jplace_tree)
+        self.assertEqual(set(legacy_node_map), set(node_map))
+
+        root = max(node_map)
+        for node in node_map:
+            if node == root:
+                continue
+            self.assertEqual(legacy_node_map[node], node_map[node], "Leaves of node " + str(node) + " differ")
+        self.assertEqual(sorted(re.findall(r"[(,](\d+):", jplace_tree)), sorted(node_map[root]))
+
+        self.assertEqual(legacy_index_tree_edges(jplace_tree), edge_lengths)
+        self.assertEqual(set(node_map).difference({root}), set(parent_map))
+        for child, parent in parent_map.items():
+            self.assertTrue(set(node_map[child]).issubset(node_map[parent]))
+
+    def test_pplacer_tree(self):
+        with open(repo_dir + "test_data" + os.sep + "pplacer_test.jplace") as jplace_handler:
+            jplace_tree = json.load(jplace_handler)["tree"]
+        # The legacy parser cannot read branch lengths in scientific notation
+        self.compare_to_legacy(re.sub(r":([0-9.]+)e-06", lambda m: ':' + "%f" % (float(m.group(1)) * 1E-6),
+                                      jplace_tree))
+
+    def test_scientific_notation(self):
+        node_map, edge_lengths, _ = index_jplace_tree("((1:1e-06{0},2:2.5E-3{1}):0.1{2},3:0.2{3}){4};")
+        self.assertEqual({"0": 1E-6, "1": 2.5E-3, "2": 0.1, "3": 0.2}, edge_lengths)
+        self.assertEqual(["2", "1"], node_map[2])
+
+    def test_reference_trees(self):
+        for refpkg_name in ["McrA", "McrB", "DsrAB"]:
+            self.compare_to_legacy(jplace_tree_string(tree_data_dir + refpkg_name + "_tree.txt"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from treesapp.msa import MultipleSequenceAlignment
+from treesapp.fasta import read_fasta_to_dict
+from treesapp.file_parsers import read_phylip_to_dict
+from treesapp.utilities import reformat_fasta_to_phy
+
+__author__ = 'Connor Morgan-Lang'
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + os.sep
+ref_alignment = repo_dir + "treesapp" + os.sep + "data" + os.sep + "alignment_data" + os.sep + "McrA.fa"
+
+
+def legacy_phylip_string(seq_dict: dict):
+    """
+    The Phylip string that check_for_removed_sequences wrote from a dictionary of sequences, before
+    MultipleSequenceAlignment.write_phylip replaced it.
+    """
+    phy_dict = reformat_fasta_to_phy(seq_dict)
+    phy_string = ' ' + str(len(seq_dict.keys())) + '  ' + str(len(next(iter(seq_dict.values())))) + '\n'
+    for count in sorted(phy_dict.keys(), key=int):
+        for seq_name in sorted(phy_dict[count].keys()):
+            sequence_part = phy_dict[count][seq_name]
+            if count == 0:
+                phy_string += str(seq_name)
+                c = len(str(seq_name))
+                while c < 10:
+                    phy_string += ' '
+                    c += 1
+            phy_string += sequence_part + '\n'
+        phy_string += '\n'
+    return phy_string
+
+
+class MultipleSequenceAlignmentTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+        self.seq_dict = {name.split('_')[0]: seq for name, seq in read_fasta_to_dict(ref_alignment).items()}
+        self.msa = MultipleSequenceAlignment.from_dict(self.seq_dict, ref_alignment)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_from_dict(self):
+        self.assertEqual(self.seq_dict, self.msa.to_dict())
+        self.assertEqual((len(self.seq_dict), len(next(iter(self.seq_dict.values())))), self.msa.dimensions())
+        for name in self.seq_dict:
+            self.assertEqual(self.seq_dict[name], self.msa.sequence(name))
+
+    def test_ungapped_lengths(self):
+        expected = [len(self.seq_dict[name].replace('-', '').replace('.', '')) for name in self.msa.names]
+        self.assertEqual(expected, list(self.msa.ungapped_lengths()))
+
+    def test_subsets(self):
+        names = sorted(self.seq_dict)[:5]
+        rows = self.msa.subset_rows(names)
+        self.assertEqual({name: self.seq_dict[name] for name in names}, rows.to_dict())
+
+        columns = np.arange(0, self.msa.dimensions()[1], 3)
+        subset = self.msa.subset_columns(columns)
+        for name in self.seq_dict:
+            self.assertEqual(self.seq_dict[name][::3], subset.sequence(name))
+
+    def test_write_phylip(self):
+        phy_file = self.output_dir + "McrA.phy"
+        self.msa.write_phylip(phy_file)
+        with open(phy_file) as phy_handler:
+            self.assertEqual(legacy_phylip_string(self.seq_dict), phy_handler.read())
+        self.assertEqual(self.seq_dict, read_phylip_to_dict(phy_file))
+
+    def test_write_fasta(self):
+        fasta_file = self.output_dir + "McrA.fa"
+        self.msa.write_fasta(fasta_file)
+        self.assertEqual(self.seq_dict, read_fasta_to_dict(fasta_file))
+
+
+if __name__ == "__main__":
+    unittest.main()
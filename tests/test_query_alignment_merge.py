@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from treesapp.assign import merge_query_alignment, load_reference_matrix
+from treesapp.file_parsers import read_hmm_alignment_map, read_stockholm_to_dict
+
+__author__ = 'Connor Morgan-Lang'
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + os.sep
+data_dir = repo_dir + "treesapp" + os.sep + "data" + os.sep
+
+# A profile with four match states, built from columns 1, 2, 4 and 6 of the reference alignment
+column_map = [1, 2, 4, 6]
+ref_matrix = {"1": "MK-VLA",
+              "2": "MKAV-A",
+              "3": "-RGVIS"}
+# Query sequences aligned to the profile alone by hmmalign, with insertions in lower-case and '.'
+query_sto = "# STOCKHOLM 1.0\n\n" \
+            "a|McrA|1_6  MK.V.A\n" \
+            "b|McrA|1_8  MKgVqA\n" \
+            "c|McrA|2_5  -K.-.S\n" \
+            "#=GC RF     xx.x.x\n" \
+            "//\n"
+
+
+class QueryAlignmentMergeTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+        self.query_sto = self.output_dir + "McrA_queries.sto"
+        with open(self.query_sto, 'w') as sto_handler:
+            sto_handler.write(query_sto)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_match_states_only(self):
+        self.assertEqual({"a|McrA|1_6": "MKVA", "b|McrA|1_8": "MKVA", "c|McrA|2_5": "-K-S"},
+                         read_stockholm_to_dict(self.query_sto, match_states_only=True))
+        self.assertEqual("MKGVQA", read_stockholm_to_dict(self.query_sto)["b|McrA|1_8"])
+
+    def test_merge_into_reference_columns(self):
+        merged = merge_query_alignment(self.query_sto, ref_matrix, column_map)
+        # Residues of the match states are placed in their columns and the columns of insert states are gaps
+        self.assertEqual({"1": "MK-VLA",
+                          "2": "MKAV-A",
+                          "3": "-RGVIS",
+                          "a|McrA|1": "MK-V-A",
+                          "b|McrA|1": "MK-V-A",
+                          "c|McrA|2": "-K---S"},
+                         merged)
+        # The cached reference alignment is not modified
+        self.assertEqual({"1": "MK-VLA", "2": "MKAV-A", "3": "-RGVIS"}, ref_matrix)
+
+    def test_match_states_not_equal_to_profile(self):
+        with self.assertRaises(SystemExit):
+            merge_query_alignment(self.query_sto, ref_matrix, column_map[:3])
+
+    def test_reference_package_map(self):
+        hmm_file = data_dir + "hmm_data" + os.sep + "McrA.hmm"
+        with open(hmm_file) as hmm_handler:
+            profile_length = [int(line.split()[1]) for line in hmm_handler if line.startswith("LENG")][0]
+        self.assertEqual(profile_length, len(read_hmm_alignment_map(hmm_file)))
+
+        ref_seqs, ref_column_map = load_reference_matrix(data_dir + "alignment_data" + os.sep + "McrA.fa", hmm_file)
+        self.assertEqual(profile_length, len(ref_column_map))
+        self.assertEqual(sorted(set(ref_column_map)), ref_column_map)
+        self.assertLessEqual(ref_column_map[-1], len(next(iter(ref_seqs.values()))))
+
+
+if __name__ == "__main__":
+    unittest.main()
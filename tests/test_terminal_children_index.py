@@ -0,0 +1,107 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from ete3 import Tree
+
+from treesapp.assign import read_the_raxml_out_tree, build_terminal_children_strings_of_assignments
+from treesapp.entish import TerminalChildrenIndex
+
+__author__ = 'Connor Morgan-Lang'
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + os.sep
+tree_data_dir = repo_dir + "treesapp" + os.sep + "data" + os.sep + "tree_data" + os.sep
+
+
+def write_labelled_tree(tree: Tree, labelled_tree_file: str):
+    """
+    Writes a tree in the format of RAxML's originalLabelledTree: an unrooted tree with numerical leaf names,
+    branch lengths and every edge labelled with its number in square brackets, e.g. 12:0.1[I3]
+    """
+    tree.unroot()
+    edge_num = 0
+    labelled_nodes = dict()
+    for node in tree.traverse("postorder"):
+        if node.is_leaf():
+            newick = node.name.split('_')[0]
+        else:
+            newick = '(' + ','.join([labelled_nodes.pop(child) for child in node.children]) + ')'
+        if node.is_root():
+            with open(labelled_tree_file, 'w') as labelled_tree:
+                labelled_tree.write(newick + ";\n")
+            break
+        labelled_nodes[node] = newick + ':' + "%f" % node.dist + "[I" + str(edge_num) + ']'
+        edge_num += 1
+    return
+
+
+def rerooted_terminal_children(tree_string: str):
+    """
+    Finds the leaves each node subtends in every tree formed by rooting tree_string on one of its edges,
+    by re-rooting the tree on each edge with ete3.
+
+    :return: Dictionary of the sets of terminal children strings of each node, indexed by the node's integer label
+    """
+    tree = Tree(tree_string, format=8)
+    terminal_children = {int(node.name): set() for node in tree.iter_descendants()}
+    for outgroup in tree.iter_descendants():
+        rooted_tree = tree.copy()
+        rooted_tree.set_outgroup(rooted_tree.search_nodes(name=outgroup.name)[0])
+        for node in rooted_tree.traverse():
+            if not node.name:
+                continue
+            leaves = sorted([int(leaf) for leaf in node.get_leaf_names()])
+            terminal_children[int(node.name)].add(''.join([str(leaf) + ' ' for leaf in leaves]))
+    return terminal_children
+
+
+class TerminalChildrenIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp() + os.sep
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def compare_to_rerooting(self, labelled_tree_file: str):
+        tree_string, insertion_point_node_hash = read_the_raxml_out_tree(labelled_tree_file)
+        tree_index = TerminalChildrenIndex(tree_string)
+        self.assertFalse(tree_index.malformed)
+        expected = rerooted_terminal_children(tree_string)
+        for node_key in expected:
+            terminal_children_strings = tree_index.terminal_children_strings(node_key)
+            self.assertEqual(len(set(terminal_children_strings)), len(terminal_children_strings))
+            self.assertEqual(expected[node_key], set(terminal_children_strings), "Node " + str(node_key) + " differs")
+
+        assignments = {edge: 1 for edge in insertion_point_node_hash}
+        terminal_children_of_assignments = build_terminal_children_strings_of_assignments(tree_index,
+                                                                                          insertion_point_node_hash,
+                                                                                          assignments)
+        for edge in assignments:
+            self.assertEqual(expected[int(insertion_point_node_hash[edge])],
+                             set(terminal_children_of_assignments[edge].keys()))
+
+    def test_small_tree(self):
+        labelled_tree_file = self.output_dir + "small_labelledTree.txt"
+        with open(labelled_tree_file, 'w') as labelled_tree:
+            labelled_tree.write("(1:0.1[I0],2:0.2[I1],((3:0.1[I2],5:0.1[I3]):0.2[I4],4:0.1[I5]):0.2[I6]);\n")
+        self.compare_to_rerooting(labelled_tree_file)
+
+    def test_reference_trees(self):
+        random.seed(5)
+        for refpkg_name in ["McrA", "DsrAB"]:
+            tree = Tree(tree_data_dir + refpkg_name + "_tree.txt")
+            # Every rooting is built with ete3 so the trees are pruned to keep the test quick
+            tree.prune(random.sample(tree.get_leaf_names(), 40))
+            labelled_tree_file = self.output_dir + refpkg_name + "_labelledTree.txt"
+            write_labelled_tree(tree, labelled_tree_file)
+            self.compare_to_rerooting(labelled_tree_file)
+
+    def test_malformed_tree(self):
+        self.assertTrue(TerminalChildrenIndex("((1,2)-2,(3,4)-3").malformed)
+        self.assertTrue(TerminalChildrenIndex("(1,2)-2)-3").malformed)
+        self.assertEqual([], TerminalChildrenIndex("((1,2)-2,(3,4)-3);").terminal_children_strings(-9))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import random
+import unittest
+import numpy as np
+from ete3 import Tree
+
+from treesapp.entish import TreeDistanceIndex
+from treesapp.phylo_dist import parent_to_tip_distances
+
+__author__ = 'Connor Morgan-Lang'
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + os.sep
+tree_data_dir = repo_dir + "treesapp" + os.sep + "data" + os.sep + "tree_data" + os.sep
+
+
+def ete3_mean_tip_distance(tree: Tree, leaf_children: list):
+    """
+    The mean tip distance as filter_placements calculated it with ete3 before TreeDistanceIndex
+    """
+    parent = tree.get_common_ancestor(leaf_children)
+    tip_distances = parent_to_tip_distances(parent, leaf_children)
+    return sum(tip_distances) / len(tip_distances)
+
+
+class TreeDistanceIndexTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(7)
+        self.trees = {refpkg_name: Tree(tree_data_dir + refpkg_name + "_tree.txt")
+                      for refpkg_name in ["McrA", "DsrAB", "NxrA"]}
+
+    def test_clade_tip_distances(self):
+        for refpkg_name, tree in self.trees.items():
+            tree_index = TreeDistanceIndex(tree)
+            internal_nodes = [node for node in tree.traverse("preorder") if not node.is_leaf()]
+            for node in [internal_nodes[0]] + random.sample(internal_nodes, min(50, len(internal_nodes))):
+                leaf_children = node.get_leaf_names()
+                self.assertAlmostEqual(ete3_mean_tip_distance(tree, leaf_children),
+                                       tree_index.mean_tip_distance(leaf_children), places=9,
+                                       msg=refpkg_name + " clade of " + ','.join(leaf_children[:3]))
+
+    def test_leaf_subset_tip_distances(self):
+        for refpkg_name, tree in self.trees.items():
+            tree_index = TreeDistanceIndex(tree)
+            leaf_names = tree.get_leaf_names()
+            for _ in range(100):
+                leaf_children = random.sample(leaf_names, random.randint(2, min(12, len(leaf_names))))
+                self.assertAlmostEqual(ete3_mean_tip_distance(tree, leaf_children),
+                                       tree_index.mean_tip_distance(leaf_children), places=9,
+                                       msg=refpkg_name + " leaves " + ','.join(leaf_children))
+
+    def test_lowest_common_ancestors(self):
+        for refpkg_name, tree in self.trees.items():
+            tree_index = TreeDistanceIndex(tree)
+            nodes = list(tree.traverse("preorder"))
+            for _ in range(100):
+                # ete3 returns the root as the common ancestor of a single node
+                node_ids = random.sample(range(len(nodes)), random.randint(2, 5))
+                ancestor = tree.get_common_ancestor([nodes[i] for i in node_ids])
+                self.assertIs(ancestor, nodes[tree_index.lca(np.array(node_ids))])
+
+    def test_single_leaf(self):
+        tree = self.trees["McrA"]
+        tree_index = TreeDistanceIndex(tree)
+        leaf_name = tree.get_leaf_names()[0]
+        self.assertEqual(0.0, tree_index.mean_tip_distance([leaf_name]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import random
+import unittest
+import _tree_parser
+
+from treesapp.entish import load_reference_tree_elements, load_reference_tree_handle
+
+__author__ = 'Connor Morgan-Lang'
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + os.sep
+tree_data_dir = repo_dir + "treesapp" + os.sep + "data" + os.sep + "tree_data" + os.sep
+
+
+def random_tree_elements(num_leaves: int):
+    """
+    Builds a random bifurcating tree in the format of _tree_parser._read_the_reference_tree, where leaves are
+    positive integers and the internal nodes are labelled with negative integers in post-order.
+    """
+    subtrees = [str(leaf) for leaf in range(1, num_leaves + 1)]
+    random.shuffle(subtrees)
+    internal_node = -2
+    while len(subtrees) > 2:
+        left = subtrees.pop(random.randrange(len(subtrees)))
+        right = subtrees.pop(random.randrange(len(subtrees)))
+        subtrees.append('(' + left + ',' + right + ')' + str(internal_node))
+        internal_node -= 1
+    return '(' + ','.join(subtrees) + ")-1;"
+
+
+class LowestCommonAncestorsTest(unittest.TestCase):
+    def compare_to_lca_helper(self, tree_elements, handle, node_sets):
+        ancestors = _tree_parser._lowest_common_ancestors(handle, node_sets)
+        self.assertEqual(len(node_sets), len(ancestors))
+        for node_set, ancestor in zip(node_sets, ancestors):
+            self.assertEqual(_tree_parser._lowest_common_ancestor(tree_elements, ','.join(node_set)), ancestor,
+                             "LCA of " + ','.join(node_set) + " differs in " + tree_elements)
+
+    def test_random_trees(self):
+        random.seed(11)
+        for num_leaves in [2, 3, 5, 20, 100]:
+            tree_elements = random_tree_elements(num_leaves)
+            handle = _tree_parser._load_tree_handle(tree_elements)
+            leaves = [str(leaf) for leaf in range(1, num_leaves + 1)]
+            node_sets = [random.sample(leaves, random.randint(1, min(6, num_leaves))) for _ in range(200)]
+            self.compare_to_lca_helper(tree_elements, handle, node_sets)
+
+    def test_absent_nodes(self):
+        tree_elements = "(((1,2)-2,3)-3,(4,5)-4)-1;"
+        handle = _tree_parser._load_tree_handle(tree_elements)
+        self.compare_to_lca_helper(tree_elements, handle, [["6"], ["1", "6"], ["4", "5"], ["2", "3"]])
+
+    def test_integer_node_names(self):
+        tree_elements = "(((1,2)-2,3)-3,(4,5)-4)-1;"
+        handle = _tree_parser._load_tree_handle(tree_elements)
+        self.assertEqual(_tree_parser._lowest_common_ancestors(handle, [["1", "4"]]),
+                         _tree_parser._lowest_common_ancestors(handle, [[1, 4]]))
+
+    def test_reference_trees(self):
+        random.seed(13)
+        for refpkg_name in ["McrA", "DsrAB"]:
+            tree_file = tree_data_dir + refpkg_name + "_tree.txt"
+            tree_elements = load_reference_tree_elements(tree_file)
+            handle = load_reference_tree_handle(tree_file)
+            self.assertIs(handle, load_reference_tree_handle(tree_file))
+            leaves = [leaf for leaf in tree_elements.replace('(', ',').replace(')', ',').split(',')
+                      if leaf.isdigit()]
+            node_sets = [random.sample(leaves, random.randint(1, 4)) for _ in range(50)]
+            self.compare_to_lca_helper(tree_elements, handle, node_sets)
+
+
+if __name__ == "__main__":
+    unittest.main()
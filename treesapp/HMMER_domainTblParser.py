@@ -4,6 +4,7 @@ import sys
 import re
 import argparse
 import logging
+from copy import copy
 
 
 def get_options():
@@ -68,6 +69,69 @@ def format_hmmer_domtbl_line(line):
     return stats
 
 
+def merge_domain_tables(shard_domtbls: list, merged_domtbl: str, dom_e=10.0):
+    """
+    Merges the domain tables written by hmmsearch for shards of a query FASTA file into a single domain table,
+    equivalent to that written by a single hmmsearch process over the whole file.
+
+    Each shard must have been searched with '-Z <number of sequences in the whole file>' so the full-sequence
+    and independent (i-Evalue) E-values are already correct, and with '--domZ 1' so the conditional E-value column
+    holds the domain's P-value. hmmsearch sets domZ to the number of target sequences that are reported,
+    so the conditional E-values are scaled here by the number of targets reported across all shards and only
+    the domains that then satisfy the domain reporting threshold (dom_e) are kept.
+
+    :param shard_domtbls: List of paths to the domain tables of each shard, in order
+    :param merged_domtbl: Path to write the merged domain table
+    :param dom_e: The domain reporting threshold used by hmmsearch (--domE)
+    :return: None
+    """
+    header = ""
+    footer = ""
+    query_hits = dict()  # Lists of (target, fields) tuples indexed by the query (HMM) name
+    for domtbl in shard_domtbls:
+        try:
+            domtbl_handler = open(domtbl)
+        except IOError:
+            logging.error("Unable to open domain table '" + domtbl + "' for reading.\n")
+            sys.exit(3)
+        comments = list()
+        for line in domtbl_handler:
+            if line[0] == '#':
+                comments.append(line)
+            else:
+                fields = line.rstrip("\n").split(None, 22)
+                if fields[3] not in query_hits:
+                    query_hits[fields[3]] = list()
+                query_hits[fields[3]].append(fields)
+        domtbl_handler.close()
+        # The first three comment lines are the column headers and the remainder are the run summary
+        if not header:
+            header = ''.join(comments[:3])
+            footer = ''.join(comments[3:])
+
+    merged_lines = ""
+    for query_name in sorted(query_hits):
+        # Targets are reported by hmmsearch in order of their full-sequence E-value and score
+        target_domains = dict()
+        for fields in query_hits[query_name]:
+            if fields[0] not in target_domains:
+                target_domains[fields[0]] = list()
+            target_domains[fields[0]].append(fields)
+        dom_z = len(target_domains)
+        for target in sorted(target_domains,
+                             key=lambda t: (float(target_domains[t][0][6]), -float(target_domains[t][0][7]), t)):
+            for fields in target_domains[target]:
+                c_evalue = float(fields[11]) * dom_z
+                if c_evalue > dom_e:
+                    continue
+                fields[11] = "%.2g" % c_evalue
+                merged_lines += ' '.join(fields) + "\n"
+
+    with open(merged_domtbl, 'w') as merged_handler:
+        merged_handler.write(header + merged_lines + footer)
+    return
+
+
 class HmmSearchStats:
     def __init__(self):
         self.raw_alignments = 0
@@ -355,6 +419,7 @@ class DomainTableParser(object):
         self.i = 0
         self.lines = []
         self.size = 0
+        self.program = "hmmsearch"
         try:
             self.commentPattern = re.compile(r'^#')
             self.src = open(dom_tbl)
@@ -376,6 +441,8 @@ class DomainTableParser(object):
             comment = self.commentPattern.match(line)
             if not comment:
                 self.lines.append(line.strip())
+            elif line.startswith("# Program:"):
+                self.program = line.split()[-1]
             if not line:
                 break
             line = self.src.readline()
@@ -400,7 +467,38 @@ class DomainTableParser(object):
             self.src.close()
             return None
 
+    def demultiplex(self):
+        """
+        Splits the domain table lines by the HMM profile that was aligned to.
+        This is necessary for domain tables written by searching a database of multiple HMM profiles,
+        where the lines of a single query sequence may interleave with those of different profiles.
+
+        :return: Dictionary of DomainTableParser instances, each with the lines of a single HMM, indexed by HMM name
+        """
+        hmm_pos = 0 if self.program == "hmmscan" else 3
+        hmm_lines = dict()
+        for line in self.lines:
+            hmm_name = format_hmmer_domtbl_line(line)[hmm_pos]
+            if hmm_name not in hmm_lines:
+                hmm_lines[hmm_name] = list()
+            hmm_lines[hmm_name].append(line)
+        self.src.close()
+
+        demultiplexed_tables = dict()
+        for hmm_name in sorted(hmm_lines):
+            hmm_table = copy(self)
+            hmm_table.alignments = {}
+            hmm_table.i = 0
+            hmm_table.lines = hmm_lines[hmm_name]
+            hmm_table.size = len(hmm_table.lines)
+            demultiplexed_tables[hmm_name] = hmm_table
+        return demultiplexed_tables
+
     def prepare_data(self, hit):
+        # The target and query columns are swapped in domain tables written by hmmscan
+        if self.program == "hmmscan":
+            hit[0], hit[3] = hit[3], hit[0]
+            hit[2], hit[5] = hit[5], hit[2]
         self.alignments['query'] = str(hit[0])
         self.alignments['query_len'] = int(hit[2])
         self.alignments['hmm_name'] = str(hit[3])
@@ -0,0 +1,250 @@
+__author__ = 'Connor Morgan-Lang'
+
+import numpy as np
+
+from .msa import MultipleSequenceAlignment
+from .file_parsers import read_multiple_alignment
+
+# Name of the in-process trimming engine, used like 'BMGE' and 'trimAl' to select it and to name trimmed MSA files
+ENGINE_NAME = "BMGEpy"
+
+AMINO_ACIDS = "ARNDCQEGHILKMFPSTWYV"
+# The nucleotides are ordered so transitions (A <-> G and C <-> T) are between indices 0 and 1, and 2 and 3
+NUCLEOTIDES = "AGCT"
+# The characters of each alphabet recognized by BMGE. All others are replaced by an 'X'
+AMINO_ACID_ALPHABET = AMINO_ACIDS + "X?-"
+NUCLEOTIDE_ALPHABET = NUCLEOTIDES + "UMRWSYKBDHVNX?-"
+# The fraction of a character assigned to each nucleotide, for the ambiguity codes
+NUCLEOTIDE_CODES = {'U': "T", 'M': "AC", 'R': "AG", 'W': "AT", 'S': "CG", 'Y': "CT", 'K': "GT",
+                    'B': "CGT", 'D': "AGT", 'H': "ACT", 'V': "ACG", 'N': "AGCT", 'X': "AGCT"}
+
+# BLOSUM30 as the joint probabilities of each pair of amino acids (ordered by AMINO_ACIDS), as distributed with BMGE
+BLOSUM30 = np.array([
+    [0.0096, 0.0038, 0.0031, 0.0043, 0.0014, 0.0031, 0.0044, 0.0052, 0.0016, 0.0040,
+     0.0056, 0.0044, 0.0018, 0.0027, 0.0028, 0.0056, 0.0040, 0.0005, 0.0014, 0.0056],
+    [0.0038, 0.0109, 0.0019, 0.0026, 0.0011, 0.0031, 0.0031, 0.0032, 0.0014, 0.0022,
+     0.0039, 0.0043, 0.0012, 0.0023, 0.0021, 0.0035, 0.0019, 0.0007, 0.0022, 0.0031],
+    [0.0031, 0.0019, 0.0055, 0.0027, 0.0010, 0.0014, 0.0024, 0.0032, 0.0011, 0.0024,
+     0.0032, 0.0027, 0.0009, 0.0017, 0.0012, 0.0028, 0.0024, 0.0002, 0.0008, 0.0022],
+    [0.0043, 0.0026, 0.0027, 0.0095, 0.0010, 0.0018, 0.0037, 0.0035, 0.0011, 0.0018,
+     0.0043, 0.0032, 0.0008, 0.0011, 0.0021, 0.0034, 0.0024, 0.0004, 0.0015, 0.0027],
+    [0.0014, 0.0011, 0.0010, 0.0010, 0.0070, 0.0007, 0.0018, 0.0011, 0.0004, 0.0012,
+     0.0023, 0.0010, 0.0004, 0.0008, 0.0007, 0.0013, 0.0009, 0.0003, 0.0004, 0.0012],
+    [0.0031, 0.0031, 0.0014, 0.0018, 0.0007, 0.0039, 0.0028, 0.0020, 0.0010, 0.0016,
+     0.0027, 0.0021, 0.0007, 0.0010, 0.0015, 0.0021, 0.0016, 0.0004, 0.0011, 0.0015],
+    [0.0044, 0.0031, 0.0024, 0.0037, 0.0018, 0.0028, 0.0094, 0.0035, 0.0018, 0.0023,
+     0.0051, 0.0053, 0.0012, 0.0016, 0.0030, 0.0038, 0.0023, 0.0007, 0.0016, 0.0026],
+    [0.0052, 0.0032, 0.0032, 0.0035, 0.0011, 0.0020, 0.0035, 0.0173, 0.0015, 0.0036,
+     0.0051, 0.0039, 0.0013, 0.0022, 0.0030, 0.0051, 0.0028, 0.0011, 0.0016, 0.0033],
+    [0.0016, 0.0014, 0.0011, 0.0011, 0.0004, 0.0010, 0.0018, 0.0015, 0.0060, 0.0012,
+     0.0022, 0.0013, 0.0008, 0.0008, 0.0014, 0.0017, 0.0010, 0.0002, 0.0010, 0.0012],
+    [0.0040, 0.0022, 0.0024, 0.0018, 0.0012, 0.0016, 0.0023, 0.0036, 0.0012, 0.0072,
+     0.0066, 0.0026, 0.0014, 0.0027, 0.0017, 0.0033, 0.0027, 0.0005, 0.0018, 0.0063],
+    [0.0056, 0.0039, 0.0032, 0.0043, 0.0023, 0.0027, 0.0051, 0.0051, 0.0022, 0.0066,
+     0.0139, 0.0044, 0.0027, 0.0055, 0.0027, 0.0047, 0.0046, 0.0009, 0.0045, 0.0074],
+    [0.0044, 0.0043, 0.0027, 0.0032, 0.0010, 0.0021, 0.0053, 0.0039, 0.0013, 0.0026,
+     0.0044, 0.0063, 0.0017, 0.0023, 0.0029, 0.0042, 0.0025, 0.0006, 0.0017, 0.0030],
+    [0.0018, 0.0012, 0.0009, 0.0008, 0.0004, 0.0007, 0.0012, 0.0013, 0.0008, 0.0014,
+     0.0027, 0.0017, 0.0012, 0.0008, 0.0005, 0.0010, 0.0010, 0.0002, 0.0007, 0.0015],
+    [0.0027, 0.0023, 0.0017, 0.0011, 0.0008, 0.0010, 0.0016, 0.0022, 0.0008, 0.0027,
+     0.0055, 0.0023, 0.0008, 0.0077, 0.0011, 0.0027, 0.0016, 0.0007, 0.0024, 0.0032],
+    [0.0028, 0.0021, 0.0012, 0.0021, 0.0007, 0.0015, 0.0030, 0.0030, 0.0014, 0.0017,
+     0.0027, 0.0029, 0.0005, 0.0011, 0.0091, 0.0024, 0.0020, 0.0004, 0.0011, 0.0017],
+    [0.0056, 0.0035, 0.0028, 0.0034, 0.0013, 0.0021, 0.0038, 0.0051, 0.0017, 0.0033,
+     0.0047, 0.0042, 0.0010, 0.0027, 0.0024, 0.0075, 0.0041, 0.0005, 0.0017, 0.0036],
+    [0.0040, 0.0019, 0.0024, 0.0024, 0.0009, 0.0016, 0.0023, 0.0028, 0.0010, 0.0027,
+     0.0046, 0.0025, 0.0010, 0.0016, 0.0020, 0.0041, 0.0046, 0.0003, 0.0014, 0.0036],
+    [0.0005, 0.0007, 0.0002, 0.0004, 0.0003, 0.0004, 0.0007, 0.0011, 0.0002, 0.0005,
+     0.0009, 0.0006, 0.0002, 0.0007, 0.0004, 0.0005, 0.0003, 0.0027, 0.0009, 0.0005],
+    [0.0014, 0.0022, 0.0008, 0.0015, 0.0004, 0.0011, 0.0016, 0.0016, 0.0010, 0.0018,
+     0.0045, 0.0017, 0.0007, 0.0024, 0.0011, 0.0017, 0.0014, 0.0009, 0.0044, 0.0024],
+    [0.0056, 0.0031, 0.0022, 0.0027, 0.0012, 0.0015, 0.0026, 0.0033, 0.0012, 0.0063,
+     0.0074, 0.0030, 0.0015, 0.0032, 0.0017, 0.0036, 0.0036, 0.0005, 0.0024, 0.0083]])
+
+
+def dna_pam(distance=100, ts_tv_ratio=2.0):
+    """
+    :param distance: The number of PAM units of evolution
+    :param ts_tv_ratio: The transition/transversion ratio
+    :return: The 4x4 DNAPAM matrix of the nucleotides (ordered by NUCLEOTIDES) used by BMGE
+    """
+    pam1 = np.full((4, 4), 1 / (200 + 100 * ts_tv_ratio))
+    pam1[0, 1] = pam1[1, 0] = pam1[2, 3] = pam1[3, 2] = ts_tv_ratio / (200 + 100 * ts_tv_ratio)
+    np.fill_diagonal(pam1, 0.99)
+    return np.linalg.matrix_power(pam1, distance)
+
+
+def character_weights(molecule: str):
+    """
+    Creates a lookup table of the contribution of every (byte) character to the frequency of each residue in a column.
+    Gap and '?' characters do not contribute to the frequencies.
+
+    :param molecule: prot | dna | rrna
+    :return: A (256 x alphabet size) numpy array
+    """
+    if molecule == "prot":
+        weights = np.zeros((256, len(AMINO_ACIDS)))
+        for i, residue in enumerate(AMINO_ACIDS):
+            weights[ord(residue), i] = 1
+        weights[ord('X')] = 0.05
+    else:
+        weights = np.zeros((256, len(NUCLEOTIDES)))
+        for i, residue in enumerate(NUCLEOTIDES):
+            weights[ord(residue), i] = 1
+        for code, residues in NUCLEOTIDE_CODES.items():
+            for residue in residues:
+                weights[ord(code), NUCLEOTIDES.index(residue)] = 1 / len(residues)
+    return weights
+
+
+def filter_characters(matrix: np.ndarray, molecule: str):
+    """
+    Converts all characters to upper-case and replaces those that are not in the molecule's alphabet with 'X'
+
+    :return: A new uint8 matrix
+    """
+    alphabet = AMINO_ACID_ALPHABET if molecule == "prot" else NUCLEOTIDE_ALPHABET
+    table = np.full(256, ord('X'), dtype=np.uint8)
+    for char in alphabet:
+        table[ord(char)] = table[ord(char.lower())] = ord(char)
+    return table[matrix]
+
+
+def column_entropies(matrix: np.ndarray, gap_rates: np.ndarray, weights: np.ndarray, similarity: np.ndarray):
+    """
+    Calculates the von Neumann entropy of each column of the alignment, weighted by the similarity of the residues
+    (Criscuolo and Gribaldo 2010). Columns with fewer than two residues have an entropy of zero.
+
+    :param matrix: A uint8 matrix of the aligned characters
+    :param gap_rates: The proportion of gaps in each column
+    :param weights: Lookup table of the contribution of each character to the residue frequencies
+    :param similarity: The residue similarity matrix
+    :return: A numpy array of the entropy of each column
+    """
+    n_rows, n_cols = matrix.shape
+    entropies = np.zeros(n_cols)
+    # Count the occurrences of each character in each column
+    codes = matrix.astype(np.int64) + 256 * np.arange(n_cols, dtype=np.int64)
+    char_counts = np.bincount(codes.ravel(), minlength=256 * n_cols).reshape((n_cols, 256))
+    frequencies = char_counts @ weights
+    totals = char_counts @ (weights.sum(axis=1) > 0)
+    columns = np.nonzero((gap_rates < (n_rows - 1) / n_rows) & (totals > 0))[0]
+    if len(columns) == 0:
+        return entropies
+
+    # diag(f).S has the same eigenvalues as the symmetric sqrt(f).S.sqrt(f)
+    root_f = np.sqrt(frequencies[columns] / totals[columns, None])
+    densities = root_f[:, :, None] * similarity[None, :, :] * root_f[:, None, :]
+    densities /= np.trace(densities, axis1=1, axis2=2)[:, None, None]
+    eigenvalues = np.linalg.eigvalsh(densities)
+    eigenvalues[np.abs(eigenvalues) < 1E-10] = 0
+    eigenvalues = np.clip(eigenvalues, 0, None)
+    logs = np.log(eigenvalues, out=np.zeros_like(eigenvalues), where=eigenvalues > 0)
+    entropies[columns] = -1 * np.sum(eigenvalues * logs, axis=1) / np.log(similarity.shape[0])
+    return entropies
+
+
+def smooth_entropies(entropies: np.ndarray, gap_rates: np.ndarray, window=3):
+    """
+    Averages the entropy of each column with those of its neighbours, weighting each by its proportion of residues.
+
+    :param window: The width of the sliding window
+    :return: A numpy array of the smoothed entropies
+    """
+    kernel = np.ones(2 * (window // 2) + 1)
+    residue_rates = 1 - gap_rates
+    numerator = np.convolve(residue_rates * entropies, kernel, mode="same")
+    denominator = np.convolve(residue_rates, kernel, mode="same")
+    denominator[denominator == 0] = 1E-5
+    return numerator / denominator
+
+
+def remove_short_blocks(keep: np.ndarray, min_block: int):
+    """
+    Unsets the columns in blocks of consecutive selected columns shorter than min_block.
+    As in BMGE, the last column of the alignment is never removed by this step.
+
+    :param keep: A boolean numpy array of the columns that are selected. It is modified in place.
+    :param min_block: The minimum number of consecutive columns in a block
+    :return: None
+    """
+    if len(keep) == 0:
+        return
+    last_column = keep[-1]
+    boundaries = np.diff(np.concatenate(([0], keep.astype(np.int8), [0])))
+    starts = np.nonzero(boundaries == 1)[0]
+    ends = np.nonzero(boundaries == -1)[0]
+    for start, end in zip(starts, ends):
+        if end - start < min_block:
+            keep[start:end] = False
+    keep[-1] = last_column
+    return
+
+
+def bmge_trim(msa: MultipleSequenceAlignment, molecule: str, row_gap=0.99, col_gap=0.33,
+              h_max=0.5, h_min=0.0, window=3, min_block=5):
+    """
+    Trims a multiple sequence alignment in the same manner as BMGE (Block Mapping and Gathering with Entropy).
+    Columns with a high (smoothed) entropy or too many gaps are removed, followed by sequences that are composed of
+    too many gaps after column removal. The columns are then re-evaluated with the remaining sequences, until no more
+    sequences are removed.
+
+    :param msa: A MultipleSequenceAlignment instance to be trimmed
+    :param molecule: prot | dna | rrna. Amino acid alignments are evaluated with BLOSUM30, nucleotides with DNAPAM100:2
+    :param row_gap: Sequences with a proportion of gaps equal to or greater than this are removed
+    :param col_gap: Columns with a proportion of gaps greater than this are removed
+    :param h_max: Columns with a smoothed entropy equal to or greater than this are removed
+    :param h_min: Columns with a smoothed entropy equal to or less than this are removed, if greater than zero
+    :param window: Width of the sliding window used for smoothing the entropies
+    :param min_block: Minimum number of consecutive columns that are retained
+    :return: A new MultipleSequenceAlignment with the selected rows and columns and characters converted as by BMGE
+    """
+    similarity = BLOSUM30 if molecule == "prot" else dna_pam(100, 2)
+    weights = character_weights(molecule)
+    matrix = filter_characters(msa.matrix, molecule)
+    n_rows, n_cols = matrix.shape
+    rows = np.arange(n_rows)
+    keep = np.zeros(n_cols, dtype=bool)
+    gap_char = ord('-')
+
+    while len(rows) > 0 and n_cols > 0:
+        sub_matrix = matrix[rows]
+        gaps = sub_matrix == gap_char
+        gap_rates = gaps.mean(axis=0)
+        entropies = column_entropies(sub_matrix, gap_rates, weights, similarity)
+        if window > 1 and h_max < 1:
+            entropies = smooth_entropies(entropies, gap_rates, window)
+
+        keep = (entropies < h_max) & (gap_rates <= col_gap)
+        if min_block > 0:
+            remove_short_blocks(keep, min_block)
+        if h_min > 0:
+            keep &= entropies > h_min
+
+        # Proportion of each sequence that is gaps after the unselected columns are masked
+        row_gap_rates = (np.count_nonzero(gaps[:, keep], axis=1) + n_cols - np.count_nonzero(keep)) / n_cols
+        retained = row_gap_rates < row_gap
+        if retained.all():
+            break
+        rows = rows[retained]
+
+    return MultipleSequenceAlignment([msa.names[row] for row in rows], matrix[rows][:, keep], msa.file)
+
+
+def trim_alignment_file(mfa_file: str, trimmed_msa_file: str, molecule: str, msa_objects=None):
+    """
+    Trims a multiple sequence alignment file with bmge_trim and writes the trimmed alignment in FASTA format.
+
+    :param mfa_file: Path to a FASTA or Phylip multiple sequence alignment file
+    :param trimmed_msa_file: Path to write the trimmed alignment to
+    :param molecule: prot | dna | rrna
+    :param msa_objects: Optional dictionary of MultipleSequenceAlignment instances indexed by file path. The untrimmed
+     alignment is read from it if present, and the trimmed alignment is added to it.
+    :return: The trimmed MultipleSequenceAlignment
+    """
+    trimmed_msa = bmge_trim(read_multiple_alignment(mfa_file, msa_objects=msa_objects), molecule)
+    trimmed_msa.file = trimmed_msa_file
+    trimmed_msa.write_fasta(trimmed_msa_file)
+    if msa_objects is not None:
+        msa_objects[trimmed_msa_file] = trimmed_msa
+    return trimmed_msa
@@ -14,9 +14,13 @@ try:
     import re
     import glob
     import time
+    import pickle
+    import itertools
     import traceback
     import subprocess
     import logging
+    import numpy as np
+    from copy import copy
     from ete3 import Tree
     from multiprocessing import Pool, Process, Lock, Queue, JoinableQueue
     from os import path
@@ -25,18 +29,24 @@ try:
     from time import gmtime, strftime
 
     from .treesapp_args import TreeSAPPArgumentParser
-    from .classy import CommandLineWorker, CommandLineFarmer, ItolJplace, NodeRetrieverWorker,\
-        TreeLeafReference, TreeProtein, MarkerBuild
-    from .fasta import format_read_fasta, get_headers, write_new_fasta, read_fasta_to_dict, FASTA
+    from .classy import ItolJplace, TreeLeafReference, TreeProtein, MarkerBuild, JPlacePQuery
+    from .fasta import format_read_fasta, get_headers, write_new_fasta, read_fasta_to_dict, FASTA,\
+        register_headers, generate_fasta_chunks, merge_prodigal_orfs, count_fasta_records
     from .entish import create_tree_info_hash, deconvolute_assignments, read_and_understand_the_reference_tree,\
-        get_node, annotate_partition_tree, find_cluster, tree_leaf_distances, index_tree_edges
-    from .external_command_interface import launch_write_command, setup_progress_bar
+        get_node, annotate_partition_tree, find_cluster, tree_leaf_distances, index_tree_edges,\
+        index_jplace_tree, TreeDistanceIndex, TerminalChildrenIndex
+    from .external_command_interface import setup_progress_bar, JobExecutor
     from .lca_calculations import *
     from .jplace_utils import *
     from .file_parsers import *
     from .phylo_dist import *
     from . import utilities
     from . import wrapper
+    from .refpkg_cache import load_cached
+    from .msa import MultipleSequenceAlignment
+    from .alignment_trimming import ENGINE_NAME, trim_alignment_file
+    from .taxonomy_store import TaxonomyStore
+    from .profiling import format_elapsed_time
 
     import _tree_parser
     import _fasta_reader
@@ -87,6 +97,169 @@ def replace_contig_names(numeric_contig_index: dict, fasta: FASTA):
     return numeric_contig_index
 
 
+def load_reference_data(ts_assign, args):
+    """
+    Loads the reference package data used by assign that is independent of the query sequences, so it can be shared
+    by multiple samples: the MarkerBuild instances, reference alignment dimensions and the tree leaf-taxonomy maps.
+    The ete3 Tree instances of the reference packages are loaded on demand by filter_placements and cached in 'trees'.
+
+    :param ts_assign: An Assigner instance, with its target_refpkgs set by check_classify_arguments
+    :param args: The parsed command-line arguments for assign
+    :return: Dictionary of the reference package data
+    """
+    ref_data = dict()
+    ref_data["marker_build_dict"] = parse_ref_build_params(ts_assign.treesapp_dir, ts_assign.target_refpkgs)
+    ref_data["alignment_dimensions"] = get_alignment_dims(ts_assign.treesapp_dir, ref_data["marker_build_dict"])
+    ref_data["tree_numbers_translation"] = read_species_translation_files(ts_assign.treesapp_dir,
+                                                                          ref_data["marker_build_dict"])
+    ref_data["trees"] = dict()
+    ref_data["edge_taxonomy"] = dict()
+    if args.check_trees:
+        validate_inputs(args, ref_data["marker_build_dict"])
+    return ref_data
+
+
+def search_homologs(ts_assign, args, marker_build_dict: dict, query_fasta: str, output_dir: str, num_seqs: int,
+                    exit_on_empty=True):
+    """
+    Searches the query sequences with the HMM profiles of the reference packages and parses the domain tables.
+
+    :param ts_assign: An Assigner instance
+    :param args: The parsed command-line arguments for assign
+    :param marker_build_dict: A dictionary of MarkerBuild instances indexed by refpkg codes/denominators
+    :param query_fasta: Path to a formatted FASTA file with numerical headers to search
+    :param output_dir: Path to the directory to write the domain tables to
+    :param num_seqs: The number of sequences in query_fasta
+    :param exit_on_empty: Flag indicating whether TreeSAPP should exit if no quality alignments are found
+    :return: Dictionary of HmmMatch instances (values) indexed by the name of the HMM they were aligned to
+    """
+    if args.single_hmm_db:
+        hmm_domtbl_files = wrapper.hmmscan_orfs(ts_assign.executables["hmmscan"], ts_assign.executables["hmmpress"],
+                                                ts_assign.hmm_dir, marker_build_dict, query_fasta, output_dir,
+                                                num_seqs, args.num_threads)
+    else:
+        hmm_domtbl_files = wrapper.hmmsearch_orfs(ts_assign.executables["hmmsearch"], ts_assign.hmm_dir,
+                                                  marker_build_dict, query_fasta, output_dir, args.num_threads,
+                                                  num_shards=args.search_shards, num_seqs=num_seqs)
+    return parse_domain_tables(args, hmm_domtbl_files, exit_on_empty)
+
+
+def search_query_chunks(ts_assign, args, marker_build_dict: dict):
+    """
+    A memory-bounded alternative to the orf-call, clean and search stages for very large inputs.
+    The input is read in batches (of args.chunk_size sequences or args.chunk_mb megabytes) that are each ORF-called
+    and formatted, then each batch is searched. Only the sequences with homologous matches, along with their header
+    information, are retained so memory scales with the batch size rather than the input size.
+
+    All batches are formatted before any are searched so that each search uses the total number of query sequences
+    as its search space size (-Z), making the full-sequence and independent E-values used to filter matches the same
+    as those of a single search. Numerical identifiers continue across batches.
+    The results can still differ from processing the input as a whole in a few ways:
+     1. hmmsearch reports domains by their conditional E-value (--domE), which is calculated from the number of
+     sequences reported in each batch, so domains at that reporting threshold may be reported differently;
+     2. a header repeated in a later batch is only detected, and its sequence dropped, if the first copy was a homolog.
+     The repeated sequence is still numbered and counted in the search space.
+
+    :param ts_assign: An Assigner instance
+    :param args: The parsed command-line arguments for assign
+    :param marker_build_dict: A dictionary of MarkerBuild instances indexed by refpkg codes/denominators
+    :return: A FASTA instance containing only the homologous query sequences and
+    a dictionary of HmmMatch instances indexed by the name of the HMM they were aligned to
+    """
+    homolog_seqs = FASTA(ts_assign.formatted_input)
+    hmm_matches = dict()
+    num_seqs = 0
+    num_formatted_seqs = 0
+    num_input_seqs = 0
+    batches = list()
+
+    # Prodigal's single-genome mode trains on the whole input so it cannot be run on batches
+    call_orfs = ts_assign.stage_status("orf-call")
+    if call_orfs and args.composition == "single":
+        ts_assign.predict_orfs(args.composition, args.num_threads)
+        call_orfs = False
+        input_fasta = ts_assign.aa_orfs_file
+    elif call_orfs:
+        input_fasta = ts_assign.input_sequences
+        for orfs_file in [ts_assign.aa_orfs_file, ts_assign.nuc_orfs_file]:
+            if os.path.isfile(orfs_file):
+                os.remove(orfs_file)
+    else:
+        input_fasta = ts_assign.input_sequences
+    ts_assign.query_sequences = ts_assign.aa_orfs_file if ts_assign.stage_status("orf-call") else input_fasta
+
+    logging.info("Formatting " + input_fasta + " in batches.\n")
+    for chunk in generate_fasta_chunks(input_fasta, args.chunk_size, int(args.chunk_mb * 1E6)):
+        chunk_dir = ts_assign.var_output_dir + "chunk" + str(len(batches)) + os.sep
+        if not os.path.isdir(chunk_dir):
+            os.mkdir(chunk_dir)
+        chunk_fasta = chunk_dir + ts_assign.sample_prefix + "_chunk.fasta"
+        with open(chunk_fasta, 'w') as chunk_handler:
+            for name, sequence in chunk:
+                chunk_handler.write('>' + name + "\n" + sequence + "\n")
+        num_chunk_seqs = len(chunk)
+        chunk.clear()
+
+        if call_orfs:
+            chunk_aa_orfs = chunk_dir + ts_assign.sample_prefix + "_chunk_ORFs.faa"
+            chunk_nuc_orfs = chunk_dir + ts_assign.sample_prefix + "_chunk_ORFs.fna"
+            wrapper.run_prodigal(args, chunk_fasta, chunk_aa_orfs, chunk_nuc_orfs)
+            merge_prodigal_orfs([chunk_aa_orfs], [num_input_seqs], ts_assign.aa_orfs_file, True)
+            merge_prodigal_orfs([chunk_nuc_orfs], [num_input_seqs], ts_assign.nuc_orfs_file, True)
+            chunk_fasta = chunk_aa_orfs
+
+        # Format the batch's headers, numbering the sequences from where the previous batch left off
+        chunk_seqs = FASTA(chunk_fasta)
+        chunk_seqs.fasta_dict = format_read_fasta(chunk_fasta, "prot", ts_assign.output_dir)
+        chunk_seqs.header_registry = register_headers(get_headers(chunk_fasta), True, num_seqs + 1)
+        chunk_seqs.change_dict_keys("num")
+        num_seqs += len(chunk_seqs.header_registry)
+        num_formatted_seqs += len(chunk_seqs.fasta_dict)
+        formatted_chunk = chunk_dir + ts_assign.sample_prefix + "_formatted.fasta"
+        write_new_fasta(chunk_seqs.fasta_dict, formatted_chunk)
+        # The batch's headers are kept on disk until its homologs are known
+        with open(chunk_dir + "header_registry.pkl", 'wb') as registry_handler:
+            pickle.dump(chunk_seqs.header_registry, registry_handler, protocol=pickle.HIGHEST_PROTOCOL)
+        batches.append((chunk_dir, formatted_chunk))
+        num_input_seqs += num_chunk_seqs
+
+    logging.info("Searching " + str(num_formatted_seqs) + " sequences in " + str(len(batches)) + " batches.\n")
+    homolog_headers = set()
+    num_repeated = 0
+    for chunk_dir, formatted_chunk in batches:
+        with open(chunk_dir + "header_registry.pkl", 'rb') as registry_handler:
+            chunk_header_registry = pickle.load(registry_handler)
+        chunk_fasta_dict = read_fasta_to_dict(formatted_chunk)
+        chunk_matches = search_homologs(ts_assign, args, marker_build_dict, formatted_chunk, chunk_dir,
+                                        num_formatted_seqs, False)
+        for marker in chunk_matches:
+            if marker not in hmm_matches:
+                hmm_matches[marker] = list()
+            for hmm_match in chunk_matches[marker]:
+                header = chunk_header_registry[hmm_match.orf]
+                # Headers are only de-duplicated within a batch by register_headers
+                if hmm_match.orf not in homolog_seqs.header_registry and header.original in homolog_headers:
+                    num_repeated += 1
+                    continue
+                hmm_matches[marker].append(hmm_match)
+                homolog_seqs.fasta_dict[hmm_match.orf] = chunk_fasta_dict[hmm_match.orf]
+                homolog_seqs.header_registry[hmm_match.orf] = header
+                homolog_headers.add(header.original)
+        shutil.rmtree(chunk_dir)
+
+    if num_repeated:
+        logging.warning(str(num_repeated) + " homologous matches were dropped as their sequence headers were "
+                        "duplicates of homologs in previous batches.\n")
+    logging.info("\tTreeSAPP analyzed the " + str(num_formatted_seqs) + " sequences found in input, in " +
+                 str(len(batches)) + " batches.\n")
+    if sum([len(hmm_matches[marker]) for marker in hmm_matches]) == 0:
+        logging.warning("No alignments met the quality cut-offs! TreeSAPP is exiting now.\n")
+        sys.exit(0)
+    homolog_seqs.index_form = "num"
+
+    return homolog_seqs, hmm_matches
+
+
 def extract_hmm_matches(hmm_matches: dict, fasta_dict: dict):
     """
     Function writes the sequences identified by the HMMs to output files in FASTA format.
@@ -154,6 +327,119 @@ def extract_hmm_matches(hmm_matches: dict, fasta_dict: dict):
     return extracted_seq_dict, numeric_contig_index
 
 
+def placement_cache_keys(ts_assign, args, ref_marker: MarkerBuild, placement_cache):
+    """
+    Determines the reference package digest and placement parameters that, along with a query sequence,
+    address a placement in the placement cache.
+
+    :return: Tuple of the reference package's digest and a string of the placement parameters
+    """
+    refpkg_files = [ts_assign.tree_dir + ref_marker.cog + "_tree.txt",
+                    ts_assign.aln_dir + ref_marker.cog + ".fa",
+                    ts_assign.hmm_dir + ref_marker.cog + ".hmm"]
+    refpkg_digest = placement_cache.refpkg_digest(refpkg_files)
+    # The query sequences are aligned as they are by hmmalign_task
+    if ref_marker.kind == "phylogenetic_rRNA":
+        aligner, query_only = "cmalign", False
+    else:
+        aligner, query_only = "hmmalign", args.align_queries_only
+    params = ','.join([args.placement_engine, str(ref_marker.model),
+                       "aligner=" + aligner, "align_queries_only=" + str(query_only),
+                       "trim_align=" + str(args.trim_align), "trim_engine=" + args.trim_engine,
+                       "min_seq_length=" + str(args.min_seq_length)])
+    return refpkg_digest, params
+
+
+def retrieve_cached_placements(ts_assign, args, placement_cache, extracted_seq_dict: dict, marker_build_dict: dict):
+    """
+    Looks up the placement of each extracted homologous sequence in the placement cache.
+
+    :param ts_assign: An Assigner instance
+    :param args: The parsed command-line arguments for assign
+    :param placement_cache: A PlacementCache instance
+    :param extracted_seq_dict: Dictionary of extracted sequences indexed by marker, group and negative integer
+    :param marker_build_dict: A dictionary of MarkerBuild instances indexed by refpkg codes/denominators
+    :return: A copy of extracted_seq_dict with only the sequences that were not found in the cache, and
+     a dictionary of the ItolJplace instances containing the cached placements, indexed by refpkg code
+    """
+    uncached_seq_dict = dict()
+    cached_jplaces = dict()
+    for marker in extracted_seq_dict:
+        ref_marker = utilities.fish_refpkg_from_build_params(marker, marker_build_dict)
+        refpkg_digest, params = placement_cache_keys(ts_assign, args, ref_marker, placement_cache)
+        tree_fields = placement_cache.get_tree(refpkg_digest, params)
+        uncached_seq_dict[marker] = dict()
+        for group in extracted_seq_dict[marker]:
+            uncached_seq_dict[marker][group] = dict()
+            for num, sequence in extracted_seq_dict[marker][group].items():
+                loci = placement_cache.get(refpkg_digest, params, sequence)
+                if loci is None or not tree_fields:
+                    uncached_seq_dict[marker][group][num] = sequence
+                    continue
+                if ref_marker.denominator not in cached_jplaces:
+                    jplace_data = ItolJplace()
+                    jplace_data.tree, jplace_data.fields = tree_fields
+                    jplace_data.version = 3
+                    jplace_data.metadata = {"invocation": "Placements retrieved from " + placement_cache.cache_dir}
+                    jplace_data.placements = list()
+                    cached_jplaces[ref_marker.denominator] = jplace_data
+                cached_jplaces[ref_marker.denominator].placements.append(JPlacePQuery([str(num)], loci))
+
+    logging.info(placement_cache.summarize())
+    return uncached_seq_dict, cached_jplaces
+
+
+def write_cached_placements(cached_jplaces: dict, output_dir: str):
+    """
+    Writes the placements retrieved from the placement cache to JPlace files that are parsed with those of
+    the placement engine, named cached_portableTree.<refpkg_code>.jplace.
+
+    :param cached_jplaces: Dictionary of ItolJplace instances indexed by refpkg code
+    :param output_dir: Path to the directory containing the placement engine's JPlace files
+    :return: List of the JPlace files written
+    """
+    jplace_files = list()
+    for denominator in sorted(cached_jplaces):
+        jplace_file = output_dir + "cached_portableTree." + denominator + ".jplace"
+        write_jplace(cached_jplaces[denominator], jplace_file)
+        jplace_files.append(jplace_file)
+    return jplace_files
+
+
+def store_placements(ts_assign, args, placement_cache, jplace_files: list, extracted_seq_dict: dict,
+                     marker_build_dict: dict):
+    """
+    Adds the placements in JPlace files written by the placement engine to the placement cache, then evicts
+    old placements to keep the cache within its size and age limits.
+
+    :param ts_assign: An Assigner instance
+    :param args: The parsed command-line arguments for assign
+    :param placement_cache: A PlacementCache instance
+    :param jplace_files: List of JPlace files, with the pquery names still the negative integers of the queries
+    :param extracted_seq_dict: Dictionary of extracted sequences indexed by marker, group and negative integer
+    :param marker_build_dict: A dictionary of MarkerBuild instances indexed by refpkg codes/denominators
+    :return: None
+    """
+    for denominator, marker_jplace_files in organize_jplace_files(jplace_files).items():
+        ref_marker = marker_build_dict[denominator]
+        refpkg_digest, params = placement_cache_keys(ts_assign, args, ref_marker, placement_cache)
+        query_seqs = dict()
+        for group in extracted_seq_dict.get(ref_marker.cog, dict()).values():
+            query_seqs.update(group)
+        for jplace_file in marker_jplace_files:
+            jplace_data = jplace_parser(jplace_file)
+            placement_cache.put_tree(refpkg_digest, params, jplace_data.tree, jplace_data.fields)
+            for pquery in jplace_data.placements:
+                for name in pquery.names:
+                    try:
+                        placement_cache.put(refpkg_digest, params, query_seqs[int(name)], pquery.loci)
+                    except (KeyError, ValueError):
+                        logging.debug("Unable to find the sequence of query '" + str(name) + "' to cache.\n")
+    placement_cache.evict()
+    logging.info(placement_cache.summarize())
+    return
+
+
 def write_grouped_fastas(extracted_seq_dict: dict, numeric_contig_index: dict, marker_build_dict, output_dir):
     hmmalign_input_fastas = list()
     bulk_marker_fasta = dict()
@@ -347,18 +633,18 @@ def detect_ribrna_sequences(args, cog_list, formatted_fasta_dict):
 
     logging.info("done.\n")
 
-    function_end_time = time.time()
-    hours, remainder = divmod(function_end_time - function_start_time, 3600)
-    minutes, seconds = divmod(remainder, 60)
     logging.debug("\trRNA-identification time required: " +
-                  ':'.join([str(hours), str(minutes), str(round(seconds, 2))]) + "\n")
+                  format_elapsed_time(time.time() - function_start_time) + "\n")
     logging.debug("\t" + str(num_rrna) + " rRNA sequences found.\n\n")
 
     return
 
 
-def get_sequence_counts(concatenated_mfa_files, ref_alignment_dimensions, verbosity, file_type):
+def get_sequence_counts(concatenated_mfa_files, ref_alignment_dimensions, verbosity, file_type, msa_objects=None):
     alignment_length_dict = dict()
+    if file_type not in ["Fasta", "Phylip", "Stockholm"]:
+        logging.error("File type '" + file_type + "' is not recognized.")
+        sys.exit(3)
     for denominator in concatenated_mfa_files:
         if denominator not in ref_alignment_dimensions:
             logging.error("Unrecognized code '" + denominator + "'.")
@@ -366,16 +652,7 @@ def get_sequence_counts(concatenated_mfa_files, ref_alignment_dimensions, verbos
 
         ref_n_seqs, ref_seq_length = ref_alignment_dimensions[denominator]
         for msa_file in concatenated_mfa_files[denominator]:
-            if file_type == "Fasta":
-                seq_dict = read_fasta_to_dict(msa_file)
-            elif file_type == "Phylip":
-                seq_dict = read_phylip_to_dict(msa_file)
-            elif file_type == "Stockholm":
-                seq_dict = read_stockholm_to_dict(msa_file)
-            else:
-                logging.error("File type '" + file_type + "' is not recognized.")
-                sys.exit(3)
-            num_seqs, sequence_length = multiple_alignment_dimensions(seq_dict, msa_file)
+            num_seqs, sequence_length = read_multiple_alignment(msa_file, file_type, msa_objects).dimensions()
             alignment_length_dict[msa_file] = sequence_length
 
             # Warn user if the multiple sequence alignment has grown significantly
@@ -402,13 +679,17 @@ def get_alignment_dims(treesapp_dir, marker_build_dict):
         if cog in all_markers:
             for marker_code in marker_build_dict:
                 if marker_build_dict[marker_code].cog == cog:
-                    seq_dict = read_fasta_to_dict(fasta)
-                    alignment_dimensions_dict[marker_code] = (multiple_alignment_dimensions(seq_dict, fasta))
+                    alignment_dimensions_dict[marker_code] = load_cached(fasta, "msa_dims", read_alignment_dims)
     return alignment_dimensions_dict
 
 
+def read_alignment_dims(msa_file):
+    seq_dict = read_fasta_to_dict(msa_file)
+    return multiple_alignment_dimensions(seq_dict, msa_file)
+
+
 def multiple_alignments(executables, treesapp_data_dir, output_dir, single_query_sequence_files, marker_build_dict,
-                        tool="hmmalign", num_proc=4):
+                        tool="hmmalign", num_proc=4, query_only=False, msa_objects=None):
     """
     Wrapper function for the multiple alignment functions - only purpose is to make an easy decision at this point...
 
@@ -419,6 +700,9 @@ def multiple_alignments(executables, treesapp_data_dir, output_dir, single_query
     :param marker_build_dict:
     :param tool: Tool to use for aligning query sequences to a reference multiple alignment [hmmalign|papara]
     :param num_proc: The number of alignment jobs to run in parallel
+    :param query_only: Flag indicating hmmalign should only align the query sequences, which are then merged with the
+     reference alignment
+    :param msa_objects: Optional dictionary for storing the MultipleSequenceAlignment instances of the files written
     :return: list of multiple sequence alignment files, generated by `tool`
     """
     if tool == "papara":
@@ -428,13 +712,73 @@ def multiple_alignments(executables, treesapp_data_dir, output_dir, single_query
         hmm_dir = treesapp_data_dir + os.sep + "hmm_data"
         alignment_dir = treesapp_data_dir + os.sep + "alignment_data"
         concatenated_msa_files = prepare_and_run_hmmalign(executables, hmm_dir, alignment_dir,
-                                                          single_query_sequence_files, marker_build_dict, num_proc)
+                                                          single_query_sequence_files, marker_build_dict, num_proc,
+                                                          query_only, msa_objects)
     else:
         logging.error("Unrecognized tool '" + str(tool) + "' for multiple sequence alignment.\n")
         sys.exit(3)
     return concatenated_msa_files
 
 
+def read_reference_matrix(ref_alignment):
+    """
+    :param ref_alignment: Path to a reference package's FASTA-formatted multiple alignment
+    :return: Dictionary of the aligned reference sequences indexed by their numerical identifiers
+    """
+    ref_matrix = dict()
+    aligned_fasta_dict = read_fasta_to_dict(ref_alignment)
+    for seq_name in aligned_fasta_dict:
+        ref_matrix[seq_name.split('_')[0]] = aligned_fasta_dict[seq_name]
+    return ref_matrix
+
+
+def load_reference_matrix(ref_alignment, ref_profile):
+    """
+    Loads a reference package's multiple alignment along with the alignment column each of its profile's match states
+    was built from. Both are cached (see refpkg_cache) so the files are not parsed again for every group of queries.
+
+    :param ref_alignment: Path to a reference package's FASTA-formatted multiple alignment
+    :param ref_profile: Path to the HMM profile built from ref_alignment
+    :return: Tuple of the reference sequence dictionary and the list of 1-based columns of the profile's match states.
+     The list is empty if the profile has no MAP annotation or it doesn't fit the alignment.
+    """
+    ref_matrix = load_cached(ref_alignment, "ref_matrix", read_reference_matrix, in_memory=True)
+    column_map = load_cached(ref_profile, "hmm_map", read_hmm_alignment_map, in_memory=True)
+    if not ref_matrix or not column_map:
+        return ref_matrix, []
+    aln_length = len(next(iter(ref_matrix.values())))
+    if column_map[-1] > aln_length or any(column_map[i] >= column_map[i+1] for i in range(len(column_map)-1)):
+        logging.debug("Match states of '" + ref_profile + "' do not map to the columns of '" + ref_alignment + "'.\n")
+        return ref_matrix, []
+    return ref_matrix, column_map
+
+
+def merge_query_alignment(query_sto, ref_matrix: dict, column_map: list):
+    """
+    Merges query sequences aligned to a profile (without the reference alignment) into the reference alignment.
+    Residues aligned to the profile's match states are placed in the reference alignment columns those states were
+    built from while insertions relative to the profile, which are not aligned in any case, are removed.
+
+    :param query_sto: Stockholm-formatted alignment of the query sequences written by hmmalign
+    :param ref_matrix: Dictionary of the aligned reference sequences indexed by their numerical identifiers
+    :param column_map: List of the 1-based reference alignment column of each match state
+    :return: Dictionary of the reference and query sequences, all the length of the reference alignment
+    """
+    seq_dict = dict(ref_matrix)
+    aln_length = len(next(iter(ref_matrix.values())))
+    for seq_name, match_states in read_stockholm_to_dict(query_sto, match_states_only=True).items():
+        if len(match_states) != len(column_map):
+            logging.error("Number of match states aligned for '" + seq_name + "' in " + query_sto +
+                          " (" + str(len(match_states)) + ") does not equal the profile length (" +
+                          str(len(column_map)) + ").\n")
+            sys.exit(5)
+        aligned_seq = ['-'] * aln_length
+        for column, residue in zip(column_map, match_states):
+            aligned_seq[column - 1] = residue
+        seq_dict[seq_name.split('_')[0]] = ''.join(aligned_seq)
+    return seq_dict
+
+
 def create_ref_phy_files(alignment_dir, output_dir, single_query_fasta_files, marker_build_dict, ref_aln_dimensions):
     """
     Creates a phy file for every reference marker that was matched by a query sequence
@@ -460,10 +804,7 @@ def create_ref_phy_files(alignment_dir, output_dir, single_query_fasta_files, ma
         aligned_fasta = alignment_dir + os.sep + marker + ".fa"
 
         num_ref_seqs, ref_align_len = ref_aln_dimensions[denominator]
-        aligned_fasta_dict = read_fasta_to_dict(aligned_fasta)
-        dict_for_phy = dict()
-        for seq_name in aligned_fasta_dict:
-            dict_for_phy[seq_name.split('_')[0]] = aligned_fasta_dict[seq_name]
+        dict_for_phy = load_cached(aligned_fasta, "ref_matrix", read_reference_matrix, in_memory=True)
         phy_dict = utilities.reformat_fasta_to_phy(dict_for_phy)
 
         utilities.write_phy_file(ref_alignment_phy, phy_dict, (num_ref_seqs, ref_align_len))
@@ -514,18 +855,94 @@ def prepare_and_run_papara(executables, treesapp_resources, single_query_fasta_f
     os.remove("papara_log.default")
     os.remove("papara_quality.default")
 
-    end_time = time.time()
-    hours, remainder = divmod(end_time - start_time, 3600)
-    minutes, seconds = divmod(remainder, 60)
-    logging.debug("\tPaPaRa time required: " +
-                  ':'.join([str(hours), str(minutes), str(round(seconds, 2))]) + "\n")
+    logging.debug("\tPaPaRa time required: " + format_elapsed_time(time.time() - start_time) + "\n")
 
     return query_alignment_files
 
 
-def prepare_and_run_hmmalign(execs, hmm_dir, alignment_dir, single_query_fasta_files, marker_build_dict, n_proc=2):
+def hmmalign_task(execs, hmm_dir, alignment_dir, query_fa_in, marker_build_dict, query_only=False):
+    """
+    Prepares the command for aligning a group of query sequences, written by write_grouped_fastas,
+    to their reference package's profile with hmmalign (or cmalign for phylogenetic_rRNA reference packages).
+
+    :param execs: Dictionary mapping software names to their executables
+    :param hmm_dir: Path to the directory containing the reference packages' HMM and CM profiles
+    :param alignment_dir: Path to the directory containing the reference packages' multiple alignments
+    :param query_fa_in: Path to a FASTA file of query sequences named <marker>_hmm_purified_group<N>.faa
+    :param marker_build_dict: A dictionary of MarkerBuild instances indexed by refpkg codes/denominators
+    :param query_only: Flag indicating only the query sequences should be aligned by hmmalign
+    :return: Tuple of the refpkg code, the alignment command, the Stockholm file it writes, its estimated memory and
+     either a tuple of the reference matrix and column map for merging the query-only alignment, or None
     """
-    Runs `hmmalign` to add the query sequences into the reference FASTA multiple alignments
+    file_name_info = re.match(r"(.*)_hmm_purified.*\.(f.*)$", os.path.basename(query_fa_in))
+    if file_name_info:
+        marker, extension = file_name_info.groups()
+    else:
+        logging.error("Unable to parse information from file name:" + "\n" + str(query_fa_in) + "\n")
+        sys.exit(3)
+
+    query_mfa_out = re.sub('.' + re.escape(extension) + r"$", ".sto", query_fa_in)
+    ref_marker = utilities.fish_refpkg_from_build_params(marker, marker_build_dict)
+
+    # Get the paths to either the HMM or CM profile files
+    ref_alignment = alignment_dir + os.sep + ref_marker.cog + ".fa"
+    ref_profile = hmm_dir + os.sep + ref_marker.cog
+    if ref_marker.kind == "phylogenetic_rRNA":
+        ref_profile += ".cm"
+    else:
+        ref_profile += ".hmm"
+
+    reference_matrix = None
+    if query_only and ref_marker.kind != "phylogenetic_rRNA":
+        ref_matrix, column_map = load_reference_matrix(ref_alignment, ref_profile)
+        if column_map:
+            reference_matrix = ref_matrix, column_map
+            ref_alignment = ""
+
+    if ref_marker.kind == "phylogenetic_rRNA":
+        malign_command = wrapper.hmmalign_command(execs["cmalign"],
+                                                  ref_alignment, ref_profile, query_fa_in, query_mfa_out)
+    else:
+        malign_command = wrapper.hmmalign_command(execs["hmmalign"],
+                                                  ref_alignment, ref_profile, query_fa_in, query_mfa_out)
+    memory = wrapper.estimate_job_memory([ref_alignment, ref_profile, query_fa_in], 20)
+    return ref_marker.denominator, malign_command, query_mfa_out, memory, reference_matrix
+
+
+def hmmalign_output_to_msa(query_mfa_out, reference_matrix=None, msa_objects=None):
+    """
+    Converts the Stockholm alignment written by hmmalign to a FASTA-formatted multiple alignment (.mfa),
+    merging the queries into the reference alignment if only the queries were aligned.
+
+    :param query_mfa_out: Path to the Stockholm file written by hmmalign
+    :param reference_matrix: Tuple of the reference matrix and column map returned by hmmalign_task, or None
+    :param msa_objects: Optional dictionary for storing the MultipleSequenceAlignment instance of the file written
+    :return: Path to the FASTA-formatted multiple alignment
+    """
+    mfa_file = re.sub(r"\.sto$", ".mfa", query_mfa_out)
+    if reference_matrix:
+        ref_matrix, column_map = reference_matrix
+        seq_dict = merge_query_alignment(query_mfa_out, ref_matrix, column_map)
+    else:
+        tmp_dict = read_stockholm_to_dict(query_mfa_out)
+        seq_dict = dict()
+        for seq_name in tmp_dict:
+            seq_dict[seq_name.split('_')[0]] = tmp_dict[seq_name]
+    msa = MultipleSequenceAlignment.from_dict(seq_dict, mfa_file)
+    msa.write_fasta(mfa_file)
+    if msa_objects is not None:
+        msa_objects[mfa_file] = msa
+    return mfa_file
+
+
+def prepare_and_run_hmmalign(execs, hmm_dir, alignment_dir, single_query_fasta_files, marker_build_dict, n_proc=2,
+                             query_only=False, msa_objects=None):
+    """
+    Runs `hmmalign` to add the query sequences into the reference FASTA multiple alignments.
+    By default the reference alignment is included with `--mapali` and re-aligned along with each group of queries.
+    If query_only is True only the queries are aligned to the HMM profile and are then merged with the reference
+    alignment using the profile's map of match states to alignment columns, falling back to `--mapali` for
+    reference packages without one (e.g. those with a covariance model).
 
     :param execs:
     :param hmm_dir:
@@ -533,11 +950,14 @@ def prepare_and_run_hmmalign(execs, hmm_dir, alignment_dir, single_query_fasta_f
     :param single_query_fasta_files:
     :param marker_build_dict:
     :param n_proc: The number of alignment jobs to run in parallel
+    :param query_only: Flag indicating only the query sequences should be aligned by hmmalign
+    :param msa_objects: Optional dictionary for storing the MultipleSequenceAlignment instances of the files written
     :return: list of multiple sequence alignment files (in Clustal format) generated by hmmalign.
     """
 
     hmmalign_singlehit_files = dict()
     mfa_out_dict = dict()
+    reference_matrices = dict()
     logging.info("Running hmmalign... ")
 
     start_time = time.time()
@@ -545,62 +965,34 @@ def prepare_and_run_hmmalign(execs, hmm_dir, alignment_dir, single_query_fasta_f
 
     # Run hmmalign on each fasta file
     for query_fa_in in sorted(single_query_fasta_files):
-        file_name_info = re.match(r"(.*)_hmm_purified.*\.(f.*)$", os.path.basename(query_fa_in))
-        if file_name_info:
-            marker, extension = file_name_info.groups()
-        else:
-            logging.error("Unable to parse information from file name:" + "\n" + str(query_fa_in) + "\n")
-            sys.exit(3)
-
-        query_mfa_out = re.sub('.' + re.escape(extension) + r"$", ".sto", query_fa_in)
-
-        ref_marker = utilities.fish_refpkg_from_build_params(marker, marker_build_dict)
-        if ref_marker.denominator not in hmmalign_singlehit_files:
-            hmmalign_singlehit_files[ref_marker.denominator] = []
+        alignment_task = hmmalign_task(execs, hmm_dir, alignment_dir, query_fa_in, marker_build_dict, query_only)
+        refpkg_code, malign_command, query_mfa_out, memory, reference_matrix = alignment_task
+        if refpkg_code not in hmmalign_singlehit_files:
+            hmmalign_singlehit_files[refpkg_code] = []
         try:
-            mfa_out_dict[ref_marker.denominator].append(query_mfa_out)
+            mfa_out_dict[refpkg_code].append(query_mfa_out)
         except KeyError:
-            mfa_out_dict[ref_marker.denominator] = [query_mfa_out]
-
-        # Get the paths to either the HMM or CM profile files
-        ref_alignment = alignment_dir + os.sep + ref_marker.cog + ".fa"
-        ref_profile = hmm_dir + os.sep + ref_marker.cog
-        if ref_marker.kind == "phylogenetic_rRNA":
-            ref_profile += ".cm"
-        else:
-            ref_profile += ".hmm"
-
-        if ref_marker.kind == "phylogenetic_rRNA":
-            task_list.append(wrapper.hmmalign_command(execs["cmalign"],
-                                                      ref_alignment, ref_profile, query_fa_in, query_mfa_out))
-        else:
-            task_list.append(wrapper.hmmalign_command(execs["hmmalign"],
-                                                      ref_alignment, ref_profile, query_fa_in, query_mfa_out))
+            mfa_out_dict[refpkg_code] = [query_mfa_out]
+        if reference_matrix:
+            reference_matrices[query_mfa_out] = reference_matrix
+        task_list.append((malign_command, memory, marker_build_dict[refpkg_code].cog))
 
     if len(task_list) > 0:
-        cl_farmer = CommandLineFarmer("cmalign/hmmalign --mapali", n_proc)
-        cl_farmer.add_tasks_to_queue(task_list)
-
-        cl_farmer.task_queue.close()
-        cl_farmer.task_queue.join()
+        executor = JobExecutor(n_proc, stage="cmalign/hmmalign --mapali")
+        for malign_command, memory, marker in task_list:
+            executor.submit(malign_command, threads=1, memory=memory, marker=marker)
+        executor.run()
+        executor.exit_on_failure(19)
 
     logging.info("done.\n")
 
     for refpkg_code in mfa_out_dict:
         for query_mfa_out in mfa_out_dict[refpkg_code]:
-            mfa_file = re.sub(r"\.sto$", ".mfa", query_mfa_out)
-            tmp_dict = read_stockholm_to_dict(query_mfa_out)
-            seq_dict = dict()
-            for seq_name in tmp_dict:
-                seq_dict[seq_name.split('_')[0]] = tmp_dict[seq_name]
-            write_new_fasta(seq_dict, mfa_file)
-            hmmalign_singlehit_files[refpkg_code].append(mfa_file)
-
-    end_time = time.time()
-    hours, remainder = divmod(end_time - start_time, 3600)
-    minutes, seconds = divmod(remainder, 60)
-    logging.debug("\thmmalign time required: " +
-                  ':'.join([str(hours), str(minutes), str(round(seconds, 2))]) + "\n")
+            hmmalign_singlehit_files[refpkg_code].append(hmmalign_output_to_msa(query_mfa_out,
+                                                                                reference_matrices.get(query_mfa_out),
+                                                                                msa_objects))
+
+    logging.debug("\thmmalign time required: " + format_elapsed_time(time.time() - start_time) + "\n")
 
     return hmmalign_singlehit_files
 
@@ -713,7 +1105,8 @@ def cat_hmmalign_singlehit_files(args, hmmalign_singlehit_files):
     return concatenated_mfa_files, nrs_of_sequences
 
 
-def check_for_removed_sequences(aln_dir, trimmed_msa_files: dict, msa_files: dict, marker_build_dict: dict, min_len=10):
+def check_for_removed_sequences(aln_dir, trimmed_msa_files: dict, msa_files: dict, marker_build_dict: dict, min_len=10,
+                                msa_objects=None, exit_on_empty=True):
     """
     Reads the multiple alignment files (either Phylip or FASTA formatted) and looks for both reference and query
     sequences that have been removed. Multiple alignment files are removed from `mfa_files` if:
@@ -726,29 +1119,34 @@ def check_for_removed_sequences(aln_dir, trimmed_msa_files: dict, msa_files: dic
     :param msa_files: A dictionary containing the untrimmed MSA files indexed by reference package code (denominator)
     :param marker_build_dict: A dictionary of MarkerBuild objects indexed by their refpkg codes/denominators
     :param min_len: The minimum allowable sequence length after trimming (not including gap characters)
-    :return: A dictionary of denominators, with multiple alignment dictionaries as values. Example:
-        {M0702: { "McrB_hmm_purified.phy-BMGE.fasta": {'1': seq1, '2': seq2}}}
+    :param msa_objects: Optional dictionary of MultipleSequenceAlignment instances indexed by file path, for both the
+     untrimmed and trimmed alignments. Alignments that are not in it are read from their files.
+    :param exit_on_empty: Flag indicating whether TreeSAPP should exit if none of the alignments pass
+    :return: A dictionary of denominators, with dictionaries of MultipleSequenceAlignment instances as values. Example:
+        {M0702: { "McrB_hmm_purified.phy-BMGE.fasta": MultipleSequenceAlignment}}
     """
     qc_ma_dict = dict()
     num_successful_alignments = 0
     discarded_seqs_string = ""
     trimmed_away_seqs = dict()
     untrimmed_msa_failed = []
+    if msa_objects is None:
+        msa_objects = dict()
     logging.debug("Validating trimmed multiple sequence alignment files... ")
 
     for denominator in sorted(trimmed_msa_files.keys()):
         marker = marker_build_dict[denominator].cog
         trimmed_away_seqs[marker] = 0
         # Create a set of the reference sequence names
-        ref_headers = get_headers(aln_dir + os.sep + marker + ".fa")
-        unique_refs = set([re.sub('_' + re.escape(marker), '', x)[1:] for x in ref_headers])
+        unique_refs = set(load_cached(aln_dir + os.sep + marker + ".fa", "ref_matrix", read_reference_matrix,
+                                      in_memory=True).keys())
         msa_passed, msa_failed, summary_str = validate_alignment_trimming(trimmed_msa_files[denominator], unique_refs,
-                                                                          True, min_len)
+                                                                          True, min_len, msa_objects)
 
         # Report the number of sequences that are removed by BMGE
         for trimmed_msa_file in trimmed_msa_files[denominator]:
             try:
-                prefix, tool = re.search('(' + re.escape(marker) + r"_.*_group\d+)-(BMGE|trimAl).fasta$",
+                prefix, tool = re.search('(' + re.escape(marker) + r"_.*_group\d+)-(BMGE|BMGEpy|trimAl).fasta$",
                                          os.path.basename(trimmed_msa_file)).groups()
             except TypeError:
                 logging.error("Unexpected file name format for a trimmed MSA.\n")
@@ -761,7 +1159,8 @@ def check_for_removed_sequences(aln_dir, trimmed_msa_files: dict, msa_files: dic
             if pair:
                 if trimmed_msa_file in msa_failed:
                     untrimmed_msa_failed.append(pair)
-                trimmed_away_seqs[marker] += len(set(get_headers(pair)).difference(set(get_headers(trimmed_msa_file))))
+                trimmed_away_seqs[marker] += len(set(read_multiple_alignment(pair, msa_objects=msa_objects).names).
+                                                 difference(msa_objects[trimmed_msa_file].names))
             else:
                 logging.error("Unable to map trimmed MSA file '" + trimmed_msa_file + "' to its original MSA.\n")
                 sys.exit(5)
@@ -773,7 +1172,7 @@ def check_for_removed_sequences(aln_dir, trimmed_msa_files: dict, msa_files: dic
                               "), trimmed MSA files were mapped to their original MSAs.\n")
                 sys.exit(3)
             untrimmed_msa_passed, _, _ = validate_alignment_trimming(untrimmed_msa_failed, unique_refs,
-                                                                     True, min_len)
+                                                                     True, min_len, msa_objects)
             msa_passed.update(untrimmed_msa_passed)
         num_successful_alignments += len(msa_passed)
         qc_ma_dict[denominator] = msa_passed
@@ -787,7 +1186,7 @@ def check_for_removed_sequences(aln_dir, trimmed_msa_files: dict, msa_files: dic
     logging.debug("\tSequences <" + str(min_len) + " characters removed after trimming:" +
                   discarded_seqs_string + "\n")
 
-    if num_successful_alignments == 0:
+    if num_successful_alignments == 0 and exit_on_empty:
         logging.error("No quality alignment files to analyze after trimming. Exiting now.\n")
         sys.exit(0)  # Should be 3, but this allows Clade_exclusion_analyzer to continue after exit
 
@@ -797,7 +1196,7 @@ def check_for_removed_sequences(aln_dir, trimmed_msa_files: dict, msa_files: dic
 def evaluate_trimming_performance(qc_ma_dict, alignment_length_dict, concatenated_msa_files, tool):
     """
 
-    :param qc_ma_dict: A dictionary mapping denominators to files to multiple alignment dictionaries
+    :param qc_ma_dict: A dictionary mapping denominators to files to MultipleSequenceAlignment instances
     :param alignment_length_dict:
     :param concatenated_msa_files: Dictionary with markers indexing original (untrimmed) multiple alignment files
     :param tool: The name of the tool that was appended to the original, untrimmed or unmasked alignment files
@@ -813,8 +1212,7 @@ def evaluate_trimming_performance(qc_ma_dict, alignment_length_dict, concatenate
             trimmed_length_dict[denominator] = list()
         for multi_align_file in qc_ma_dict[denominator]:
             file_type = multi_align_file.split('.')[-1]
-            multi_align = qc_ma_dict[denominator][multi_align_file]
-            num_seqs, trimmed_seq_length = multiple_alignment_dimensions(multi_align, multi_align_file)
+            num_seqs, trimmed_seq_length = qc_ma_dict[denominator][multi_align_file].dimensions()
 
             original_multi_align = re.sub('-' + tool + '.' + file_type, '.' + of_ext, multi_align_file)
             raw_align_len = alignment_length_dict[original_multi_align]
@@ -841,75 +1239,228 @@ def produce_phy_files(qc_ma_dict, molecule_type="prot"):
     """
     Produces phy files from the provided list of alignment files
 
-    :param qc_ma_dict:
+    :param qc_ma_dict: A dictionary mapping denominators to files to MultipleSequenceAlignment instances
     :param molecule_type:
     :return: Dictionary containing the names of the produced phy files mapped to its f_contig
     """
 
     phy_files = dict()
-    sequence_lengths = dict()
 
     logging.debug("Writing filtered multiple alignment files to Phylip... ")
 
     # Open each alignment file
     for denominator in sorted(qc_ma_dict.keys()):
-        sequence_lengths[denominator] = set()
         # Prepare the phy file for writing
         if denominator not in phy_files.keys():
             phy_files[denominator] = list()
 
         for multi_align_file in qc_ma_dict[denominator]:
-            multi_align_dict = qc_ma_dict[denominator][multi_align_file]
+            multi_align = qc_ma_dict[denominator][multi_align_file]
             final_phy_file_name = re.sub(".fasta$|.phy$", "-qcd.phy", multi_align_file)
-            sequences_for_phy = dict()
-
-            for name in sorted(multi_align_dict.keys()):
-                seq_name = name.strip()
-                seq_name = seq_name.split('_')[0]
-
-                sequence = multi_align_dict[name]
-                sequence = re.sub(r' ', '', sequence)
-                sequence_lengths[denominator].add(len(sequence))
-                # Ensure the sequences contain only valid characters for RAxML
-                sequence = re.sub(r'\.', 'X', sequence)
-                sequence = re.sub(r'\*', 'X', sequence)
-                sequence = re.sub('-', 'X', sequence)
-
-                if re.search(r'\AX+\Z', sequence):
-                    sequence = re.sub('X', 'V', sequence, 1)
-
-                if molecule_type != "prot":
-                    sequence = re.sub('U', 'T', sequence)  # Got error from RAxML when encountering Uracil
-
-                sequences_for_phy[seq_name] = sequence
-
-            # Write the sequences to the phy file
-            phy_dict = utilities.reformat_fasta_to_phy(sequences_for_phy)
-            if len(sequence_lengths[denominator]) != 1:
-                logging.error("Sequence lengths varied in " + multi_align_file + "\n")
-            phy_string = ' ' + str(len(multi_align_dict.keys())) + '  ' + str(sequence_lengths[denominator].pop()) + '\n'
-            for count in sorted(phy_dict.keys(), key=int):
-                for seq_name in sorted(phy_dict[count].keys()):
-                    sequence_part = phy_dict[count][seq_name]
-                    if count == 0:
-                        phy_string += str(seq_name)
-                        length = len(str(seq_name))
-                        c = length
-                        while c < 10:
-                            phy_string += ' '
-                            c += 1
-                    phy_string += sequence_part + '\n'
-
-                phy_string += '\n'
-
-            with open(final_phy_file_name, 'w') as phy_output:
-                phy_output.write(phy_string)
+
+            # Ensure the sequences contain only valid characters for RAxML
+            matrix = multi_align.matrix.copy()
+            matrix[np.isin(matrix, np.frombuffer(b".*-", dtype=np.uint8))] = ord('X')
+            if matrix.shape[1] > 0:
+                matrix[np.all(matrix == ord('X'), axis=1), 0] = ord('V')
+            if molecule_type != "prot":
+                matrix[matrix == ord('U')] = ord('T')  # Got error from RAxML when encountering Uracil
+
+            seq_names = [name.strip().split('_')[0] for name in multi_align.names]
+            MultipleSequenceAlignment(seq_names, matrix, final_phy_file_name).write_phylip(final_phy_file_name)
             phy_files[denominator].append(final_phy_file_name)
     logging.debug("done.\n")
 
     return phy_files
 
 
+class MarkerPipeline:
+    """
+    Aligns, trims and places the query sequences of each reference package as a chain of dependent jobs
+    (align -> msa -> trim -> validate -> place) rather than running each stage on every reference package
+    before starting the next. A group's alignment is trimmed as soon as hmmalign has aligned it, and a reference
+    package's placements start as soon as all of its alignments are validated, so the quick reference packages are
+    placed while the slower ones are still being aligned.
+    Every step runs the same functions, on the same files, as the staged workflow so the outputs should be identical.
+
+    Only the external tools (hmmalign, BMGE and the placement engine) are run by the JobExecutor. The steps run in
+    this process (converting alignments, BMGEpy trimming and validation) are run in this thread as the previous job
+    of their group finishes, so the helpers they share with the staged workflow exit from the main thread, as they
+    do there, rather than from a worker thread.
+    """
+    def __init__(self, ts_assign, args, marker_build_dict: dict, ref_alignment_dimensions: dict):
+        self.ts_assign = ts_assign
+        self.args = args
+        self.marker_build_dict = marker_build_dict
+        self.ref_alignment_dimensions = ref_alignment_dimensions
+        self.executor = JobExecutor(args.num_threads, stage="marker pipeline")
+        self.place = wrapper.placement_engine(ts_assign.executables, args.placement_engine)
+        self.msa_objects = dict()  # Alignments are kept in memory, indexed by their file paths, between the steps
+        self.steps = dict()  # Maps each Job to the refpkg code it is for, the step it performs and its output file
+        self.step_times = dict()  # The time spent on the steps run in this thread, indexed by the step
+        self.unfinished_groups = dict()  # The number of groups of each refpkg that are still being aligned or trimmed
+        self.reference_matrices = dict()
+        self.placement_threads = dict()
+        self.msa_files = dict()
+        self.trimmed_msa_files = dict()
+        self.phy_files = dict()
+        self.jplace_files = list()
+
+    @staticmethod
+    def group_prefix(msa_file: str):
+        """
+        :return: The name shared by all files derived from a group of query sequences, e.g. McrA_hmm_purified_group0
+        """
+        return re.match(r"(.*_group\d+)", os.path.basename(msa_file)).group(1)
+
+    def submit(self, denominator: str, step: str, task, args=(), threads=1, memory=0, name="", output=""):
+        job = self.executor.submit(task, args, threads, memory, name,
+                                   marker=self.marker_build_dict[denominator].cog, stage=step)
+        self.steps[job] = denominator, step, output
+        return
+
+    def run_step(self, step: str, task, args=()):
+        """
+        Runs a step of the pipeline in this thread, recording the time it took.
+        """
+        start_time = time.time()
+        result = task(*args)
+        self.step_times[step] = self.step_times.get(step, 0.0) + time.time() - start_time
+        return result
+
+    def trim(self, denominator: str, mfa_file: str):
+        """
+        Trims a group's alignment: BMGEpy in this thread, other tools by submitting their command to the executor.
+
+        :return: True if the alignment was trimmed, False if a job was submitted to trim it
+        """
+        tool = self.args.trim_engine
+        molecule = self.marker_build_dict[denominator].molecule
+        trim_command, trimmed_msa_file = wrapper.get_msa_trim_command(self.ts_assign.executables, mfa_file,
+                                                                      molecule, tool)
+        self.trimmed_msa_files[denominator].append(trimmed_msa_file)
+        if tool == ENGINE_NAME:
+            self.run_step("trim", trim_alignment_file, (mfa_file, trimmed_msa_file, molecule, self.msa_objects))
+            return True
+        self.submit(denominator, "trim", trim_command, memory=wrapper.estimate_trim_memory(mfa_file, tool),
+                    name=tool + ':' + os.path.basename(mfa_file))
+        return False
+
+    def validate_alignments(self, denominator: str):
+        """
+        Equivalent to the steps of the staged workflow between trimming and placement, for a single refpkg.
+
+        :return: List of the multiple alignment files to be placed
+        """
+        msa_files = {denominator: sorted(self.msa_files[denominator])}
+        alignment_length_dict = get_sequence_counts(msa_files, self.ref_alignment_dimensions, self.args.verbose,
+                                                    utilities.find_msa_type(msa_files), self.msa_objects)
+        if not self.args.trim_align:
+            return msa_files[denominator]
+        trimmed_msa_files = {denominator: sorted(self.trimmed_msa_files[denominator])}
+        qc_ma_dict = check_for_removed_sequences(self.ts_assign.aln_dir, trimmed_msa_files, msa_files,
+                                                 self.marker_build_dict, self.args.min_seq_length, self.msa_objects,
+                                                 False)
+        evaluate_trimming_performance(qc_ma_dict, alignment_length_dict, msa_files, self.args.trim_engine)
+        return produce_phy_files(qc_ma_dict)[denominator]
+
+    def submit_placements(self, denominator: str, phy_files: list):
+        self.phy_files[denominator] = phy_files
+        ref_marker = self.marker_build_dict[denominator]
+        placement_jobs = [wrapper.placement_job_info(self.ts_assign.tree_dir, phy_file, ref_marker)
+                          for phy_file in phy_files]
+        placement_jobs.sort(key=lambda job: (-job[0], job[1]))
+        for _, query_name, reference_tree_file, phy_file, model, _ in placement_jobs:
+            threads = self.placement_threads[self.group_prefix(phy_file)]
+            self.submit(denominator, "place", self.place,
+                        (reference_tree_file, phy_file, model, self.ts_assign.var_output_dir, query_name, threads),
+                        threads, wrapper.estimate_placement_memory(phy_file, model), query_name)
+        return
+
+    def finish_group(self, denominator: str):
+        """
+        Once all of a reference package's groups are aligned (and trimmed), validates them and submits the placements
+        """
+        self.unfinished_groups[denominator] -= 1
+        if self.unfinished_groups[denominator] == 0:
+            phy_files = self.run_step("validate", self.validate_alignments, (denominator,))
+            self.submit_placements(denominator, phy_files)
+        return
+
+    def advance(self, job):
+        """
+        Called in this thread with each job as it finishes to run or submit the next step of its group or reference
+        package. Nothing more is done for a group whose job failed; the failures are reported once all jobs finish.
+        """
+        denominator, step, output = self.steps.pop(job)
+        if job.failed():
+            return
+        if step == "align":
+            msa_file = self.run_step("msa", hmmalign_output_to_msa,
+                                     (output, self.reference_matrices.get(output), self.msa_objects))
+            self.msa_files[denominator].append(msa_file)
+            if self.args.trim_align and not self.trim(denominator, msa_file):
+                return
+            self.finish_group(denominator)
+        elif step == "trim":
+            self.finish_group(denominator)
+        elif step == "place":
+            self.jplace_files.append(job.result["jplace"])
+        return
+
+    def run(self, homolog_seq_files: list):
+        """
+        :param homolog_seq_files: List of the FASTA files of grouped query sequences written by write_grouped_fastas
+        :return: Dictionary of the multiple alignment files that were placed, indexed by refpkg code, and
+         the list of JPlace files written, in the order the placements finished
+        """
+        logging.info("Aligning, trimming and placing the query sequences of each reference package... ")
+        start_time = time.time()
+
+        hmm_dir = self.ts_assign.refpkg_dir + os.sep + "hmm_data"
+        alignment_dir = self.ts_assign.refpkg_dir + os.sep + "alignment_data"
+        alignment_tasks = list()
+        group_sizes = list()
+        for query_fa_in in sorted(homolog_seq_files):
+            alignment_task = hmmalign_task(self.ts_assign.executables, hmm_dir, alignment_dir, query_fa_in,
+                                           self.marker_build_dict, self.args.align_queries_only)
+            denominator = alignment_task[0]
+            alignment_tasks.append((query_fa_in, alignment_task))
+            # The group's placement job is sized by its number of queries and its reference alignment's length
+            group_sizes.append(count_fasta_records(query_fa_in) * self.ref_alignment_dimensions[denominator][1])
+        group_threads = wrapper.allocate_placement_threads(group_sizes, self.args.num_threads)
+
+        for (query_fa_in, alignment_task), threads in zip(alignment_tasks, group_threads):
+            denominator, malign_command, query_mfa_out, memory, reference_matrix = alignment_task
+            if denominator not in self.unfinished_groups:
+                self.unfinished_groups[denominator] = 0
+                self.msa_files[denominator] = list()
+                self.trimmed_msa_files[denominator] = list()
+            self.unfinished_groups[denominator] += 1
+            if reference_matrix:
+                self.reference_matrices[query_mfa_out] = reference_matrix
+            self.placement_threads[self.group_prefix(query_fa_in)] = threads
+            self.submit(denominator, "align", malign_command, threads=1, memory=memory,
+                        name=os.path.basename(query_mfa_out), output=query_mfa_out)
+
+        self.executor.run(self.advance)
+        self.executor.exit_on_failure(19)
+        logging.info("done.\n")
+
+        if self.args.trim_align and self.phy_files and not any(self.phy_files.values()):
+            logging.error("No quality alignment files to analyze after trimming. Exiting now.\n")
+            sys.exit(0)  # Should be 3, but this allows Clade_exclusion_analyzer to continue after exit
+
+        logging.debug("\tPer-marker alignment, trimming and placement time required: " +
+                      format_elapsed_time(time.time() - start_time) + "\n")
+        for step in self.step_times:
+            logging.debug("\t\tTime spent on the '" + step + "' steps in this process: " +
+                          format_elapsed_time(self.step_times[step]) + "\n")
+        logging.debug("\t" + self.args.placement_engine + " was called " + str(len(self.jplace_files)) + " times.\n")
+
+        return self.phy_files, self.jplace_files
+
+
 def pparse_ref_trees(denominator_ref_tree_dict, args):
     ref_trees_dict = dict()
 
@@ -949,11 +1500,11 @@ def pparse_raxml_out_trees(labelled_trees, args):
     pool = Pool(processes=int(args.num_threads))
 
     def log_tree(result):
-        f_contig, rooted_labelled_trees, insertion_point_node_hash = result
-        if rooted_labelled_trees is None:
+        f_contig, labelled_tree_index, insertion_point_node_hash = result
+        if labelled_tree_index is None:
             pool.terminate()
             sys.exit()
-        raxml_tree_dict[f_contig] = [rooted_labelled_trees, insertion_point_node_hash]
+        raxml_tree_dict[f_contig] = [labelled_tree_index, insertion_point_node_hash]
 
     def no_tree_handler(error):
         logging.error(error + "-->{}\n<--".format(error.__cause__))
@@ -979,39 +1530,22 @@ def pparse_raxml_out_trees(labelled_trees, args):
 
 def read_understand_and_reroot_the_labelled_tree(labelled_tree_file, f_contig):
     labelled_tree_elements, insertion_point_node_hash = read_the_raxml_out_tree(labelled_tree_file)
-    # # Old and slow:
-    # labelled_tree_info = create_tree_info_hash()
-    # labelled_tree_info = get_node_subtrees(labelled_tree_elements, labelled_tree_info)
-    # labelled_tree_info = assign_parents_and_children(labelled_tree_info, f_contig)
-    # if labelled_tree_info is None:
-    #     return [f_contig, None, insertion_point_node_hash]
-    # labelled_tree_info = build_tree_info_quartets(labelled_tree_info)
-    # rooted_labelled_trees = build_newly_rooted_trees(labelled_tree_info)
-    # return [f_contig, rooted_labelled_trees, insertion_point_node_hash]
-
-    # Using the C++ _tree_parser extension:
-    labelled_tree_assignments = _tree_parser._get_parents_and_children(labelled_tree_elements)
-    if labelled_tree_assignments == "$":
+    # A single index represents the labelled tree re-rooted on each of its edges
+    labelled_tree_index = TerminalChildrenIndex(labelled_tree_elements)
+    if labelled_tree_index.malformed:
         sys.stderr.write("Poison pill received from " + f_contig + "\n")
         sys.stderr.flush()
         return [f_contig, None, insertion_point_node_hash]
-    else:
-        labelled_tree_info, terminal_children_of_labelled_tree = deconvolute_assignments(labelled_tree_assignments)
-        labelled_tree_info['subtree_of_node'] = terminal_children_of_labelled_tree
-        labelled_tree_info = build_tree_info_quartets(labelled_tree_info)
-        rooted_labelled_trees = build_newly_rooted_trees(labelled_tree_info)
-        return [f_contig, rooted_labelled_trees, insertion_point_node_hash]
+    return [f_contig, labelled_tree_index, insertion_point_node_hash]
 
 
 def identify_the_correct_terminal_children_of_each_assignment(terminal_children_of_reference,
-                                                              rooted_labelled_trees,
+                                                              labelled_tree_index,
                                                               insertion_point_node_hash,
-                                                              assignments, num_threads, parse_log):
-    terminal_children_of_assignments = build_terminal_children_strings_of_assignments(rooted_labelled_trees,
+                                                              assignments, parse_log):
+    terminal_children_of_assignments = build_terminal_children_strings_of_assignments(labelled_tree_index,
                                                                                       insertion_point_node_hash,
-                                                                                      assignments,
-                                                                                      num_threads,
-                                                                                      parse_log)
+                                                                                      assignments)
     real_terminal_children_of_assignments = compare_terminal_children_strings(terminal_children_of_assignments,
                                                                               terminal_children_of_reference,
                                                                               parse_log)
@@ -1031,65 +1565,46 @@ def read_the_raxml_out_tree(labelled_tree_file):
     except IOError:
         logging.error("Could not open " + labelled_tree_file + " for reading!\n")
         sys.exit(5)
-    tree_string = ''
-
-    for line in raxml_tree:
-        line = line.strip()
-        tree_string += line
-
+    tree_string = ''.join([line.strip() for line in raxml_tree])
     raxml_tree.close()
-    tree_symbols_raw_1 = list(tree_string)
+
+    # Root the tree by joining the first two children of the (trifurcating) root
     bracket_diff = 0
-    tree_string_neu = '('
     comma_count = 0
-
-    for tree_symbol_raw_1 in tree_symbols_raw_1:
-        if comma_count < 2:
-            if tree_symbol_raw_1 == '(':
-                bracket_diff += 1
-            if tree_symbol_raw_1 == ')':
-                bracket_diff -= 1
-            if tree_symbol_raw_1 == ',' and bracket_diff == 1:
-                comma_count += 1
+    for pos, tree_symbol in enumerate(tree_string):
+        if tree_symbol == '(':
+            bracket_diff += 1
+        elif tree_symbol == ')':
+            bracket_diff -= 1
+        elif tree_symbol == ',' and bracket_diff == 1:
+            comma_count += 1
             if comma_count == 2:
-                tree_string_neu += '):1.0[I666999666]'
-        tree_string_neu += tree_symbol_raw_1
-
-    tree_string = tree_string_neu
-    tree_string = re.sub('\(', 'L', tree_string)
-    tree_string = re.sub('\)', 'R', tree_string)
-    tree_string = re.sub('\[', 'Q', tree_string)
+                tree_string = tree_string[:pos] + '):1.0[I666999666]' + tree_string[pos:]
+                break
+    tree_string = '(' + tree_string
 
     # Remove the branch lengths
-    try:
-        tree_string = re.sub(":[.0-9]+Q", 'Q', tree_string)
-    except AssertionError:
-        raise AssertionError("Unable to remove branch lengths!")
-
-    while re.search(r'((\D(\d+))QI(\d+)])', tree_string):
-        to_be_replaced = re.search(r'((\D(\d+))QI(\d+)])', tree_string).group(1)
-        replacement = re.search(r'((\D(\d+))QI(\d+)])', tree_string).group(2)
-        terminal_leaf = re.search(r'((\D(\d+))QI(\d+)])', tree_string).group(3)
-        insertion_point = re.search(r'((\D(\d+))QI(\d+)])', tree_string).group(4)
-        if int(terminal_leaf) <= 0:
-            sys.stderr.write("ERROR: Your tree has terminal leaves with numbers <= 0. "
-                             "Please change them to positive values!\n")
-            sys.stderr.flush()
-            sys.exit(-1)
-        insertion_point_node_hash[insertion_point] = terminal_leaf
-        tree_string = re.sub(to_be_replaced, replacement, tree_string)
-    count = -2
-    while re.search(r'QI(\d+)]', tree_string):
-        insertion_point_node_hash[re.search(r'QI(\d+)]', tree_string).group(1)] = count
-        tree_string = re.sub(r'QI(\d+)]', str(count), tree_string, 1)
-        count += -1
-
-    tree_string = re.sub('L', '(', tree_string)
-    tree_string = re.sub('R', ')', tree_string)
-    tree_string = re.sub('Q', '[', tree_string)
-    # Remove these lines when using the C++ extension:
-    # tree_elements = split_tree_string(tree_string)
-    # return tree_elements, insertion_point_node_hash
+    tree_string = re.sub(r":[.0-9]+\[", '[', tree_string)
+
+    # In a single pass, replace the edge labels of terminal leaves with the leaf and
+    # the remaining edge labels with negative internal node numbers, from left to right
+    internal_nodes = itertools.count(-2, -1)
+
+    def replace_edge_label(edge_label):
+        terminal_leaf, insertion_point = edge_label.groups()
+        if terminal_leaf:
+            if int(terminal_leaf) <= 0:
+                sys.stderr.write("ERROR: Your tree has terminal leaves with numbers <= 0. "
+                                 "Please change them to positive values!\n")
+                sys.stderr.flush()
+                sys.exit(-1)
+            insertion_point_node_hash[insertion_point] = terminal_leaf
+            return terminal_leaf
+        node = next(internal_nodes)
+        insertion_point_node_hash[insertion_point] = node
+        return str(node)
+
+    tree_string = re.sub(r"(\d*)\[I(\d+)]", replace_edge_label, tree_string)
     return tree_string, insertion_point_node_hash
 
 
@@ -1109,160 +1624,27 @@ def split_tree_string(tree_string):
     return tree_elements
 
 
-def build_tree_info_quartets(tree_info):
-    for node in sorted(tree_info['parent_of_node'].keys(), key=int):
-        parent = tree_info['parent_of_node'][node]
-        if int(parent) == -1:
-            for roots_child in sorted(tree_info['children_of_node']['-1'].keys(), key=int):
-                if roots_child == node:
-                    continue
-                parent = roots_child
-
-        tree_info['quartets'][node][parent] = 1
-        if node in tree_info['children_of_node']:
-            for child in sorted(tree_info['children_of_node'][node].keys(), key=int):
-                tree_info['quartets'][node][child] = 1
-
-    return tree_info
-
-
-def build_newly_rooted_trees(tree_info):
-    """
-    Builds a new tree that is re-rooted on every node in the tree
-    :param tree_info:
-    :return:
-    """
-
-    tree_number = 0
-    list_of_already_used_attachments = utilities.Autovivify()
-    rooted_trees = utilities.Autovivify()
-    
-    for node in sorted(tree_info['quartets'].keys(), key=int):
-        if node in list_of_already_used_attachments:
-            continue
-        for attachment in sorted(tree_info['quartets'][node].keys(), key=int):
-            list_of_already_used_attachments[attachment] = 1
-            tree_string = ''
-            node_infos = utilities.Autovivify()
-            node_infos['previous_node'] = ''
-            node_infos['node'] = ';'
-            node_infos['open_attachments'][node] = 1
-            node_infos['open_attachments'][attachment] = 1
-            new_tree = recursive_tree_builder(tree_info, node_infos, tree_string)
-            rooted_trees[tree_number] = new_tree
-            tree_number += 1
-    return rooted_trees
-
-
-def recursive_tree_builder(tree_info, node_infos, tree_string):
-    node = node_infos['node']
-    count = 0
-
-    for attachment in sorted(node_infos['open_attachments'].keys(), key=int):
-        count += 1
-        if count == 1:
-            tree_string += '('
-        node_infos2 = utilities.Autovivify()
-        node_infos2['previous_node'] = node
-        node_infos2['node'] = attachment
-        count2 = 0
-
-        for attachment_of_used_attachment in sorted(tree_info['quartets'][attachment].keys()):
-            if attachment_of_used_attachment in node_infos['open_attachments']:
-                continue
-            if attachment_of_used_attachment == node:
-                continue
-            count2 += 1
-            node_infos2['open_attachments'][attachment_of_used_attachment] = 1
-
-        if count2 > 0:
-            tree_string = recursive_tree_builder(tree_info, node_infos2, tree_string)
-        else:
-            tree_string += str(attachment)
-        if count == 1:
-            tree_string += ','
-        if count == 2:
-            tree_string += ')' + str(node)
-
-    return tree_string
-
-
-def parallel_subtree_node_retriever(rooted_trees, num_threads, parse_log):
-    """
-    Run `get_node_subtrees` in parallel for each of the elements in rooted_trees
-    :param rooted_trees: Dictionary of rooted trees
-    :param num_threads: Number of threads to use
-    :param parse_log: The file object to write parsing information to
-    :return: rooted_tree_nodes - a list of results from get_node_subtrees(), one for each rooted_tree
-    """
-    job_queue = JoinableQueue()
-    result_queue = Queue()
-    rooted_tree_nodes = list()
-
-    worker_group = [NodeRetrieverWorker(job_queue, result_queue) for i in range(int(num_threads))]
-    for worker in worker_group:
-        worker.start()
-
-    # tasks = [split_tree_string(rooted_trees[rooted_tree]) for rooted_tree in rooted_trees.keys()]
-    # tasks = [rooted_trees[rooted_tree] for rooted_tree in rooted_trees.keys()]
-    # for task in tasks:
-    #     print "Input: " + task
-    tasks = rooted_trees.values()
-    parse_log.write("Number of subtrees = " + str(len(tasks)) + "\n")
-    parse_log.flush()
-    for rooted_tree_elements in tasks:
-        if job_queue.full():
-            sys.exit("ERROR: multiprocessing.Queue full in parallel_subtree_node_retriever!")
-        job_queue.put(rooted_tree_elements)
-
-    for i in range(int(num_threads)):
-        job_queue.put(None)
-
-    for i in range(len(rooted_trees.keys())):
-        rooted_tree_nodes.append(result_queue.get())
-
-    job_queue.close()
-    result_queue.close()
-    result_queue.join_thread()
-    return rooted_tree_nodes
-
-
-def build_terminal_children_strings_of_assignments(rooted_trees, insertion_point_node_hash,
-                                                   assignments, num_threads, parse_log):
+def build_terminal_children_strings_of_assignments(labelled_tree_index, insertion_point_node_hash, assignments):
     """
     Performed for each gene (f_contig) identified
-    :param rooted_trees: All possible rooted trees for a given tree (with sequence inserted)
+    :param labelled_tree_index: A TerminalChildrenIndex of the tree (with sequence inserted), covering all rootings
     :param insertion_point_node_hash:
     :param assignments: The node that is inserted into the RAxML tree - found in *RAxML_classification.txt for f_contig
-    :param num_threads: Number of threads to use for parsing the subtrees of each node in parallel
-    :param parse_log: Name of the RAxML_output parse log file to write to
     :return:
     """
     terminal_children_strings_of_assignments = utilities.Autovivify()
 
     for assignment in sorted(assignments.keys()):
         internal_node_of_assignment = insertion_point_node_hash[assignment]
-        # parse_log.write("Starting to retrieve all subtrees at " + time.ctime())
-        rooted_tree_nodes = parallel_subtree_node_retriever(rooted_trees, num_threads, parse_log)
-        # parse_log.write("Finished retrieving subtrees at " + time.ctime() + "\n")
-        for rooted_tree_info in rooted_tree_nodes:
-            assignment_subtree = str(rooted_tree_info['subtree_of_node'][str(internal_node_of_assignment)])
-            terminal_children = utilities.Autovivify()
-
-            if re.search(r'\A(\d+)\Z', assignment_subtree):
-                terminal_children[re.search(r'\A(\d+)\Z', assignment_subtree).group(1)] = 1
-            else:
-                for each_hit in re.findall(r'(\D)(\d+)', assignment_subtree):
-                    if each_hit[0] == '-':
-                        continue
-                    terminal_children[each_hit[1]] = 1
-
-            terminal_children_string_of_assignment = ''
-
-            # terminal_children_string_of_assignment = ' '.join(sorted(terminal_children.keys(), key=int))
-            for terminal_child_of_assignment in sorted(terminal_children.keys(), key=int):
-                terminal_children_string_of_assignment += str(terminal_child_of_assignment) + ' '
-
+        try:
+            node_key = int(internal_node_of_assignment)
+        except TypeError:
+            node_key = None
+        terminal_children_strings = labelled_tree_index.terminal_children_strings(node_key)
+        if not terminal_children_strings:
+            # The assignment's node is not in the tree (e.g. mp_root)
+            terminal_children_strings = ['']
+        for terminal_children_string_of_assignment in terminal_children_strings:
             terminal_children_strings_of_assignments[assignment][terminal_children_string_of_assignment] = 1
 
     return terminal_children_strings_of_assignments
@@ -1350,6 +1732,10 @@ def delete_files(clean_up, output_dir_var, section, rpkm_dir=None):
             files_to_be_deleted += glob.glob(output_dir_var + '*.phy')
             files_to_be_deleted += glob.glob(output_dir_var + '*.phy.reduced')
             files_to_be_deleted += glob.glob(output_dir_var + '*RAxML_classification.txt')
+            files_to_be_deleted += glob.glob(output_dir_var + '*_EPA-ng.txt')
+            files_to_be_deleted += glob.glob(output_dir_var + '*.EPA-ng_info.txt')
+            files_to_be_deleted += glob.glob(output_dir_var + '*_pplacer.txt')
+            files_to_be_deleted += glob.glob(output_dir_var + '*.pplacer_RAxML_info.txt')
             # Need this for annotate_extra_treesapp.py
             # files_to_be_deleted += glob.glob(output_dir_var + '*.jplace')
 
@@ -1464,7 +1850,12 @@ def align_reads_to_nucs(bwa_exe, reference_fasta, aln_output_dir, args):
     index_command += [reference_fasta]
     index_command += ["1>", "/dev/null", "2>", aln_output_dir + "treesapp_bwa_index.stderr"]
 
-    launch_write_command(index_command)
+    # The BWT index is built from the ORFs in memory, which BWA MEM then loads along with a buffer for each thread
+    executor = JobExecutor(args.num_threads, stage="BWA")
+    executor.submit(index_command, threads=1, memory=wrapper.estimate_job_memory([reference_fasta], 10),
+                    name="bwa index")
+    executor.run()
+    executor.exit_on_failure(19)
 
     bwa_command = [bwa_exe, "mem"]
     bwa_command += ["-t", str(args.num_threads)]
@@ -1480,11 +1871,11 @@ def align_reads_to_nucs(bwa_exe, reference_fasta, aln_output_dir, args):
         bwa_command.append(args.reverse)
     bwa_command += ["1>", sam_file, "2>", aln_output_dir + "treesapp_bwa_mem.stderr"]
 
-    p_bwa = subprocess.Popen(' '.join(bwa_command), shell=True, preexec_fn=os.setsid)
-    p_bwa.wait()
-    if p_bwa.returncode != 0:
-        logging.error("bwa mem did not complete successfully for:\n" +
-                      str(' '.join(bwa_command)) + "\n")
+    executor.submit(bwa_command, threads=args.num_threads, collect_all=False, name="bwa mem",
+                    memory=wrapper.estimate_job_memory([reference_fasta], 10, 50 * args.num_threads))
+    executor.run()
+    if executor.failures:
+        logging.error(executor.summarize_failures())
 
     logging.info("done.\n")
 
@@ -1514,12 +1905,10 @@ def run_rpkm(rpkm_exe: str, sam_file: str, orf_nuc_fasta: str, rpkm_output_dir:
     rpkm_command += ["-o", rpkm_output_file]
     rpkm_command += ["1>", rpkm_output_dir + "rpkm_stdout.txt", "2>", rpkm_output_dir + "rpkm_stderr.txt"]
 
-    p_rpkm = subprocess.Popen(' '.join(rpkm_command), shell=True, preexec_fn=os.setsid)
-    p_rpkm.wait()
-    if p_rpkm.returncode != 0:
-        logging.error("RPKM calculation did not complete successfully for:\n" +
-                      str(' '.join(rpkm_command)) + "\n")
-        sys.exit(3)
+    executor = JobExecutor(1, stage="RPKM calculation")
+    executor.submit(rpkm_command, collect_all=False, memory=wrapper.estimate_job_memory([sam_file, orf_nuc_fasta]))
+    executor.run()
+    executor.exit_on_failure(3)
     logging.info("done.\n")
 
     return rpkm_output_file
@@ -1611,6 +2000,40 @@ def summarize_placements_rpkm(tree_saps: dict, abundance_dict: dict, marker_buil
     return
 
 
+def fan_out_duplicates(tree_saps: dict, classified_seq_dict: dict, duplicate_headers: dict):
+    """
+    Copies the classifications of representative query sequences to the identical sequences they represented
+    after deduplication, so each is reported (and its abundance measured) as if it had been placed itself.
+
+    :param tree_saps: Dictionary mapping refpkg codes to all TreeProtein instances for classified sequences
+    :param classified_seq_dict: Dictionary mapping the placed sequences' names to their sequences.
+     The sequences of the duplicates are added to this dictionary.
+    :param duplicate_headers: Dictionary mapping the original header of each representative sequence
+     to a list of the original headers of its duplicates
+    :return: None
+    """
+    fanned_out = 0
+    for refpkg_code in tree_saps:
+        placed_seqs = list()
+        for placed_seq in tree_saps[refpkg_code]:  # type: TreeProtein
+            placed_seqs.append(placed_seq)
+            seq_name = re.sub(r"\|{0}\|\d+_\d+$".format(re.escape(placed_seq.name)), '', placed_seq.contig_name)
+            if seq_name not in duplicate_headers:
+                continue
+            name_suffix = placed_seq.contig_name[len(seq_name):]
+            for duplicate_name in duplicate_headers[seq_name]:
+                duplicate_seq = copy(placed_seq)
+                duplicate_seq.contig_name = duplicate_name + name_suffix
+                if placed_seq.contig_name in classified_seq_dict:
+                    classified_seq_dict[duplicate_seq.contig_name] = classified_seq_dict[placed_seq.contig_name]
+                placed_seqs.append(duplicate_seq)
+                fanned_out += 1
+        tree_saps[refpkg_code] = placed_seqs
+
+    logging.debug("Classifications of representative sequences copied to " + str(fanned_out) + " duplicates.\n")
+    return
+
+
 def abundify_tree_saps(tree_saps: dict, abundance_dict: dict):
     """
     Add abundance (RPKM or presence count) values to the TreeProtein instances (abundance variable)
@@ -1747,7 +2170,7 @@ def enumerate_taxonomic_lineages(lineage_list):
     return taxonomic_counts
 
 
-def filter_placements(tree_saps, marker_build_dict, tree_data_dir: str, min_likelihood: float):
+def filter_placements(tree_saps, marker_build_dict, tree_data_dir: str, min_likelihood: float, ref_trees=None):
     """
     Determines the total distance of each placement from its branch point on the tree
     and removes the placement if the distance is deemed too great
@@ -1756,8 +2179,12 @@ def filter_placements(tree_saps, marker_build_dict, tree_data_dir: str, min_like
     :param marker_build_dict: A dictionary of MarkerBuild objects (used here for lowest_confident_rank)
     :param tree_data_dir: Directory containing reference package tree files (Newick)
     :param min_likelihood: Likelihood-weight-ratio (LWR) threshold for filtering pqueries
+    :param ref_trees: Optional dictionary of TreeDistanceIndex instances indexed by marker, shared between calls.
+    Trees that are missing are read from tree_data_dir, indexed and added to it.
     :return:
     """
+    if ref_trees is None:
+        ref_trees = dict()
 
     logging.info("Filtering low-quality placements... ")
     unclassified_seqs = dict()  # A dictionary tracking the seqs unclassified for each marker
@@ -1770,8 +2197,12 @@ def filter_placements(tree_saps, marker_build_dict, tree_data_dir: str, min_like
         unclassified_seqs[marker]["beyond"] = list()
         unclassified_seqs[marker]["far_beyond"] = list()
 
-        tree = Tree(tree_data_dir + os.sep + marker + "_tree.txt")
-        max_dist, leaf_ds = tree_leaf_distances(tree)
+        if marker not in ref_trees:
+            ref_trees[marker] = TreeDistanceIndex(Tree(tree_data_dir + os.sep + marker + "_tree.txt"))
+        tree_index = ref_trees[marker]
+        # The mean distance from each edge's LCA to its tips, indexed by the edge (inode) the pqueries were placed on
+        edge_tip_distances = dict()
+        max_dist, leaf_ds = tree_leaf_distances(tree_index.tree)
         # Find the maximum distance and standard deviation of distances from the root to all leaves
         max_dist_threshold = max_dist
         mean_dist_threshold = utilities.mean(leaf_ds)
@@ -1790,7 +2221,7 @@ def filter_placements(tree_saps, marker_build_dict, tree_data_dir: str, min_like
                                 tree_sap.summarize())
                 tree_sap.classified = False
                 continue
-            elif tree_sap.placements[0] == '{}':
+            elif not tree_sap.placements[0].loci:
                 unclassified_seqs[marker]["np"].append(tree_sap)
                 tree_sap.classified = False
                 continue
@@ -1813,16 +2244,16 @@ def filter_placements(tree_saps, marker_build_dict, tree_data_dir: str, min_like
             # Find the distance away from this edge's bifurcation (if internal) or tip (if leaf)
 
             if len(leaf_children) > 1:
-                # We need to find the LCA in the Tree instance to find the distances to tips for ete3
-                parent = tree.get_common_ancestor(leaf_children)
-                tip_distances = parent_to_tip_distances(parent, leaf_children)
+                if tree_sap.inode not in edge_tip_distances:
+                    edge_tip_distances[tree_sap.inode] = tree_index.mean_tip_distance(leaf_children)
+                mean_tip_distance = edge_tip_distances[tree_sap.inode]
             else:
-                tip_distances = [0.0]
+                mean_tip_distance = 0.0
 
-            tree_sap.avg_evo_dist = round(distal_length + pendant_length + (sum(tip_distances) / len(tip_distances)), 4)
+            tree_sap.avg_evo_dist = round(distal_length + pendant_length + mean_tip_distance, 4)
             tree_sap.distances = str(distal_length) + ',' +\
                                  str(pendant_length) + ',' +\
-                                 str(sum(tip_distances) / len(tip_distances))
+                                 str(mean_tip_distance)
 
     logging.info("done.\n")
 
@@ -1837,7 +2268,71 @@ def filter_placements(tree_saps, marker_build_dict, tree_data_dir: str, min_like
     return tree_saps
 
 
-def write_tabular_output(tree_saps, tree_numbers_translation, marker_build_dict, sample_name, output_file):
+class EdgeTaxonomy:
+    """
+    The taxonomic lineages of the leaves subtended by placement edges of a reference tree, and the lowest common
+    taxonomy (LCA*) and weighted taxonomic distance derived from them. These depend only on the edge(s) a query
+    sequence was placed on, so they are calculated for the first query placed on an edge and looked up afterwards.
+    The lineages are interned in a TaxonomyStore so the consensus and distances are calculated on integer arrays.
+    """
+    def __init__(self, leaves: list):
+        """
+        :param leaves: A list of TreeLeafReference instances for the leaves of a reference tree
+        """
+        self.taxonomy = TaxonomyStore()
+        # Maps each leaf to the taxon ID of its lineage, or None if it has no lineage information
+        self.leaf_taxa = dict()
+        for leaf in leaves:
+            if leaf.lineage:
+                self.leaf_taxa[leaf.number] = self.taxonomy.intern(utilities.clean_lineage_string(leaf.lineage))
+            else:
+                self.leaf_taxa[leaf.number] = None
+        self.edges = dict()
+
+    def children_taxa(self, pquery: JPlacePQuery, node_map: dict):
+        """
+        Equivalent to jplace_utils.children_lineage but returns the taxon IDs of the leaves' lineages
+        """
+        children = list()
+        for locus in pquery.loci:
+            for tree_leaf in node_map[locus[0]]:
+                try:
+                    taxon = self.leaf_taxa[tree_leaf]
+                except KeyError:
+                    logging.error("Unable to find '" + tree_leaf + "' in leaf-lineage map.\n")
+                    sys.exit(3)
+                if taxon is not None:
+                    children.append(taxon)
+                else:
+                    logging.warning("No lineage information available for " + tree_leaf + ".\n")
+        return np.array(children, dtype=np.int64)
+
+    def classify(self, tree_sap: TreeProtein):
+        """
+        :param tree_sap: A classified TreeProtein instance
+        :return: Tuple of the lineages of the leaves its placement edge(s) subtend, its lowest common taxonomy and its
+         weighted taxonomic distance
+        """
+        edge_key = tuple(locus[0] for locus in tree_sap.placements[0].loci)
+        if edge_key not in self.edges:
+            children = self.children_taxa(tree_sap.placements[0], tree_sap.node_map)
+            lineage_list = [self.taxonomy.lineage(taxon) for taxon in children]
+            if len(lineage_list) == 0:
+                return lineage_list, "", 0.0
+            elif len(lineage_list) == 1:
+                lct = lineage_list[0]
+                wtd = 0.0
+            else:
+                # algorithm options are "MEGAN", "LCAp", and "LCA*" (default)
+                lct_taxon = self.taxonomy.consensus(children)
+                lct = self.taxonomy.lineage(lct_taxon)
+                wtd = self.taxonomy.weighted_distance(children, lct_taxon)
+            self.edges[edge_key] = (lineage_list, lct, wtd)
+        return self.edges[edge_key]
+
+
+def write_tabular_output(tree_saps, tree_numbers_translation, marker_build_dict, sample_name, output_file,
+                         edge_taxonomy=None):
     """
     Write the final classification table
 
@@ -1846,9 +2341,13 @@ def write_tabular_output(tree_saps, tree_numbers_translation, marker_build_dict,
     :param marker_build_dict: A dictionary of MarkerBuild objects (used here for lowest_confident_rank)
     :param sample_name: String representing the name of the sample (i.e. Assign.sample_prefix)
     :param output_file: Path to write the classification table
+    :param edge_taxonomy: Optional dictionary indexed by denominator, shared between calls, of the taxonomy of each
+     placement edge. The taxonomy only depends on the edge(s) a sequence was placed on, so it is calculated once for
+     each edge and added to this dictionary.
     :return: None
     """
-    leaf_taxa_map = dict()
+    if edge_taxonomy is None:
+        edge_taxonomy = dict()
     # TODO: Add the start and stop positions of the extracted sequence to the classification table
     tab_out_string = "Sample\tQuery\tMarker\tLength\tTaxonomy\tConfident_Taxonomy\tAbundance\tiNode\tLWR\tEvoDist\tDistances\n"
     try:
@@ -1858,35 +2357,19 @@ def write_tabular_output(tree_saps, tree_numbers_translation, marker_build_dict,
         sys.exit(3)
 
     for denominator in tree_saps:
-        # All the leaves for that tree [number, translation, lineage]
-        leaves = tree_numbers_translation[denominator]
-        lineage_list = list()
-        # Test if the reference set have lineage information
-        for leaf in leaves:
-            lineage_list.append(utilities.clean_lineage_string(leaf.lineage).split('; '))
-            leaf_taxa_map[leaf.number] = leaf.lineage
-        taxonomic_counts = enumerate_taxonomic_lineages(lineage_list)
+        if denominator not in edge_taxonomy:
+            edge_taxonomy[denominator] = EdgeTaxonomy(tree_numbers_translation[denominator])
+        refpkg_edge_taxonomy = edge_taxonomy[denominator]
 
         for tree_sap in tree_saps[denominator]:  # type: TreeProtein
             if not tree_sap.classified:
                 continue
 
-            tree_sap.lineage_list = children_lineage(leaf_taxa_map, tree_sap.placements[0], tree_sap.node_map)
-
+            tree_sap.lineage_list, tree_sap.lct, tree_sap.wtd = refpkg_edge_taxonomy.classify(tree_sap)
             if len(tree_sap.lineage_list) == 0:
                 logging.error("Unable to find lineage information for marker " +
                               denominator + ", contig " + tree_sap.contig_name + "!\n")
                 sys.exit(3)
-            elif len(tree_sap.lineage_list) == 1:
-                tree_sap.lct = tree_sap.lineage_list[0]
-                tree_sap.wtd = 0.0
-            else:
-                lca = tree_sap.megan_lca()
-                # algorithm options are "MEGAN", "LCAp", and "LCA*" (default)
-                tree_sap.lct = lowest_common_taxonomy(tree_sap.lineage_list, lca, taxonomic_counts, "LCA*")
-                tree_sap.wtd, status = weighted_taxonomic_distance(tree_sap.lineage_list, tree_sap.lct)
-                if status > 0:
-                    tree_sap.summarize()
 
             # Based on the calculated distance from the leaves, what rank is most appropriate?
             recommended_rank = rank_recommender(tree_sap.avg_evo_dist,
@@ -1934,6 +2417,7 @@ def parse_raxml_output(epa_output_dir, tree_data_dir, marker_build_dict, parsing
     jplace_collection = organize_jplace_files(jplace_files)
     itol_data = dict()  # contains all pqueries, indexed by marker name (e.g. McrA, nosZ, 16srRNA)
     tree_saps = dict()  # contains individual pquery information for each mapped protein (N==1), indexed by denominator
+    jplace_tree_indices = dict()  # Node-leaves maps, edge lengths and parent maps indexed by the JPlace tree string
     # Use the jplace files to guide which markers iTOL outputs should be created for
     classified_seqs = 0
     for denominator in jplace_collection:
@@ -1943,7 +2427,10 @@ def parse_raxml_output(epa_output_dir, tree_data_dir, marker_build_dict, parsing
         for filename in jplace_collection[denominator]:
             # Load the JSON placement (jplace) file containing >= 1 pquery into ItolJplace object
             jplace_data = jplace_parser(filename)
-            tree_index = index_tree_edges(jplace_data.tree)
+            # The node-leaves map and edge lengths are computed once for each tree and shared by its pqueries
+            if jplace_data.tree not in jplace_tree_indices:
+                jplace_tree_indices[jplace_data.tree] = index_jplace_tree(jplace_data.tree)
+            node_map, tree_index, _ = jplace_tree_indices[jplace_data.tree]
             # Demultiplex all pqueries in jplace_data into individual TreeProtein objects
             tree_placement_queries = demultiplex_pqueries(jplace_data)
             # Filter the placements, determine the likelihood associated with the harmonized placement
@@ -1954,7 +2441,7 @@ def parse_raxml_output(epa_output_dir, tree_data_dir, marker_build_dict, parsing
                     pquery.contig_name = seq_info.group(1)
                     start, end = seq_info.groups()[1:]
                     pquery.seq_len = int(end) - int(start)
-                pquery.create_jplace_node_map()
+                pquery.node_map = node_map
                 pquery.check_jplace(tree_index)
                 if parsing_method == "best":
                     pquery.filter_max_weight_placement()
@@ -1983,11 +2470,7 @@ def parse_raxml_output(epa_output_dir, tree_data_dir, marker_build_dict, parsing
 
     logging.info("done.\n")
 
-    function_end_time = time.time()
-    hours, remainder = divmod(function_end_time - function_start_time, 3600)
-    minutes, seconds = divmod(remainder, 60)
-    logging.debug("\tTree parsing time required: " +
-                  ':'.join([str(hours), str(minutes), str(round(seconds, 2))]) + "\n")
+    logging.debug("\tTree parsing time required: " + format_elapsed_time(time.time() - function_start_time) + "\n")
     logging.debug("\t" + str(len(jplace_files)) + " RAxML output files.\n" +
                   "\t" + str(classified_seqs) + " sequences placed into trees by RAxML.\n\n")
 
@@ -7,17 +7,19 @@ import re
 import logging
 import time
 from shutil import rmtree, copy
-from copy import deepcopy
-from multiprocessing import Process, JoinableQueue
 from glob import glob
 from json import loads, dumps
 from collections import namedtuple
-from .fasta import format_read_fasta, write_new_fasta, get_header_format, FASTA, get_headers
+from .fasta import format_read_fasta, write_new_fasta, get_header_format, FASTA, get_headers,\
+    split_fasta_by_length, merge_prodigal_orfs
 from .utilities import median, which, is_exe, return_sequence_info_groups, write_dict_to_table
-from .entish import get_node, create_tree_info_hash, subtrees_to_dictionary
+from .entish import get_node, load_reference_tree_handle, index_jplace_tree
+from .refpkg_cache import load_cached
 from .lca_calculations import determine_offset, clean_lineage_string, optimal_taxonomic_assignment
 from . import entrez_utils
-from .external_command_interface import launch_write_command
+from .external_command_interface import JobExecutor, resource_usage, clear_resource_usage,\
+    summarize_resource_usage, write_resource_report
+from .profiling import StageProfiler, format_elapsed_time
 from numpy import var
 
 import _tree_parser
@@ -76,12 +78,16 @@ class ReferencePackage:
         return True
 
     def tax_ids_file_to_leaves(self):
+        return load_cached(self.lineage_ids, "refpkg_leaves", self.read_tax_ids_file)
+
+    @staticmethod
+    def read_tax_ids_file(lineage_ids):
         tree_leaves = list()
         unknown = 0
         try:
-            tax_ids_handler = open(self.lineage_ids, 'r', encoding='utf-8')
+            tax_ids_handler = open(lineage_ids, 'r', encoding='utf-8')
         except IOError:
-            logging.error("Unable to open " + self.lineage_ids + "\n")
+            logging.error("Unable to open " + lineage_ids + "\n")
             sys.exit(5)
 
         for line in tax_ids_handler:
@@ -95,7 +101,7 @@ class ReferencePackage:
             try:
                 number, seq_name, lineage = fields
             except (ValueError, IndexError):
-                logging.error("Unexpected number of fields in " + self.lineage_ids +
+                logging.error("Unexpected number of fields in " + lineage_ids +
                               ".\nInvoked .split(\'\\t\') on line " + str(line) + "\n")
                 sys.exit(5)
             leaf = TreeLeafReference(number, seq_name)
@@ -107,7 +113,7 @@ class ReferencePackage:
             tree_leaves.append(leaf)
 
         if len(tree_leaves) == unknown:
-            logging.error("Lineage information was not properly loaded for " + self.lineage_ids + "\n")
+            logging.error("Lineage information was not properly loaded for " + lineage_ids + "\n")
             sys.exit(5)
 
         tax_ids_handler.close()
@@ -224,6 +230,39 @@ class MarkerBuild:
         return
 
 
+class JPlacePQuery:
+    """
+    A single pquery from the "placements" array of a JPlace file, decoded from JSON once when the file is parsed.
+    'names' holds the names of the placed sequence(s) ("n") and 'loci' the candidate placements ("p"),
+    each a list of values ordered as in the JPlace "fields" (e.g. edge_num, likelihood, like_weight_ratio, ...)
+    """
+    __slots__ = ["names", "loci"]
+
+    def __init__(self, names=None, loci=None):
+        self.names = names if names is not None else list()
+        self.loci = loci if loci is not None else list()
+
+    @classmethod
+    def from_json(cls, placement):
+        """
+        :param placement: Either a JSON-formatted pquery string or the dictionary decoded from one
+        :return: A JPlacePQuery instance
+        """
+        if isinstance(placement, str):
+            placement = loads(placement)
+        if 'nm' in placement:
+            # Names with multiplicities, e.g. from pplacer: [["name", mass], ...]
+            names = [name_mass[0] for name_mass in placement['nm']]
+        else:
+            names = placement.get('n', list())
+        if isinstance(names, str):
+            names = [names]
+        return cls(list(names), placement.get('p', list()))
+
+    def to_json(self):
+        return '{' + dumps('p') + ':' + dumps(self.loci) + ', ' + dumps('n') + ':' + dumps(self.names) + '}'
+
+
 class ItolJplace:
     """
     A class to hold all data relevant to a jplace file to be viewed in iTOL
@@ -273,7 +312,7 @@ class ItolJplace:
         summary_string += "Placement information:\n"
         if not self.placements:
             summary_string += "\tNone.\n"
-        elif self.placements[0] == '{}':
+        elif not self.placements[0].loci:
             summary_string += "\tNone.\n"
         else:
             if self.likelihood and self.lwr and self.inode:
@@ -282,10 +321,7 @@ class ItolJplace:
                 summary_string += "\tL.W.R\t\t" + str(self.lwr) + "\n"
             else:
                 for pquery in self.placements:
-                    placement = loads(str(pquery), encoding="utf-8")
-                    for k, v in placement.items():
-                        if k == 'p':
-                            summary_string += '\t' + str(v) + "\n"
+                    summary_string += '\t' + str(pquery.loci) + "\n"
         summary_string += "Non-redundant lineages of child nodes:\n"
         if len(self.lineage_list) > 0:
             for lineage in sorted(set(self.lineage_list)):
@@ -310,36 +346,21 @@ class ItolJplace:
         :return:
         """
         nodes = list()
-        for d_place in self.placements:
-            if isinstance(d_place, str):
-                for k, v in loads(d_place).items():
-                    if k == 'p':
-                        for pquery in v:
-                            nodes.append(str(pquery[0]))
-            else:
-                logging.error("Unable to handle type " + type(d_place) + "\n")
-                sys.exit(17)
+        for pquery in self.placements:
+            for locus in pquery.loci:
+                nodes.append(str(locus[0]))
         return nodes
 
     def correct_decoding(self):
         """
-        Since the JSON decoding is unable to decode recursively, this needs to be fixed for each placement
-        Formatting and string conversion are also performed here
+        Since the JSON decoding is unable to decode recursively, this needs to be fixed for each placement.
+        Any placements that are still JSON strings or dictionaries are converted to JPlacePQuery instances
+        and the field names are quoted for writing.
 
         :return:
         """
-        new_placement_collection = []  # a list of dictionary-like strings
-        placement_string = ""  # e.g. {"p":[[226, -31067.028237, 0.999987, 0.012003, 2e-06]], "n":["query"]}
-        for d_place in self.placements:
-            if not isinstance(d_place, str):
-                dict_strings = list()  # e.g. "n":["query"]
-                for k, v in d_place.items():
-                    dict_strings.append(dumps(k) + ':' + dumps(v))
-                    placement_string = ', '.join(dict_strings)
-                new_placement_collection.append('{' + placement_string + '}')
-            else:
-                new_placement_collection.append(d_place)
-        self.placements = new_placement_collection
+        self.placements = [pquery if isinstance(pquery, JPlacePQuery) else JPlacePQuery.from_json(pquery)
+                           for pquery in self.placements]
 
         decoded_fields = list()
         for field in self.fields:
@@ -351,21 +372,16 @@ class ItolJplace:
         return
 
     def rename_placed_sequence(self, seq_name):
-        new_placement_collection = dict()
-        for d_place in self.placements:
-            for key, value in d_place.items():
-                if key == 'n':
-                    new_placement_collection['n'] = [seq_name]
-                else:
-                    new_placement_collection[key] = value
-        self.placements = [new_placement_collection]
+        loci = list()
+        for pquery in self.placements:
+            loci = pquery.loci
+        self.placements = [JPlacePQuery([seq_name], loci)]
         return
 
     def name_placed_sequence(self):
-        for d_place in self.placements:
-            for key, value in d_place.items():
-                if key == 'n':
-                    self.contig_name = value[0]
+        for pquery in self.placements:
+            if pquery.names:
+                self.contig_name = pquery.names[0]
         return
 
     def get_field_position_from_jplace_fields(self, field_name):
@@ -393,15 +409,9 @@ class ItolJplace:
         Therefore, this function is usually looped over.
         """
         position = self.get_field_position_from_jplace_fields(element_name)
-        placement = loads(self.placements[0], encoding="utf-8")
         element_value = None
-        for k, v in placement.items():
-            if k == 'p':
-                acc = 0
-                while acc < len(v):
-                    pquery_fields = v[acc]
-                    element_value = pquery_fields[position]
-                    acc += 1
+        if self.placements[0].loci:
+            element_value = self.placements[0].loci[-1][position]
         return element_value
 
     def filter_min_weight_threshold(self, threshold=0.1):
@@ -416,28 +426,15 @@ class ItolJplace:
             return
         # Filter the placements
         new_placement_collection = list()
-        placement_string = ""
         for pquery in self.placements:
-            placement = loads(pquery, encoding="utf-8")
-            dict_strings = list()
-            if len(placement["p"]) >= 1:
-                for k, v in placement.items():
-                    if k == 'p':
-                        tmp_placements = []
-                        for candidate in v:
-                            if float(candidate[x]) >= threshold:
-                                tmp_placements.append(candidate)
-
-                        # If no placements met the likelihood filter then the sequence cannot be classified
-                        # Alternatively: first two will be returned and used for LCA - can test...
-                        if len(tmp_placements) > 0:
-                            v = tmp_placements
-                            dict_strings.append(dumps(k) + ':' + dumps(v))
-                            placement_string = ', '.join(dict_strings)
-                        else:
-                            self.classified = False
+            if len(pquery.loci) >= 1:
+                tmp_placements = [candidate for candidate in pquery.loci if float(candidate[x]) >= threshold]
+                # If no placements met the likelihood filter then the sequence cannot be classified
+                # Alternatively: first two will be returned and used for LCA - can test...
+                if len(tmp_placements) == 0:
+                    self.classified = False
                 # Add the filtered placements back to the object.placements
-                new_placement_collection.append('{' + placement_string + '}')
+                new_placement_collection.append(JPlacePQuery(pquery.names, tmp_placements))
             else:
                 # If there is only one placement, the LWR is 1.0 so no filtering required!
                 new_placement_collection.append(pquery)
@@ -453,21 +450,18 @@ class ItolJplace:
         :return: dict()
         """
         for pquery in self.placements:
-            placement = loads(pquery, encoding="utf-8")
-            for k, v in placement.items():
-                if k == 'p':
-                    for locus in v:
-                        jplace_node = locus[0]
-                        tree_leaves = self.node_map[jplace_node]
-                        try:
-                            normalized_abundance = float(self.abundance/len(tree_leaves))
-                        except TypeError:
-                            logging.warning("Unable to find abundance for " + self.contig_name + "... setting to 0.\n")
-                            normalized_abundance = 0.0
-                        for tree_leaf in tree_leaves:
-                            if tree_leaf not in leaf_rpkm_sums.keys():
-                                leaf_rpkm_sums[tree_leaf] = 0.0
-                            leaf_rpkm_sums[tree_leaf] += normalized_abundance
+            for locus in pquery.loci:
+                jplace_node = locus[0]
+                tree_leaves = self.node_map[jplace_node]
+                try:
+                    normalized_abundance = float(self.abundance/len(tree_leaves))
+                except TypeError:
+                    logging.warning("Unable to find abundance for " + self.contig_name + "... setting to 0.\n")
+                    normalized_abundance = 0.0
+                for tree_leaf in tree_leaves:
+                    if tree_leaf not in leaf_rpkm_sums.keys():
+                        leaf_rpkm_sums[tree_leaf] = 0.0
+                    leaf_rpkm_sums[tree_leaf] += normalized_abundance
         return leaf_rpkm_sums
 
     def filter_max_weight_placement(self):
@@ -483,70 +477,28 @@ class ItolJplace:
 
         # Filter the placements
         new_placement_collection = list()
-        placement_string = ""
         for pquery in self.placements:
-            placement = loads(pquery, encoding="utf-8")
-            if placement:
-                dict_strings = list()
-                max_lwr = 0
-                if len(placement["p"]) > 1:
-                    for k, v in placement.items():
-                        if k == 'p':
-                            acc = 0
-                            tmp_placements = deepcopy(v)
-                            while acc < len(tmp_placements):
-                                candidate = tmp_placements[acc]
-                                if float(candidate[x]) > max_lwr:
-                                    v = [tmp_placements.pop(acc)]
-                                    max_lwr = candidate[x]
-                                else:
-                                    acc += 1
-                        dict_strings.append(dumps(k) + ':' + dumps(v))
-                        placement_string = ', '.join(dict_strings)
-                    # Add the filtered placements back to the object.placements
-                    new_placement_collection.append('{' + placement_string + '}')
-                else:
-                    new_placement_collection.append(pquery)
+            if not pquery.loci:
+                continue
+            if len(pquery.loci) > 1:
+                # The first of the placements with the maximum LWR is kept
+                best_locus = pquery.loci[0]
+                for candidate in pquery.loci[1:]:
+                    if float(candidate[x]) > float(best_locus[x]):
+                        best_locus = candidate
+                new_placement_collection.append(JPlacePQuery(pquery.names, [best_locus]))
+            else:
+                new_placement_collection.append(pquery)
         self.placements = new_placement_collection
         return
 
     def create_jplace_node_map(self):
         """
-        Loads a mapping between all nodes (internal and leaves) and all leaves
+        Loads a mapping between all nodes (internal and leaves) and all leaves.
+        When many pqueries are placed on the same tree the node map from entish.index_jplace_tree should be shared.
         :return:
         """
-        no_length_tree = re.sub(":[0-9.]+{", ":{", self.tree)
-        self.node_map.clear()
-        node_stack = list()
-        leaf_stack = list()
-        x = 0
-        num_buffer = ""
-        while x < len(no_length_tree):
-            c = no_length_tree[x]
-            if re.search(r"[0-9]", c):
-                while re.search(r"[0-9]", c):
-                    num_buffer += c
-                    x += 1
-                    c = no_length_tree[x]
-                node_stack.append([str(num_buffer)])
-                num_buffer = ""
-                x -= 1
-            elif c == ':':
-                # Append the most recent leaf
-                current_node, x = get_node(no_length_tree, x + 1)
-                self.node_map[current_node] = node_stack.pop()
-                leaf_stack.append(current_node)
-            elif c == ')':
-                # Set the child leaves to the leaves of the current node's two children
-                while c == ')' and x < len(no_length_tree):
-                    if no_length_tree[x + 1] == ';':
-                        break
-                    current_node, x = get_node(no_length_tree, x + 2)
-                    self.node_map[current_node] = self.node_map[leaf_stack.pop()] + self.node_map[leaf_stack.pop()]
-                    leaf_stack.append(current_node)
-                    x += 1
-                    c = no_length_tree[x]
-            x += 1
+        self.node_map, _, _ = index_jplace_tree(self.tree)
         return
 
     def check_jplace(self, tree_index):
@@ -560,21 +512,15 @@ class ItolJplace:
         distal_pos = self.get_field_position_from_jplace_fields("distal_length")
         edge_pos = self.get_field_position_from_jplace_fields("edge_num")
         for pquery in self.placements:
-            placement = loads(pquery, encoding="utf-8")
-            if placement:
-                if len(placement["p"]) > 1:
-                    for k, v in placement.items():
-                        if k == 'p':
-                            for edge_placement in v:
-                                place_len = float(edge_placement[distal_pos])
-                                edge = edge_placement[edge_pos]
-                                tree_len = tree_index[str(edge)]
-                                if place_len > tree_len:
-                                    logging.debug("Distal length adjusted to fit JPlace " +
-                                                  self.name + " tree for " + self.contig_name + ".\n")
-                                    edge_placement[distal_pos] = tree_len
-                else:
-                    pass
+            if len(pquery.loci) > 1:
+                for edge_placement in pquery.loci:
+                    place_len = float(edge_placement[distal_pos])
+                    edge = edge_placement[edge_pos]
+                    tree_len = tree_index[str(edge)]
+                    if place_len > tree_len:
+                        logging.debug("Distal length adjusted to fit JPlace " +
+                                      self.name + " tree for " + self.contig_name + ".\n")
+                        edge_placement[distal_pos] = tree_len
 
         return
 
@@ -588,34 +534,39 @@ class ItolJplace:
         if self.name == "nr":
             self.name = "COGrRNA"
         reference_tree_file = tree_data_dir + os.sep + self.name + "_tree.txt"
-        reference_tree_elements = _tree_parser._read_the_reference_tree(reference_tree_file)
         lwr_pos = self.get_field_position_from_jplace_fields("like_weight_ratio")
-        if not lwr_pos:
+        edge_pos = self.get_field_position_from_jplace_fields("edge_num")
+        if lwr_pos is None or edge_pos is None:
             return
-        singular_placements = list()
-        for pquery in self.placements:
-            placement = loads(pquery, encoding="utf-8")
-            dict_strings = list()
-            for k, v in placement.items():
-                if len(v) > 1:
-                    lwr_sum = 0
-                    loci = list()
-                    for locus in v:
-                        lwr_sum += float(locus[lwr_pos])
-                        loci.append(str(self.node_map[locus[0]][0]))
-                    ancestral_node = _tree_parser._lowest_common_ancestor(reference_tree_elements, ','.join(loci))
-                    # Create a placement from the ancestor, and the first locus in loci fields
-                    v = [[ancestral_node, v[0][1], round(lwr_sum, 2), 0, 0]]
-                dict_strings.append(dumps(k) + ':' + dumps(v))
-            singular_placements.append('{' + ','.join(dict_strings) + '}')
-
-        self.placements = singular_placements
+        # Branch lengths are zeroed since the placement is moved to the ancestral node
+        length_positions = [self.get_field_position_from_jplace_fields(field_name)
+                            for field_name in ["distal_length", "pendant_length"]]
+        ambiguous_pqueries = [pquery for pquery in self.placements if len(pquery.loci) > 1]
+        if not ambiguous_pqueries:
+            return
+        # The LCAs of all pqueries are found with a single call to the reference tree's native handle
+        node_sets = [[self.node_map[locus[edge_pos]][0] for locus in pquery.loci] for pquery in ambiguous_pqueries]
+        tree_handle = load_reference_tree_handle(reference_tree_file)
+        ancestral_nodes = _tree_parser._lowest_common_ancestors(tree_handle, node_sets)
+        for pquery, ancestral_node in zip(ambiguous_pqueries, ancestral_nodes):
+            lwr_sum = 0
+            for locus in pquery.loci:
+                lwr_sum += float(locus[lwr_pos])
+            # Create a placement from the ancestor, and the first locus in loci fields
+            harmonized_locus = list(pquery.loci[0])
+            harmonized_locus[edge_pos] = ancestral_node
+            harmonized_locus[lwr_pos] = round(lwr_sum, 2)
+            for length_pos in length_positions:
+                if length_pos is not None:
+                    harmonized_locus[length_pos] = 0
+            pquery.loci = [harmonized_locus]
         return
 
     def clear_object(self):
         self.placements.clear()
         self.fields.clear()
-        self.node_map.clear()
+        # The node map may be shared by pqueries placed on the same tree so it is replaced rather than cleared
+        self.node_map = dict()
         self.contig_name = ""
         self.name = ""
         self.tree = ""
@@ -732,96 +683,6 @@ class TreeLeafReference:
             self.analysis_type = ""
 
 
-class CommandLineWorker(Process):
-    def __init__(self, task_queue, commander):
-        Process.__init__(self)
-        self.task_queue = task_queue
-        self.master = commander
-
-    def run(self):
-        while True:
-            next_task = self.task_queue.get()
-            if next_task is None:
-                # Poison pill means shutdown
-                self.task_queue.task_done()
-                break
-            logging.debug("STAGE: " + self.master + "\n" +
-                          "\tCOMMAND:\n" + " ".join(next_task) + "\n")
-            launch_write_command(next_task)
-            self.task_queue.task_done()
-        return
-
-
-class CommandLineFarmer:
-    """
-    A worker that will launch command-line jobs using multiple processes in its queue
-    """
-
-    def __init__(self, command, num_threads):
-        """
-        Instantiate a CommandLineFarmer object to oversee multiprocessing of command-line jobs
-        :param command:
-        :param num_threads:
-        """
-        self.max_size = 32767  # The actual size limit of a JoinableQueue
-        self.task_queue = JoinableQueue(self.max_size)
-        self.num_threads = int(num_threads)
-
-        process_queues = [CommandLineWorker(self.task_queue, command) for i in range(int(self.num_threads))]
-        for process in process_queues:
-            process.start()
-
-    def add_tasks_to_queue(self, task_list):
-        """
-        Function for adding commands from task_list to task_queue while ensuring space in the JoinableQueue
-        :param task_list: List of commands
-        :return: Nothing
-        """
-        num_tasks = len(task_list)
-
-        task = task_list.pop()
-        while task:
-            if not self.task_queue.full():
-                self.task_queue.put(task)
-                if num_tasks > 1:
-                    task = task_list.pop()
-                    num_tasks -= 1
-                else:
-                    task = None
-
-        i = self.num_threads
-        while i:
-            if not self.task_queue.full():
-                self.task_queue.put(None)
-                i -= 1
-
-        return
-
-
-class NodeRetrieverWorker(Process):
-    """
-    Doug Hellman's Consumer class for handling processes via queues
-    """
-
-    def __init__(self, task_queue, result_queue):
-        Process.__init__(self)
-        self.task_queue = task_queue
-        self.result_queue = result_queue
-
-    def run(self):
-        while True:
-            next_task = self.task_queue.get()
-            if next_task is None:
-                # Poison pill means shutdown
-                self.task_queue.task_done()
-                break
-            result = _tree_parser._build_subtrees_newick(next_task)
-            subtrees = subtrees_to_dictionary(result, create_tree_info_hash())
-            self.task_queue.task_done()
-            self.result_queue.put(subtrees)
-        return
-
-
 def get_header_info(header_registry, code_name=''):
     """
 
@@ -1053,6 +914,7 @@ class TreeSAPP:
         # Values that need to be entered later, in the command-specific class
         self.stages = dict()  # Used to track what progress stages need to be completed
         self.stage_file = ""  # The file to write progress updates to
+        self.profiler = StageProfiler()  # Records the time and memory used by each stage
 
     def get_info(self):
         info_string = "Executables:\n\t" + "\n\t".join([k + ": " + v for k, v in self.executables.items()]) + "\n"
@@ -1083,6 +945,8 @@ class TreeSAPP:
             self.var_output_dir = args.output + "intermediates" + os.sep
             self.sample_prefix = '.'.join(os.path.basename(args.input).split('.')[:-1])
             self.formatted_input = self.var_output_dir + self.sample_prefix + "_formatted.fasta"
+        if "cprofile" in vars(args) and args.cprofile:
+            self.profiler = StageProfiler(detailed=True)
         self.executables = self.find_executables(args)
 
     def check_previous_output(self, args):
@@ -1129,6 +993,23 @@ class TreeSAPP:
                 logging.warning("Reclassify impossible as " + self.output_dir + " is missing input files.\n")
         return
 
+    def report_resource_usage(self):
+        """
+        Logs the resources used by each stage's external processes and writes the details of every process
+        to resource_usage.tsv and resource_usage.json in the final outputs directory.
+        The records are cleared afterwards so consecutive runs (e.g. samples) are reported separately.
+
+        :return: None
+        """
+        if not resource_usage():
+            return
+        report_dir = self.final_output_dir if os.path.isdir(self.final_output_dir) else self.output_dir
+        logging.info(summarize_resource_usage())
+        if report_dir:
+            write_resource_report(report_dir + "resource_usage")
+        clear_resource_usage()
+        return
+
     def stage_lookup(self, name: str, tolerant=False):
         """
         Used for looking up a stage in self.stages by its stage.name
@@ -1147,6 +1028,31 @@ class TreeSAPP:
             sys.exit(3)
         return
 
+    def begin_stage(self, name: str):
+        """
+        Ends the stage currently being profiled and starts profiling the stage called name,
+        which must be one of self.stages (see stage_lookup)
+        :param name: Name of a stage
+        :return: None
+        """
+        self.profiler.start(self.stage_lookup(name).name)
+        return
+
+    def write_performance_profile(self):
+        """
+        Logs the time and memory used by each stage and writes them to performance_profile.json
+        in the final outputs directory. With --cprofile, the cProfile statistics of each stage are written there too.
+        :return: None
+        """
+        self.profiler.stop()
+        if not self.profiler.stages:
+            return
+        profile_dir = self.final_output_dir if os.path.isdir(self.final_output_dir) else self.output_dir
+        logging.info(self.profiler.summarize())
+        if profile_dir:
+            self.profiler.write(profile_dir + "performance_profile.json", profile_dir + "profile_")
+        return
+
     def first_stage(self):
         for x in sorted(self.stages, key=int):  # type: int
             stage = self.stages[x]  # type: ModuleFunction
@@ -1301,6 +1207,10 @@ class TreeSAPP:
         # Extra executables necessary for certain modes of TreeSAPP
         if self.command == "assign":
             dependencies += ["bwa", "rpkm"]
+            if args.single_hmm_db:
+                dependencies += ["hmmscan", "hmmpress"]
+            if args.placement_engine != "raxml":
+                dependencies.append(args.placement_engine)
 
         if self.command == "update":
             dependencies += ["usearch", "blastn", "blastp", "makeblastdb", "mafft"]
@@ -1961,52 +1871,49 @@ class Assigner(TreeSAPP):
         start_time = time.time()
 
         if num_threads > 1 and composition == "meta":
-            # Split the input FASTA into num_threads files to run Prodigal in parallel
-            input_fasta_dict = format_read_fasta(self.input_sequences, self.molecule_type, self.output_dir)
-            n_seqs = len(input_fasta_dict.keys())
-            chunk_size = int(n_seqs / num_threads) + (n_seqs % num_threads)
-            split_files = write_new_fasta(input_fasta_dict,
-                                          self.var_output_dir + self.sample_prefix,
-                                          chunk_size)
+            # Split the input FASTA into num_threads contiguous shards with approximately equal numbers of bases.
+            # Prodigal's metagenome mode predicts genes on each sequence independently, so sharding is lossless.
+            shards = split_fasta_by_length(self.input_sequences, self.var_output_dir + self.sample_prefix, num_threads)
         else:
-            split_files = [self.input_sequences]
+            shards = [(self.input_sequences, 0)]
 
         task_list = list()
-        for fasta_chunk in split_files:
+        aa_orf_shards = list()
+        nuc_orf_shards = list()
+        for fasta_chunk, _ in shards:
             chunk_prefix = self.var_output_dir + '.'.join(os.path.basename(fasta_chunk).split('.')[:-1])
+            aa_orf_shards.append(chunk_prefix + "_ORFs.faa")
+            nuc_orf_shards.append(chunk_prefix + "_ORFs.fna")
             prodigal_command = [self.executables["prodigal"]]
             prodigal_command += ["-i", fasta_chunk]
             prodigal_command += ["-p", composition]
-            prodigal_command += ["-a", chunk_prefix + "_ORFs.faa"]
-            prodigal_command += ["-d", chunk_prefix + "_ORFs.fna"]
+            prodigal_command += ["-a", aa_orf_shards[-1]]
+            prodigal_command += ["-d", nuc_orf_shards[-1]]
             prodigal_command += ["1>/dev/null", "2>/dev/null"]
             task_list.append(prodigal_command)
 
-        num_tasks = len(task_list)
-        if num_tasks > 0:
-            cl_farmer = CommandLineFarmer("Prodigal -p " + composition, num_threads)
-            cl_farmer.add_tasks_to_queue(task_list)
-
-            cl_farmer.task_queue.close()
-            cl_farmer.task_queue.join()
+        if len(task_list) > 0:
+            executor = JobExecutor(num_threads, stage="Prodigal -p " + composition)
+            for prodigal_command, shard in zip(task_list, shards):
+                executor.submit(prodigal_command, threads=1, memory=50 + 2 * os.path.getsize(shard[0]) / 1E6)
+            executor.run()
+            executor.exit_on_failure(19)
 
-        # Concatenate outputs
+        # Concatenate outputs in the order of the shards, offsetting the sequence numbers in the ORF IDs
         if not os.path.isfile(self.aa_orfs_file) and not os.path.isfile(self.nuc_orfs_file):
-            tmp_prodigal_aa_orfs = glob(self.var_output_dir + self.sample_prefix + "*_ORFs.faa")
-            tmp_prodigal_nuc_orfs = glob(self.var_output_dir + self.sample_prefix + "*_ORFs.fna")
-            os.system("cat " + ' '.join(tmp_prodigal_aa_orfs) + " > " + self.aa_orfs_file)
-            os.system("cat " + ' '.join(tmp_prodigal_nuc_orfs) + " > " + self.nuc_orfs_file)
-            intermediate_files = list(tmp_prodigal_aa_orfs + tmp_prodigal_nuc_orfs + split_files)
+            seq_offsets = [offset for _, offset in shards]
+            merge_prodigal_orfs(aa_orf_shards, seq_offsets, self.aa_orfs_file)
+            merge_prodigal_orfs(nuc_orf_shards, seq_offsets, self.nuc_orfs_file)
+            intermediate_files = aa_orf_shards + nuc_orf_shards
+            if len(shards) > 1 or shards[0][0] != self.input_sequences:
+                intermediate_files += [fasta_chunk for fasta_chunk, _ in shards]
             for tmp_file in intermediate_files:
-                os.remove(tmp_file)
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
 
         logging.info("done.\n")
 
-        end_time = time.time()
-        hours, remainder = divmod(end_time - start_time, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        logging.debug("\tProdigal time required: " +
-                      ':'.join([str(hours), str(minutes), str(round(seconds, 2))]) + "\n")
+        logging.debug("\tProdigal time required: " + format_elapsed_time(time.time() - start_time) + "\n")
 
         return
 
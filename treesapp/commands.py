@@ -4,6 +4,7 @@ import sys
 import re
 import os
 import shutil
+from copy import deepcopy
 from random import randint
 from . import entrez_utils
 from . import file_parsers
@@ -24,10 +25,13 @@ from .classy import TreeProtein, MarkerBuild, TreeSAPP, Assigner, Evaluator, Cre
     prep_logging, dedup_records, TaxonTest, Purity
 from . import create_refpkg
 from .assign import abundify_tree_saps, delete_files, validate_inputs,\
-    get_alignment_dims, extract_hmm_matches, write_grouped_fastas, create_ref_phy_files,\
+    get_alignment_dims, extract_hmm_matches, write_grouped_fastas, create_ref_phy_files, search_homologs,\
+    search_query_chunks, load_reference_data,\
     multiple_alignments, get_sequence_counts, check_for_removed_sequences,\
     evaluate_trimming_performance, produce_phy_files, parse_raxml_output, filter_placements, align_reads_to_nucs,\
-    summarize_placements_rpkm, run_rpkm, write_tabular_output, produce_itol_inputs, replace_contig_names
+    summarize_placements_rpkm, run_rpkm, write_tabular_output, produce_itol_inputs, replace_contig_names,\
+    fan_out_duplicates, retrieve_cached_placements, write_cached_placements, store_placements, MarkerPipeline
+from .placement_cache import PlacementCache
 from .jplace_utils import sub_indices_for_seq_names_jplace, jplace_parser, demultiplex_pqueries
 from .clade_exclusion_evaluator import pick_taxonomic_representatives, select_rep_seqs,\
     map_seqs_to_lineages, prep_graftm_ref_files, build_graftm_package, map_headers_to_lineage, graftm_classify,\
@@ -112,6 +116,7 @@ def train(sys_args):
         sys.exit(33)
 
     if ts_trainer.stage_status("search"):
+        ts_trainer.begin_stage("search")
         # Read the FASTA into a dictionary - homologous sequences will be extracted from this
         ref_seqs.fasta_dict = fasta.format_read_fasta(ts_trainer.input_sequences, ts_trainer.molecule_type, ts_trainer.output_dir)
         ref_seqs.header_registry = fasta.register_headers(fasta.get_headers(ts_trainer.input_sequences))
@@ -132,9 +137,11 @@ def train(sys_args):
         ref_seqs.change_dict_keys("formatted")
         ts_trainer.hmm_purified_seqs = ts_trainer.input_sequences
 
+    ts_trainer.begin_stage("lineages")
     ts_trainer.fetch_entrez_lineages(ref_seqs, args.molecule, args.acc_to_taxid)
 
     # Read in the reference fasta file
+    ts_trainer.begin_stage("place")
     ref_fasta_dict = fasta.read_fasta_to_dict(ts_trainer.ref_pkg.msa)
 
     taxa_evo_dists = dict()
@@ -168,6 +175,7 @@ def train(sys_args):
             logging.info("Unable to complete phylogenetic distance and rank correlation.\n")
 
     # Write the text file containing distances used in the regression analysis
+    ts_trainer.begin_stage("regress")
     with open(ts_trainer.placement_summary, 'w') as out_handler:
         trained_string = "Regression parameters = " + re.sub(' ', '', str(pfit_array)) + "\n"
         ranks = ["Phylum", "Class", "Order", "Family", "Genus", "Species"]
@@ -178,6 +186,9 @@ def train(sys_args):
             trained_string += "\n"
         out_handler.write(trained_string)
 
+    ts_trainer.write_performance_profile()
+    ts_trainer.report_resource_usage()
+
     return
 
 
@@ -213,6 +224,7 @@ def create(sys_args):
     ref_seqs = fasta.FASTA(args.input)
 
     if ts_create.stage_status("search"):
+        ts_create.begin_stage("search")
         # Read the FASTA into a dictionary - homologous sequences will be extracted from this
         ref_seqs.fasta_dict = fasta.format_read_fasta(args.input, ts_create.molecule_type, ts_create.output_dir)
         ref_seqs.header_registry = fasta.register_headers(fasta.get_headers(args.input))
@@ -252,10 +264,12 @@ def create(sys_args):
     # Using the accession-lineage-map (if available) map the sequence names to their respective lineages
     # Proceed with creating the Entrez-queries for sequences lacking lineage information
     ##
+    ts_create.begin_stage("lineages")
     fasta_records = ts_create.fetch_entrez_lineages(ref_seqs, args.molecule, args.acc_to_taxid)
     create_refpkg.fill_ref_seq_lineages(fasta_records, ts_create.seq_lineage_map)
 
     if ts_create.stage_status("clean"):
+        ts_create.begin_stage("clean")
         # Remove the sequences failing 'filter' and/or only retain the sequences in 'screen'
         fasta_records = create_refpkg.screen_filter_taxa(fasta_records, args.screen, args.filter, ref_seqs.amendments)
         # Remove the sequence records with low resolution lineages, according to args.min_taxonomic_rank
@@ -279,6 +293,7 @@ def create(sys_args):
     # Optionally cluster the input sequences using USEARCH at the specified identity
     ##
     if ts_create.stage_status("cluster"):
+        ts_create.begin_stage("cluster")
         ref_seqs.change_dict_keys("num")
         # Write a FASTA for clustering containing the formatted headers since
         # not all clustering tools + versions keep whole header - spaces are replaced with underscores
@@ -328,6 +343,7 @@ def create(sys_args):
                 # fasta_records[num_id].cluster_lca is left empty
 
     if ts_create.stage_status("build"):
+        ts_create.begin_stage("build")
         # TODO: Have a command-line flag to toggle this on (DEFAULT) and off
         fasta_records = create_refpkg.remove_outlier_sequences(fasta_records,
                                                                ts_create.executables["OD-seq"],
@@ -421,7 +437,7 @@ def create(sys_args):
                 sys.exit(13)
             # There is only a single trimmed-MSA file in the dictionary
             for trimmed_msa_file in qc_ma_dict:
-                dict_for_phy = qc_ma_dict[trimmed_msa_file]
+                dict_for_phy = qc_ma_dict[trimmed_msa_file].to_dict()
                 os.remove(trimmed_msa_file)
         else:
             for seq_name in ref_aligned_fasta_dict:
@@ -463,6 +479,7 @@ def create(sys_args):
     if args.trim_align:
         trainer_cmd.append("--trim_align")
     if ts_create.stage_status("train"):
+        ts_create.begin_stage("train")
         train(trainer_cmd)
     else:
         logging.info("Skipping training:\n$ treesapp train" + ' '.join(trainer_cmd))
@@ -471,6 +488,7 @@ def create(sys_args):
     # Finish validating the file and append the reference package build parameters to the master table
     ##
     if ts_create.stage_status("update"):
+        ts_create.begin_stage("update")
         if args.fast:
             marker_package.tree_tool = "FastTree"
         else:
@@ -490,6 +508,9 @@ def create(sys_args):
     logging.info("Data for " + ts_create.ref_pkg.prefix + " has been generated successfully.\n")
     ts_create.remove_intermediates()
 
+    ts_create.write_performance_profile()
+    ts_create.report_resource_usage()
+
     return
 
 
@@ -556,6 +577,7 @@ def update(sys_args):
     ##
     # Add lineages - use taxa if provided with a table mapping contigs to taxa, TreeSAPP-assigned taxonomy otherwise
     ##
+    ts_updater.begin_stage("lineages")
     classified_seq_lineage_map = dict()
     # need_lineage_list = set(classified_fasta.header_registry.keys())  # TreeSAPP IDs that still need lineages
     querying_classified_fasta = classified_fasta
@@ -680,6 +702,7 @@ def update(sys_args):
     ##
     # Call create to create a new, updated reference package where the new sequences are guaranteed
     ##
+    ts_updater.begin_stage("rebuild")
     create_cmd = ["-i", ts_updater.combined_fasta,
                   "-c", ts_updater.ref_pkg.prefix,
                   "-p", str(ts_updater.prop_sim),
@@ -714,6 +737,9 @@ def update(sys_args):
     logging.debug("\tOld HMM length = " + str(hmm_length) + "\n" +
                   "\tNew HMM length = " + str(new_hmm_length) + "\n")
 
+    ts_updater.write_performance_profile()
+    ts_updater.report_resource_usage()
+
     return
 
 
@@ -837,6 +863,10 @@ def assign(sys_args):
     add_classify_arguments(parser)
     args = parser.parse_args(sys_args)
 
+    if args.manifest:
+        assign_samples(args, sys_args)
+        return
+
     ts_assign = Assigner()
     ts_assign.furnish_with_arguments(args)
     ts_assign.check_previous_output(args)
@@ -849,71 +879,199 @@ def assign(sys_args):
     check_classify_arguments(ts_assign, args)
     ts_assign.validate_continue(args)
 
-    marker_build_dict = file_parsers.parse_ref_build_params(ts_assign.treesapp_dir,
-                                                            ts_assign.target_refpkgs)
-    ref_alignment_dimensions = get_alignment_dims(ts_assign.treesapp_dir, marker_build_dict)
-    tree_numbers_translation = file_parsers.read_species_translation_files(ts_assign.treesapp_dir, marker_build_dict)
-    if args.check_trees:
-        validate_inputs(args, marker_build_dict)
+    ref_data = load_reference_data(ts_assign, args)
+    assign_sample(ts_assign, args, ref_data)
 
-    ##
-    # STAGE 2: Predict open reading frames (ORFs) if the input is an assembly, read, format and write the FASTA
-    ##
-    if ts_assign.stage_status("orf-call"):
-        ts_assign.predict_orfs(args.composition, args.num_threads)
-        ts_assign.query_sequences = ts_assign.aa_orfs_file
-    else:
-        ts_assign.query_sequences = ts_assign.input_sequences
-
-    query_seqs = fasta.FASTA(ts_assign.query_sequences)
-    # Read the query sequences provided and (by default) write a new FASTA file with formatted headers
-    if ts_assign.stage_status("clean"):
-        logging.info("Reading and formatting " + ts_assign.query_sequences + "... ")
-        query_seqs.fasta_dict = fasta.format_read_fasta(ts_assign.query_sequences, "prot", ts_assign.output_dir)
-        query_seqs.header_registry = fasta.register_headers(fasta.get_headers(ts_assign.query_sequences), True)
-        query_seqs.change_dict_keys("num")
-        logging.info("done.\n")
-        logging.info("Writing formatted FASTA file to " + ts_assign.formatted_input + "... ")
-        fasta.write_new_fasta(query_seqs.fasta_dict, ts_assign.formatted_input)
-        logging.info("done.\n")
+    return
+
+
+def assign_samples(args, sys_args):
+    """
+    Classifies each of the samples listed in a manifest (provided as the input) with a single TreeSAPP invocation.
+    The reference package data (including the reference trees loaded by filter_placements) is loaded once and
+    shared by all samples, and each sample's outputs are written to its own sub-directory of the output directory,
+    named after the sample. Samples are classified sequentially; each stage creates its own JobExecutor with all
+    of the threads, so no worker pools are shared between samples.
+
+    :param args: Command-line arguments parsed by the assign sub-command's argument parser
+    :param sys_args: Unparsed command-line arguments passed to assign
+    :return: None
+    """
+    if args.output[-1] != os.sep:
+        args.output += os.sep
+    log_file_name = args.output + "TreeSAPP_classify_log.txt"
+    prep_logging(log_file_name, args.verbose)
+    logging.info("\n##\t\t\t\tAssigning sequences with TreeSAPP\t\t\t\t##\n\n")
+
+    check_parser_arguments(args, sys_args)
+    samples = file_parsers.read_sample_manifest(args.input)
+
+    # Prepare the output directories and arguments for all samples before running any, so errors are caught early
+    sample_assigners = list()
+    for sample_name, sample_fasta, reads, reverse in samples:
+        # A deep copy so changes to mutable arguments by one sample's checks are not seen by the others
+        sample_args = deepcopy(args)
+        sample_args.input = sample_fasta
+        sample_args.output = args.output + sample_name + os.sep
+        if reads:
+            sample_args.reads = reads
+            sample_args.reverse = reverse
+        ts_assign = Assigner()
+        ts_assign.furnish_with_arguments(sample_args)
+        ts_assign.sample_prefix = sample_name
+        ts_assign.formatted_input = ts_assign.var_output_dir + ts_assign.sample_prefix + "_formatted.fasta"
+        ts_assign.check_previous_output(sample_args)
+        check_classify_arguments(ts_assign, sample_args)
+        ts_assign.validate_continue(sample_args)
+        sample_assigners.append((ts_assign, sample_args))
+
+    ref_data = load_reference_data(sample_assigners[0][0], args)
+    for ts_assign, sample_args in sample_assigners:
+        logging.info("\n##\t\t\tAssigning sequences in sample '" + ts_assign.sample_prefix + "'\t\t\t##\n\n")
+        assign_sample(ts_assign, sample_args, ref_data)
+
+    return
+
+
+def collapse_duplicates(query_seqs: fasta.FASTA):
+    """
+    Removes the duplicate sequences from query_seqs, leaving one representative of each group of identical sequences
+    to be searched, aligned and placed.
+
+    :param query_seqs: A FASTA instance with the query sequences, indexed by their numerical TreeSAPP IDs
+    :return: Dictionary mapping the original header of each representative to a list of its duplicates' headers
+    """
+    duplicates = query_seqs.collapse_duplicate_sequences()
+    duplicate_headers = dict()
+    for rep_id in duplicates:
+        duplicate_headers[query_seqs.header_registry[rep_id].original] = [query_seqs.header_registry[num_id].original
+                                                                          for num_id in duplicates[rep_id]]
+    num_duplicates = sum([len(duplicates[rep_id]) for rep_id in duplicates])
+    logging.info("\t" + str(num_duplicates) + " duplicate sequences were collapsed into " +
+                 str(len(duplicates)) + " representatives.\n")
+    return duplicate_headers
+
+
+def assign_sample(ts_assign: Assigner, args, ref_data: dict):
+    """
+    Runs the assign stages that follow argument-parsing and reference package loading on a single sample.
+
+    :param ts_assign: An Assigner instance that has been furnished with the sample's arguments
+    :param args: Command-line arguments for the sample, checked by check_classify_arguments
+    :param ref_data: A dictionary of the reference package data returned by load_reference_data
+    :return: None
+    """
+    marker_build_dict = ref_data["marker_build_dict"]
+    ref_alignment_dimensions = ref_data["alignment_dimensions"]
+    tree_numbers_translation = ref_data["tree_numbers_translation"]
+
+    duplicate_headers = dict()
+    if (args.chunk_size or args.chunk_mb) and ts_assign.stage_status("search"):
+        ##
+        # STAGES 2 and 3: Predict ORFs, format and search the input in batches, retaining only the homologs
+        ##
+        ts_assign.begin_stage("search")
+        query_seqs, hmm_matches = search_query_chunks(ts_assign, args, marker_build_dict)
     else:
-        ts_assign.formatted_input = ts_assign.query_sequences
-        query_seqs.load_fasta()
-        query_seqs.change_dict_keys("num")  # Swap the formatted headers for the numerical IDs for quick look-ups
-    logging.info("\tTreeSAPP will analyze the " + str(len(query_seqs.fasta_dict)) + " sequences found in input.\n")
+        ##
+        # STAGE 2: Predict open reading frames (ORFs) if the input is an assembly, read, format and write the FASTA
+        ##
+        if ts_assign.stage_status("orf-call"):
+            ts_assign.begin_stage("orf-call")
+            ts_assign.predict_orfs(args.composition, args.num_threads)
+            ts_assign.query_sequences = ts_assign.aa_orfs_file
+        else:
+            ts_assign.query_sequences = ts_assign.input_sequences
+
+        query_seqs = fasta.FASTA(ts_assign.query_sequences)
+        # Read the query sequences provided and (by default) write a new FASTA file with formatted headers
+        if ts_assign.stage_status("clean"):
+            ts_assign.begin_stage("clean")
+            logging.info("Reading and formatting " + ts_assign.query_sequences + "... ")
+            query_seqs.fasta_dict = fasta.format_read_fasta(ts_assign.query_sequences, "prot", ts_assign.output_dir)
+            query_seqs.header_registry = fasta.register_headers(fasta.get_headers(ts_assign.query_sequences), True)
+            query_seqs.change_dict_keys("num")
+            logging.info("done.\n")
+            num_seqs = len(query_seqs.fasta_dict)
+            if args.dedup:
+                duplicate_headers = collapse_duplicates(query_seqs)
+            logging.info("Writing formatted FASTA file to " + ts_assign.formatted_input + "... ")
+            fasta.write_new_fasta(query_seqs.fasta_dict, ts_assign.formatted_input)
+            logging.info("done.\n")
+        else:
+            ts_assign.formatted_input = ts_assign.query_sequences
+            query_seqs.load_fasta()
+            query_seqs.change_dict_keys("num")  # Swap the formatted headers for the numerical IDs for quick look-ups
+            num_seqs = len(query_seqs.fasta_dict)
+            if args.dedup:
+                duplicate_headers = collapse_duplicates(query_seqs)
+                if duplicate_headers:
+                    # Only the representative sequences are searched
+                    ts_assign.formatted_input = ts_assign.var_output_dir + ts_assign.sample_prefix + "_dedup.fasta"
+                    fasta.write_new_fasta(query_seqs.fasta_dict, ts_assign.formatted_input)
+        logging.info("\tTreeSAPP will analyze the " + str(num_seqs) + " sequences found in input.\n")
+
+        ##
+        # STAGE 3: Run hmmsearch on the query sequences to search for marker homologs
+        ##
+        if ts_assign.stage_status("search"):
+            ts_assign.begin_stage("search")
+            hmm_matches = search_homologs(ts_assign, args, marker_build_dict, ts_assign.formatted_input,
+                                          ts_assign.var_output_dir, num_seqs)
+
+    placement_cache = None
+    cached_jplaces = dict()
+    if args.placement_cache:
+        placement_cache = PlacementCache(args.placement_cache, args.placement_cache_mb, args.placement_cache_days)
 
-    ##
-    # STAGE 3: Run hmmsearch on the query sequences to search for marker homologs
-    ##
     if ts_assign.stage_status("search"):
-        hmm_domtbl_files = wrapper.hmmsearch_orfs(ts_assign.executables["hmmsearch"], ts_assign.hmm_dir,
-                                                  marker_build_dict, ts_assign.formatted_input,
-                                                  ts_assign.var_output_dir, args.num_threads)
-        hmm_matches = file_parsers.parse_domain_tables(args, hmm_domtbl_files)
         extracted_seq_dict, numeric_contig_index = extract_hmm_matches(hmm_matches, query_seqs.fasta_dict)
         numeric_contig_index = replace_contig_names(numeric_contig_index, query_seqs)
-        homolog_seq_files = write_grouped_fastas(extracted_seq_dict, numeric_contig_index,
+        if placement_cache:
+            # Only the sequences without a cached placement are aligned and placed
+            uncached_seq_dict, cached_jplaces = retrieve_cached_placements(ts_assign, args, placement_cache,
+                                                                           extracted_seq_dict, marker_build_dict)
+        else:
+            uncached_seq_dict = extracted_seq_dict
+        homolog_seq_files = write_grouped_fastas(uncached_seq_dict, numeric_contig_index,
                                                  marker_build_dict, ts_assign.var_output_dir)
 
     ##
     # STAGE 4: Run hmmalign or PaPaRa, and optionally BMGE, to produce the MSAs required to for the ML estimations
     ##
-    if ts_assign.stage_status("align"):
+    phy_files = dict()
+    jplace_files = list()
+    pipelined = args.pipeline and ts_assign.stage_status("align") and ts_assign.stage_status("place")
+    if pipelined and homolog_seq_files:
+        # STAGES 4 and 5 run on each reference package as soon as its previous step is finished
+        # so the time spent placing queries is profiled as part of the align stage
+        ts_assign.begin_stage("align")
         create_ref_phy_files(ts_assign.aln_dir, ts_assign.var_output_dir,
                              homolog_seq_files, marker_build_dict, ref_alignment_dimensions)
+        marker_pipeline = MarkerPipeline(ts_assign, args, marker_build_dict, ref_alignment_dimensions)
+        phy_files, jplace_files = marker_pipeline.run(homolog_seq_files)
+        delete_files(args.delete, ts_assign.var_output_dir, 3)
+    elif ts_assign.stage_status("align") and homolog_seq_files:
+        ts_assign.begin_stage("align")
+        create_ref_phy_files(ts_assign.aln_dir, ts_assign.var_output_dir,
+                             homolog_seq_files, marker_build_dict, ref_alignment_dimensions)
+        # Alignments are kept in memory, indexed by their file paths, to avoid re-reading them in each step
+        msa_objects = dict()
         concatenated_msa_files = multiple_alignments(ts_assign.executables, ts_assign.refpkg_dir,
                                                      ts_assign.var_output_dir, homolog_seq_files, marker_build_dict,
-                                                     "hmmalign", args.num_threads)
+                                                     "hmmalign", args.num_threads, args.align_queries_only,
+                                                     msa_objects)
         file_type = utilities.find_msa_type(concatenated_msa_files)
         alignment_length_dict = get_sequence_counts(concatenated_msa_files, ref_alignment_dimensions,
-                                                    args.verbose, file_type)
+                                                    args.verbose, file_type, msa_objects)
 
         if args.trim_align:
-            tool = "BMGE"
+            tool = args.trim_engine
             trimmed_mfa_files = wrapper.filter_multiple_alignments(ts_assign.executables, concatenated_msa_files,
-                                                                   marker_build_dict, args.num_threads, tool)
+                                                                   marker_build_dict, args.num_threads, tool,
+                                                                   msa_objects)
             qc_ma_dict = check_for_removed_sequences(ts_assign.aln_dir, trimmed_mfa_files, concatenated_msa_files,
-                                                     marker_build_dict, args.min_seq_length)
+                                                     marker_build_dict, args.min_seq_length, msa_objects)
             evaluate_trimming_performance(qc_ma_dict, alignment_length_dict, concatenated_msa_files, tool)
             phy_files = produce_phy_files(qc_ma_dict)
         else:
@@ -924,16 +1082,26 @@ def assign(sys_args):
     # STAGE 5: Run RAxML to compute the ML estimations
     ##
     if ts_assign.stage_status("place"):
-        wrapper.launch_evolutionary_placement_queries(ts_assign.executables, ts_assign.tree_dir,
-                                                      phy_files, marker_build_dict,
-                                                      ts_assign.var_output_dir, args.num_threads)
+        ts_assign.begin_stage("place")
+        if not pipelined:
+            jplace_files = wrapper.launch_evolutionary_placement_queries(ts_assign.executables, ts_assign.tree_dir,
+                                                                         phy_files, marker_build_dict,
+                                                                         ts_assign.var_output_dir, args.num_threads,
+                                                                         args.placement_engine)
+        if placement_cache:
+            store_placements(ts_assign, args, placement_cache, jplace_files, extracted_seq_dict, marker_build_dict)
+            write_cached_placements(cached_jplaces, ts_assign.var_output_dir)
         sub_indices_for_seq_names_jplace(ts_assign.var_output_dir, numeric_contig_index, marker_build_dict)
 
     if ts_assign.stage_status("classify"):
+        ts_assign.begin_stage("classify")
         tree_saps, itol_data = parse_raxml_output(ts_assign.var_output_dir, ts_assign.tree_dir, marker_build_dict)
-        tree_saps = filter_placements(tree_saps, marker_build_dict, ts_assign.tree_dir, args.min_likelihood)
+        tree_saps = filter_placements(tree_saps, marker_build_dict, ts_assign.tree_dir, args.min_likelihood,
+                                      ref_data["trees"])
         # TODO: Replace this merge_fasta_dicts_by_index with FASTA - only necessary for writing the classified sequences
         extracted_seq_dict = fasta.merge_fasta_dicts_by_index(extracted_seq_dict, numeric_contig_index)
+        if duplicate_headers:
+            fan_out_duplicates(tree_saps, extracted_seq_dict, duplicate_headers)
         fasta.write_classified_sequences(tree_saps, extracted_seq_dict, ts_assign.classified_aa_seqs)
         abundance_dict = dict()
         rpkm_output_dir = ""
@@ -954,6 +1122,7 @@ def assign(sys_args):
                 logging.warning("Unable to read '" + ts_assign.nuc_orfs_file + "'.\n" +
                                 "Cannot create the nucleotide FASTA file of classified sequences!\n")
             if args.rpkm:
+                ts_assign.begin_stage("rpkm")
                 rpkm_output_dir = ts_assign.output_dir + "RPKM_outputs" + os.sep
                 sam_file = align_reads_to_nucs(ts_assign.executables["bwa"], ts_assign.classified_nuc_seqs,
                                                rpkm_output_dir, args)
@@ -970,14 +1139,19 @@ def assign(sys_args):
                     abundance_dict = utilities.rekey_dict(abundance_dict, header_map)
                     summarize_placements_rpkm(tree_saps, abundance_dict, marker_build_dict, ts_assign.final_output_dir)
 
+        ts_assign.begin_stage("classify")
         abundify_tree_saps(tree_saps, abundance_dict)
         assign_out = ts_assign.final_output_dir + os.sep + "marker_contig_map.tsv"
-        write_tabular_output(tree_saps, tree_numbers_translation, marker_build_dict, ts_assign.sample_prefix, assign_out)
+        write_tabular_output(tree_saps, tree_numbers_translation, marker_build_dict, ts_assign.sample_prefix,
+                             assign_out, ref_data["edge_taxonomy"])
         produce_itol_inputs(tree_saps, marker_build_dict, itol_data, ts_assign.output_dir, ts_assign.refpkg_dir)
         delete_files(args.delete, ts_assign.var_output_dir, 4, rpkm_output_dir)
 
     delete_files(args.delete, ts_assign.var_output_dir, 5)
 
+    ts_assign.write_performance_profile()
+    ts_assign.report_resource_usage()
+
     return
 
 
@@ -1009,6 +1183,7 @@ def purity(sys_args):
     ref_seqs.load_fasta()
 
     if ts_purity.stage_status("assign"):
+        ts_purity.begin_stage("assign")
         assign_args = ["-i", ts_purity.input_sequences, "-o", ts_purity.assign_dir,
                        "-m", ts_purity.molecule_type, "-n", str(args.num_threads),
                        "-t", ts_purity.refpkg_build.denominator,
@@ -1019,6 +1194,7 @@ def purity(sys_args):
             logging.error("TreeSAPP failed.\n")
 
     if ts_purity.stage_status("summarize"):
+        ts_purity.begin_stage("summarize")
         metadat_dict = dict()
         # Parse classification table and identify the groups that were assigned
         if os.path.isfile(ts_purity.classifications):
@@ -1051,6 +1227,9 @@ def purity(sys_args):
             summary_str += "\n\t".join(ortholog_map[ortholog_name]) + "\n"
         logging.debug(summary_str)
 
+    ts_purity.write_performance_profile()
+    ts_purity.report_resource_usage()
+
     return
 
 
@@ -1115,6 +1294,7 @@ def evaluate(sys_args):
 
     # Checkpoint three: We have accessions linked to taxa, and sequences to analyze with TreeSAPP, but not classified
     if ts_evaluate.stage_status("classify"):
+        ts_evaluate.begin_stage("classify")
         # Run TreeSAPP against the provided tax_ids file and the unique taxa FASTA file
         if args.length:
             min_seq_length = str(min(args.length - 10, 30))
@@ -1253,6 +1433,7 @@ def evaluate(sys_args):
         remove_clade_exclusion_files(ts_evaluate.var_output_dir + refpkg_name + os.sep)
 
     if ts_evaluate.stage_status("calculate"):
+        ts_evaluate.begin_stage("calculate")
         # everything has been prepared, only need to parse the classifications and map lineages
         logging.info("Finishing up the mapping of classified, filtered taxonomic sequences.\n")
         for rank in sorted(ts_evaluate.taxa_tests):
@@ -1312,4 +1493,7 @@ def evaluate(sys_args):
         containment_strings = determine_containment(ts_evaluate)
         ts_evaluate.write_containment_table(containment_strings, args.tool)
 
+    ts_evaluate.write_performance_profile()
+    ts_evaluate.report_resource_usage()
+
     return
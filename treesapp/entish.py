@@ -5,10 +5,15 @@ import re
 import _tree_parser
 import os
 import logging
+import numpy as np
 from .utilities import Autovivify, mean
+from .refpkg_cache import load_cached
 from ete3 import Tree
 from scipy import log2
 
+# Native tree handles (PyCapsules, which cannot be pickled) indexed by the reference tree elements string they load
+_tree_handles = dict()
+
 
 def get_node(tree, pos):
     node = ""
@@ -109,44 +114,78 @@ class TreeNode:
         return info_string
 
 
+jplace_token_re = re.compile(r"([(),;])|:([0-9.eE+-]+)|\[(\d+)\]|{(\d+)}|([^(),:;\[\]{}]+)")
+
+
+def index_jplace_tree(jplace_tree: str):
+    """
+    Tokenizes a JPlace-formatted Newick tree, where each edge is numbered in curly braces (e.g. '(1:0.1{0},...'),
+    in a single linear pass to index:
+        1. every node (keyed by its edge number) to the names of all leaves it subtends
+        2. the length of every edge, keyed by the string of its edge number
+        3. the parent node of every node
+
+    The leaf lists are ordered the same as those of ItolJplace.create_jplace_node_map (right child's leaves first).
+    Since these are invariant for a reference tree, they are meant to be computed once and shared by all pqueries.
+
+    :param jplace_tree: The Newick tree string from a JPlace file
+    :return: Tuple of the node-leaves map, edge-lengths dictionary and child-parent map
+    """
+    node_map = dict()
+    edge_lengths = dict()
+    parent_map = dict()
+    children_stack = [list()]
+    pending_leaves = None  # Leaves subtended by the node whose edge number has not been read yet
+    pending_children = list()
+    pending_length = None
+    for token in jplace_token_re.finditer(jplace_tree):
+        delimiter, length, _, edge, label = token.groups()
+        if delimiter == '(':
+            children_stack.append(list())
+        elif delimiter == ')':
+            pending_children = children_stack.pop()
+            pending_leaves = list()
+            for child in reversed(pending_children):
+                pending_leaves += node_map[child]
+        elif delimiter:
+            pending_leaves = None
+            pending_children = list()
+        elif label is not None:
+            # Labels following a ')' are internal node names or support values and are ignored
+            if pending_leaves is None:
+                pending_leaves = [label.strip()]
+        elif length is not None:
+            pending_length = float(length)
+        elif edge is not None:
+            edge = int(edge)
+            if edge in node_map:
+                logging.error("Key '" + str(edge) + "' being overwritten in internal-node map\n")
+                sys.exit(11)
+            node_map[edge] = pending_leaves if pending_leaves is not None else list()
+            if pending_length is not None:
+                edge_lengths[str(edge)] = pending_length
+            for child in pending_children:
+                parent_map[child] = edge
+            children_stack[-1].append(edge)
+            pending_leaves = None
+            pending_children = list()
+            pending_length = None
+
+    return node_map, edge_lengths, parent_map
+
+
 def create_tree_internal_node_map(jplace_tree_string):
     """
     Loads a mapping between all internal nodes to their internal parents
     :return:
     """
-    no_length_tree = re.sub(r"(\d+)?:[0-9.]+(\[\d+\])?{", ":{", jplace_tree_string)
     node_map = dict()
-    parent_map = dict()
-    node_stack = list()
-
-    x = 0
-    while x < len(no_length_tree):
-        c = no_length_tree[x]
-        if c == ':':
-            # Append the most recent leaf
-            current_node, x = get_node(no_length_tree, x + 1)
-            tree_node = TreeNode(current_node)
-            # node_map[current_node] = tree_node.get_parents()
-            node_stack.append(tree_node)
-            node_map[tree_node.node_id] = tree_node
-        elif c == ')':
-            # Set the child leaves to the leaves of the current node's two children
-            while c == ')' and x < len(no_length_tree):
-                if no_length_tree[x + 1] == ';':
-                    break
-                current_node, x = get_node(no_length_tree, x + 2)
-                tree_node = TreeNode(current_node)
-                r_child = node_stack.pop()
-                r_child.parent = tree_node
-                l_child = node_stack.pop()
-                l_child.parent = tree_node
-                node_stack.append(tree_node)
-                node_map[tree_node.node_id] = tree_node
-                x += 1
-                c = no_length_tree[x]
-        x += 1
-    for node in sorted(node_map):
-        parent_map[node] = node_map[node].all_parents()
+    _, _, parent_map = index_jplace_tree(jplace_tree_string)
+    for child in parent_map:
+        for node_id in [child, parent_map[child]]:
+            if node_id not in node_map:
+                node_map[node_id] = TreeNode(node_id)
+        node_map[child].parent = node_map[parent_map[child]]
     return node_map
 
 
@@ -170,52 +209,7 @@ def map_internal_nodes_leaves(tree):
     Loads a mapping between all internal nodes and their child leaves
     :return:
     """
-    no_length_tree = re.sub(r":[0-9.]+(\[\d+\])?{", ":{", tree)
-    node_map = dict()
-    node_stack = list()
-    leaf_stack = list()
-    x = 0
-    num_buffer = ""
-    while x < len(no_length_tree):
-        c = no_length_tree[x]
-        if re.search(r"\d", c):
-            while re.search(r"\d", c):
-                num_buffer += c
-                x += 1
-                c = no_length_tree[x]
-            node_stack.append([str(num_buffer)])
-            num_buffer = ""
-            x -= 1
-        elif c == ':':
-            # Append the most recent leaf
-            current_node, x = get_node(no_length_tree, x + 1)
-            if current_node in node_map:
-                logging.error("Key '" + str(current_node) + "' being overwritten in internal-node map\n")
-                sys.exit(11)
-            node_map[current_node] = node_stack.pop()
-            leaf_stack.append(current_node)
-        elif c == ')':
-            # Set the child leaves to the leaves of the current node's two children
-            while c == ')' and x < len(no_length_tree):
-                if no_length_tree[x + 1] == ';':
-                    break
-                while c != '{':
-                    x += 1
-                    c = no_length_tree[x]
-                current_node, x = get_node(no_length_tree, x)
-                if current_node in node_map:
-                    logging.error("Key '" + str(current_node) + "' being overwritten in internal-node map\n")
-                    sys.exit(11)
-                node_map[current_node] = node_map[leaf_stack.pop()] + node_map[leaf_stack.pop()]
-                leaf_stack.append(current_node)
-                x += 1
-                c = no_length_tree[x]
-        x += 1
-
-    if node_stack:
-        logging.error("Node stack not empty by end of loading internal-node map:\n" + str(node_stack) + "\n")
-        sys.exit(11)
-
+    node_map, _, _ = index_jplace_tree(tree)
     # validate_internal_node_map(node_map)
     return node_map
 
@@ -257,16 +251,35 @@ def deconvolute_assignments(reference_tree_assignments):
     return tree_info, terminal_children_of_reference
 
 
+def load_reference_tree_elements(reference_tree_file):
+    # The string returned by the C++ _tree_parser extension is immutable so it is also reused within a process
+    return load_cached(reference_tree_file, "tree_elements", _tree_parser._read_the_reference_tree, in_memory=True)
+
+
+def load_reference_tree_handle(reference_tree_file):
+    """
+    Loads the reference tree into the _tree_parser extension once per process, returning a handle that
+    lowest common ancestor queries are answered from without re-parsing the tree elements for each query.
+
+    :param reference_tree_file: Path to a reference package's tree (e.g. data/tree_data/McrA_tree.txt)
+    :return: An opaque handle for _tree_parser._lowest_common_ancestors
+    """
+    reference_tree_elements = load_reference_tree_elements(reference_tree_file)
+    if reference_tree_elements not in _tree_handles:
+        _tree_handles[reference_tree_elements] = _tree_parser._load_tree_handle(reference_tree_elements)
+    return _tree_handles[reference_tree_elements]
+
+
 def read_and_map_internal_nodes_from_newick_tree(reference_tree_file, denominator):
     # Using the C++ _tree_parser extension:
-    reference_tree_elements = _tree_parser._read_the_reference_tree(reference_tree_file)
+    reference_tree_elements = load_reference_tree_elements(reference_tree_file)
     internal_node_map = map_internal_nodes_leaves(reference_tree_elements)
     return internal_node_map
 
 
 def read_and_understand_the_reference_tree(reference_tree_file, denominator):
     # Using the C++ _tree_parser extension:
-    reference_tree_elements = _tree_parser._read_the_reference_tree(reference_tree_file)
+    reference_tree_elements = load_reference_tree_elements(reference_tree_file)
     reference_tree_assignments = _tree_parser._get_parents_and_children(reference_tree_elements)
     if reference_tree_assignments == "$":
         sys.stderr.write("Poison pill received from " + denominator + "\n")
@@ -329,27 +342,176 @@ def tree_leaf_distances(tree: Tree):
     return max_dist, leaf_distances
 
 
-def index_tree_edges(tree: str):
-    edge_index = dict()
-    dist = ""
-    edge = ""
-    i = 0
-    n = len(tree)
-    while i < n:
-        if tree[i] in [':', '{']:
-            i += 1
-            if dist:
-                while re.match(r"[0-9]", tree[i]):
-                    edge += tree[i]
-                    i += 1
-                edge_index[edge] = float(dist)
-                dist = ""
-                edge = ""
-            else:
-                while re.match(r"[0-9.]", tree[i]):
-                    dist += tree[i]
-                    i += 1
+class TreeDistanceIndex:
+    """
+    An index of an ete3 Tree for answering lowest common ancestor (LCA) and tip-distance queries in constant time.
+    The nodes are numbered in pre-order and an Euler tour of the tree is indexed by a sparse table of the shallowest
+    node in every interval of a power-of-two length. The LCA of a set of nodes is then the shallowest node between
+    their first and last occurrences in the tour, found by comparing two overlapping intervals.
+    """
+    def __init__(self, tree: Tree):
+        self.tree = tree
+        nodes = list(tree.traverse("preorder"))
+        node_ids = {node: i for i, node in enumerate(nodes)}
+        num_nodes = len(nodes)
+        self.parent = np.full(num_nodes, -1, dtype=np.int64)
+        self.depth = np.zeros(num_nodes, dtype=np.int64)
+        self.root_dist = np.zeros(num_nodes)
+        self.leaf_ids = dict()
+        children = [list() for _ in range(num_nodes)]
+        for i, node in enumerate(nodes):
+            if node.is_leaf():
+                self.leaf_ids[node.name] = i
+            if i == 0:
+                continue
+            parent = node_ids[node.up]
+            children[parent].append(i)
+            self.parent[i] = parent
+            self.depth[i] = self.depth[parent] + 1
+            self.root_dist[i] = self.root_dist[parent] + node.dist
+
+        # The number of leaves each node subtends and the sum of their distances from the root
+        self.num_leaves = np.zeros(num_nodes, dtype=np.int64)
+        self.leaf_dist_sum = np.zeros(num_nodes)
+        for i in range(num_nodes - 1, -1, -1):
+            if not children[i]:
+                self.num_leaves[i] = 1
+                self.leaf_dist_sum[i] = self.root_dist[i]
+            if i > 0:
+                self.num_leaves[self.parent[i]] += self.num_leaves[i]
+                self.leaf_dist_sum[self.parent[i]] += self.leaf_dist_sum[i]
+
+        # Euler tour, recording each node when it is first visited and after each of its children
+        euler = list()
+        self.first = np.zeros(num_nodes, dtype=np.int64)
+        stack = [(0, 0)]
+        while stack:
+            node, child = stack.pop()
+            if child == 0:
+                self.first[node] = len(euler)
+            euler.append(node)
+            if child < len(children[node]):
+                stack.append((node, child + 1))
+                stack.append((children[node][child], 0))
+
+        self.sparse_table = [np.array(euler, dtype=np.int64)]
+        width = 1
+        while 2 * width <= len(euler):
+            prev = self.sparse_table[-1]
+            left, right = prev[:-width], prev[width:]
+            self.sparse_table.append(np.where(self.depth[left] <= self.depth[right], left, right))
+            width *= 2
+
+    def range_minimum(self, i: int, j: int):
+        """
+        :return: The shallowest node in the Euler tour between positions i and j (inclusive)
+        """
+        level = (j - i + 1).bit_length() - 1
+        left = self.sparse_table[level][i]
+        right = self.sparse_table[level][j - (1 << level) + 1]
+        return left if self.depth[left] <= self.depth[right] else right
+
+    def lca(self, node_ids):
+        """
+        :param node_ids: A list or numpy array of node numbers
+        :return: The number of the nodes' lowest common ancestor
+        """
+        positions = self.first[node_ids]
+        return self.range_minimum(int(positions.min()), int(positions.max()))
+
+    def mean_tip_distance(self, leaf_names: list):
+        """
+        Calculates the mean distance from the LCA of a set of leaves to each of the leaves.
+        This is constant-time when the leaves are all that the LCA subtends (i.e. they are a clade).
+
+        :param leaf_names: A list of leaf names
+        :return: The mean tip distance as a float
+        """
+        leaf_ids = np.array([self.leaf_ids[name] for name in leaf_names], dtype=np.int64)
+        ancestor = self.lca(leaf_ids)
+        if self.num_leaves[ancestor] == len(set(leaf_names)):
+            mean_root_dist = self.leaf_dist_sum[ancestor] / self.num_leaves[ancestor]
         else:
-            i += 1
+            mean_root_dist = np.mean(self.root_dist[leaf_ids])
+        return float(mean_root_dist - self.root_dist[ancestor])
 
+
+class TerminalChildrenIndex:
+    """
+    An index of a tree string in the format returned by assign.read_the_raxml_out_tree, where leaves are positive
+    integers and internal nodes are labelled with negative integers, for finding the terminal children (leaves) a node
+    subtends in each of the trees formed by re-rooting the tree on any of its edges.
+    The tree is parsed in a single pass and the leaves are numbered in the order they appear, so the leaves of every
+    clade are a contiguous range. Wherever the tree is rooted, a node subtends either the leaves in its own range or
+    all leaves except those in the range of one of its children, so no rooted tree needs to be built.
+    """
+    def __init__(self, tree_string: str):
+        self.leaves = list()
+        self.node_index = dict()
+        self.leaf_range = list()
+        self.child_ranges = list()
+        self.malformed = False
+        open_nodes = list()
+        for token in re.finditer(r"\(|\)(-\d+)?|(\d+)", tree_string):
+            if token.group(0) == '(':
+                open_nodes.append((len(self.leaf_range), len(self.leaves)))
+                self.leaf_range.append(None)
+                self.child_ranges.append(list())
+                continue
+            if token.group(2):
+                node = len(self.leaf_range)
+                self.node_index[int(token.group(2))] = node
+                self.leaves.append(int(token.group(2)))
+                self.leaf_range.append((len(self.leaves) - 1, len(self.leaves)))
+                self.child_ranges.append(list())
+            elif open_nodes:
+                node, start = open_nodes.pop()
+                self.leaf_range[node] = (start, len(self.leaves))
+                if token.group(1):
+                    self.node_index[int(token.group(1))] = node
+            else:
+                self.malformed = True
+                break
+            if open_nodes:
+                self.child_ranges[open_nodes[-1][0]].append(self.leaf_range[node])
+        if open_nodes or not self.leaf_range:
+            self.malformed = True
+
+    def terminal_children(self, node_key: int):
+        """
+        The sets of leaves subtended by a node in all rootings of the tree, each represented by a range of leaves.
+
+        :param node_key: The integer a leaf or internal node is labelled with in the tree string
+        :return: A list of (start, end, complement) tuples. If complement is False the leaves are
+         self.leaves[start:end], otherwise they are all leaves except those. An empty list if the node is not found.
+        """
+        try:
+            node = self.node_index[node_key]
+        except KeyError:
+            return list()
+        start, end = self.leaf_range[node]
+        if end - start == 1:
+            return [(start, end, False)]
+        return [(start, end, False)] + [(c_start, c_end, True) for c_start, c_end in self.child_ranges[node]]
+
+    def terminal_children_strings(self, node_key: int):
+        """
+        :param node_key: The integer a leaf or internal node is labelled with in the tree string
+        :return: A list of the distinct strings of the leaves subtended by the node in each rooting of the tree, in the
+         format of entish.format_subtrees (leaf numbers sorted in ascending order, each followed by a space)
+        """
+        terminal_children_strings = list()
+        for start, end, complement in self.terminal_children(node_key):
+            if complement:
+                leaves = self.leaves[:start] + self.leaves[end:]
+            else:
+                leaves = self.leaves[start:end]
+            terminal_children_string = ''.join([str(leaf) + ' ' for leaf in sorted(leaves)])
+            if terminal_children_string not in terminal_children_strings:
+                terminal_children_strings.append(terminal_children_string)
+        return terminal_children_strings
+
+
+def index_tree_edges(tree: str):
+    _, edge_index, _ = index_jplace_tree(tree)
     return edge_index
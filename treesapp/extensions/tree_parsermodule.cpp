@@ -5,6 +5,8 @@
 #include <stack>
 #include <vector>
 #include <string>
+#include <unordered_map>
+#include <unordered_set>
 
 using namespace std;
 
@@ -12,6 +14,8 @@ static PyObject *read_the_reference_tree(PyObject *self, PyObject *args);
 static PyObject *get_parents_and_children(PyObject *self, PyObject *args);
 static PyObject *build_subtrees_newick(PyObject *self, PyObject *args);
 static PyObject *lowest_common_ancestor(PyObject *self, PyObject *args);
+static PyObject *load_tree_handle(PyObject *self, PyObject *args);
+static PyObject *lowest_common_ancestors(PyObject *self, PyObject *args);
 char *get_node_relationships(char *tree_string);
 char *split_tree_string(char *tree_string);
 
@@ -23,6 +27,10 @@ static char build_subtrees_newick_docstring[] =
         "Reads the labelled, rooted tree and returns all subtrees in the tree";
 static char lowest_common_ancestor_docstring[] =
         "Calculate lowest common ancestor for a set of nodes in a tree";
+static char load_tree_handle_docstring[] =
+        "Parses the string returned by _read_the_reference_tree into a tree that is kept in memory for LCA queries";
+static char lowest_common_ancestors_docstring[] =
+        "Calculate the lowest common ancestor of each set of nodes in a list, using a tree from _load_tree_handle";
 
 //static PyMethodDef module_methods[] = {
 //    {"error_out", (PyCFunction)error_out, METH_NOARGS, NULL},
@@ -46,6 +54,14 @@ static PyMethodDef module_methods[] = {
         lowest_common_ancestor,
         METH_VARARGS,
         lowest_common_ancestor_docstring},
+        {"_load_tree_handle",
+        load_tree_handle,
+        METH_VARARGS,
+        load_tree_handle_docstring},
+        {"_lowest_common_ancestors",
+        lowest_common_ancestors,
+        METH_VARARGS,
+        lowest_common_ancestors_docstring},
         {NULL, NULL, 0, NULL}
 };
 
@@ -719,6 +735,162 @@ static PyObject *lowest_common_ancestor(PyObject *self, PyObject *args) {
 }
 
 
+/**
+  A tree that is parsed once and kept in memory, for answering many LCA queries.
+  Nodes are numbered in the post-order they are visited by lca_helper so the LCA's number is the same.
+  */
+struct TreeHandle {
+    std::vector<long> parent;
+    std::vector<long> depth;
+    std::unordered_map<long, long> key_index;
+};
+
+static const char tree_handle_name[] = "_tree_parser.TreeHandle";
+
+
+long index_post_order(TreeNode* node, TreeHandle* handle, long depth) {
+    if (node == NULL)
+        return -1;
+    long left = index_post_order(node->left, handle, depth + 1);
+    long right = index_post_order(node->right, handle, depth + 1);
+    long index = handle->parent.size();
+    handle->parent.push_back(-1);
+    handle->depth.push_back(depth);
+    if (left >= 0) handle->parent[left] = index;
+    if (right >= 0) handle->parent[right] = index;
+    if (handle->key_index.find(node->key) == handle->key_index.end())
+        handle->key_index[node->key] = index;
+    return index;
+}
+
+
+/*
+ Returns the same node number as lca_helper: that of the first node, in post-order, whose subtree contains all keys.
+ The first node (number 0) is never returned if there are other nodes containing all keys, as in lca_helper.
+ */
+long handle_lca(TreeHandle* handle, std::vector<long>& keys) {
+    long num_nodes = handle->parent.size();
+    if (num_nodes == 0)
+        return 0;
+    if (keys.empty())
+        return num_nodes > 1 ? 1 : 0;
+
+    long ancestor = -1;
+    for (size_t i = 0; i < keys.size(); i++) {
+        std::unordered_map<long, long>::iterator it = handle->key_index.find(keys[i]);
+        if (it == handle->key_index.end())
+            return 0;
+        long node = it->second;
+        if (ancestor < 0) {
+            ancestor = node;
+            continue;
+        }
+        while (handle->depth[node] > handle->depth[ancestor])
+            node = handle->parent[node];
+        while (handle->depth[ancestor] > handle->depth[node])
+            ancestor = handle->parent[ancestor];
+        while (node != ancestor) {
+            node = handle->parent[node];
+            ancestor = handle->parent[ancestor];
+        }
+    }
+    if (ancestor == 0 && handle->parent[0] >= 0)
+        ancestor = handle->parent[0];
+    return ancestor;
+}
+
+
+void delete_tree_handle(PyObject *capsule) {
+    TreeHandle* handle = (TreeHandle*) PyCapsule_GetPointer(capsule, tree_handle_name);
+    delete handle;
+}
+
+
+static PyObject *load_tree_handle(PyObject *self, PyObject *args) {
+    char* tree_string;
+    if (!PyArg_ParseTuple(args, "s", &tree_string)) {
+        return NULL;
+    }
+
+    Link * linked_list = NULL;
+    load_linked_list(tree_string, linked_list);
+    TreeNode* root = NULL;
+    std::stack<TreeNode*> merge;
+    load_tree_from_list(linked_list, root, merge);
+
+    TreeHandle* handle = new TreeHandle;
+    index_post_order(root, handle, 0);
+
+    // Nodes left on the merge stack may also be in the tree, so each node is only deleted once
+    std::unordered_set<TreeNode*> nodes;
+    std::stack<TreeNode*> unvisited;
+    unvisited.push(root);
+    while (!merge.empty()) {
+        unvisited.push(merge.top());
+        merge.pop();
+    }
+    while (!unvisited.empty()) {
+        TreeNode* node = unvisited.top();
+        unvisited.pop();
+        if (node == NULL || !nodes.insert(node).second)
+            continue;
+        unvisited.push(node->left);
+        unvisited.push(node->right);
+    }
+    for (std::unordered_set<TreeNode*>::iterator it = nodes.begin(); it != nodes.end(); ++it)
+        delete *it;
+    deleteList(linked_list);
+
+    return PyCapsule_New(handle, tree_handle_name, delete_tree_handle);
+}
+
+
+static PyObject *lowest_common_ancestors(PyObject *self, PyObject *args) {
+    PyObject* capsule;
+    PyObject* node_sets;
+    if (!PyArg_ParseTuple(args, "OO", &capsule, &node_sets)) {
+        return NULL;
+    }
+    TreeHandle* handle = (TreeHandle*) PyCapsule_GetPointer(capsule, tree_handle_name);
+    if (handle == NULL) {
+        return NULL;
+    }
+    PyObject* sets = PySequence_Fast(node_sets, "Expected a list of lists of node names");
+    if (sets == NULL) {
+        return NULL;
+    }
+
+    Py_ssize_t num_sets = PySequence_Fast_GET_SIZE(sets);
+    PyObject* ancestors = PyList_New(num_sets);
+    std::vector<long> keys;
+    for (Py_ssize_t i = 0; i < num_sets; i++) {
+        PyObject* nodes = PySequence_Fast(PySequence_Fast_GET_ITEM(sets, i), "Expected a list of node names");
+        if (nodes == NULL) {
+            Py_DECREF(ancestors);
+            Py_DECREF(sets);
+            return NULL;
+        }
+        keys.clear();
+        for (Py_ssize_t j = 0; j < PySequence_Fast_GET_SIZE(nodes); j++) {
+            PyObject* node = PySequence_Fast_GET_ITEM(nodes, j);
+            if (PyUnicode_Check(node))
+                keys.push_back(atol(PyUnicode_AsUTF8(node)));
+            else
+                keys.push_back(PyLong_AsLong(node));
+        }
+        Py_DECREF(nodes);
+        if (PyErr_Occurred()) {
+            Py_DECREF(ancestors);
+            Py_DECREF(sets);
+            return NULL;
+        }
+        PyList_SET_ITEM(ancestors, i, PyLong_FromLong(handle_lca(handle, keys)));
+    }
+    Py_DECREF(sets);
+    return ancestors;
+}
+
+
 static PyObject *build_subtrees_newick(PyObject *self, PyObject *args) {
     /*
      Function to parse the rooted, assigned tree and find all subtrees of the inserted node
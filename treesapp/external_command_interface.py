@@ -2,13 +2,164 @@ __author__ = 'Connor Morgan-Lang'
 
 import os
 import sys
+import time
+import json
 import logging
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+# The megabytes of memory shared by the jobs of each JobExecutor. 0 means the physical memory of the machine is used
+_memory_budget = {"mb": 0}
+# The resources used by each external process, recorded by run_command
+_resource_usage = list()
+_resource_lock = threading.Lock()
+# The stage and marker of the Job running in each thread, used to label the processes it launches
+_job_context = threading.local()
 
-def launch_write_command(cmd_list, collect_all=True):
+
+def set_memory_budget(max_memory_mb):
+    _memory_budget["mb"] = max(0, float(max_memory_mb))
+    return
+
+
+def physical_memory_mb():
+    """
+    :return: The physical memory of the machine in megabytes, or 0 if it cannot be determined
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1E6
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def memory_budget():
+    return _memory_budget["mb"] if _memory_budget["mb"] else physical_memory_mb()
+
+
+def wait_for_process(proc: subprocess.Popen):
+    """
+    Waits for a process to finish with os.wait4 so its resource usage is collected along with its exit status.
+    The usage includes that of the children the process waited for, i.e. the tool launched by the shell.
+
+    :param proc: A subprocess.Popen instance whose output has been read
+    :return: The process' return code and a resource.struct_rusage, or None if it could not be collected
+    """
+    if not hasattr(os, "wait4"):
+        return proc.wait(), None
+    try:
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        return proc.wait(), None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode, rusage
+
+
+def record_resource_usage(cmd_list, wall_time: float, returncode: int, rusage=None):
+    """
+    Adds a process to the resource usage records, labelled with the stage and marker of the Job that launched it.
+    """
+    process = {"stage": getattr(_job_context, "stage", ""),
+               "marker": getattr(_job_context, "marker", ""),
+               "executable": os.path.basename(cmd_list[0]),
+               "returncode": returncode,
+               "wall_time": round(wall_time, 3),
+               "user_time": 0.0,
+               "system_time": 0.0,
+               "max_rss_mb": 0.0,
+               "command": ' '.join(cmd_list)}
+    if rusage is not None:
+        process["user_time"] = round(rusage.ru_utime, 3)
+        process["system_time"] = round(rusage.ru_stime, 3)
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        process["max_rss_mb"] = round(rusage.ru_maxrss / (1E6 if sys.platform == "darwin" else 1E3), 1)
+    with _resource_lock:
+        _resource_usage.append(process)
+    return
+
+
+def resource_usage():
+    with _resource_lock:
+        return list(_resource_usage)
+
+
+def clear_resource_usage():
+    with _resource_lock:
+        _resource_usage.clear()
+    return
+
+
+def summarize_stage_resources(processes: list):
+    """
+    :param processes: A list of process records, as returned by resource_usage()
+    :return: A dictionary of the number of processes, total wall and CPU time and largest maximum resident set size
+     of each stage, indexed by the stage name. Processes launched outside of a stage are grouped by their executable.
+    """
+    stages = dict()
+    for process in processes:
+        stage = process["stage"] if process["stage"] else process["executable"]
+        if stage not in stages:
+            stages[stage] = {"processes": 0, "failed": 0, "wall_time": 0.0, "cpu_time": 0.0, "max_rss_mb": 0.0}
+        stage_summary = stages[stage]
+        stage_summary["processes"] += 1
+        if process["returncode"] != 0:
+            stage_summary["failed"] += 1
+        stage_summary["wall_time"] = round(stage_summary["wall_time"] + process["wall_time"], 3)
+        cpu_time = process["user_time"] + process["system_time"]
+        stage_summary["cpu_time"] = round(stage_summary["cpu_time"] + cpu_time, 3)
+        stage_summary["max_rss_mb"] = max(stage_summary["max_rss_mb"], process["max_rss_mb"])
+    return stages
+
+
+def summarize_resource_usage(processes=None):
+    if processes is None:
+        processes = resource_usage()
+    stages = summarize_stage_resources(processes)
+    summary_string = "Resources used by external tools:\n"
+    summary_string += "\t" + "\t".join(["Stage", "Processes", "Failed", "Wall time (s)", "CPU time (s)",
+                                        "Max RSS (MB)"]) + "\n"
+    for stage in stages:
+        stage_summary = stages[stage]
+        summary_string += "\t" + "\t".join([stage, str(stage_summary["processes"]), str(stage_summary["failed"]),
+                                            str(round(stage_summary["wall_time"], 1)),
+                                            str(round(stage_summary["cpu_time"], 1)),
+                                            str(stage_summary["max_rss_mb"])]) + "\n"
+    return summary_string
+
+
+def write_resource_report(output_prefix: str, processes=None):
     """
-    Wrapper function for opening subprocesses through subprocess.Popen()
+    Writes the resource usage of each external process to a tab-separated table (<output_prefix>.tsv) and,
+    along with the summary of each stage, to a JSON file (<output_prefix>.json)
+
+    :param output_prefix: Path and prefix of the files to write
+    :param processes: A list of process records. All processes recorded by run_command if None
+    :return: None
+    """
+    if processes is None:
+        processes = resource_usage()
+    fields = ["stage", "marker", "executable", "returncode", "wall_time", "user_time", "system_time", "max_rss_mb",
+              "command"]
+    try:
+        with open(output_prefix + ".tsv", 'w') as tsv_handler:
+            tsv_handler.write("\t".join(fields) + "\n")
+            for process in processes:
+                tsv_handler.write("\t".join([str(process[field]) for field in fields]) + "\n")
+        with open(output_prefix + ".json", 'w') as json_handler:
+            json.dump({"stages": summarize_stage_resources(processes), "processes": processes}, json_handler,
+                      indent=2)
+    except IOError:
+        logging.warning("Unable to write the resource usage report to " + output_prefix + ".tsv and .json\n")
+    return
+
+
+def run_command(cmd_list, collect_all=True):
+    """
+    Runs a command in a shell through subprocess.Popen() without checking whether it completed successfully.
+    The wall time, CPU time and maximum resident set size of the process are recorded (see resource_usage).
 
     :param cmd_list: A list of strings forming a complete command call
     :param collect_all: A flag determining whether stdout and stderr are returned
@@ -16,26 +167,240 @@ def launch_write_command(cmd_list, collect_all=True):
     :return: A string with stdout and/or stderr text and the returncode of the executable
     """
     stdout = ""
+    start_time = time.time()
     if collect_all:
         proc = subprocess.Popen(' '.join(cmd_list),
                                 shell=True,
-                                preexec_fn=os.setsid,
+                                start_new_session=True,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.STDOUT)
-        stdout = proc.communicate()[0].decode("utf-8")
+        stdout = proc.stdout.read().decode("utf-8")
+        proc.stdout.close()
     else:
         proc = subprocess.Popen(' '.join(cmd_list),
                                 shell=True,
-                                preexec_fn=os.setsid)
-        proc.wait()
+                                start_new_session=True)
+    returncode, rusage = wait_for_process(proc)
+    record_resource_usage(cmd_list, time.time() - start_time, returncode, rusage)
+    return stdout, returncode
+
+
+def launch_write_command(cmd_list, collect_all=True):
+    """
+    Wrapper function for opening subprocesses through subprocess.Popen(). TreeSAPP exits if the command fails.
+
+    :param cmd_list: A list of strings forming a complete command call
+    :param collect_all: A flag determining whether stdout and stderr are returned
+    via stdout or just stderr is returned leaving stdout to be written to the screen
+    :return: A string with stdout and/or stderr text and the returncode of the executable
+    """
+    stdout, returncode = run_command(cmd_list, collect_all)
 
     # Ensure the command completed successfully
-    if proc.returncode != 0:
+    if returncode != 0:
         logging.error(cmd_list[0] + " did not complete successfully! Command used:\n" +
                       ' '.join(cmd_list) + "\nOutput:\n" + stdout)
         sys.exit(19)
 
-    return stdout, proc.returncode
+    return stdout, returncode
+
+
+class ExternalCommandError(Exception):
+    """
+    Raised by run_checked_command when a command fails, so that the failure of a function run as a Job is collected
+    by its JobExecutor rather than exiting from a worker thread.
+    """
+    pass
+
+
+def run_checked_command(cmd_list, collect_all=True):
+    """
+    Equivalent to launch_write_command for functions that are run by a JobExecutor:
+    ExternalCommandError is raised if the command fails, instead of exiting.
+
+    :param cmd_list: A list of strings forming a complete command call
+    :param collect_all: A flag determining whether stdout and stderr are returned
+    via stdout or just stderr is returned leaving stdout to be written to the screen
+    :return: A string with stdout and/or stderr text and the returncode of the executable
+    """
+    stdout, returncode = run_command(cmd_list, collect_all)
+    if returncode != 0:
+        raise ExternalCommandError(os.path.basename(cmd_list[0]) + " did not complete successfully! Command used:\n" +
+                                   ' '.join(cmd_list) + "\nOutput:\n" + stdout)
+    return stdout, returncode
+
+
+class Job:
+    """
+    A unit of work run by a JobExecutor: either a command (a list of strings) that is run in a shell or a function,
+    along with the number of threads and megabytes of memory it is expected to use.
+    The processes a job launches are recorded under its stage and marker.
+    """
+    def __init__(self, task, args=(), threads=1, memory=0, name="", stage="", collect_all=True, marker=""):
+        self.task = task
+        self.args = tuple(args)
+        self.threads = max(1, int(threads))
+        self.memory = max(0, float(memory))
+        self.stage = stage
+        self.marker = marker
+        self.collect_all = collect_all
+        if name:
+            self.name = name
+        elif isinstance(task, list):
+            self.name = os.path.basename(task[0])
+        else:
+            self.name = task.__name__
+        self.result = None
+        self.returncode = None
+        self.error = ""
+        self.wall_time = 0.0
+
+    def run(self):
+        start_time = time.time()
+        parent_context = getattr(_job_context, "stage", ""), getattr(_job_context, "marker", "")
+        _job_context.stage, _job_context.marker = self.stage, self.marker
+        try:
+            if isinstance(self.task, list):
+                self.result, self.returncode = run_command(self.task, self.collect_all)
+                if self.returncode != 0:
+                    self.error = "exit status " + str(self.returncode) + ". Command used:\n" + ' '.join(self.task) +\
+                                 "\nOutput:\n" + self.result
+            else:
+                self.result = self.task(*self.args)
+        except SystemExit as exit_status:
+            # Functions that call sys.exit (e.g. through launch_write_command) have already logged the reason
+            self.error = "exited with status " + str(exit_status.code)
+        except Exception as error:
+            self.error = type(error).__name__ + ": " + str(error)
+        _job_context.stage, _job_context.marker = parent_context
+        self.wall_time = time.time() - start_time
+        return self
+
+    def failed(self):
+        return len(self.error) > 0
+
+
+class JobExecutor:
+    """
+    Runs commands and functions concurrently within a budget of CPU threads and memory.
+    Each job declares the number of threads and megabytes of memory it uses, and jobs are started in the order they
+    were submitted whenever enough threads and memory are free; smaller jobs are started ahead of a larger job that
+    does not yet fit, and a job is always started when nothing else is running so it cannot wait forever.
+    A job that fails does not stop the others. Failures are collected so the caller can report all of them at once.
+    """
+    def __init__(self, num_threads, max_memory=None, stage=""):
+        """
+        :param num_threads: The number of CPU threads shared by all running jobs
+        :param max_memory: The megabytes of memory shared by all running jobs. The global budget if None
+         and unlimited if 0
+        :param stage: A name for the jobs, used in log messages
+        """
+        self.num_threads = max(1, int(num_threads))
+        self.max_memory = memory_budget() if max_memory is None else max(0, float(max_memory))
+        self.stage = stage
+        self.pending = list()
+        self.finished = list()
+        self.failures = list()
+
+    def submit(self, task, args=(), threads=1, memory=0, name="", collect_all=True, marker="", stage=""):
+        """
+        :param task: Either a command (list of strings) to run in a shell or a function to call with args
+        :param args: Arguments for the function
+        :param threads: The number of threads the job uses, capped at the executor's num_threads
+        :param memory: The estimated megabytes of memory the job uses
+        :param name: A name for the job, used in log messages. The executable or function name by default
+        :param collect_all: Flag indicating whether a command's stdout is returned (True) or written to the screen
+        :param marker: The name of the marker (reference package) the job is for, if any
+        :param stage: The stage the job is part of, if not the executor's stage
+        :return: The Job instance, which holds the result or error once the executor has run
+        """
+        job = Job(task, args, min(int(threads), self.num_threads), memory, name, stage if stage else self.stage,
+                  collect_all, marker)
+        self.pending.append(job)
+        return job
+
+    def fits(self, job: Job, free_threads: int, free_memory: float):
+        if job.threads > free_threads:
+            return False
+        if self.max_memory and job.memory > free_memory:
+            return False
+        return True
+
+    def run(self, callback=None):
+        """
+        Runs all submitted jobs, returning once they have finished.
+
+        :param callback: Optional function called in this thread with each Job as it finishes.
+         It may submit more jobs to this executor.
+        :return: A list of the jobs that finished, in the order they finished
+        """
+        finished = list()
+        running = dict()
+        free_threads = self.num_threads
+        free_memory = self.max_memory
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            while self.pending or running:
+                i = 0
+                while i < len(self.pending):
+                    job = self.pending[i]
+                    if running and not self.fits(job, free_threads, free_memory):
+                        i += 1
+                        continue
+                    self.pending.pop(i)
+                    logging.debug("\tLaunching " + job.name + (" for " + job.stage if job.stage else "") +
+                                  " with " + str(job.threads) + " threads and " + str(round(job.memory)) + "MB.\n")
+                    running[executor.submit(job.run)] = job
+                    free_threads -= job.threads
+                    free_memory -= job.memory
+
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    free_threads += job.threads
+                    free_memory += job.memory
+                    if job.failed():
+                        self.failures.append(job)
+                    finished.append(job)
+                    if callback:
+                        callback(job)
+        self.finished += finished
+        return finished
+
+    def summarize_failures(self):
+        summary = str(len(self.failures)) + " of " + str(len(self.finished)) + ' ' +\
+                  (self.stage + ' ' if self.stage else '') + "jobs did not complete successfully:\n"
+        for job in self.failures:
+            summary += "\t" + job.name + ": " + job.error + "\n"
+        return summary
+
+    def exit_on_failure(self, exit_code):
+        """
+        Logs every failed job and exits if any jobs failed. Called by stages that cannot continue after a failure.
+        """
+        if self.failures:
+            logging.error(self.summarize_failures())
+            sys.exit(exit_code)
+        return
+
+
+def run_job(task, stage: str, args=(), threads=1, memory=0, marker="", collect_all=True):
+    """
+    Runs a single command or function through a JobExecutor, so it is given its declared threads and memory and its
+    processes are recorded under the stage. The caller is responsible for handling the failure of the job.
+
+    :param task: Either a command (list of strings) to run in a shell or a function to call with args
+    :param stage: The stage the job is part of, e.g. the name of the external tool
+    :param args: Arguments for the function
+    :param threads: The number of threads the job uses
+    :param memory: The estimated megabytes of memory the job uses
+    :param marker: The name of the marker (reference package) the job is for, if any
+    :param collect_all: Flag indicating whether a command's stdout is returned (True) or written to the screen
+    :return: The finished Job instance
+    """
+    executor = JobExecutor(threads, stage=stage)
+    job = executor.submit(task, args, threads, memory, marker=marker, collect_all=collect_all)
+    executor.run()
+    return job
 
 
 def setup_progress_bar(num_items):
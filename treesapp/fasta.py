@@ -5,6 +5,7 @@ import re
 import os
 import logging
 from time import sleep
+from hashlib import md5
 
 import _fasta_reader
 from .utilities import median, reformat_string, rekey_dict, return_sequence_info_groups
@@ -41,6 +42,145 @@ def generate_fasta(fasta_handler):  # this is a generator function
                 break
 
 
+def generate_fasta_chunks(fasta_file, max_seqs=0, max_bytes=0):
+    """
+    Generator function for reading a FASTA file in batches, so the whole file is never held in memory.
+    A batch is yielded once it holds max_seqs sequences or max_bytes characters, whichever is reached first.
+
+    :param fasta_file: Path to a FASTA file to be read in batches
+    :param max_seqs: The maximum number of sequences in each batch. Unbounded if 0.
+    :param max_bytes: The approximate maximum number of characters (headers and sequences) in each batch.
+    Unbounded if 0.
+    :return: Lists of (header, sequence) tuples, in the order they were read from fasta_file
+    """
+    try:
+        fasta_handler = open(fasta_file, 'r')
+    except IOError:
+        logging.error("Unable to open " + fasta_file + " for reading!\n")
+        sys.exit(5)
+
+    chunk = list()
+    n_bytes = 0
+    for name, sequence in generate_fasta(fasta_handler):
+        chunk.append((name, sequence))
+        n_bytes += len(name) + len(sequence)
+        if (max_seqs and len(chunk) >= max_seqs) or (max_bytes and n_bytes >= max_bytes):
+            yield chunk
+            chunk = list()
+            n_bytes = 0
+    fasta_handler.close()
+
+    if chunk:
+        yield chunk
+
+
+def count_fasta_records(fasta_file):
+    """
+    Counts the number of sequences in a FASTA file without loading them
+
+    :param fasta_file: Path to a FASTA file
+    :return: The number of headers in fasta_file
+    """
+    num_seqs = 0
+    try:
+        fasta_handler = open(fasta_file, 'r')
+    except IOError:
+        logging.error("Unable to open " + fasta_file + " for reading!\n")
+        sys.exit(5)
+    for line in fasta_handler:
+        if line[0] == '>':
+            num_seqs += 1
+    fasta_handler.close()
+    return num_seqs
+
+
+def split_fasta_by_length(fasta_file, output_prefix, num_shards):
+    """
+    Splits a FASTA file into contiguous shards that contain roughly equal numbers of residues.
+    Sequences are not reordered or renamed so the shards concatenated in order are equivalent to the input.
+
+    :param fasta_file: Path to the FASTA file to be split
+    :param output_prefix: Prefix of the shard file paths, to which '_<shard number>.fasta' is appended
+    :param num_shards: The maximum number of shards to create. Fewer are written if there are fewer sequences.
+    :return: List of tuples, each containing the path to a shard and the number of sequences preceding it in fasta_file
+    """
+    try:
+        fasta_handler = open(fasta_file, 'r')
+    except IOError:
+        logging.error("Unable to open " + fasta_file + " for reading!\n")
+        sys.exit(5)
+
+    # First pass to find the total length so shard boundaries can be placed at equal residue intervals
+    total_length = 0
+    num_seqs = 0
+    for _, sequence in generate_fasta(fasta_handler):
+        total_length += len(sequence)
+        num_seqs += 1
+    num_shards = max(1, min(num_shards, num_seqs))
+
+    shards = list()
+    shard_file = ""
+    shard_handler = None
+    cumulative_length = 0
+    seq_index = 0
+    fasta_handler.seek(0)
+    for name, sequence in generate_fasta(fasta_handler):
+        # Start a new shard when the residues written so far pass the boundary of the current shard
+        if shard_handler is None or \
+                (len(shards) < num_shards and cumulative_length >= len(shards) * total_length / num_shards):
+            if shard_handler:
+                shard_handler.close()
+            shard_file = output_prefix + '_' + str(len(shards) + 1) + ".fasta"
+            try:
+                shard_handler = open(shard_file, 'w')
+            except IOError:
+                logging.error("Unable to open " + shard_file + " for writing!\n")
+                sys.exit(5)
+            shards.append((shard_file, seq_index))
+        shard_handler.write('>' + name + "\n" + sequence + "\n")
+        cumulative_length += len(sequence)
+        seq_index += 1
+    fasta_handler.close()
+    if shard_handler:
+        shard_handler.close()
+
+    return shards
+
+
+def merge_prodigal_orfs(orf_files, seq_offsets, merged_file, append=False):
+    """
+    Concatenates the ORF FASTA files written by Prodigal for contiguous shards of an input, in order.
+    Prodigal numbers the 'ID=' attribute of each ORF header by the position of its sequence in the input (e.g. ID=3_1)
+    so these are incremented by the number of sequences preceding each shard to match those of an unsharded run.
+
+    :param orf_files: List of paths to Prodigal's amino acid or nucleotide ORF files, in the order of the shards
+    :param seq_offsets: List of the number of input sequences preceding each shard
+    :param merged_file: Path to the file to write the merged ORFs to
+    :param append: Flag indicating whether to append to merged_file rather than overwriting it
+    :return: None
+    """
+    id_re = re.compile(r"(# ID=)(\d+)(_\d+;)")
+    try:
+        merged_handler = open(merged_file, 'a' if append else 'w')
+    except IOError:
+        logging.error("Unable to open " + merged_file + " for writing!\n")
+        sys.exit(5)
+
+    for orf_file, offset in zip(orf_files, seq_offsets):
+        try:
+            orf_handler = open(orf_file, 'r')
+        except IOError:
+            logging.error("Unable to open " + orf_file + " for reading!\n")
+            sys.exit(5)
+        for line in orf_handler:
+            if offset and line[0] == '>':
+                line = id_re.sub(lambda m: m.group(1) + str(int(m.group(2)) + offset) + m.group(3), line, 1)
+            merged_handler.write(line)
+        orf_handler.close()
+    merged_handler.close()
+    return
+
+
 def read_fasta_to_dict(fasta_file):
     """
     Reads any fasta file using a generator function (generate_fasta) into a dictionary collection
@@ -82,8 +222,8 @@ class Header:
         self.accession = return_sequence_info_groups(sequence_info, header_db, self.original).accession
 
 
-def register_headers(header_list, drop=True):
-    acc = 1
+def register_headers(header_list, drop=True, first_num=1):
+    acc = first_num
     header_registry = dict()
     dup_checker = set()
     dups = []
@@ -414,6 +554,34 @@ class FASTA:
 
         return
 
+    def collapse_duplicate_sequences(self):
+        """
+        Removes all but one representative of each group of identical sequences from self.fasta_dict.
+        Unlike dedup_by_sequences, the header_registry is left intact so the results of the representatives can be
+        propagated to the sequences they represent. Sequences are compared by their MD5 digests and the representative
+        of each group is the sequence with the lowest numerical TreeSAPP ID.
+
+        :return: Dictionary mapping the numerical ID of each representative to a list of its duplicates' numerical IDs
+        """
+        if self.index_form != "num":
+            self.change_dict_keys("num")
+        representatives = dict()
+        duplicates = dict()
+        for num_id in sorted(self.fasta_dict, key=int):
+            seq_digest = md5(self.fasta_dict[num_id].encode("utf-8")).digest()
+            if seq_digest not in representatives:
+                representatives[seq_digest] = num_id
+                continue
+            rep_id = representatives[seq_digest]
+            if rep_id not in duplicates:
+                duplicates[rep_id] = list()
+            duplicates[rep_id].append(num_id)
+
+        for rep_id in duplicates:
+            for num_id in duplicates[rep_id]:
+                self.fasta_dict.pop(num_id)
+        return duplicates
+
     def dedup_by_accession(self):
         count_dict = dict()
         dedup_header_dict = dict()
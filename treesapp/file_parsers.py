@@ -9,6 +9,8 @@ from .classy import TreeLeafReference, MarkerBuild, Cluster
 from .HMMER_domainTblParser import DomainTableParser, HmmSearchStats,\
     format_split_alignments, filter_incomplete_hits, filter_poor_hits, renumber_multi_matches, detect_orientation
 from .fasta import read_fasta_to_dict
+from .refpkg_cache import load_cached
+from .msa import MultipleSequenceAlignment
 
 __author__ = 'Connor Morgan-Lang'
 
@@ -240,7 +242,7 @@ def best_discrete_matches(matches: list) -> list:
     return len_sorted_matches
 
 
-def parse_domain_tables(args, hmm_domtbl_files):
+def parse_domain_tables(args, hmm_domtbl_files, exit_on_empty=True):
     # Check if the HMM filtering thresholds have been set
     if not hasattr(args, "min_e"):
         args.min_e = 1E-5
@@ -269,10 +271,14 @@ def parse_domain_tables(args, hmm_domtbl_files):
         rp_marker, reference = re.sub("_domtbl.txt", '', os.path.basename(domtbl_file)).split("_to_")
         domain_table = DomainTableParser(domtbl_file)
         domain_table.read_domtbl_lines()
-        distinct_matches = format_split_alignments(domain_table, search_stats)
-        purified_matches = filter_poor_hits(args, distinct_matches, search_stats)
-        complete_gene_hits = filter_incomplete_hits(args, purified_matches, search_stats)
-        renumber_multi_matches(complete_gene_hits)
+        # Domain tables from a database of multiple HMM profiles are parsed one HMM at a time
+        complete_gene_hits = list()
+        for hmm_table in domain_table.demultiplex().values():
+            distinct_matches = format_split_alignments(hmm_table, search_stats)
+            purified_matches = filter_poor_hits(args, distinct_matches, search_stats)
+            hmm_gene_hits = filter_incomplete_hits(args, purified_matches, search_stats)
+            renumber_multi_matches(hmm_gene_hits)
+            complete_gene_hits += hmm_gene_hits
 
         for match in complete_gene_hits:
             match.genome = reference
@@ -308,6 +314,9 @@ def parse_domain_tables(args, hmm_domtbl_files):
 
     alignment_stat_string = search_stats.summarize()
 
+    if search_stats.seqs_identified == 0 and not exit_on_empty:
+        logging.debug(alignment_stat_string)
+        return hmm_matches
     if search_stats.seqs_identified == 0 and search_stats.dropped == 0:
         logging.warning("No alignments found! TreeSAPP is exiting now.\n")
         sys.exit(0)
@@ -431,6 +440,10 @@ def read_colours_file(annotation_file):
 
 def tax_ids_file_to_leaves(tax_ids_file):
     # TODO: Replace all instances of this function call with that from the class ReferencePackage
+    return load_cached(tax_ids_file, "leaves", read_tax_ids_file)
+
+
+def read_tax_ids_file(tax_ids_file):
     tree_leaves = list()
     unknown = 0
     try:
@@ -533,7 +546,7 @@ def read_phylip_to_dict(phylip_input):
 
     line = phylip.readline()
     try:
-        num_sequences, aln_length = line.strip().split(' ')
+        num_sequences, aln_length = line.split()
         num_sequences = int(num_sequences)
         aln_length = int(aln_length)
     except ValueError:
@@ -589,10 +602,12 @@ def read_phylip_to_dict(phylip_input):
     return seq_dict
 
 
-def read_stockholm_to_dict(sto_file):
+def read_stockholm_to_dict(sto_file, match_states_only=False):
     """
 
     :param sto_file: A Stockholm-formatted multiple alignment file
+    :param match_states_only: Flag indicating the insert columns of a profile alignment (lower-case residues and '.')
+     should be removed, leaving only the residues and deletions aligned to the profile's match states
     :return: A dictionary with sequence headers as keys and sequences as values
     """
     seq_dict = dict()
@@ -620,12 +635,49 @@ def read_stockholm_to_dict(sto_file):
 
             if seq_name not in seq_dict:
                 seq_dict[seq_name] = ""
-            seq_dict[seq_name] += re.sub('\.', '-', sequence.upper())
+            if match_states_only:
+                seq_dict[seq_name] += re.sub(r"[a-z.]", '', sequence)
+            else:
+                seq_dict[seq_name] += re.sub('\.', '-', sequence.upper())
         line = sto_handler.readline()
 
     return seq_dict
 
 
+def read_hmm_alignment_map(hmm_file):
+    """
+    Reads the MAP annotation of an HMMER3 profile, the column of the multiple alignment the profile was built from
+    that each match state was derived from.
+
+    :param hmm_file: Path to an HMMER3 profile
+    :return: A list of the 1-based alignment column of each match state, or an empty list if the profile has no map
+    """
+    column_map = list()
+    has_map = False
+    in_model = False
+    try:
+        hmm_handler = open(hmm_file, 'r')
+    except IOError:
+        logging.error("Unable to open " + hmm_file + " for reading!\n")
+        sys.exit(3)
+
+    for line in hmm_handler:
+        if line.startswith("MAP"):
+            has_map = line.split()[1] == "yes"
+        elif line.startswith("HMM "):
+            in_model = True
+        elif line.startswith("//"):
+            break
+        elif in_model and has_map:
+            fields = line.split()
+            # Match emission lines: state number, one score per residue, then MAP, CONS, RF, MM and CS annotations
+            if len(fields) > 6 and fields[0].isdigit():
+                column_map.append(int(fields[-5]))
+    hmm_handler.close()
+
+    return column_map
+
+
 def read_uc(uc_file):
     """
     Function to read a USEARCH cluster (.uc) file
@@ -696,7 +748,84 @@ def read_rpkm(rpkm_output_file):
     return rpkm_values
 
 
-def validate_alignment_trimming(msa_files: list, unique_ref_headers: set, queries_mapped=False, min_seq_length=30):
+def read_sample_manifest(manifest_file):
+    """
+    Read the tab-separated manifest of samples to be classified by a single assign invocation.
+    Each line is expected to have between 2 and 4 elements: sample name, FASTA file, forward FASTQ and reverse FASTQ.
+    Blank lines and those beginning with '#' are skipped. Relative paths are relative to the manifest's directory.
+    :param manifest_file: A file path
+    :return: List of lists, each containing the sample name, FASTA path, and FASTQ paths (or None if not provided)
+    """
+    samples = list()
+    sample_names = set()
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+
+    try:
+        manifest = open(manifest_file)
+    except IOError:
+        logging.error("Unable to open " + manifest_file + " for reading!\n")
+        sys.exit(5)
+
+    for line in manifest:
+        if not line.strip() or line[0] == '#':
+            continue
+        fields = line.strip().split("\t")
+        if len(fields) < 2 or len(fields) > 4:
+            logging.error("Unexpected line format in sample manifest - should contain 2 to 4 tab-separated elements, "
+                          "" + str(len(fields)) + " encountered. Offending line:\n" + line + "\n")
+            sys.exit(5)
+        sample_name = fields[0]
+        if sample_name in sample_names:
+            logging.error("Sample name '" + sample_name + "' is found multiple times in " + manifest_file + "\n")
+            sys.exit(5)
+        sample_names.add(sample_name)
+        paths = [os.path.join(manifest_dir, path) if path else None for path in fields[1:]]
+        while len(paths) < 3:
+            paths.append(None)
+        if not os.path.isfile(paths[0]):
+            logging.error("FASTA file '" + paths[0] + "' for sample '" + sample_name + "' doesn't exist.\n")
+            sys.exit(5)
+        samples.append([sample_name] + paths)
+    manifest.close()
+
+    if not samples:
+        logging.error("No samples were found in " + manifest_file + "\n")
+        sys.exit(5)
+    return samples
+
+
+def read_multiple_alignment(msa_file: str, file_type="", msa_objects=None):
+    """
+    Reads a multiple sequence alignment file into a MultipleSequenceAlignment instance.
+    If msa_objects is provided alignments are only read from their file once and reused afterwards.
+
+    :param msa_file: A Phylip-, FASTA- or Stockholm-formatted multiple alignment file
+    :param file_type: Either 'Phylip', 'Fasta' or 'Stockholm'. If empty the format is determined from the extension.
+    :param msa_objects: Optional dictionary of MultipleSequenceAlignment instances indexed by their file paths
+    :return: A MultipleSequenceAlignment instance
+    """
+    if msa_objects is not None and msa_file in msa_objects:
+        return msa_objects[msa_file]
+
+    f_ext = msa_file.split('.')[-1]
+    if file_type == "Phylip" or (not file_type and re.search("phy", f_ext)):
+        seq_dict = read_phylip_to_dict(msa_file)
+    elif file_type == "Fasta" or (not file_type and (re.match("^f", f_ext) or f_ext == "mfa")):
+        seq_dict = read_fasta_to_dict(msa_file)
+    elif file_type == "Stockholm" or (not file_type and re.match("sto", f_ext)):
+        seq_dict = read_stockholm_to_dict(msa_file)
+    else:
+        logging.error("Unable to detect file format of " + msa_file + ".\n")
+        sys.exit(13)
+
+    msa = MultipleSequenceAlignment.from_dict(seq_dict, msa_file)
+    if msa_objects is not None:
+        msa_objects[msa_file] = msa
+    return msa
+
+
+def validate_alignment_trimming(msa_files: list, unique_ref_headers: set, queries_mapped=False, min_seq_length=30,
+                                msa_objects=None):
     """
     Parse a list of multiple sequence alignment (MSA) files and determine whether the multiple alignment:
         1. is shorter then the min_seq_length (30 by default)
@@ -709,7 +838,9 @@ def validate_alignment_trimming(msa_files: list, unique_ref_headers: set, querie
         While query sequences _could_ be identified as any that are not in unique_ref_headers,
         queries have names that are negative integers for more rapid and scalable identification
     :param min_seq_length: Optional minimum unaligned (no '-'s) length a sequence must exceed to be retained
-    :return: 1. Dictionary indexed by MSA file name mapping to FASTA-dictionaries and
+    :param msa_objects: Optional dictionary of MultipleSequenceAlignment instances indexed by file path.
+        Alignments in msa_files that are in msa_objects are not read from file.
+    :return: 1. Dictionary indexed by MSA file name mapping to MultipleSequenceAlignment instances and
     2. A string mapping the number of query sequences removed from each MSA file
     """
     discarded_seqs_string = ""
@@ -717,28 +848,16 @@ def validate_alignment_trimming(msa_files: list, unique_ref_headers: set, querie
     failed_multiple_alignments = list()
     n_refs = len(unique_ref_headers)
     for multi_align_file in msa_files:
-        filtered_multi_align = dict()
-        discarded_seqs = list()
         num_queries_retained = 0
         n_retained_refs = 0
         n_msa_refs = 0
-        f_ext = multi_align_file.split('.')[-1]
 
         # Read the multiple alignment file
-        if re.search("phy", f_ext):  # File is in Phylip format
-            seq_dict = read_phylip_to_dict(multi_align_file)
-        elif re.match("^f", f_ext):  # This is meant to match all fasta extensions
-            seq_dict = read_fasta_to_dict(multi_align_file)
-        elif f_ext == "mfa":  # This is meant to match a multiple alignment in FASTA format
-            seq_dict = read_fasta_to_dict(multi_align_file)
-        else:
-            logging.error("Unable to detect file format of " + multi_align_file + ".\n")
-            sys.exit(13)
+        msa = read_multiple_alignment(multi_align_file, msa_objects=msa_objects)
 
-        # Parse the MSA dict and ensure headers are integer-compatible
-        multi_align = dict()
-        for seq_name in seq_dict:
-            seq = seq_dict[seq_name]
+        # Parse the MSA names and ensure headers are integer-compatible
+        seq_names = list()
+        for seq_name in msa.names:
             try:
                 if int(seq_name) > 0:
                     n_msa_refs += 1
@@ -753,26 +872,27 @@ def validate_alignment_trimming(msa_files: list, unique_ref_headers: set, querie
                                   " detected in " + multi_align_file + ".\n")
                     sys.exit(13)
                 n_msa_refs += 1
-            multi_align[seq_name] = seq
-        if len(multi_align) == 0:
+            seq_names.append(seq_name)
+        if len(seq_names) == 0:
             logging.warning("No sequences were read from " + multi_align_file + ".\n" +
                             "The untrimmed alignment will be used instead.\n")
             failed_multiple_alignments.append(multi_align_file)
             continue
+        multi_align = msa.rename(seq_names)
+        seq_lengths = dict(zip(seq_names, multi_align.ungapped_lengths(b'-')))
         # The numeric identifiers make it easy to maintain order in the Phylip file by a numerical sort
-        for seq_name in sorted(multi_align, key=int):
-            seq_dummy = re.sub('-', '', multi_align[seq_name])
-            if len(seq_dummy) < min_seq_length:
-                discarded_seqs.append(seq_name)
-            else:
-                filtered_multi_align[seq_name] = multi_align[seq_name]
+        retained_seqs = list()
+        for seq_name in sorted(seq_lengths, key=int):
+            if seq_lengths[seq_name] >= min_seq_length:
+                retained_seqs.append(seq_name)
                 # The negative integers indicate this is a query sequence
                 if seq_name[0] == '-':
                     num_queries_retained += 1
                 else:
                     n_retained_refs += 1
-        discarded_seqs_string += "\n\t\t" + multi_align_file + " = " + str(len(discarded_seqs))
-        if len(discarded_seqs) == len(multi_align.keys()):
+        num_discarded = len(seq_lengths) - len(retained_seqs)
+        discarded_seqs_string += "\n\t\t" + multi_align_file + " = " + str(num_discarded)
+        if num_discarded == len(seq_lengths):
             # Throw an error if the final trimmed alignment is shorter than min_seq_length, and therefore empty
             logging.warning("Multiple sequence alignment in " + multi_align_file +
                             " is shorter than minimum sequence length threshold (" + str(min_seq_length) +
@@ -794,7 +914,7 @@ def validate_alignment_trimming(msa_files: list, unique_ref_headers: set, querie
         elif queries_mapped and num_queries_retained == 0:
             logging.warning("No query sequences in " + multi_align_file + " were retained after trimming.\n")
         else:
-            successful_multiple_alignments[multi_align_file] = filtered_multi_align
+            successful_multiple_alignments[multi_align_file] = multi_align.subset_rows(retained_seqs)
 
         if multi_align_file in successful_multiple_alignments:
             discarded_seqs_string += " (retained)"
@@ -5,23 +5,24 @@ import re
 import glob
 import os
 import logging
-from .classy import ItolJplace, TreeProtein
-from json import load, loads, dumps
+from .classy import ItolJplace, TreeProtein, JPlacePQuery
+from json import load
 from .utilities import clean_lineage_string
 
+# The fields of RAxML's (and EPA-ng's) JPlace files, in the order TreeSAPP indexes placement loci by
+RAXML_FIELDS = ["edge_num", "likelihood", "like_weight_ratio", "distal_length", "pendant_length"]
 
-def children_lineage(leaves_taxa_map: dict, pquery: str, node_map: dict):
+
+def children_lineage(leaves_taxa_map: dict, pquery: JPlacePQuery, node_map: dict):
     """
     From the jplace placement field ()
     :param leaves_taxa_map: Dictionary mapping tree leaf nodes to taxonomic lineages
-    :param pquery:
+    :param pquery: A JPlacePQuery instance
     :param node_map:
     :return:
     """
     children = list()
-    placement = loads(pquery, encoding="utf-8")
-    loci = placement['p']
-    for locus in loci:
+    for locus in pquery.loci:
         jplace_node = locus[0]
         tree_leaves = node_map[jplace_node]
         for tree_leaf in tree_leaves:
@@ -43,31 +44,50 @@ def pquery_likelihood_weight_ratio(pquery, position):
     """
     Determines the likelihood weight ratio (LWR) for a single placement. There may be multiple placements
     (or 'pquery's) in a single .jplace file. Therefore, this function is usually looped over.
-    :param pquery:
+    :param pquery: A JPlacePQuery instance
     :param position: The position of "like_weight_ration" in the pquery fields
     :return: The float(LWR) of a single placement
     """
     lwr = 0.0
-    placement = loads(str(pquery), encoding="utf-8")
-    for k, v in placement.items():
-        if k == 'p':
-            acc = 0
-            while acc < len(v):
-                pquery_fields = v[acc]
-                lwr = float(pquery_fields[position])
-                acc += 1
+    for pquery_fields in pquery.loci:
+        lwr = float(pquery_fields[position])
     return lwr
 
 
+def normalize_jplace_fields(jplace_data: ItolJplace):
+    """
+    pplacer writes the JPlace fields in alphabetical order (distal_length, edge_num, like_weight_ratio, ...) rather
+    than in RAxML's order, which loci are indexed by throughout TreeSAPP (e.g. locus[0] is the edge_num).
+    The fields, and the values of every locus, are reordered so those in RAXML_FIELDS come first and in that order,
+    followed by any others (e.g. pplacer's marginal_like) in their original order.
+
+    :param jplace_data: An ItolJplace instance with its fields and placements loaded from a JPlace file
+    :return: None
+    """
+    field_names = [str(field).strip('"') for field in jplace_data.fields]
+    if "edge_num" not in field_names:
+        logging.error("Unable to find 'edge_num' in the JPlace fields: " + ", ".join(field_names) + "\n")
+        sys.exit(3)
+    order = [field_names.index(field) for field in RAXML_FIELDS if field in field_names]
+    order += [x for x in range(len(field_names)) if field_names[x] not in RAXML_FIELDS]
+    if order == list(range(len(field_names))):
+        return
+    jplace_data.fields = [jplace_data.fields[x] for x in order]
+    for pquery in jplace_data.placements:
+        pquery.loci = [[locus[x] for x in order] for locus in pquery.loci]
+    return
+
+
 def jplace_parser(filename):
     """
-    Parses the jplace file using the load function from the JSON library
-    :param filename: jplace file output by RAxML
+    Parses the jplace file using the load function from the JSON library.
+    The fields and loci are ordered as RAxML writes them, regardless of the placement engine.
+    :param filename: jplace file output by RAxML, EPA-ng or pplacer
     :return: ItolJplace object
     """
     itol_datum = ItolJplace()
-    with open(filename) as jplace:
-        jplace_dat = load(jplace, encoding="utf-8")
+    with open(filename, encoding="utf-8") as jplace:
+        jplace_dat = load(jplace)
         itol_datum.tree = jplace_dat["tree"]
         # A list of strings
         if sys.version_info > (2, 9):
@@ -76,8 +96,9 @@ def jplace_parser(filename):
             itol_datum.fields = [x.decode("utf-8") for x in jplace_dat["fields"]]
         itol_datum.version = jplace_dat["version"]
         itol_datum.metadata = jplace_dat["metadata"]
-        # A list of dictionaries of where the key is a string and the value is a list of lists
-        itol_datum.placements = jplace_dat["placements"]
+        # A list of dictionaries of where the key is a string and the value is a list of lists, decoded once here
+        itol_datum.placements = [JPlacePQuery.from_json(pquery) for pquery in jplace_dat["placements"]]
+    normalize_jplace_fields(itol_datum)
 
     jplace_dat.clear()
 
@@ -110,27 +131,16 @@ def filter_jplace_data(jplace_data: ItolJplace, tree_saps: list):
     new_placement_collection = list()
     sapling_map = {sapling.contig_name: sapling for sapling in tree_saps}
 
-    for d_place in jplace_data.placements:
-        dict_strings = list()
-        classified = False
-        for k, v in loads(d_place).items():
-            if k == 'n':
-                # Find the TreeProtein that matches the placement (same contig name)
-                try:
-                    sapling = sapling_map[v[0]]
-                except KeyError:
-                    logging.error("Unable to find sequence '" + str(v[0]) + "' in sapling-map keys.\n")
-                    sys.exit(5)
-                # If the TreeProtein is classified, flag to append
-                classified = sapling.classified
-                dict_strings.append(dumps(k) + ":" + dumps(v))
-            elif k == 'p':
-                dict_strings.append(dumps(k) + ":" + dumps(v))
-            else:
-                logging.error("Unrecognized key '" + str(k) + "' in Jplace \"placements\".")
-                sys.exit(9)
-        if classified:
-            new_placement_collection.append('{' + ', '.join(dict_strings) + '}')
+    for pquery in jplace_data.placements:
+        # Find the TreeProtein that matches the placement (same contig name)
+        try:
+            sapling = sapling_map[pquery.names[0]]
+        except (KeyError, IndexError):
+            logging.error("Unable to find sequence '" + str(pquery.names) + "' in sapling-map keys.\n")
+            sys.exit(5)
+        # If the TreeProtein is classified, flag to append
+        if sapling.classified:
+            new_placement_collection.append(pquery)
     jplace_data.placements = new_placement_collection
     return jplace_data
 
@@ -160,20 +170,8 @@ def write_jplace(itol_datum: ItolJplace, jplace_file: str):
     jplace_out.write('{\n\t"tree": "')
     jplace_out.write(itol_datum.tree + "\", \n")
     jplace_out.write("\t\"placements\": [\n\t")
-    # The [] is lost from 'n': ["query"] during loads
-    new_placement_collection = list()
-    for d_place in itol_datum.placements:
-        dict_strings = list()
-        for k, v in loads(d_place).items():
-            if k == 'n':
-                dict_strings.append(dumps(k) + ":[" + dumps(v) + "]")
-            elif k == 'p':
-                dict_strings.append(dumps(k) + ":" + dumps(v))
-            else:
-                logging.error("Unrecognized key '" + str(k) + "' in Jplace \"placements\".")
-                sys.exit(9)
-        new_placement_collection.append('{' + ', '.join(dict_strings) + '}')
-    jplace_out.write(",\n\t".join(new_placement_collection))
+    # Placements are only serialized back to JSON here
+    jplace_out.write(",\n\t".join([pquery.to_json() for pquery in itol_datum.placements]))
     jplace_out.write("\n\t],\n")
     jplace_out.write("\t\"metadata\": " + re.sub('\'', '"', str(itol_datum.metadata)) + ",\n")
     jplace_out.write("\t\"version\": " + str(itol_datum.version) + ",\n")
@@ -233,7 +231,7 @@ def sub_indices_for_seq_names_jplace(jplace_dir, numeric_contig_index, marker_bu
         for jplace_path in jplace_files:
             jplace_data = jplace_parser(jplace_path)
             for pquery in jplace_data.placements:
-                pquery["n"] = numeric_contig_index[marker][int(pquery["n"][0])]
+                pquery.names = [numeric_contig_index[marker][int(pquery.names[0])]]
             write_jplace(jplace_data, jplace_dir + os.sep + "tmp.jplace")
             os.rename(jplace_dir + os.sep + "tmp.jplace", jplace_path)
     return
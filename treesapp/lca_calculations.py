@@ -6,9 +6,14 @@ import re
 import logging
 from pygtrie import StringTrie
 from .utilities import median, clean_lineage_string, load_taxonomic_trie
+from .refpkg_cache import load_cached
 
 
 def all_possible_assignments(tax_ids_file):
+    return load_cached(tax_ids_file, "taxa_trie", read_possible_assignments)
+
+
+def read_possible_assignments(tax_ids_file):
     try:
         cog_tax_ids = open(tax_ids_file, 'r', encoding='utf-8')
     except IOError:
@@ -0,0 +1,121 @@
+__author__ = 'Connor Morgan-Lang'
+
+import sys
+import logging
+import numpy as np
+
+GAP_CHARS = b"-."
+
+
+class MultipleSequenceAlignment:
+    """
+    An in-memory multiple sequence alignment: a matrix of the aligned characters (as uint8), one row per sequence,
+    and an index of each sequence name's row.
+    Alignments are parsed once and passed between the alignment, trimming and validation steps of assign rather than
+    being written and re-read as dictionaries of strings by each.
+    """
+    def __init__(self, names: list, matrix: np.ndarray, file_path=""):
+        self.names = list(names)
+        self.matrix = matrix
+        self.file = file_path
+        self.index = {name: row for row, name in enumerate(self.names)}
+
+    @classmethod
+    def from_dict(cls, seq_dict: dict, file_path=""):
+        """
+        :param seq_dict: A dictionary containing headers as keys and aligned sequences as values
+        :param file_path: The name of the file the alignment was read from or is to be written to
+        :return: A MultipleSequenceAlignment instance
+        """
+        names = list(seq_dict.keys())
+        lengths = np.fromiter((len(seq) for seq in seq_dict.values()), dtype=np.int64, count=len(names))
+        if len(lengths) and lengths.min() != lengths.max():
+            logging.error("Number of aligned columns is inconsistent in " + file_path + "!\n")
+            sys.exit(3)
+        n_cols = int(lengths[0]) if len(lengths) else 0
+        matrix = np.frombuffer(bytearray(''.join(seq_dict.values()), "ascii"), dtype=np.uint8)
+        return cls(names, matrix.reshape((len(names), n_cols)), file_path)
+
+    def __len__(self):
+        return len(self.names)
+
+    def dimensions(self):
+        """
+        :return: tuple = (nrow, ncolumn)
+        """
+        return self.matrix.shape[0], self.matrix.shape[1]
+
+    def sequence(self, name: str):
+        return self.matrix[self.index[name]].tobytes().decode("ascii")
+
+    def to_dict(self):
+        return {name: self.matrix[row].tobytes().decode("ascii") for row, name in enumerate(self.names)}
+
+    def gaps(self, gap_chars=GAP_CHARS):
+        """
+        :return: A boolean matrix, True where a character is a gap
+        """
+        return np.isin(self.matrix, np.frombuffer(gap_chars, dtype=np.uint8))
+
+    def ungapped_lengths(self, gap_chars=GAP_CHARS):
+        """
+        :return: An array of the number of non-gap characters in each sequence
+        """
+        return self.matrix.shape[1] - np.count_nonzero(self.gaps(gap_chars), axis=1)
+
+    def rename(self, names: list):
+        """
+        :return: A new MultipleSequenceAlignment, sharing this instance's matrix, with the sequence names replaced
+        """
+        if len(names) != len(self.names):
+            logging.error("Unable to rename " + str(len(self.names)) + " sequences with " + str(len(names)) +
+                          " names.\n")
+            sys.exit(3)
+        return MultipleSequenceAlignment(names, self.matrix, self.file)
+
+    def subset_rows(self, names: list):
+        """
+        :param names: The names of the sequences to retain, in the order they are to be in
+        :return: A new MultipleSequenceAlignment containing only the sequences in names
+        """
+        rows = np.array([self.index[name] for name in names], dtype=np.int64)
+        return MultipleSequenceAlignment(names, self.matrix[rows], self.file)
+
+    def subset_columns(self, columns):
+        """
+        :param columns: Either a boolean mask the length of the alignment or an array of the column indices to retain
+        :return: A new MultipleSequenceAlignment containing only the selected columns
+        """
+        return MultipleSequenceAlignment(self.names, self.matrix[:, columns], self.file)
+
+    def write_fasta(self, fasta_file: str):
+        fasta_string = ""
+        for name in sorted(self.names):
+            fasta_string += '>' + name + "\n" + self.sequence(name) + "\n"
+        with open(fasta_file, 'w') as fa_out:
+            fa_out.write(fasta_string)
+        return
+
+    def write_phylip(self, phy_file: str, block_len=50, name_width=10):
+        """
+        Writes the alignment in interleaved Phylip format, with the sequences sorted by name.
+
+        :param phy_file: Path to the Phylip file to write
+        :param block_len: The number of characters of each sequence per interleaved block
+        :param name_width: Sequence names are padded with spaces to this width
+        :return: None
+        """
+        num_seqs, aln_length = self.dimensions()
+        ordered_names = sorted(self.names)
+        sequences = [self.sequence(name) for name in ordered_names]
+        phy_string = ' ' + str(num_seqs) + '  ' + str(aln_length) + '\n'
+        for start in range(0, aln_length, block_len):
+            for name, sequence in zip(ordered_names, sequences):
+                if start == 0:
+                    phy_string += name.ljust(name_width)
+                phy_string += sequence[start:start + block_len] + '\n'
+            phy_string += '\n'
+
+        with open(phy_file, 'w') as phy_output:
+            phy_output.write(phy_string)
+        return
@@ -6,6 +6,7 @@ import logging
 from ete3 import Tree
 from .file_parsers import tax_ids_file_to_leaves
 from .utilities import clean_lineage_string, median
+from .taxonomy_store import TaxonomyStore
 
 import numpy as np
 import scipy.optimize as so
@@ -111,40 +112,26 @@ def trim_lineages_to_rank(leaf_taxa_map: dict, rank: str):
     ranks = {"Kingdom": 1, "Phylum": 2, "Class": 3, "Order": 4, "Family": 5, "Genus": 6, "Species": 7}
     unknowns_re = re.compile("unclassified|environmental sample", re.IGNORECASE)
     depth = ranks[rank]
-    truncated = 0
-    unclassified = 0
-    for node_name in sorted(leaf_taxa_map):
-        c_lineage = clean_lineage_string(leaf_taxa_map[node_name])
-        c_lineage_s = c_lineage.split("; ")
-
-        # Remove lineage from testing if the rank doesn't exist (unclassified at a high rank)
-        if len(c_lineage_s) < depth:
-            truncated += 1
-            continue
-
-        try:
-            unknowns_re.search(c_lineage)
-        except TypeError:
-            logging.error("Unexpected type (" + str(type(c_lineage)) + ") for '" + str(c_lineage) + "'\n")
+    node_names = sorted(leaf_taxa_map)
+    for node_name in node_names:
+        if not isinstance(leaf_taxa_map[node_name], str):
+            logging.error("Unexpected type (" + str(type(leaf_taxa_map[node_name])) + ") for '" +
+                          str(leaf_taxa_map[node_name]) + "'\n")
             sys.exit(33)
 
-        if unknowns_re.search(c_lineage):
-            i = 0
-            while i < depth:
-                try:
-                    taxon = c_lineage_s[i]
-                except IndexError:
-                    logging.error(rank + " position (" + str(depth) + ") unavailable in " + c_lineage + " ")
-                    break
-                if unknowns_re.search(taxon):
-                    i -= 1
-                    break
-                i += 1
-            if i < depth:
-                unclassified += 1
-                continue
-        trimmed_lineage_map[node_name] = "; ".join(c_lineage_s[:depth])
-
+    taxonomy = TaxonomyStore()
+    taxa = taxonomy.intern_all([clean_lineage_string(leaf_taxa_map[node_name]) for node_name in node_names])
+    # Remove lineage from testing if the rank doesn't exist (unclassified at a high rank)
+    deep_enough = taxonomy.depths(taxa) >= depth
+    # Remove lineages with an unknown taxon at the desired rank or higher
+    unknown_names = np.append(taxonomy.match_names(unknowns_re), False)
+    classified = ~np.any(unknown_names[taxonomy.name_matrix(taxa, depth)], axis=1)
+    trimmed_taxa = taxonomy.trim(taxa, depth)
+    for i in np.nonzero(deep_enough & classified)[0]:
+        trimmed_lineage_map[node_names[i]] = taxonomy.lineage(trimmed_taxa[i])
+
+    truncated = int(np.count_nonzero(~deep_enough))
+    unclassified = int(np.count_nonzero(deep_enough & ~classified))
     logging.debug(str(truncated) + " lineages truncated before " + rank + " were removed during lineage trimming.\n" +
                   str(unclassified) + " lineages unclassified at or before " + rank + " also removed.\n")
     return trimmed_lineage_map
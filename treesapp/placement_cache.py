@@ -0,0 +1,175 @@
+__author__ = 'Connor Morgan-Lang'
+
+import os
+import time
+import pickle
+import logging
+from hashlib import md5
+
+from .refpkg_cache import file_md5
+
+# Increment whenever the structure of the cached placements changes
+CACHE_VERSION = 1
+
+
+class PlacementCache:
+    """
+    An on-disk, content-addressed cache of the phylogenetic placements of query sequences.
+    Placements are indexed by the MD5 digest of the reference package's files (tree, alignment and HMM profile),
+    the sequence that was aligned and placed, and the parameters that influence placement (e.g. engine, trimming).
+    Each placement is pickled in a separate file, <cache_dir>/<first two characters of the key>/<key>.pkl,
+    and the JPlace tree and fields of each reference package are stored in <cache_dir>/trees/.
+    """
+    def __init__(self, cache_dir: str, max_mb=1000.0, max_days=90.0):
+        if cache_dir[-1] != os.sep:
+            cache_dir += os.sep
+        self.cache_dir = cache_dir
+        self.tree_dir = cache_dir + "trees" + os.sep
+        self.max_bytes = int(max_mb * 1E6)
+        self.max_age = max_days * 86400
+        self.refpkg_digests = dict()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        if not os.path.isdir(self.tree_dir):
+            os.makedirs(self.tree_dir)
+
+    def refpkg_digest(self, refpkg_files: list):
+        """
+        :param refpkg_files: List of paths to the files of a reference package that determine its placements
+        :return: A hexadecimal MD5 digest of the contents of all files
+        """
+        key = tuple(refpkg_files)
+        if key not in self.refpkg_digests:
+            self.refpkg_digests[key] = md5(''.join([file_md5(refpkg_file)
+                                                    for refpkg_file in refpkg_files]).encode("utf-8")).hexdigest()
+        return self.refpkg_digests[key]
+
+    @staticmethod
+    def placement_key(refpkg_digest: str, params: str, sequence: str):
+        return md5('|'.join([str(CACHE_VERSION), refpkg_digest, params, sequence]).encode("utf-8")).hexdigest()
+
+    def entry_path(self, key: str):
+        return self.cache_dir + key[:2] + os.sep + key + ".pkl"
+
+    def tree_path(self, refpkg_digest: str, params: str):
+        return self.tree_dir + md5('|'.join([refpkg_digest, params]).encode("utf-8")).hexdigest() + ".pkl"
+
+    @staticmethod
+    def read_entry(entry_file: str):
+        try:
+            with open(entry_file, 'rb') as entry_handler:
+                entry = pickle.load(entry_handler)
+        except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError):
+            return None
+        if not isinstance(entry, dict) or entry.get("version") != CACHE_VERSION:
+            return None
+        return entry
+
+    @staticmethod
+    def write_entry(entry_file: str, entry: dict):
+        try:
+            entry_dir = os.path.dirname(entry_file)
+            if not os.path.isdir(entry_dir):
+                os.makedirs(entry_dir)
+            # Write to a temporary file first so concurrent TreeSAPP processes never read a partial entry
+            tmp_file = entry_file + '.' + str(os.getpid())
+            with open(tmp_file, 'wb') as entry_handler:
+                pickle.dump(entry, entry_handler, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, entry_file)
+        except (IOError, OSError, pickle.PicklingError) as error:
+            logging.debug("Unable to write placement cache entry '" + entry_file + "': " + str(error) + "\n")
+            return False
+        return True
+
+    def get_tree(self, refpkg_digest: str, params: str):
+        """
+        :return: Tuple of the JPlace tree string and list of JPlace fields for the reference package,
+         or None if they have not been cached
+        """
+        entry = self.read_entry(self.tree_path(refpkg_digest, params))
+        if entry is None:
+            return None
+        return entry["tree"], entry["fields"]
+
+    def put_tree(self, refpkg_digest: str, params: str, tree: str, fields: list):
+        tree_file = self.tree_path(refpkg_digest, params)
+        if not os.path.isfile(tree_file):
+            self.write_entry(tree_file, {"version": CACHE_VERSION, "tree": tree, "fields": fields})
+        return
+
+    def get(self, refpkg_digest: str, params: str, sequence: str):
+        """
+        :return: The list of placement loci (lists of values ordered by the JPlace fields) for the sequence,
+         or None if it has not been cached
+        """
+        entry_file = self.entry_path(self.placement_key(refpkg_digest, params, sequence))
+        entry = self.read_entry(entry_file)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Refresh the modification time so recently used placements are evicted last
+        try:
+            os.utime(entry_file)
+        except OSError:
+            pass
+        return entry["p"]
+
+    def put(self, refpkg_digest: str, params: str, sequence: str, loci: list):
+        entry_file = self.entry_path(self.placement_key(refpkg_digest, params, sequence))
+        if self.write_entry(entry_file, {"version": CACHE_VERSION, "p": loci}):
+            self.stored += 1
+        return
+
+    def evict(self):
+        """
+        Removes placements that have not been used in more than max_age seconds,
+        followed by the least recently used placements until the cache is smaller than max_bytes.
+        """
+        entries = list()
+        total_size = 0
+        now = time.time()
+        for entry_dir in os.listdir(self.cache_dir):
+            if len(entry_dir) != 2 or not os.path.isdir(self.cache_dir + entry_dir):
+                continue
+            for entry_name in os.listdir(self.cache_dir + entry_dir):
+                entry_file = self.cache_dir + entry_dir + os.sep + entry_name
+                try:
+                    stat = os.stat(entry_file)
+                except OSError:
+                    continue
+                if self.max_age and now - stat.st_mtime > self.max_age:
+                    self.remove_entry(entry_file)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_file))
+                total_size += stat.st_size
+
+        if self.max_bytes and total_size > self.max_bytes:
+            for _, size, entry_file in sorted(entries):
+                if total_size <= self.max_bytes:
+                    break
+                self.remove_entry(entry_file)
+                total_size -= size
+        return
+
+    def remove_entry(self, entry_file: str):
+        try:
+            os.remove(entry_file)
+            self.evicted += 1
+        except OSError:
+            pass
+        return
+
+    def summarize(self):
+        lookups = self.hits + self.misses
+        summary_string = "Placement cache '" + self.cache_dir + "':\n"
+        summary_string += "\tLook-ups = " + str(lookups) + "\n"
+        summary_string += "\tHits = " + str(self.hits)
+        if lookups:
+            summary_string += " (" + str(round(100.0 * self.hits / lookups, 1)) + "%)"
+        summary_string += "\n"
+        summary_string += "\tPlacements stored = " + str(self.stored) + "\n"
+        summary_string += "\tPlacements evicted = " + str(self.evicted) + "\n"
+        return summary_string
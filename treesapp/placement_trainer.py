@@ -14,7 +14,7 @@ from . import file_parsers
 from . import utilities
 from . import wrapper
 from .phylo_dist import trim_lineages_to_rank, cull_outliers, parent_to_tip_distances, regress_ranks
-from .external_command_interface import setup_progress_bar, launch_write_command
+from .external_command_interface import setup_progress_bar, launch_write_command, run_job
 from .jplace_utils import jplace_parser
 from .classy import ReferencePackage
 from .entish import map_internal_nodes_leaves
@@ -439,9 +439,16 @@ def train_placement_distances(rank_training_seqs: dict, taxonomic_ranks: dict,
             logging.debug("Number of sequences discarded: " + summary_str + "\n")
 
             # Run RAxML with the parameters specified
-            raxml_files = wrapper.raxml_evolutionary_placement(executables["raxmlHPC"], temp_tree_file,
-                                                               query_filtered_multiple_alignment, ref_pkg.sub_model,
-                                                               "./", query_name, raxml_threads)
+            placement_job = run_job(wrapper.raxml_evolutionary_placement, "RAxML",
+                                    (executables["raxmlHPC"], temp_tree_file, query_filtered_multiple_alignment,
+                                     ref_pkg.sub_model, "./", query_name, raxml_threads),
+                                    raxml_threads,
+                                    wrapper.estimate_placement_memory(query_filtered_multiple_alignment,
+                                                                      ref_pkg.sub_model))
+            if placement_job.failed():
+                logging.error("RAxML did not complete successfully: " + placement_job.error + "\n")
+                sys.exit(19)
+            raxml_files = placement_job.result
 
             # Parse the JPlace file to pull distal_length+pendant_length for each placement
             jplace_data = jplace_parser(raxml_files["jplace"])
@@ -450,29 +457,23 @@ def train_placement_distances(rank_training_seqs: dict, taxonomic_ranks: dict,
             for pquery in jplace_data.placements:
                 top_lwr = 0.1
                 top_placement = PQuery(taxonomy, rank)
-                for name, info in pquery.items():
-                    if name == 'p':
-                        for placement in info:
-                            # Only record the best placement's distance
-                            lwr = float(placement[2])
-                            if lwr > top_lwr:
-                                top_lwr = lwr
-                                top_placement.inode = placement[0]
-                                top_placement.likelihood = placement[1]
-                                top_placement.lwr = lwr
-                                top_placement.distal = round(float(placement[3]), 6)
-                                top_placement.pendant = round(float(placement[4]), 6)
-                                leaf_children = node_map[int(top_placement.inode)]
-                                if len(leaf_children) > 1:
-                                    # Reference tree with clade excluded
-                                    parent = tmp_tree.get_common_ancestor(leaf_children)
-                                    tip_distances = parent_to_tip_distances(parent, leaf_children)
-                                    top_placement.mean_tip = round(float(sum(tip_distances)/len(tip_distances)), 6)
-                    elif name == 'n':
-                        top_placement.name = query_seq_name_map[int(info.pop())]
-                    else:
-                        logging.error("Unexpected variable in pquery keys: '" + name + "'\n")
-                        sys.exit(33)
+                for placement in pquery.loci:
+                    # Only record the best placement's distance
+                    lwr = float(placement[2])
+                    if lwr > top_lwr:
+                        top_lwr = lwr
+                        top_placement.inode = placement[0]
+                        top_placement.likelihood = placement[1]
+                        top_placement.lwr = lwr
+                        top_placement.distal = round(float(placement[3]), 6)
+                        top_placement.pendant = round(float(placement[4]), 6)
+                        leaf_children = node_map[int(top_placement.inode)]
+                        if len(leaf_children) > 1:
+                            # Reference tree with clade excluded
+                            parent = tmp_tree.get_common_ancestor(leaf_children)
+                            tip_distances = parent_to_tip_distances(parent, leaf_children)
+                            top_placement.mean_tip = round(float(sum(tip_distances)/len(tip_distances)), 6)
+                top_placement.name = query_seq_name_map[int(pquery.names[-1])]
 
                 if top_placement.lwr >= 0.5:  # The minimum likelihood weight ration a placement requires to be included
                     pqueries.append(top_placement)
@@ -0,0 +1,173 @@
+__author__ = 'Connor Morgan-Lang'
+
+import os
+import io
+import sys
+import json
+import time
+import logging
+import pstats
+import cProfile
+import resource
+import tracemalloc
+
+
+def format_elapsed_time(seconds: float):
+    """
+    :param seconds: A number of seconds
+    :return: A string of the hours, minutes and seconds separated by colons, e.g. 0.0:1.0:12.34
+    """
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return ':'.join([str(hours), str(minutes), str(round(seconds, 2))])
+
+
+def max_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return round(resource.getrusage(who).ru_maxrss / (1E6 if sys.platform == "darwin" else 1E3), 1)
+
+
+def current_rss_mb():
+    """
+    :return: The resident set size of this process in megabytes, or None if it cannot be read from /proc
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return round(resident_pages * os.sysconf("SC_PAGE_SIZE") / 1E6, 1)
+
+
+def children_cpu_time():
+    """
+    :return: The user and system CPU seconds used by all child processes that have been waited for
+    """
+    rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return rusage.ru_utime + rusage.ru_stime
+
+
+class StageProfiler:
+    """
+    Records the wall time, CPU time and memory used by each stage of a TreeSAPP command.
+    A stage is started with start() and runs until the next stage is started or stop() is called, so the time
+    between two stages is attributed to the earlier one. Stages that are started more than once are accumulated.
+
+    The CPU time of TreeSAPP (all threads) and of the external tools it waited for are recorded separately.
+    When detailed, the peak memory allocated by Python (tracemalloc) during each stage is also recorded and the
+    functions called by the main thread are profiled with cProfile. Both noticeably slow TreeSAPP down.
+    """
+    def __init__(self, detailed=False):
+        self.detailed = detailed
+        self.current = ""
+        self.stages = dict()
+        self.stats = dict()
+        self.start_time = time.time()
+        self.start_cpu = time.process_time()
+        self.start_child_cpu = children_cpu_time()
+        self._stage_start = (0.0, 0.0, 0.0)
+        self._profiler = None
+        if self.detailed and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def start(self, name: str):
+        if name == self.current:
+            return
+        self.stop()
+        self.current = name
+        if name not in self.stages:
+            self.stages[name] = {"runs": 0, "wall_time": 0.0, "cpu_time": 0.0, "external_cpu_time": 0.0,
+                                 "python_peak_mb": None, "rss_mb": None, "max_rss_mb": 0.0}
+        self.stages[name]["runs"] += 1
+        # Before Python 3.9 the peak cannot be reset, so it is the peak since tracing began
+        if self.detailed and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        if self.detailed:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._stage_start = (time.time(), time.process_time(), children_cpu_time())
+        return
+
+    def stop(self):
+        if not self.current:
+            return
+        wall_time = time.time() - self._stage_start[0]
+        cpu_time = time.process_time() - self._stage_start[1]
+        external_cpu_time = children_cpu_time() - self._stage_start[2]
+        if self._profiler:
+            self._profiler.disable()
+            if self.current in self.stats:
+                self.stats[self.current].add(self._profiler)
+            else:
+                self.stats[self.current] = pstats.Stats(self._profiler)
+            self._profiler = None
+
+        stage = self.stages[self.current]
+        stage["wall_time"] = round(stage["wall_time"] + wall_time, 3)
+        stage["cpu_time"] = round(stage["cpu_time"] + cpu_time, 3)
+        stage["external_cpu_time"] = round(stage["external_cpu_time"] + external_cpu_time, 3)
+        if self.detailed and tracemalloc.is_tracing():
+            python_peak_mb = round(tracemalloc.get_traced_memory()[1] / 1E6, 1)
+            stage["python_peak_mb"] = max(stage["python_peak_mb"] or 0.0, python_peak_mb)
+        stage["rss_mb"] = current_rss_mb()
+        # The high-water mark of the process, which only increases over the course of the run
+        stage["max_rss_mb"] = max_rss_mb()
+        self.current = ""
+        return
+
+    def profile(self):
+        """
+        :return: A dictionary of the resources used by each stage, in the order they were started, and in total
+        """
+        total = {"wall_time": round(time.time() - self.start_time, 3),
+                 "cpu_time": round(time.process_time() - self.start_cpu, 3),
+                 "external_cpu_time": round(children_cpu_time() - self.start_child_cpu, 3),
+                 "max_rss_mb": max_rss_mb(),
+                 "external_max_rss_mb": max_rss_mb(resource.RUSAGE_CHILDREN)}
+        stages = list()
+        for name in self.stages:
+            stage = {"stage": name}
+            stage.update(self.stages[name])
+            stages.append(stage)
+        return {"detailed": self.detailed, "stages": stages, "total": total}
+
+    def summarize(self):
+        summary_string = "Stage profile:\n"
+        summary_string += "\t" + "\t".join(["Stage", "Wall time (s)", "CPU time (s)", "External CPU time (s)",
+                                            "Python peak (MB)", "Max RSS (MB)"]) + "\n"
+        for name in self.stages:
+            stage = self.stages[name]
+            summary_string += "\t" + "\t".join([name, str(round(stage["wall_time"], 1)),
+                                                str(round(stage["cpu_time"], 1)),
+                                                str(round(stage["external_cpu_time"], 1)),
+                                                str(stage["python_peak_mb"]), str(stage["max_rss_mb"])]) + "\n"
+        return summary_string
+
+    def write(self, profile_file: str, stats_prefix="", num_functions=15):
+        """
+        Stops the current stage and writes the profile of all stages to a JSON file.
+        If the profile is detailed, the cProfile statistics of each stage are also written to
+        <stats_prefix><stage>.prof (readable with pstats or snakeviz) and the most time-consuming functions are logged.
+
+        :param profile_file: Path to the JSON file to write
+        :param stats_prefix: Path and prefix of the cProfile statistics files
+        :param num_functions: The number of functions, by cumulative time, to log for each stage
+        :return: None
+        """
+        self.stop()
+        try:
+            with open(profile_file, 'w') as profile_handler:
+                json.dump(self.profile(), profile_handler, indent=2)
+        except IOError:
+            logging.warning("Unable to write the performance profile to " + profile_file + "\n")
+            return
+
+        for name in self.stats:
+            stats_file = stats_prefix + name + ".prof"
+            self.stats[name].dump_stats(stats_file)
+            stats_stream = io.StringIO()
+            self.stats[name].stream = stats_stream
+            self.stats[name].sort_stats("cumulative").print_stats(num_functions)
+            logging.debug("Functions with the greatest cumulative time in stage '" + name + "' (" + stats_file +
+                          "):\n" + stats_stream.getvalue() + "\n")
+        return
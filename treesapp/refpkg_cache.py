@@ -0,0 +1,129 @@
+__author__ = 'Connor Morgan-Lang'
+
+import os
+import pickle
+import logging
+from hashlib import md5
+
+# Increment whenever the structure of a cached object changes (e.g. new attributes of TreeLeafReference)
+CACHE_VERSION = 1
+_data_dir = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")) + os.sep
+_cache_dir = _data_dir + "refpkg_cache" + os.sep
+_memory_cache = dict()
+
+
+def file_md5(file_path):
+    digest = md5()
+    with open(file_path, 'rb') as file_handler:
+        for block in iter(lambda: file_handler.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_stamp(file_path):
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def cache_file_path(source_file: str, kind: str):
+    source_name = os.path.basename(source_file)
+    path_digest = md5(os.path.realpath(source_file).encode("utf-8")).hexdigest()[:10]
+    return _cache_dir + kind + '_' + source_name + '_' + path_digest + ".pkl"
+
+
+def is_cacheable(source_file: str):
+    """
+    Only the reference package files distributed in TreeSAPP's data directory are cached.
+    Files written elsewhere (e.g. intermediates of create or evaluate) are usually short-lived and parsed directly.
+    """
+    return os.path.realpath(source_file).startswith(_data_dir) and os.path.isfile(source_file)
+
+
+def read_cache(cache_file: str, source_file: str):
+    """
+    Loads the object pickled in cache_file if the cache is still valid for source_file.
+    The cache is valid if it was written by the same CACHE_VERSION and the source file's modification time and size
+    are unchanged. If only the modification time changed (e.g. after a fresh checkout) the MD5 checksum of the source
+    file is compared with the one recorded and, if equal, the cache is still used and its timestamp refreshed.
+
+    :param cache_file: Path to the pickled cache
+    :param source_file: Path to the file the cached object was parsed from
+    :return: Tuple of a boolean indicating whether the cache is valid and the cached object (or None if invalid)
+    """
+    try:
+        with open(cache_file, 'rb') as cache_handler:
+            cache = pickle.load(cache_handler)
+    except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError):
+        return False, None
+
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+        return False, None
+    stamp = file_stamp(source_file)
+    if cache["stamp"] == stamp:
+        return True, cache["data"]
+    if cache["stamp"][1] == stamp[1] and cache["md5"] == file_md5(source_file):
+        cache["stamp"] = stamp
+        write_cache(cache_file, cache)
+        return True, cache["data"]
+    return False, None
+
+
+def write_cache(cache_file: str, cache: dict):
+    try:
+        if not os.path.isdir(_cache_dir):
+            os.makedirs(_cache_dir)
+        # Write to a temporary file first so concurrent TreeSAPP processes never read a partial cache
+        tmp_file = cache_file + '.' + str(os.getpid())
+        with open(tmp_file, 'wb') as cache_handler:
+            pickle.dump(cache, cache_handler, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except (IOError, OSError, pickle.PicklingError, RecursionError) as error:
+        logging.debug("Unable to write reference package cache '" + cache_file + "': " + str(error) + "\n")
+    return
+
+
+def load_cached(source_file: str, kind: str, parser, in_memory=False):
+    """
+    Returns the object parsed from source_file by parser, using a versioned pickle in data/refpkg_cache/
+    in place of re-parsing the text file whenever it is still valid.
+
+    :param source_file: Path to the reference package file to be parsed
+    :param kind: A short name for the parser, used to distinguish caches of different objects from the same file
+    :param parser: A function that takes source_file as its only argument and returns a pickle-able object
+    :param in_memory: Flag indicating the object is immutable and can also be reused within this process
+    :return: The object returned by parser(source_file), or its cached copy
+    """
+    if not is_cacheable(source_file):
+        return parser(source_file)
+
+    memory_key = (kind, os.path.realpath(source_file))
+    if in_memory and memory_key in _memory_cache:
+        stamp, data = _memory_cache[memory_key]
+        if stamp == file_stamp(source_file):
+            return data
+
+    cache_file = cache_file_path(source_file, kind)
+    valid, data = read_cache(cache_file, source_file)
+    if not valid:
+        data = parser(source_file)
+        cache = {"version": CACHE_VERSION,
+                 "stamp": file_stamp(source_file),
+                 "md5": file_md5(source_file),
+                 "data": data}
+        write_cache(cache_file, cache)
+
+    if in_memory:
+        _memory_cache[memory_key] = (file_stamp(source_file), data)
+    return data
+
+
+def clear_cache():
+    """
+    Removes all reference package caches, on-disk and in-memory.
+    """
+    _memory_cache.clear()
+    if os.path.isdir(_cache_dir):
+        for cache_file in os.listdir(_cache_dir):
+            if cache_file.endswith(".pkl"):
+                os.remove(_cache_dir + cache_file)
+    return
@@ -0,0 +1,199 @@
+__author__ = 'Connor Morgan-Lang'
+
+import numpy as np
+
+# The maximum distance (number of ranks) used to normalize the weighted taxonomic distance
+_MAX_DIST = 7
+
+
+class TaxonomyStore:
+    """
+    A table of taxonomic lineages where every taxon, i.e. a unique path of names from the root ('Root; Bacteria',
+    'Root; Bacteria; Proteobacteria', ...), is interned as an integer. Each taxon's parent, depth and the taxa
+    along its path from the root are stored in numpy arrays so that lowest common ancestors, majority-vote consensus
+    (LCA*), rank trimming and taxonomic distances are calculated for arrays of taxa without splitting and
+    joining '; '-separated lineage strings.
+
+    Taxon 0 is the root, the empty lineage. Lineages are split on '; ' exactly as the string functions in
+    lca_calculations do, so a lineage and the string returned by TaxonomyStore.lineage() for its taxon are identical.
+    """
+    def __init__(self, lineages=None):
+        self.parent = [-1]
+        self.depth = [0]
+        self.name_ids = [-1]
+        self.lineages = [""]
+        self.names = list()
+        self._name_index = dict()
+        self._children = [dict()]
+        self._lineage_index = {"": 0}
+        # ancestors[taxon, d] is the taxon at depth d + 1 on the path to taxon, or -1 beyond its depth
+        self._ancestors = np.full((64, 8), -1, dtype=np.int64)
+        self._name_matrix = np.full((64, 8), -1, dtype=np.int64)
+        self._depths = np.zeros(64, dtype=np.int64)
+        self.max_depth = 0
+        if lineages:
+            self.intern_all(lineages)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def _add_taxon(self, parent: int, name: str):
+        taxon = len(self.parent)
+        depth = self.depth[parent] + 1
+        if name not in self._name_index:
+            self._name_index[name] = len(self.names)
+            self.names.append(name)
+        self.parent.append(parent)
+        self.depth.append(depth)
+        self.name_ids.append(self._name_index[name])
+        self.lineages.append(name if parent == 0 else self.lineages[parent] + "; " + name)
+        self._children.append(dict())
+        self._children[parent][name] = taxon
+
+        rows, width = self._ancestors.shape
+        if taxon >= rows or depth > width:
+            new_shape = (max(rows, 2 * taxon), max(width, 2 * depth))
+            for attr in ["_ancestors", "_name_matrix"]:
+                grown = np.full(new_shape, -1, dtype=np.int64)
+                grown[:rows, :width] = getattr(self, attr)
+                setattr(self, attr, grown)
+            grown = np.zeros(new_shape[0], dtype=np.int64)
+            grown[:rows] = self._depths
+            self._depths = grown
+        self._depths[taxon] = depth
+        self.max_depth = max(self.max_depth, depth)
+        self._ancestors[taxon] = self._ancestors[parent]
+        self._ancestors[taxon, depth - 1] = taxon
+        self._name_matrix[taxon] = self._name_matrix[parent]
+        self._name_matrix[taxon, depth - 1] = self._name_index[name]
+        return taxon
+
+    def intern(self, lineage: str):
+        """
+        :param lineage: A '; '-separated taxonomic lineage string
+        :return: The integer ID of the lineage's taxon, which is added to the table if it is new
+        """
+        try:
+            return self._lineage_index[lineage]
+        except KeyError:
+            pass
+        taxon = 0
+        for name in lineage.split("; "):
+            try:
+                taxon = self._children[taxon][name]
+            except KeyError:
+                taxon = self._add_taxon(taxon, name)
+        self._lineage_index[lineage] = taxon
+        return taxon
+
+    def intern_all(self, lineages):
+        """
+        :param lineages: An iterable of '; '-separated lineage strings
+        :return: A numpy array of the taxon IDs of the lineages
+        """
+        return np.array([self.intern(lineage) for lineage in lineages], dtype=np.int64)
+
+    def lineage(self, taxon: int):
+        return self.lineages[taxon]
+
+    def depths(self, taxa: np.ndarray):
+        return self._depths[taxa]
+
+    def ancestors(self, taxa: np.ndarray, depth=None):
+        """
+        :param taxa: A numpy array of taxon IDs
+        :param depth: Optional number of ranks (from the root) to include
+        :return: A (len(taxa) x depth) matrix of the taxa on the path to each taxon, padded with -1
+        """
+        if depth is None:
+            depth = self.max_depth
+        matrix = self._ancestors[taxa, :depth]
+        if matrix.shape[1] < depth:
+            matrix = np.pad(matrix, ((0, 0), (0, depth - matrix.shape[1])), constant_values=-1)
+        return matrix
+
+    def name_matrix(self, taxa: np.ndarray, depth=None):
+        """
+        :return: A (len(taxa) x depth) matrix of the name IDs on the path to each taxon, padded with -1
+        """
+        if depth is None:
+            depth = self.max_depth
+        matrix = self._name_matrix[taxa, :depth]
+        if matrix.shape[1] < depth:
+            matrix = np.pad(matrix, ((0, 0), (0, depth - matrix.shape[1])), constant_values=-1)
+        return matrix
+
+    def match_names(self, name_re):
+        """
+        :param name_re: A compiled regular expression
+        :return: A boolean numpy array, indexed by name ID, of the names that the regular expression matches
+        """
+        return np.array([bool(name_re.search(name)) for name in self.names], dtype=bool)
+
+    def lca(self, taxa: np.ndarray):
+        """
+        The lowest common ancestor of the taxa, the deepest taxon on all of their paths from the root.
+
+        :param taxa: A numpy array of taxon IDs
+        :return: The taxon ID of the lowest common ancestor, which is 0 (the root) if the taxa share no ancestor
+        """
+        paths = self.ancestors(taxa)
+        shared = np.logical_and.reduce(paths == paths[0], axis=0) & (paths[0] >= 0)
+        lca_depth = len(shared) if shared.all() else int(np.argmin(shared))
+        return int(paths[0, lca_depth - 1]) if lca_depth else 0
+
+    def trim(self, taxa: np.ndarray, depth: int):
+        """
+        :return: A numpy array of the ancestors of each taxon at depth, or -1 for taxa shallower than depth
+        """
+        return self.ancestors(taxa, depth)[:, depth - 1]
+
+    def consensus(self, taxa: np.ndarray, min_ranks=4):
+        """
+        Approximates LCA* (without entropy calculations) as in lca_calculations.lowest_common_taxonomy:
+        starting from the root, the name held by more than half of the taxa at each rank is added to the consensus
+        until there is no majority. Only taxa with at least min_ranks ranks vote, unless there are none.
+
+        :param taxa: A numpy array of taxon IDs
+        :param min_ranks: Taxa with fewer ranks than this are not considered
+        :return: The taxon ID of the consensus lineage
+        """
+        depths = self.depths(taxa)
+        max_ranks = int(depths.max())
+        voters = taxa[depths >= min_ranks]
+        if len(voters) == 0:
+            voters = taxa
+        names = self.name_matrix(voters, max_ranks)
+        consensus = 0
+        for rank in range(max_ranks):
+            votes = names[:, rank]
+            name_ids, counts = np.unique(votes[votes >= 0], return_counts=True)
+            if len(counts) == 0 or counts.max() <= len(voters) / 2:
+                break
+            name = self.names[name_ids[np.argmax(counts)]]
+            try:
+                consensus = self._children[consensus][name]
+            except KeyError:
+                consensus = self._add_taxon(consensus, name)
+        return consensus
+
+    def distances(self, taxa: np.ndarray, taxon: int):
+        """
+        The number of ranks that must be climbed from each of the taxa and taxon to reach their common ancestor,
+        as calculated by lca_calculations.compute_taxonomic_distance.
+
+        :return: A numpy array of the distance between each of the taxa and taxon
+        """
+        depths = self.depths(taxa)
+        width = max(int(depths.max()), self.depth[taxon])
+        paths = self.ancestors(taxa, width)
+        shared = (paths == self.ancestors(np.array([taxon]), width)[0]) & (paths >= 0)
+        shared_depth = np.where(shared.all(axis=1), width, np.argmin(shared, axis=1))
+        return np.maximum(depths, self.depth[taxon]) - shared_depth
+
+    def weighted_distance(self, taxa: np.ndarray, taxon: int):
+        """
+        :return: The weighted taxonomic distance of the taxa from a common ancestor, taxon, as a float
+        """
+        numerator = int(np.sum(np.power(2, self.distances(taxa, taxon))))
+        return round(float(numerator/(len(taxa) * 2**_MAX_DIST)), 5)
@@ -7,6 +7,7 @@ from glob import glob
 from .classy import Assigner, Evaluator, Creator, PhyTrainer, Updater, Purity
 from .utilities import available_cpu_count, get_refpkg_build
 from .entrez_utils import read_accession_taxa_map
+from .external_command_interface import set_memory_budget
 
 
 class TreeSAPPArgumentParser(argparse.ArgumentParser):
@@ -81,6 +82,13 @@ class TreeSAPPArgumentParser(argparse.ArgumentParser):
         self.miscellany.add_argument('-n', '--num_procs', dest="num_threads", default=2, type=int,
                                      help='The number of CPU threads or parallel processes '
                                           'to use in various pipeline steps [DEFAULT = 2]')
+        self.miscellany.add_argument('--max_memory', default=0, type=float, required=False,
+                                     help='The megabytes of memory that concurrently running external tools '
+                                          'may use in total [DEFAULT = the physical memory]')
+        self.miscellany.add_argument('--cprofile', action='store_true', default=False,
+                                     help='Profiles the functions called and the memory allocated by each stage, '
+                                          'writing cProfile statistics to the final outputs. '
+                                          'Slows the analysis down.')
 
     def add_accession_params(self):
         self.optopt.add_argument("--accession2taxid", dest="acc_to_taxid", required=False, default=None,
@@ -150,6 +158,55 @@ def add_classify_arguments(parser: TreeSAPPArgumentParser):
                                help='A comma-separated list specifying which marker genes to query in input by'
                                ' the "denominator" column in data/tree_data/cog_list.tsv'
                                ' - e.g., M0701,D0601 for mcrA and nosZ\n[DEFAULT = ALL]')
+    parser.optopt.add_argument("--chunk_size", default=0, type=int,
+                               help="Read, ORF-call and search the input in batches of this many sequences, "
+                                    "retaining only the homologous sequences, to bound memory for very large inputs. "
+                                    "[DEFAULT = 0 (no batching)]")
+    parser.optopt.add_argument("--chunk_mb", default=0, type=float,
+                               help="Like --chunk_size but batches are limited to this many megabytes of sequence. "
+                                    "[DEFAULT = 0 (no batching)]")
+    parser.optopt.add_argument("--placement_engine", default="raxml", choices=["raxml", "epa-ng", "pplacer"],
+                               help="Software used for placing the query sequences on the reference trees. "
+                                    "EPA-ng is recommended for large numbers of query sequences. [DEFAULT = raxml]")
+    parser.optopt.add_argument("--dedup", default=False, action="store_true",
+                               help="Search, align and place only one representative of identical query sequences. "
+                                    "Classifications are copied to all of the duplicates.")
+    parser.optopt.add_argument("--search_shards", default=1, type=int,
+                               help="Split the query sequences into this many shards that are searched by hmmsearch "
+                                    "in parallel, with E-values calculated for the whole input. [DEFAULT = 1]")
+    parser.optopt.add_argument("--align_queries_only", default=False, action="store_true",
+                               help="Align only the query sequences to each reference package's HMM profile and "
+                                    "merge them into its reference alignment, rather than re-aligning the reference "
+                                    "sequences for every group of queries. Insertions relative to the profile are "
+                                    "removed from the query sequences.")
+    parser.optopt.add_argument("--trim_engine", default="BMGE", choices=["BMGE", "BMGEpy"],
+                               help="Software used for trimming the multiple sequence alignments when --trim_align is "
+                                    "used. BMGEpy is an implementation of BMGE's entropy and gap-rate filtering that "
+                                    "trims the alignments within TreeSAPP, without launching Java. WARNING: BMGEpy "
+                                    "has not yet been validated against BMGE.jar (see "
+                                    "dev_utils/trim_engine_concordance.py) and may select different columns and "
+                                    "sequences. [DEFAULT = BMGE]")
+    parser.optopt.add_argument("--placement_cache", default="", type=str,
+                               help="Path to a directory for caching the placements of query sequences. Sequences "
+                                    "placed by previous runs with the same reference packages and placement "
+                                    "parameters are not aligned and placed again. Not used with --trim_align, "
+                                    "since the trimmed columns depend on the queries aligned together. "
+                                    "[DEFAULT = no caching]")
+    parser.optopt.add_argument("--placement_cache_mb", default=1000.0, type=float,
+                               help="Maximum size of the placement cache in megabytes. Least recently used placements "
+                                    "are evicted first. [DEFAULT = 1000, 0 for no limit]")
+    parser.optopt.add_argument("--placement_cache_days", default=90.0, type=float,
+                               help="Placements unused for this many days are evicted from the placement cache. "
+                                    "[DEFAULT = 90, 0 for no limit]")
+    parser.optopt.add_argument("--single_hmm_db", default=False, action="store_true",
+                               help="Search all target HMM profiles as a single hmmpress'd database with hmmscan, "
+                                    "reading the query sequences only once. Recommended for large inputs.")
+    parser.optopt.add_argument("--manifest", default=False, action="store_true",
+                               help="The input (-i) is a tab-separated manifest of samples to classify, one per line: "
+                                    "sample name, FASTA file and optionally the forward and reverse FASTQ files. "
+                                    "Reference packages are loaded once and each sample is written to "
+                                    "its own sub-directory of the output directory. Samples are classified one "
+                                    "after another, each with all of the threads.")
     parser.optopt.add_argument("--stage", default="continue", required=False,
                                choices=["continue", "orf-call", "search", "align", "place", "classify"],
                                help="The stage(s) for TreeSAPP to execute [DEFAULT = continue]")
@@ -163,6 +220,11 @@ def add_classify_arguments(parser: TreeSAPPArgumentParser):
     parser.miscellany.add_argument('-d', '--delete', default=False, action="store_true",
                                    help='Delete intermediate file to save disk space. '
                                         'Recommended for large metagenomes!')
+    parser.miscellany.add_argument("--pipeline", default=False, action="store_true",
+                                   help="Pipeline each reference package through alignment, trimming and placement "
+                                        "as soon as its previous step is finished, rather than running each of "
+                                        "these stages on all reference packages before the next. EXPERIMENTAL: "
+                                        "its outputs have not been verified to match those of the staged workflow.")
 
     return
 
@@ -372,6 +434,12 @@ def check_parser_arguments(args, sys_args):
                         "Using maximum threads available (" + str(available_cpu_count()) + ")\n")
         args.num_threads = available_cpu_count()
 
+    if "max_memory" in vars(args):
+        if args.max_memory < 0:
+            logging.error("--max_memory must be a positive number of megabytes.\n")
+            sys.exit(3)
+        set_memory_budget(args.max_memory)
+
     return
 
 
@@ -479,6 +547,30 @@ def check_classify_arguments(assigner: Assigner, args):
     else:
         assigner.target_refpkgs = []
 
+    if args.chunk_size < 0 or args.chunk_mb < 0:
+        logging.error("Batch sizes (--chunk_size and --chunk_mb) must be positive.\n")
+        sys.exit(3)
+
+    if args.dedup and (args.chunk_size or args.chunk_mb):
+        logging.warning("Deduplication (--dedup) is not performed when the input is processed in batches.\n")
+        args.dedup = False
+
+    if args.trim_align and args.trim_engine == "BMGEpy":
+        logging.warning("BMGEpy has not been validated against BMGE.jar and may trim alignments differently.\n")
+
+    if args.placement_cache_mb < 0 or args.placement_cache_days < 0:
+        logging.error("Placement cache limits (--placement_cache_mb and --placement_cache_days) must be positive.\n")
+        sys.exit(3)
+
+    if args.placement_cache and args.trim_align:
+        logging.warning("The placement cache (--placement_cache) is not used with --trim_align since the columns "
+                        "trimmed, and therefore the placements, depend on the other queries in a group.\n")
+        args.placement_cache = ""
+
+    if args.search_shards < 1:
+        logging.error("The number of query shards (--search_shards) must be at least one.\n")
+        sys.exit(3)
+
     if args.molecule == "prot":
         assigner.change_stage_status("orf-call", False)
         if args.rpkm:
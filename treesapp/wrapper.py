@@ -4,12 +4,21 @@ import time
 import re
 import glob
 import logging
-from shutil import copy
-
-from treesapp.external_command_interface import launch_write_command, setup_progress_bar
-from treesapp.classy import CommandLineFarmer
-from .fasta import read_fasta_to_dict
+import threading
+from functools import partial
+from shutil import copy, rmtree
+from hashlib import md5
+
+from treesapp.external_command_interface import setup_progress_bar, JobExecutor, run_job, run_checked_command,\
+    ExternalCommandError
+from .fasta import read_fasta_to_dict, write_new_fasta, split_fasta_by_length, count_fasta_records
+from .file_parsers import read_phylip_to_dict
+from .HMMER_domainTblParser import merge_domain_tables
 from .utilities import remove_dashes_from_msa
+from .alignment_trimming import ENGINE_NAME, trim_alignment_file
+from .profiling import format_elapsed_time
+
+_pplacer_stats_lock = threading.Lock()
 
 
 def construct_tree(executables: dict, molecule: str, multiple_alignment_file: str,
@@ -37,6 +46,8 @@ def construct_tree(executables: dict, molecule: str, multiple_alignment_file: st
         tree_build_cmd += ["-out", tree_file]
         tree_build_cmd.append(multiple_alignment_file)
         tree_builder = "FastTree"
+        tree_threads = 1
+        tree_memory = estimate_job_memory([multiple_alignment_file], 20)
     else:
         tree_build_cmd = [executables["raxmlHPC"]]
         tree_build_cmd += ["-f", "a"]
@@ -49,15 +60,18 @@ def construct_tree(executables: dict, molecule: str, multiple_alignment_file: st
         tree_build_cmd += ["-T", str(args.num_threads)]
 
         if args.raxml_model:
-            tree_build_cmd += ["-m", args.raxml_model]
+            tree_model = args.raxml_model
         elif args.molecule == "prot":
-            tree_build_cmd += ["-m", "PROTGAMMAAUTO"]
+            tree_model = "PROTGAMMAAUTO"
         elif args.molecule == "rrna" or molecule == "dna":
-            tree_build_cmd += ["-m", "GTRGAMMA"]
+            tree_model = "GTRGAMMA"
         else:
             logging.error("A substitution model could not be specified with the 'molecule' argument: " + args.molecule)
             sys.exit(13)
+        tree_build_cmd += ["-m", tree_model]
         tree_builder = "RAxML"
+        tree_threads = args.num_threads
+        tree_memory = estimate_placement_memory(multiple_alignment_file, tree_model)
 
     # Ensure the tree from a previous run isn't going to be over-written
     if not os.path.exists(tree_output_dir):
@@ -68,15 +82,14 @@ def construct_tree(executables: dict, molecule: str, multiple_alignment_file: st
         sys.exit(13)
 
     logging.info("Building phylogenetic tree with " + tree_builder + "... ")
-    if args.fast:
-        stdout, returncode = launch_write_command(tree_build_cmd, True)
+    tree_job = run_job(tree_build_cmd, tree_builder, threads=tree_threads, memory=tree_memory,
+                       collect_all=args.fast)
+    if args.fast and tree_job.result is not None:
         with open(tree_output_dir + os.sep + "FastTree_info." + tree_prefix, 'w') as fast_info:
-            fast_info.write(stdout + "\n")
-    else:
-        stdout, returncode = launch_write_command(tree_build_cmd, False)
+            fast_info.write(tree_job.result + "\n")
     logging.info("done.\n")
 
-    if returncode != 0:
+    if tree_job.failed():
         logging.error(tree_builder + " did not complete successfully! " +
                       "Look in " + tree_output_dir + os.sep +
                       tree_builder + "_info." + tree_prefix + " for an error message.\n" +
@@ -86,49 +99,164 @@ def construct_tree(executables: dict, molecule: str, multiple_alignment_file: st
     return tree_builder
 
 
-def launch_evolutionary_placement_queries(executables, tree_dir, phy_files, marker_build_dict, output_dir, num_threads):
+def alignment_placement_size(msa_file: str):
     """
-    Run EPA through RAxML using Phylip files containing the reference and query sequences, and the reference trees
+    Estimates the amount of work EPA will perform on a multiple alignment as the number of query sequences
+    multiplied by the number of alignment columns. Query sequences are recognized by their negative numeric names.
+    Both Phylip and FASTA formatted alignments are supported, and only the sequence names are read.
 
-    :param executables:
-    :param tree_dir:
-    :param phy_files:
-    :param marker_build_dict:
-    :param output_dir:
-    :param num_threads:
-    :return: None
+    :param msa_file: Path to a multiple alignment file containing reference and query sequences
+    :return: Integer representing the size of the placement job
+    """
+    num_queries = 0
+    num_columns = 0
+    with open(msa_file) as msa_handler:
+        first_line = msa_handler.readline()
+        header = first_line.split()
+        if len(header) == 2 and header[0].isdigit() and header[1].isdigit():
+            # Phylip: the sequence names are the first field of the first block of lines
+            num_seqs, num_columns = int(header[0]), int(header[1])
+            for _ in range(num_seqs):
+                if msa_handler.readline().lstrip().startswith('-'):
+                    num_queries += 1
+        else:
+            line = first_line
+            first_seq = True
+            while line:
+                if line[0] == '>':
+                    if num_columns:
+                        first_seq = False
+                    if line[1:].startswith('-'):
+                        num_queries += 1
+                elif first_seq:
+                    num_columns += len(line.strip())
+                line = msa_handler.readline()
+    # Alignments without any recognizable queries are still placed, so they are scheduled by their width alone
+    return max(1, num_queries) * max(1, num_columns)
+
+
+def allocate_placement_threads(job_sizes: list, num_threads: int, min_threads=2):
+    """
+    Divides a thread budget among placement jobs in proportion to the size of each job.
+    Every job is given at least min_threads (or num_threads, if fewer are available) and at most num_threads.
+
+    :param job_sizes: List of job sizes, as calculated by alignment_placement_size
+    :param num_threads: The total number of threads available to all placement jobs
+    :param min_threads: The minimum number of threads each job should be given
+    :return: List of the number of threads for each job, in the order of job_sizes
+    """
+    num_threads = max(1, int(num_threads))
+    min_threads = min(num_threads, max(1, min_threads))
+    total_size = sum(job_sizes)
+    job_threads = list()
+    for size in job_sizes:
+        if total_size > 0:
+            share = int(round(num_threads * float(size) / total_size))
+        else:
+            share = 0
+        job_threads.append(max(min_threads, min(num_threads, share)))
+    return job_threads
+
+
+def estimate_job_memory(input_files: list, scale=1.0, base=50):
+    """
+    A rough estimate of the memory a job will use: a baseline plus a multiple of the size of its input files.
+
+    :param input_files: List of paths to the files the job reads
+    :param scale: The number of bytes of memory used for each byte of input
+    :param base: Megabytes used regardless of the input size
+    :return: The estimated megabytes of memory
+    """
+    input_size = 0
+    for input_file in input_files:
+        if input_file and os.path.isfile(input_file):
+            input_size += os.path.getsize(input_file)
+    return base + scale * input_size / 1E6
+
+
+def estimate_placement_memory(msa_file: str, model: str):
+    """
+    Estimates the memory used by phylogenetic placement from the number of characters in the multiple alignment.
+    The conditional likelihood vectors store a double for every character, character state and rate category.
+
+    :param msa_file: Path to a multiple alignment file containing reference and query sequences
+    :param model: The substitution model to be used e.g. PROTGAMMALG, GTRCAT
+    :return: The estimated megabytes of memory
+    """
+    if model and model.upper().startswith("PROT"):
+        bytes_per_char = 20 * 4 * 8
+    else:
+        bytes_per_char = 4 * 4 * 8
+    return estimate_job_memory([msa_file], bytes_per_char)
+
+
+def placement_job_info(tree_dir: str, phy_file: str, ref_marker):
+    """
+    :param tree_dir: Path to the directory containing the reference trees
+    :param phy_file: Path to a multiple alignment of the reference and query sequences to be placed
+    :param ref_marker: The MarkerBuild instance of the reference package
+    :return: Tuple of the placement job's size, query name, reference tree file, multiple alignment, model and marker
+    """
+    reference_tree_file = tree_dir + os.sep + ref_marker.cog + '_tree.txt'
+    query_name = re.sub("_hmm_purified.phy.*$", '', os.path.basename(phy_file))
+    query_name = re.sub(ref_marker.cog, ref_marker.denominator, query_name)
+    return alignment_placement_size(phy_file), query_name, reference_tree_file, phy_file, ref_marker.model,\
+        ref_marker.cog
+
+
+def launch_evolutionary_placement_queries(executables, tree_dir, phy_files, marker_build_dict, output_dir, num_threads,
+                                          engine="raxml"):
+    """
+    Run phylogenetic placement (RAxML's EPA by default) using Phylip files containing the reference and query sequences,
+    and the reference trees. Multiple placement processes are run concurrently. Each placement job is given a number
+    of threads in proportion to the size of its alignment (number of queries multiplied by the number of columns)
+    and the largest jobs are launched first; smaller jobs are started whenever enough of the num_threads budget is free.
+
+    :param executables: Dictionary mapping software names to their executables
+    :param tree_dir: Path to the directory containing the reference trees
+    :param phy_files: Dictionary of multiple alignment files indexed by their refpkg denominator
+    :param marker_build_dict: A dictionary of MarkerBuild instances indexed by refpkg codes/denominators
+    :param output_dir: Path to write the EPA outputs
+    :param num_threads: The total number of threads available to all placement processes
+    :param engine: Name of the placement software [raxml|epa-ng|pplacer]
+    :return: List of the jplace files written, in the order the jobs finished
     """
-    logging.info("Running RAxML... coffee?\n")
+    engine_names = {"raxml": "RAxML", "epa-ng": "EPA-ng", "pplacer": "pplacer"}
+    place = placement_engine(executables, engine)
+    logging.info("Running " + engine_names[engine] + "... coffee?\n")
 
     start_time = time.time()
 
-    raxml_calls = 0
-    # Maximum-likelihood sequence placement analyses
-    denominator_reference_tree_dict = dict()
+    # Gather the placement jobs and estimate the size of each
+    placement_jobs = list()
     for denominator in sorted(phy_files.keys()):
         if not isinstance(denominator, str):
             logging.error(str(denominator) + " is not string but " + str(type(denominator)) + "\n")
             raise AssertionError()
-        # Establish the reference tree file to be used for this contig
-        ref_marker = marker_build_dict[denominator]
-        reference_tree_file = tree_dir + os.sep + ref_marker.cog + '_tree.txt'
-        if denominator not in denominator_reference_tree_dict.keys():
-            denominator_reference_tree_dict[denominator] = reference_tree_file
         for phy_file in phy_files[denominator]:
-            query_name = re.sub("_hmm_purified.phy.*$", '', os.path.basename(phy_file))
-            query_name = re.sub(marker_build_dict[denominator].cog, denominator, query_name)
-            raxml_evolutionary_placement(executables["raxmlHPC"], reference_tree_file, phy_file,
-                                         ref_marker.model, output_dir, query_name, num_threads)
-            raxml_calls += 1
-
-    end_time = time.time()
-    hours, remainder = divmod(end_time - start_time, 3600)
-    minutes, seconds = divmod(remainder, 60)
-    logging.debug("\tRAxML time required: " +
-                  ':'.join([str(hours), str(minutes), str(round(seconds, 2))]) + "\n")
-    logging.debug("\tRAxML was called " + str(raxml_calls) + " times.\n")
+            placement_jobs.append(placement_job_info(tree_dir, phy_file, marker_build_dict[denominator]))
 
-    return
+    # Largest jobs first, with the query name breaking ties so the schedule is deterministic.
+    # Smaller jobs are launched whenever enough threads and memory are free.
+    placement_jobs.sort(key=lambda job: (-job[0], job[1]))
+    job_threads = allocate_placement_threads([job[0] for job in placement_jobs], num_threads)
+    executor = JobExecutor(num_threads, stage=engine_names[engine])
+    for placement_job, threads in zip(placement_jobs, job_threads):
+        _, query_name, reference_tree_file, phy_file, model, marker = placement_job
+        executor.submit(place, (reference_tree_file, phy_file, model, output_dir, query_name, threads),
+                        threads, estimate_placement_memory(phy_file, model), query_name, marker=marker)
+
+    jplace_files = list()
+    for placement_job in executor.run():
+        if not placement_job.failed():
+            jplace_files.append(placement_job.result["jplace"])
+    executor.exit_on_failure(19)
+
+    logging.debug("\t" + engine_names[engine] + " time required: " +
+                  format_elapsed_time(time.time() - start_time) + "\n")
+    logging.debug("\t" + engine_names[engine] + " was called " + str(len(jplace_files)) + " times.\n")
+
+    return jplace_files
 
 
 def raxml_evolutionary_placement(raxml_exe: str, reference_tree_file: str, multiple_alignment: str, model: str,
@@ -203,7 +331,7 @@ def raxml_evolutionary_placement(raxml_exe: str, reference_tree_file: str, multi
                      '-n', query_name,
                      '-w', output_dir,
                      '>', epa_files["stdout"]]
-    launch_write_command(raxml_command)
+    run_checked_command(raxml_command)
 
     # Rename the RAxML output files
     if os.path.exists(epa_info):
@@ -216,9 +344,8 @@ def raxml_evolutionary_placement(raxml_exe: str, reference_tree_file: str, multi
         copy(epa_tree, epa_files["tree"])
         os.remove(epa_tree)
     else:
-        logging.error("Some files were not successfully created for " + query_name + "\n" +
-                      "Check " + epa_files["stdout"] + " for an error!\n")
-        sys.exit(3)
+        raise ExternalCommandError("Some files were not successfully created for " + query_name + "\n" +
+                                   "Check " + epa_files["stdout"] + " for an error!")
     # Remove useless files
     if os.path.exists(epa_labelled_tree):
         os.remove(epa_labelled_tree)
@@ -228,6 +355,206 @@ def raxml_evolutionary_placement(raxml_exe: str, reference_tree_file: str, multi
     return epa_files
 
 
+def raxml_to_raxmlng_model(model: str):
+    """
+    Converts a RAxML (v8) substitution model name (e.g. PROTGAMMALG, GTRGAMMA) to the equivalent RAxML-ng/EPA-ng
+    model string (e.g. LG+G, GTR+G). Rate heterogeneity is always modelled with a discrete Gamma distribution.
+
+    :param model: The substitution model used by RAxML
+    :return: The model string to be used by EPA-ng
+    """
+    model_re = re.compile(r"^(PROT)?(GAMMA|CAT)(I|X)?(\w+?)(F)?$")
+    if model and model.startswith("GTR"):
+        return "GTR+G"
+    model_match = model_re.match(model) if model else None
+    if not model_match or model_match.group(4) == "AUTO":
+        logging.error("Unable to convert RAxML substitution model '" + str(model) + "' for EPA-ng.\n")
+        sys.exit(3)
+    ng_model = model_match.group(4) + "+G"
+    if model_match.group(5):
+        ng_model += "+F"
+    return ng_model
+
+
+def split_placement_alignment(multiple_alignment: str, output_prefix: str):
+    """
+    Splits a multiple alignment containing both reference and query sequences, in either Phylip or FASTA format,
+    into two FASTA files. Query sequences are recognized by their negative numeric names.
+
+    :param multiple_alignment: Path to a multiple alignment file containing reference and query sequences
+    :param output_prefix: Prefix of the two FASTA files to write
+    :return: Paths to the reference and the query FASTA files
+    """
+    with open(multiple_alignment) as msa_handler:
+        header = msa_handler.readline().split()
+    if len(header) == 2 and header[0].isdigit() and header[1].isdigit():
+        msa_dict = read_phylip_to_dict(multiple_alignment)
+    else:
+        msa_dict = read_fasta_to_dict(multiple_alignment)
+
+    query_names = [seq_name for seq_name in msa_dict if seq_name.startswith('-')]
+    ref_names = [seq_name for seq_name in msa_dict if not seq_name.startswith('-')]
+    ref_fasta = output_prefix + "_references.fasta"
+    query_fasta = output_prefix + "_queries.fasta"
+    write_new_fasta(msa_dict, ref_fasta, None, ref_names)
+    write_new_fasta(msa_dict, query_fasta, None, query_names)
+    return ref_fasta, query_fasta
+
+
+def epa_ng_placement(epa_exe: str, reference_tree_file: str, multiple_alignment: str, model: str,
+                     output_dir: str, query_name: str, num_threads=2):
+    """
+    A wrapper for EPA-ng, an alternative to RAxML's evolutionary placement algorithm.
+    EPA-ng requires the reference and query sequences in separate alignment files so the multiple alignment
+    is first split, and EPA-ng's outputs are then renamed so they are parsed just like RAxML's outputs.
+
+    :param epa_exe: Path to the EPA-ng executable to be used
+    :param reference_tree_file: The reference tree for evolutionary placement to operate on
+    :param multiple_alignment: Path to a multiple alignment file containing reference and query sequences
+    :param model: The substitution model, as used by RAxML (e.g. PROTGAMMALG), to be used by EPA-ng
+    :param output_dir: Path to write the EPA-ng outputs
+    :param query_name: Prefix name for all of the output files
+    :param num_threads: Number of threads EPA-ng should use (default = 2)
+    :return: A dictionary of files written by EPA-ng that are used by TreeSAPP. For example epa_files["jplace"]
+    """
+    epa_files = dict()
+    if not os.path.isabs(output_dir):
+        output_dir = os.getcwd() + os.sep + output_dir
+    if output_dir[-1] != os.sep:
+        output_dir += os.sep
+
+    if not model:
+        logging.error("No substitution model provided for evolutionary placement of " + query_name + ".\n")
+        raise AssertionError()
+
+    # EPA-ng always writes the same file names so each job is given its own working directory
+    job_dir = output_dir + query_name + "_EPA-ng" + os.sep
+    if not os.path.isdir(job_dir):
+        os.makedirs(job_dir)
+    epa_files["stdout"] = output_dir + query_name + "_EPA-ng.txt"
+    epa_files["info"] = output_dir + query_name + ".EPA-ng_info.txt"
+    epa_files["jplace"] = output_dir + "EPA-ng_portableTree." + query_name + ".jplace"
+
+    ref_fasta, query_fasta = split_placement_alignment(multiple_alignment, job_dir + query_name)
+    epa_command = [epa_exe,
+                   "--tree", reference_tree_file,
+                   "--ref-msa", ref_fasta,
+                   "--query", query_fasta,
+                   "--model", raxml_to_raxmlng_model(model),
+                   "--threads", str(int(num_threads)),
+                   "--outdir", job_dir,
+                   "--redo",
+                   '>', epa_files["stdout"]]
+    run_checked_command(epa_command)
+
+    if not os.path.isfile(job_dir + "epa_result.jplace"):
+        raise ExternalCommandError("Some files were not successfully created for " + query_name + "\n" +
+                                   "Check " + epa_files["stdout"] + " for an error!")
+    os.replace(job_dir + "epa_result.jplace", epa_files["jplace"])
+    if os.path.isfile(job_dir + "epa_info.log"):
+        os.replace(job_dir + "epa_info.log", epa_files["info"])
+    rmtree(job_dir)
+
+    return epa_files
+
+
+def pplacer_placement(pplacer_exe: str, raxml_exe: str, reference_tree_file: str, multiple_alignment: str,
+                      model: str, output_dir: str, query_name: str, num_threads=2):
+    """
+    A wrapper for pplacer. Since pplacer reads the substitution model parameters from a RAxML info file,
+    these are first estimated on the reference alignment and fixed reference tree with `raxmlHPC -f e`.
+    That is only performed once per reference tree; all placement jobs using the same tree share the file.
+
+    :param pplacer_exe: Path to the pplacer executable to be used
+    :param raxml_exe: Path to the RAxML executable used to estimate the model parameters
+    :param reference_tree_file: The reference tree for evolutionary placement to operate on
+    :param multiple_alignment: Path to a multiple alignment file containing reference and query sequences
+    :param model: The substitution model, as used by RAxML (e.g. PROTGAMMALG)
+    :param output_dir: Path to write the pplacer outputs
+    :param query_name: Prefix name for all of the output files
+    :param num_threads: Number of threads pplacer should use (default = 2)
+    :return: A dictionary of files written by pplacer that are used by TreeSAPP. For example epa_files["jplace"]
+    """
+    epa_files = dict()
+    if not os.path.isabs(output_dir):
+        output_dir = os.getcwd() + os.sep + output_dir
+    if output_dir[-1] != os.sep:
+        output_dir += os.sep
+
+    if not model:
+        logging.error("No substitution model provided for evolutionary placement of " + query_name + ".\n")
+        raise AssertionError()
+
+    job_dir = output_dir + query_name + "_pplacer" + os.sep
+    if not os.path.isdir(job_dir):
+        os.makedirs(job_dir)
+    epa_files["stdout"] = output_dir + query_name + "_pplacer.txt"
+    epa_files["jplace"] = output_dir + "pplacer_portableTree." + query_name + ".jplace"
+    tree_name = re.sub("_tree.txt$", '', os.path.basename(reference_tree_file))
+    epa_files["info"] = output_dir + tree_name + ".pplacer_RAxML_info.txt"
+
+    ref_fasta, query_fasta = split_placement_alignment(multiple_alignment, job_dir + query_name)
+
+    with _pplacer_stats_lock:
+        if not os.path.isfile(epa_files["info"]):
+            stats_name = tree_name + "_stats"
+            raxml_command = [raxml_exe,
+                             '-m', model,
+                             '-T', str(int(num_threads)),
+                             '-s', ref_fasta,
+                             '-t', reference_tree_file,
+                             '-f', 'e',
+                             '-n', stats_name,
+                             '-w', job_dir,
+                             '>', job_dir + stats_name + "_RAxML.txt"]
+            run_checked_command(raxml_command)
+            os.replace(job_dir + "RAxML_info." + stats_name, epa_files["info"])
+
+    # pplacer reads a single alignment containing both the reference and query sequences
+    combined_fasta = job_dir + query_name + "_combined.fasta"
+    with open(combined_fasta, 'w') as combined_handler:
+        for fasta_file in [ref_fasta, query_fasta]:
+            with open(fasta_file) as fasta_handler:
+                combined_handler.write(fasta_handler.read())
+
+    pplacer_command = [pplacer_exe,
+                       "-t", reference_tree_file,
+                       "-s", epa_files["info"],
+                       "-j", str(int(num_threads)),
+                       "-o", epa_files["jplace"],
+                       combined_fasta,
+                       '>', epa_files["stdout"]]
+    run_checked_command(pplacer_command)
+
+    if not os.path.isfile(epa_files["jplace"]):
+        raise ExternalCommandError("Some files were not successfully created for " + query_name + "\n" +
+                                   "Check " + epa_files["stdout"] + " for an error!")
+    rmtree(job_dir)
+
+    return epa_files
+
+
+def placement_engine(executables: dict, engine="raxml"):
+    """
+    Selects the software used for phylogenetic placement of query sequences onto the reference trees.
+    All engines write JPlace files named *portableTree.<query_name>.jplace that are parsed identically.
+
+    :param executables: Dictionary mapping software names to their executables
+    :param engine: Name of the placement software [raxml|epa-ng|pplacer]
+    :return: A function that accepts the arguments reference_tree_file, multiple_alignment, model, output_dir,
+     query_name and num_threads, runs the placement and returns a dictionary of the files written (e.g. "jplace")
+    """
+    if engine == "raxml":
+        return partial(raxml_evolutionary_placement, executables["raxmlHPC"])
+    elif engine == "epa-ng":
+        return partial(epa_ng_placement, executables["epa-ng"])
+    elif engine == "pplacer":
+        return partial(pplacer_placement, executables["pplacer"], executables["raxmlHPC"])
+    else:
+        logging.error("Unrecognized phylogenetic placement engine '" + str(engine) + "'.\n")
+        sys.exit(3)
+
+
 def trimal_command(executable, mfa_file, trimmed_msa_file):
     trim_command = [executable,
                     '-in', mfa_file,
@@ -250,11 +577,16 @@ def bmge_command(executable, mfa_file, trimmed_msa_file, molecule):
 
 
 def hmmalign_command(executable, ref_aln, ref_profile, input_fasta, output_multiple_alignment):
-    malign_command = [executable,
-                      '--mapali', ref_aln,
-                      '--outformat', 'Stockholm',
-                      ref_profile, input_fasta,
-                      '>', output_multiple_alignment]
+    """
+    :param ref_aln: Path to the reference multiple alignment the profile was built from, to include in the output.
+     If empty only the query sequences are aligned to the profile.
+    """
+    malign_command = [executable]
+    if ref_aln:
+        malign_command += ['--mapali', ref_aln]
+    malign_command += ['--outformat', 'Stockholm',
+                       ref_profile, input_fasta,
+                       '>', output_multiple_alignment]
 
     return malign_command
 
@@ -276,12 +608,12 @@ def profile_aligner(executables, ref_aln, ref_profile, input_fasta, output_sto,
     else:
         malign_command = hmmalign_command(executables["hmmalign"], ref_aln, ref_profile, input_fasta, output_sto)
 
-    stdout, returncode = launch_write_command(malign_command)
-    if returncode != 0:
-        logging.error("Multiple alignment failed for " + input_fasta + ". Command used:\n" +
-                      ' '.join(malign_command) + " output:\n" + stdout + "\n")
+    malign_job = run_job(malign_command, os.path.basename(malign_command[0]),
+                         memory=estimate_job_memory([ref_profile, input_fasta], 10))
+    if malign_job.failed():
+        logging.error("Multiple alignment failed for " + input_fasta + ": " + malign_job.error + "\n")
         sys.exit(3)
-    return stdout
+    return malign_job.result
 
 
 def run_papara(executable, tree_file, ref_alignment_phy, query_fasta, molecule):
@@ -292,12 +624,11 @@ def run_papara(executable, tree_file, ref_alignment_phy, query_fasta, molecule):
     if molecule == "prot":
         papara_command.append("-a")
 
-    stdout, ret_code = launch_write_command(papara_command)
-    if ret_code != 0:
-        logging.error("PaPaRa did not complete successfully!\n" +
-                      "Command used:\n" + ' '.join(papara_command) + "\n")
+    papara_job = run_job(papara_command, "PaPaRa", memory=estimate_job_memory([ref_alignment_phy, query_fasta], 10))
+    if papara_job.failed():
+        logging.error("PaPaRa did not complete successfully: " + papara_job.error + "\n")
         sys.exit(3)
-    return stdout
+    return papara_job.result
 
 
 def cluster_new_reference_sequences(update_tree, args, new_ref_seqs_fasta):
@@ -309,7 +640,10 @@ def cluster_new_reference_sequences(update_tree, args, new_ref_seqs_fasta):
     usearch_command += ["--log", update_tree.Output + os.sep + "usearch_sort.log"]
     # usearch_command += ["1>", "/dev/null", "2>", "/dev/null"]
 
-    launch_write_command(usearch_command)
+    usearch_job = run_job(usearch_command, "USEARCH", memory=estimate_job_memory([new_ref_seqs_fasta], 2))
+    if usearch_job.failed():
+        logging.error("USEARCH did not sort the sequences successfully: " + usearch_job.error + "\n")
+        sys.exit(19)
 
     uclust_id = "0." + str(int(update_tree.cluster_id))
     try:
@@ -325,7 +659,10 @@ def cluster_new_reference_sequences(update_tree, args, new_ref_seqs_fasta):
     uclust_command += ["--log", update_tree.Output + os.sep + "usearch_cluster.log"]
     # uclust_command += ["1>", "/dev/null", "2>", "/dev/null"]
 
-    launch_write_command(uclust_command)
+    uclust_job = run_job(uclust_command, "USEARCH", memory=estimate_job_memory([new_ref_seqs_fasta], 2))
+    if uclust_job.failed():
+        logging.error("UCLUST did not complete successfully: " + uclust_job.error + "\n")
+        sys.exit(19)
 
     logging.info("done.\n")
 
@@ -349,27 +686,25 @@ def cluster_sequences(uclust_exe, fasta_input, uclust_prefix, similarity=0.60):
     uclust_cmd += ["-sort", "length"]
     uclust_cmd += ["-centroids", uclust_prefix + ".fa"]
     uclust_cmd += ["--uc", uclust_prefix + ".uc"]
+    uclust_job = run_job(uclust_cmd, "USEARCH", memory=estimate_job_memory([fasta_input], 2))
     logging.info("done.\n")
-    stdout, returncode = launch_write_command(uclust_cmd)
 
-    if returncode != 0:
-        logging.error("UCLUST did not complete successfully! Command used:\n" +
-                      ' '.join(uclust_cmd) + "\n")
+    if uclust_job.failed():
+        logging.error("UCLUST did not complete successfully: " + uclust_job.error + "\n")
         sys.exit(13)
 
-    logging.debug(stdout)
+    logging.debug(uclust_job.result)
     return
 
 
 def build_hmm_profile(hmmbuild_exe, msa_in, output_hmm):
     logging.debug("Building HMM profile... ")
     hmm_build_command = [hmmbuild_exe, output_hmm, msa_in]
-    stdout, hmmbuild_pro_returncode = launch_write_command(hmm_build_command)
+    hmmbuild_job = run_job(hmm_build_command, "hmmbuild", memory=estimate_job_memory([msa_in], 10))
     logging.debug("done.\n")
 
-    if hmmbuild_pro_returncode != 0:
-        logging.error("hmmbuild did not complete successfully for:\n" +
-                      ' '.join(hmm_build_command) + "\n")
+    if hmmbuild_job.failed():
+        logging.error("hmmbuild did not complete successfully: " + hmmbuild_job.error + "\n")
         sys.exit(7)
 
 
@@ -380,24 +715,48 @@ def run_prodigal(args, fasta_file, output_file, nucleotide_orfs=None):
     prodigal_command += ["-a", output_file]
     if nucleotide_orfs:
         prodigal_command += ["-d", nucleotide_orfs]
-    stdout, proc_code = launch_write_command(prodigal_command)
+    prodigal_job = run_job(prodigal_command, "Prodigal", memory=estimate_job_memory([fasta_file], 2))
 
-    if proc_code != 0:
-        logging.error("Prodigal did not complete successfully!\n" +
-                      "Command used:\n" + ' '.join(prodigal_command), "err", "\n")
+    if prodigal_job.failed():
+        logging.error("Prodigal did not complete successfully: " + prodigal_job.error + "\n")
         sys.exit(3)
     return
 
 
-def run_hmmsearch(hmmsearch_exe: str, hmm_profile: str, query_fasta: str, output_dir: str, num_threads=2):
+def allocate_threads(num_jobs: int, num_threads: int, min_threads=2):
     """
-    Function for searching a fasta file with an hmm profile
+    Splits a thread budget across a number of independent jobs so as many jobs as possible are run concurrently
+    while each job receives at least `min_threads` threads (unless the budget is smaller than that).
+
+    :param num_jobs: The number of jobs that need to be run
+    :param num_threads: The total number of threads available
+    :param min_threads: The minimum number of threads each job should be given
+    :return: Tuple of the number of jobs to run concurrently and the number of threads for each job
+    """
+    num_threads = max(1, int(num_threads))
+    if num_jobs < 1:
+        return 1, num_threads
+    n_parallel = max(1, min(num_jobs, num_threads // max(1, min_threads)))
+    threads_per_job = max(1, num_threads // n_parallel)
+    return n_parallel, threads_per_job
+
+
+def hmmsearch_command(hmmsearch_exe: str, hmm_profile: str, query_fasta: str, output_dir: str, num_threads=2,
+                      z_size=0, dom_z=0):
+    """
+    Formats the hmmsearch command for searching a FASTA file with an HMM profile
+
     :param hmmsearch_exe: Path to the executable for hmmsearch
     :param hmm_profile: Path to the HMM profile file
     :param query_fasta: Path to the FASTA file to be queried by the profile
     :param output_dir: Path to the directory for writing the outputs
     :param num_threads: Number of threads to be used by hmmsearch
-    :return:
+    :param z_size: The number of sequences to calculate E-values for (-Z), if not the number in query_fasta.
+     For example, when query_fasta is a shard of a larger file or its duplicate sequences were removed.
+    :param dom_z: The number of sequences to calculate conditional E-values for (--domZ), if not the number of
+     sequences reported. Shards are searched with dom_z=1 so the conditional E-values can be corrected by
+     merge_domain_tables.
+    :return: The hmmsearch command (list) and the path to the domain table it will write
     """
     # Find the name of the HMM. Use it to name the output file
     rp_marker = re.sub(".hmm", '', os.path.basename(hmm_profile))
@@ -407,22 +766,50 @@ def run_hmmsearch(hmmsearch_exe: str, hmm_profile: str, query_fasta: str, output
     hmmsearch_command_base = [hmmsearch_exe]
     hmmsearch_command_base += ["--cpu", str(num_threads)]
     hmmsearch_command_base.append("--noali")
+    if z_size:
+        hmmsearch_command_base += ["-Z", str(z_size)]
+    if dom_z:
+        hmmsearch_command_base += ["--domZ", str(dom_z)]
     # Customize the command for this input and HMM
     final_hmmsearch_command = hmmsearch_command_base + ["--domtblout", domtbl]
     final_hmmsearch_command += [hmm_profile, query_fasta]
-    stdout, ret_code = launch_write_command(final_hmmsearch_command)
+    return final_hmmsearch_command, domtbl
+
+
+def run_hmmsearch(hmmsearch_exe: str, hmm_profile: str, query_fasta: str, output_dir: str, num_threads=2,
+                  z_size=0, dom_z=0):
+    """
+    Function for searching a fasta file with an hmm profile
+    :param hmmsearch_exe: Path to the executable for hmmsearch
+    :param hmm_profile: Path to the HMM profile file
+    :param query_fasta: Path to the FASTA file to be queried by the profile
+    :param output_dir: Path to the directory for writing the outputs
+    :param num_threads: Number of threads to be used by hmmsearch
+    :param z_size: The number of sequences to calculate E-values for, if not the number in query_fasta
+    :param dom_z: The number of sequences to calculate conditional E-values for, if not the number reported
+    :return:
+    """
+    final_hmmsearch_command, domtbl = hmmsearch_command(hmmsearch_exe, hmm_profile, query_fasta,
+                                                        output_dir, num_threads, z_size, dom_z)
+    hmmsearch_job = run_job(final_hmmsearch_command, "hmmsearch", threads=num_threads,
+                            memory=estimate_job_memory([hmm_profile], 10))
 
     # Check to ensure the job finished properly
-    if ret_code != 0:
-        logging.error("hmmsearch did not complete successfully! Output:\n" + stdout + "\n" +
-                      "Command used:\n" + ' '.join(final_hmmsearch_command) + "\n")
+    if hmmsearch_job.failed():
+        logging.error("hmmsearch did not complete successfully: " + hmmsearch_job.error + "\n")
         sys.exit(13)
 
     return [domtbl]
 
 
-def hmmsearch_orfs(hmmsearch_exe, hmm_dir, marker_build_dict, fasta_file, output_dir, num_threads=2):
-    hmm_domtbl_files = list()
+def find_target_hmm_profiles(hmm_dir: str, marker_build_dict: dict):
+    """
+    Finds the HMM profile files in hmm_dir for each of the reference packages in marker_build_dict
+
+    :param hmm_dir: Path to the directory containing the reference packages' HMM profiles
+    :param marker_build_dict: A dictionary of MarkerBuild instances indexed by refpkg codes/denominators
+    :return: Two lists of HMM profile paths, the first for protein and the second for nucleotide reference packages
+    """
     nucl_target_hmm_files = list()
     prot_target_hmm_files = list()
 
@@ -450,25 +837,201 @@ def hmmsearch_orfs(hmmsearch_exe, hmm_dir, marker_build_dict, fasta_file, output
             else:
                 nucl_target_hmm_files.append(hmm_profile)
 
-    acc = 0.0
-    logging.info("Searching for marker proteins in ORFs using hmmsearch.\n")
-    step_proportion = setup_progress_bar(len(prot_target_hmm_files) + len(nucl_target_hmm_files))
+    return prot_target_hmm_files, nucl_target_hmm_files
+
+
+def hmmsearch_orfs(hmmsearch_exe, hmm_dir, marker_build_dict, fasta_file, output_dir, num_threads=2, n_parallel=None,
+                   num_shards=1, num_seqs=0):
+    """
+    Searches the query sequences in fasta_file with the HMM profile of each reference package in marker_build_dict.
+    Since hmmsearch scales poorly beyond a few threads, the searches are run concurrently with the num_threads
+    budget split across the concurrent hmmsearch processes.
+
+    If num_shards is greater than one, fasta_file is also split into that many shards of roughly equal numbers of
+    residues and every profile searches each shard in a separate process. The E-values are calculated for the size
+    of the whole file and the domain tables of the shards are merged so they match those of an unsharded search.
+
+    :param hmmsearch_exe: Path to the executable for hmmsearch
+    :param hmm_dir: Path to the directory containing the reference packages' HMM profiles
+    :param marker_build_dict: A dictionary of MarkerBuild instances indexed by refpkg codes/denominators
+    :param fasta_file: Path to the FASTA file to be queried by the profiles
+    :param output_dir: Path to the directory for writing the domain tables
+    :param num_threads: The total number of threads available to all hmmsearch processes
+    :param n_parallel: The number of hmmsearch processes to run concurrently. Determined from num_threads if None
+    :param num_shards: The number of shards to split fasta_file into
+    :param num_seqs: The number of sequences E-values are calculated for. This is the number in fasta_file unless
+     duplicate sequences were removed from it, in which case it is the number before deduplication.
+     Counted from fasta_file if not provided and it is sharded.
+    :return: List of the domain tables written by hmmsearch
+    """
+    hmm_domtbl_files = list()
+    prot_target_hmm_files, nucl_target_hmm_files = find_target_hmm_profiles(hmm_dir, marker_build_dict)
 
-    # Create and launch the hmmsearch commands iteratively.
-    for hmm_file in prot_target_hmm_files:
-        # TODO: Parallelize this by allocating no more than 2 threads per process
-        hmm_domtbl_files += run_hmmsearch(hmmsearch_exe, hmm_file, fasta_file, output_dir, num_threads)
+    if num_shards > 1:
+        shards = split_fasta_by_length(fasta_file, output_dir + "hmmsearch_shard", num_shards)
+        if not num_seqs:
+            num_seqs = count_fasta_records(fasta_file)
+    else:
+        shards = [(fasta_file, 0)]
+    search_jobs = list()
+    for hmm_file in sorted(prot_target_hmm_files, key=os.path.getsize, reverse=True):
+        for shard_num in range(len(shards)):
+            search_jobs.append((hmm_file, shard_num))
+
+    if n_parallel:
+        n_parallel = max(1, min(int(n_parallel), len(search_jobs)))
+        threads_per_job = max(1, int(num_threads) // n_parallel)
+    else:
+        n_parallel, threads_per_job = allocate_threads(len(search_jobs), num_threads)
+    executor = JobExecutor(n_parallel * threads_per_job, stage="hmmsearch")
 
+    start_time = time.time()
+    acc = 0.0
+    logging.info("Searching for marker proteins in ORFs using hmmsearch.\n")
+    logging.debug("\tRunning " + str(n_parallel) + " hmmsearch processes concurrently with " +
+                  str(threads_per_job) + " threads each" +
+                  (" over " + str(len(shards)) + " shards of the input" if len(shards) > 1 else "") + ".\n")
+    step_proportion = setup_progress_bar(len(search_jobs) + len(nucl_target_hmm_files))
+
+    # Each shard's domain tables are written to its own directory since they are named by the HMM profile
+    shard_dirs = [output_dir]
+    if len(shards) > 1:
+        shard_dirs = [output_dir + "hmmsearch_shard_" + str(shard_num + 1) + os.sep for shard_num in range(len(shards))]
+        for shard_dir in shard_dirs:
+            if not os.path.isdir(shard_dir):
+                os.makedirs(shard_dir)
+
+    # Create and launch the hmmsearch commands, updating the progress bar as each search finishes
+    search_domtbls = dict()
+    for hmm_file, shard_num in search_jobs:
+        search_command, domtbl = hmmsearch_command(hmmsearch_exe, hmm_file, shards[shard_num][0],
+                                                   shard_dirs[shard_num], threads_per_job, num_seqs,
+                                                   1 if len(shards) > 1 else 0)
+        search = executor.submit(search_command, threads=threads_per_job, memory=estimate_job_memory([hmm_file], 10),
+                                 name=os.path.basename(hmm_file),
+                                 marker=re.sub(".hmm$", '', os.path.basename(hmm_file)))
+        search_domtbls[search] = domtbl
+
+    def log_search(search):
+        nonlocal acc
+        if not search.failed():
+            hmm_domtbl_files.append(search_domtbls[search])
         # Update the progress bar
         acc += 1.0
         if acc >= step_proportion:
             acc -= step_proportion
-            time.sleep(0.1)
             sys.stdout.write("-")
             sys.stdout.flush()
+
+    executor.run(log_search)
     sys.stdout.write("-]\n")
+    executor.exit_on_failure(13)
+
+    if len(shards) > 1:
+        # Merge the domain tables of each profile, in shard order, into output_dir
+        merged_domtbl_files = list()
+        for hmm_file in prot_target_hmm_files:
+            domtbl_name = re.sub(".hmm", '', os.path.basename(hmm_file)) + "_to_ORFs_domtbl.txt"
+            merge_domain_tables([shard_dir + domtbl_name for shard_dir in shard_dirs], output_dir + domtbl_name)
+            merged_domtbl_files.append(output_dir + domtbl_name)
+        for shard_num in range(len(shards)):
+            rmtree(shard_dirs[shard_num])
+            os.remove(shards[shard_num][0])
+        hmm_domtbl_files = merged_domtbl_files
+
+    logging.debug("\thmmsearch time required: " + format_elapsed_time(time.time() - start_time) + "\n")
+
+    return sorted(hmm_domtbl_files)
+
 
-    return hmm_domtbl_files
+def build_hmm_database(hmmpress_exe: str, hmm_files: list, output_dir: str):
+    """
+    Concatenates HMM profiles into a single database and indexes it with hmmpress for hmmscan.
+    The database is named by the profiles it contains so it is reused by later runs with the same profiles,
+    and it is only rebuilt if any of the profiles have been modified since it was pressed.
+
+    :param hmmpress_exe: Path to the executable for hmmpress
+    :param hmm_files: List of paths to HMM profile files
+    :param output_dir: Path to the directory to write the HMM database to
+    :return: Path to the concatenated, pressed HMM database
+    """
+    profile_names = sorted([os.path.basename(hmm_file) for hmm_file in hmm_files])
+    db_name = "treesapp_" + md5(','.join(profile_names).encode("utf-8")).hexdigest()[:10] + ".hmm"
+    hmm_db = output_dir + db_name
+    press_files = [hmm_db + ext for ext in [".h3f", ".h3i", ".h3m", ".h3p"]]
+
+    # Determine whether a previously pressed database can be used
+    if all(os.path.isfile(db_file) for db_file in [hmm_db] + press_files):
+        db_mtime = min(os.path.getmtime(db_file) for db_file in [hmm_db] + press_files)
+        if max(os.path.getmtime(hmm_file) for hmm_file in hmm_files) < db_mtime:
+            logging.debug("Using the HMM database '" + hmm_db + "' pressed by a previous run.\n")
+            return hmm_db
+
+    logging.debug("Concatenating " + str(len(hmm_files)) + " HMM profiles into '" + hmm_db + "'... ")
+    with open(hmm_db, 'w') as db_handler:
+        for hmm_file in sorted(hmm_files):
+            with open(hmm_file) as profile:
+                db_handler.write(profile.read())
+    logging.debug("done.\n")
+
+    press_command = [hmmpress_exe, "-f", hmm_db]
+    executor = JobExecutor(1, stage="hmmpress")
+    executor.submit(press_command, threads=1, memory=estimate_job_memory([hmm_db], 2),
+                    marker=re.sub(r"\.hmm$", '', db_name))
+    executor.run()
+    executor.exit_on_failure(13)
+
+    return hmm_db
+
+
+def hmmscan_orfs(hmmscan_exe: str, hmmpress_exe: str, hmm_dir: str, marker_build_dict: dict, fasta_file: str,
+                 output_dir: str, num_seqs: int, num_threads=2):
+    """
+    Searches the query sequences in fasta_file against a single database of all target HMM profiles using hmmscan.
+    Unlike hmmsearch_orfs, where the query sequences are read for each reference package's HMM,
+    hmmscan reads the query sequences only once and writes a single domain table for all HMM profiles.
+
+    Full-sequence E-values are made equivalent to those of hmmsearch by setting the search space size (-Z)
+     to the number of query sequences.
+
+    :param hmmscan_exe: Path to the executable for hmmscan
+    :param hmmpress_exe: Path to the executable for hmmpress
+    :param hmm_dir: Path to the directory containing the reference packages' HMM profiles
+    :param marker_build_dict: A dictionary of MarkerBuild instances indexed by refpkg codes/denominators
+    :param fasta_file: Path to the FASTA file to be searched
+    :param output_dir: Path to the directory for writing the HMM database and domain table
+    :param num_seqs: The number of sequences in fasta_file
+    :param num_threads: Number of threads to be used by hmmscan
+    :return: A list containing the domain table written by hmmscan
+    """
+    prot_target_hmm_files, _ = find_target_hmm_profiles(hmm_dir, marker_build_dict)
+    if len(prot_target_hmm_files) == 0:
+        logging.error("No HMM profiles were found for the target reference packages.\n")
+        sys.exit(3)
+
+    start_time = time.time()
+    hmm_db = build_hmm_database(hmmpress_exe, prot_target_hmm_files, output_dir)
+    domtbl = output_dir + re.sub(r"\.hmm$", '', os.path.basename(hmm_db)) + "_to_ORFs_domtbl.txt"
+
+    logging.info("Searching for marker proteins in ORFs using hmmscan... ")
+    hmmscan_command = [hmmscan_exe]
+    hmmscan_command += ["--cpu", str(num_threads)]
+    hmmscan_command += ["-Z", str(max(1, int(num_seqs)))]
+    hmmscan_command.append("--noali")
+    hmmscan_command += ["--domtblout", domtbl]
+    hmmscan_command += [hmm_db, fasta_file]
+    hmmscan_command += ["1>/dev/null"]
+    # A single job, so hmmscan shares the memory budget and failure reporting with the other stages
+    executor = JobExecutor(num_threads, stage="hmmscan")
+    executor.submit(hmmscan_command, threads=num_threads, memory=estimate_job_memory([hmm_db], 10),
+                    marker=re.sub(r"\.hmm$", '', os.path.basename(hmm_db)))
+    executor.run()
+    executor.exit_on_failure(13)
+    logging.info("done.\n")
+
+    logging.debug("\thmmscan time required: " + format_elapsed_time(time.time() - start_time) + "\n")
+
+    return [domtbl]
 
 
 def generate_blast_database(args, fasta, molecule, prefix, multiple=True):
@@ -503,11 +1066,14 @@ def generate_blast_database(args, fasta, molecule, prefix, multiple=True):
     makeblastdb_command += ["-dbtype", molecule]
 
     # Launch the command
-    stdout, makeblastdb_pro_returncode = launch_write_command(makeblastdb_command)
+    makeblastdb_job = run_job(makeblastdb_command, "makeblastdb", memory=estimate_job_memory([blastdb_in], 2))
+    if makeblastdb_job.failed():
+        logging.error("makeblastdb did not complete successfully: " + makeblastdb_job.error + "\n")
+        sys.exit(19)
 
     logging.info("done\n")
 
-    return stdout, blastdb_out
+    return makeblastdb_job.result, blastdb_out
 
 
 def run_mafft(mafft_exe: str, fasta_in: str, fasta_out: str, num_threads):
@@ -528,11 +1094,12 @@ def run_mafft(mafft_exe: str, fasta_in: str, fasta_out: str, num_threads):
     mafft_align_command += [fasta_in, '1>' + fasta_out]
     mafft_align_command += ["2>", "/dev/null"]
 
-    stdout, mafft_proc_returncode = launch_write_command(mafft_align_command, False)
+    mafft_job = run_job(mafft_align_command, "MAFFT", threads=num_threads,
+                        memory=estimate_job_memory([fasta_in], 50), collect_all=False)
 
-    if mafft_proc_returncode != 0:
+    if mafft_job.failed():
         logging.error("Multiple sequence alignment using " + mafft_exe +
-                      " did not complete successfully! Command used:\n" + ' '.join(mafft_align_command) + "\n")
+                      " did not complete successfully: " + mafft_job.error + "\n")
         sys.exit(7)
     else:
         mfa = read_fasta_to_dict(fasta_out)
@@ -555,11 +1122,11 @@ def run_odseq(odseq_exe, fasta_in, outliers_fa, num_threads):
     odseq_command += ["--score", str(5)]
     odseq_command.append("--full")
 
-    stdout, odseq_proc_returncode = launch_write_command(odseq_command)
+    odseq_job = run_job(odseq_command, "OD-seq", threads=num_threads, memory=estimate_job_memory([fasta_in], 20))
 
-    if odseq_proc_returncode != 0:
+    if odseq_job.failed():
         logging.error("Outlier detection using " + odseq_exe +
-                      " did not complete successfully! Command used:\n" + ' '.join(odseq_command) + "\n")
+                      " did not complete successfully: " + odseq_job.error + "\n")
         sys.exit(7)
 
     return
@@ -567,13 +1134,15 @@ def run_odseq(odseq_exe, fasta_in, outliers_fa, num_threads):
 
 def get_msa_trim_command(executables, mfa_file, molecule, tool="BMGE"):
     """
-    Trims/masks/filters the multiple sequence alignment using either BMGE or trimAl
+    Trims/masks/filters the multiple sequence alignment using either BMGE, trimAl or TreeSAPP's own implementation
+    of BMGE (BMGEpy, see alignment_trimming.py)
 
     :param executables: A dictionary mapping software to a path of their respective executable
     :param mfa_file: Name of a MSA file
     :param molecule: prot | dna
-    :param tool: Name of the software to use for trimming [BMGE|trimAl]
-    Returns file name of the trimmed multiple alignment file in FASTA format
+    :param tool: Name of the software to use for trimming [BMGE|BMGEpy|trimAl]
+    Returns the trimming command, which is None for BMGEpy, and the file name of the trimmed multiple alignment file
+     in FASTA format
     """
     f_ext = mfa_file.split('.')[-1]
     if not re.match("mfa|fasta|phy|fa", f_ext):
@@ -585,6 +1154,9 @@ def get_msa_trim_command(executables, mfa_file, molecule, tool="BMGE"):
         trim_command = trimal_command(executables["trimal"], mfa_file, trimmed_msa_file)
     elif tool == "BMGE":
         trim_command = bmge_command(executables["BMGE.jar"], mfa_file, trimmed_msa_file, molecule)
+    elif tool == ENGINE_NAME:
+        # BMGEpy is run in-process with alignment_trimming.trim_alignment_file
+        trim_command = None
     else:
         logging.error("Unsupported trimming software requested: '" + tool + "'")
         sys.exit(5)
@@ -592,15 +1164,26 @@ def get_msa_trim_command(executables, mfa_file, molecule, tool="BMGE"):
     return trim_command, trimmed_msa_file
 
 
-def filter_multiple_alignments(executables, concatenated_mfa_files, marker_build_dict, n_proc=1, tool="BMGE"):
+def estimate_trim_memory(mfa_file: str, tool="BMGE"):
+    if tool == "BMGE":
+        # The Java heap size set in bmge_command, with some overhead for the virtual machine
+        return 512 + 100
+    return estimate_job_memory([mfa_file], 20)
+
+
+def filter_multiple_alignments(executables, concatenated_mfa_files, marker_build_dict, n_proc=1, tool="BMGE",
+                               msa_objects=None):
     """
     Runs BMGE using the provided lists of the concatenated hmmalign files, and the number of sequences in each file.
+    When tool is BMGEpy the alignments are trimmed in this process instead of launching a command for each file.
 
     :param executables: A dictionary mapping software to a path of their respective executable
     :param concatenated_mfa_files: A dictionary containing f_contig keys mapping to a FASTA or Phylip sequential file
     :param marker_build_dict:
     :param n_proc: The number of parallel processes to be launched for alignment trimming
     :param tool: The software to use for alignment trimming
+    :param msa_objects: Optional dictionary of MultipleSequenceAlignment instances indexed by file path. Alignments
+     trimmed in-process are read from and added to it.
     :return: A list of files resulting from BMGE multiple sequence alignment masking.
     """
     logging.info("Running " + tool + "... ")
@@ -617,20 +1200,21 @@ def filter_multiple_alignments(executables, concatenated_mfa_files, marker_build
             trim_command, trimmed_msa_file = get_msa_trim_command(executables, concatenated_mfa_file,
                                                                   marker_build_dict[denominator].molecule, tool)
             trimmed_output_files[denominator].append(trimmed_msa_file)
-            task_list.append(trim_command)
+            if tool == ENGINE_NAME:
+                trim_alignment_file(concatenated_mfa_file, trimmed_msa_file,
+                                    marker_build_dict[denominator].molecule, msa_objects)
+            else:
+                task_list.append((trim_command, concatenated_mfa_file, marker_build_dict[denominator].cog))
 
     if len(task_list) > 0:
-        cl_farmer = CommandLineFarmer("Multiple alignment trimming with " + tool, n_proc)
-        cl_farmer.add_tasks_to_queue(task_list)
-
-        cl_farmer.task_queue.close()
-        cl_farmer.task_queue.join()
+        executor = JobExecutor(n_proc, stage="Multiple alignment trimming with " + tool)
+        for trim_command, concatenated_mfa_file, marker in task_list:
+            executor.submit(trim_command, threads=1, memory=estimate_trim_memory(concatenated_mfa_file, tool),
+                            marker=marker)
+        executor.run()
+        executor.exit_on_failure(19)
 
     logging.info("done.\n")
 
-    end_time = time.time()
-    hours, remainder = divmod(end_time - start_time, 3600)
-    minutes, seconds = divmod(remainder, 60)
-    logging.debug("\t" + tool + " time required: " +
-                  ':'.join([str(hours), str(minutes), str(round(seconds, 2))]) + "\n")
+    logging.debug("\t" + tool + " time required: " + format_elapsed_time(time.time() - start_time) + "\n")
     return trimmed_output_files